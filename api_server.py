@@ -1,20 +1,35 @@
-from flask import Flask, send_file, send_from_directory, redirect, request, jsonify, render_template
-from db_connector import cursor as db_cursor
+from flask import Flask, send_file, send_from_directory, redirect, request, jsonify, render_template, Response, stream_with_context
+from db_connector import cursor as db_cursor, get_pool_stats
+from refresh_coordinator import get_coordinator
+import tracking_events
+import search_index
+import count_cache
+import event_index
+import row_mapper
+import spedizioni_schema
+import endpoint_health
+import token_manager
+import quote_aggregator
+import quote_cache
+import quote_policy
+import bulk_pricer
+from tracking_cache import get_cache as get_tracking_cache, is_delivered
 import os
+import json
+import time
+import base64
 import logging
 from pathlib import Path
 from flask_cors import CORS
 from typing import Any, Dict, List, Tuple
 from datetime import datetime, date, timedelta
+from decimal import Decimal
 import mysql.connector
 
 # Basic logger so top-level initialization errors are logged instead of raising NameError
 logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
 
-# Dizionario globale per mappature eventi
-event_mappings = {}
-
 app = Flask(__name__, static_folder='static', static_url_path='/static', template_folder='templates')
 
 # Redirect legacy /img/* requests to /html/img/*
@@ -68,43 +83,6 @@ def serve_index():
         return send_file(path)
     return "index.html non trovato", 404
 
-def load_tracking_codes():
-    # Carica le mappature dei codici eventi dal database con nome e colore.
-    # This is lazy: call it explicitly when DB utilities (db_cursor) are available.
-    global event_mappings
-
-    with db_cursor() as (conn, cur):
-        # Ordina per ID per prendere sempre l'ultimo inserito in caso di duplicati
-        query = "SELECT vettore, codice, nome, colore FROM codici_tracking ORDER BY id"
-        cur.execute(query)
-        results = cur.fetchall()
-
-        event_mappings = {}
-        for row in results:
-            vettore_raw = row[0]
-            codice = row[1]
-            nome = row[2]
-            colore = row[3] if len(row) > 3 else '#000000'
-
-            # Controlla che vettore non sia None
-            if not vettore_raw:
-                continue
-
-            vettore = vettore_raw.upper()
-
-            if vettore not in event_mappings:
-                event_mappings[vettore] = {}
-
-            # Sovrascrive eventuali duplicati con l'ultimo (ID più alto)
-            event_mappings[vettore][codice] = {
-                'nome': nome,
-                'colore': colore or '#000000'
-            }
-
-        LOG.info(f"🎯 Caricate {len(results)} mappature eventi con colori")
-        LOG.info(f"🔍 Debug mappature DHL: {event_mappings.get('DHL', {})}")
-
-
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -123,86 +101,44 @@ def serve_home():
     sort_dir = request.args.get("sort_dir", "asc").lower()
     if sort_dir not in ("asc", "desc"): sort_dir = "asc"
 
-    # NUOVO: Avvia aggiornamento tracking TUTTI i record con final_position = 0
-    import threading
-    def update_tracking_async():
-        try:
-            from tracking_service import TrackingService
-            tracking_service = TrackingService()
-            
-            with db_cursor() as (conn, cur):
-                # Prendi TUTTE le spedizioni in transito (final_position = 0)
-                query = """
-                SELECT id FROM spedizioni 
-                WHERE final_position = 0 
-                AND awb IS NOT NULL 
-                AND vettore IS NOT NULL
-                ORDER BY data_spedizione DESC
-                """
-                cur.execute(query)
-                spedizioni = cur.fetchall()
-                
-                LOG.info(f"🔄 Aggiornamento tracking per {len(spedizioni)} spedizioni in transito")
-                
-                for spedizione in spedizioni:
-                    try:
-                        tracking_service.update_tracking(spedizione[0])
-                    except Exception as e:
-                        LOG.warning(f"Errore tracking spedizione {spedizione[0]}: {e}")
-                        
-                LOG.info(f"✅ Aggiornamento tracking completato")
-                    
-        except Exception as e:
-            LOG.error(f"❌ Errore aggiornamento tracking automatico: {e}")
-    
-    # Avvia thread in background (non blocca il caricamento pagina)
-    thread = threading.Thread(target=update_tracking_async, daemon=True)
-    thread.start()
+    # Chiede un aggiornamento tracking dei record con final_position = 0:
+    # al massimo un ciclo per processo, le altre visite si uniscono o vengono scartate
+    get_coordinator().request_refresh()
 
     # Filtro per spedizioni in transito - ATTIVO DI DEFAULT
     only_transit = request.args.get("only_transit", "1") == "1"
     where_sql = " WHERE final_position = 0" if only_transit else ""
 
-    conn = mysql.connector.connect(
-        host=os.getenv('DB_HOST', 'localhost'),
-        port=int(os.getenv('DB_PORT', 3307)),
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD'),
-        database=os.getenv('DB_DATABASE')
-    )
-    cur = conn.cursor()
-    # Conta totale spedizioni filtrate
-    cur.execute(f"SELECT COUNT(*) FROM spedizioni{where_sql}")
-    total_items = int(cur.fetchone()[0])
-    total_pages = max(1, (total_items + page_size - 1) // page_size)
-    offset = (page - 1) * page_size
-    # Query ordinata e paginata con filtro
-    query = f"""
-        SELECT id, data_spedizione, mitt_ragione_sociale, mitt_citta, mitt_codice_nazione, dest_ragione_sociale, dest_citta, dest_codice_nazione, vettore, awb, last_position
-        FROM spedizioni
-        {where_sql}
-        ORDER BY {sort_by} {sort_dir}
-        LIMIT %s OFFSET %s
-    """
-    cur.execute(query, (page_size, offset))
-    spedizioni = [
-        {
-            "id": row[0],
-            "data_spedizione": row[1], 
-            "mitt_ragione_sociale": row[2],
-            "mitt_citta": row[3],
-            "mitt_codice_nazione": row[4],
-            "dest_ragione_sociale": row[5],
-            "dest_citta": row[6],
-            "dest_codice_nazione": row[7],
-            "vettore": row[8],
-            "awb": row[9],
-            "last_position": row[10],
-        }
-        for row in cur.fetchall() if row[2] is not None
-    ]
-    cur.close()
-    conn.close()
+    with db_cursor() as (conn, cur):
+        # Conta totale spedizioni filtrate
+        total_items = count_cache.get_count_cache().count(cur, "spedizioni", where_sql, [])
+        total_pages = max(1, (total_items + page_size - 1) // page_size)
+        offset = (page - 1) * page_size
+        # Query ordinata e paginata con filtro
+        query = f"""
+            SELECT id, data_spedizione, mitt_ragione_sociale, mitt_citta, mitt_codice_nazione, dest_ragione_sociale, dest_citta, dest_codice_nazione, vettore, awb, last_position
+            FROM spedizioni
+            {where_sql}
+            ORDER BY {sort_by} {sort_dir}
+            LIMIT %s OFFSET %s
+        """
+        cur.execute(query, (page_size, offset))
+        spedizioni = [
+            {
+                "id": row[0],
+                "data_spedizione": row[1], 
+                "mitt_ragione_sociale": row[2],
+                "mitt_citta": row[3],
+                "mitt_codice_nazione": row[4],
+                "dest_ragione_sociale": row[5],
+                "dest_citta": row[6],
+                "dest_codice_nazione": row[7],
+                "vettore": row[8],
+                "awb": row[9],
+                "last_position": row[10],
+            }
+            for row in cur.fetchall() if row[2] is not None
+        ]
     return render_template(
         'home.html',
         spedizioni=spedizioni,
@@ -216,47 +152,11 @@ def serve_home():
 
 def get_event_display_name(vettore, codice):
     """Ottiene il nome personalizzato per un codice evento (retrocompatibilità)"""
-    if not event_mappings:
-        load_tracking_codes()
-    
-    vettore = vettore.upper()
-    mapping = event_mappings.get(vettore, {}).get(codice, {})
-    if isinstance(mapping, dict):
-        return mapping.get('nome', codice)
-    return mapping or codice
+    return event_index.display_name(vettore, codice)
 
 def get_event_info(vettore, descrizione):
     """Ottiene informazioni complete per una descrizione evento (nome + colore)"""
-    if not event_mappings:
-        load_tracking_codes()
-    
-    # Protezione contro valori None/vuoti
-    if not vettore or not descrizione:
-        return {'nome': descrizione or '', 'colore': '#000000'}
-    
-    vettore = vettore.upper()
-    
-    # Debug: log cosa stiamo cercando
-    LOG.info(f"🔍 DEBUG get_event_info: vettore='{vettore}', descrizione='{descrizione}'")
-    LOG.info(f"🔍 DEBUG mappature disponibili per {vettore}: {list(event_mappings.get(vettore, {}).keys())}")
-    
-    # Prima prova: match esatto del codice (per retrocompatibilità)
-    if descrizione in event_mappings.get(vettore, {}):
-        mapping = event_mappings[vettore][descrizione]
-        if isinstance(mapping, dict):
-            result = {
-                'nome': mapping.get('nome', descrizione),
-                'colore': mapping.get('colore', '#000000')
-            }
-            LOG.info(f"✅ DEBUG trovato mapping esatto: {result}")
-            return result
-    
-    # Fallback: restituisci la descrizione originale con colore default
-    LOG.info(f"❌ DEBUG nessun mapping trovato per {vettore} {descrizione}")
-    return {
-        'nome': descrizione,
-        'colore': '#000000'
-    }
+    return event_index.lookup(vettore, descrizione)
 
 def _load_env_from_file() -> None:
     env_path = Path(__file__).resolve().parent / ".env"
@@ -303,18 +203,8 @@ CORS(app)  # abilita richieste dal tuo frontend locale
 def legacy_img_redirect(filename):
     return redirect(f'/html/img/{filename}', code=302)
 
-# Mappa sicura per ORDER BY (nomi colonna DB reali)
-SORT_MAP = {
-    "id": "id",
-    # use the sender/recipient official name fields that exist in the table
-    "mittente": "mitt_ragione_sociale",
-    "destinatario": "dest_ragione_sociale",
-    "vettore": "vettore",
-    "awb": "awb",
-    "data_spedizione": "data_spedizione",
-    "last_position": "last_position",
-    "final_position": "final_position",
-}
+# Mappa sicura per ORDER BY (nomi colonna DB reali, con indici keyset in spedizioni_schema)
+SORT_MAP = spedizioni_schema.SORT_MAP
 ALLOWED_DIR = {"asc", "desc"}
 
 # Colonne che estraiamo
@@ -341,6 +231,21 @@ COLUMNS = [
     "num_colli", "peso", "dim1", "dim2", "dim3", "dim_lunghezza", "dim_larghezza", "dim_altezza",
 ]
 
+# Colonne lette da /api/spedizioni e dalla risposta di update_spedizione
+LIST_FIELDS = list(dict.fromkeys(COLUMNS + list(row_mapper.SOURCE_COLUMNS)))
+
+# Campi di spedizioni usati da form-spedizione.html
+FORM_FIELDS = [
+    "id", "vettore", "servizio", "awb", "data_spedizione", "last_position", "last_position_update",
+    "tariffa_base", "importo_iva", "costo_assicurazione", "costo_contrassegno",
+    "mitt_cliente", "mitt_ragione_sociale", "mitt_contatto", "mitt_indirizzo", "mitt_civico",
+    "mitt_cap", "mitt_citta", "mitt_provincia", "mitt_nazione", "mitt_codice_nazione",
+    "mitt_telefono", "mitt_email", "mitt_partita_iva", "mitt_codice_fiscale", "mitt_eori",
+    "dest_cliente", "dest_ragione_sociale", "dest_contatto", "dest_indirizzo", "dest_civico",
+    "dest_cap", "dest_citta", "dest_provincia", "dest_nazione", "dest_codice_nazione",
+    "dest_telefono", "dest_email", "dest_partitva_iva", "dest_partita_iva", "dest_codice_fiscale", "dest_eori",
+]
+
 # Campi usati dal filtro globale q
 Q_FIELDS = [
     "vettore", "last_position", "final_position",
@@ -356,9 +261,14 @@ Q_FIELDS = [
 def _clean_text(value: Any) -> str:
     return value.strip() if isinstance(value, str) else ""
 
-def _build_where_and_params(q, vettore, awb, mos, date_from, date_to, final_position=None) -> Tuple[str, List[Any]]:
+def _build_where_and_params(q, vettore, awb, mos, date_from, date_to, final_position=None) -> Tuple[str, List[Any], Any]:
+    """
+    Restituisce (where_sql, params, rilevanza). Il filtro q usa search_index
+    (FULLTEXT / prefisso AWB); rilevanza è (espressione, params) per ORDER BY o None.
+    """
     where = []
     params: List[Any] = []
+    relevance = None
 
     if mos:
         where.append("id = %s")
@@ -373,10 +283,9 @@ def _build_where_and_params(q, vettore, awb, mos, date_from, date_to, final_posi
         params.append(f"%{awb}%")
 
     if q:
-        like = f"%{q}%"
-        ors = " OR ".join([f"{f} LIKE %s" for f in Q_FIELDS])
-        where.append(f"({ors})")
-        params.extend([like] * len(Q_FIELDS))
+        q_sql, q_params, relevance = search_index.build_condition(q, Q_FIELDS)
+        where.append(q_sql)
+        params.extend(q_params)
 
     if date_from:
         try:
@@ -404,7 +313,71 @@ def _build_where_and_params(q, vettore, awb, mos, date_from, date_to, final_posi
             # ignore invalid values
             pass
 
-    return (" WHERE " + " AND ".join(where)) if where else "", params
+    return (" WHERE " + " AND ".join(where)) if where else "", params, relevance
+
+def _encode_cursor_value(value: Any) -> Any:
+    """Valore della colonna di ordinamento in forma JSON (con tipo per date e decimali)"""
+    if isinstance(value, datetime):
+        return {"t": "datetime", "v": value.isoformat()}
+    if isinstance(value, date):
+        return {"t": "date", "v": value.isoformat()}
+    if isinstance(value, Decimal):
+        return {"t": "decimal", "v": str(value)}
+    return value
+
+def _decode_cursor_value(value: Any) -> Any:
+    if isinstance(value, dict):
+        if value.get("t") == "datetime":
+            return datetime.fromisoformat(value["v"])
+        if value.get("t") == "date":
+            return date.fromisoformat(value["v"])
+        if value.get("t") == "decimal":
+            return Decimal(value["v"])
+        raise ValueError("tipo cursore non valido")
+    return value
+
+def _encode_cursor(sort_by: str, sort_dir: str, value: Any, last_id: Any) -> str:
+    """Cursore opaco con (valore colonna di ordinamento, id) dell'ultima riga della pagina"""
+    payload = {"s": sort_by, "d": sort_dir, "v": _encode_cursor_value(value), "id": last_id}
+    raw = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor: str, sort_by: str, sort_dir: str) -> Tuple[Any, Any]:
+    """Restituisce (valore, id) dal cursore. ValueError se non valido o di un altro ordinamento"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        value, last_id = _decode_cursor_value(payload["v"]), payload["id"]
+    except Exception:
+        raise ValueError("cursor non valido")
+    if payload.get("s") != sort_by or payload.get("d") != sort_dir:
+        raise ValueError("cursor non valido per questo ordinamento")
+    return value, last_id
+
+def _keyset_segments(sort_col: str, sort_dir: str, value: Any, last_id: Any) -> List[Tuple[str, List[Any]]]:
+    """
+    Condizioni "dopo l'ultima riga" per ORDER BY sort_col sort_dir, id sort_dir,
+    come segmenti da leggere in ordine finché la pagina non è piena.
+
+    MySQL ordina i NULL per primi in ASC e per ultimi in DESC, quindi:
+     - DESC: dopo un valore vengono i valori minori e poi tutti i NULL
+     - ASC: dopo un NULL vengono gli altri NULL e poi tutti i valori non NULL
+    Valori e NULL stanno in segmenti separati (un OR tra i due impedirebbe la
+    scansione di intervallo sull'indice (sort_col, id)); la condizione sui
+    valori ripete il limite su sort_col per lo stesso motivo.
+    """
+    op = "<" if sort_dir == "desc" else ">"
+    if sort_col == "id":
+        return [(f"id {op} %s", [last_id])]
+    if value is None:
+        segments = [(f"{sort_col} IS NULL AND id {op} %s", [last_id])]
+        if sort_dir == "asc":
+            segments.append((f"{sort_col} IS NOT NULL", []))
+        return segments
+    seek = (f"{sort_col} {op}= %s AND ({sort_col} {op} %s OR id {op} %s)", [value, value, last_id])
+    if sort_dir == "desc":
+        return [seek, (f"{sort_col} IS NULL", [])]
+    return [seek]
 
 def _get_personalized_last_position_with_color(row, idx: Dict[str, int]) -> tuple:
     """Personalizza il last_position usando i mapping dei codici eventi, restituisce (testo, colore)"""
@@ -431,142 +404,10 @@ def _get_personalized_last_position_with_color(row, idx: Dict[str, int]) -> tupl
     
     return (last_position, "#000000")
 
-def _row_to_item(row, idx: Dict[str, int]) -> Dict[str, Any]:
-    def g(c): return row[idx[c]]
-    v = g("data_spedizione")
-    if isinstance(v, datetime):
-        data_iso = v.isoformat()
-    elif isinstance(v, date):
-        data_iso = datetime(v.year, v.month, v.day).isoformat()
-    else:
-        data_iso = str(v) if v is not None else None
-
-    # helper to pick the first non-empty value from candidate column names
-    def pick(first, *candidates):
-        v = g(first) if first in idx else None
-        if v:
-            return v
-        for c in candidates:
-            if c in idx:
-                vv = g(c)
-                if vv:
-                    return vv
-        return None
-    id = pick("id")
-    mitt_nome = pick("mitt_ragione_sociale", "mitt_cliente", "mitt_contatto", "mitt_citta", "mitt_codice_nazione")
-    mitt_citta = g("mitt_citta") if "mitt_citta" in idx else None
-    mitt_codice_nazione = g("mitt_codice_nazione") if "mitt_codice_nazione" in idx else None
-    dest_nome = pick("dest_ragione_sociale", "dest_cliente", "dest_contatto", "dest_citta", "dest_codice_nazione")
-    
-    # optional service/billing fields (if present in the result set)
-    servizio = pick("servizio", "service", "product", "tipo_servizio", "service_code")
-    tariffa = pick("tariffa", "price", "fare", "rate", "amount_before_tax", "tariff", "prezzo")
-    iva = pick("iva", "vat", "tax", "tax_amount", "iva_amount")
-    totale = pick("totale", "total", "amount", "grand_total", "totale_da_pagare", "prezzo_totale")
-
-    # shipment detail: number of pieces, weight and three dimension fields
-    num_colli = pick("num_colli", "colli", "pieces")
-    peso = pick("peso", "weight", "total_weight", "peso_kg")
-    dim1 = pick("dim1", "dim_lunghezza", "lunghezza", "length")
-    dim2 = pick("dim2", "dim_larghezza", "larghezza", "width")
-    dim3 = pick("dim3", "dim_altezza", "altezza", "height")
-
-    # Converti final_position da numero a stringa leggibile
-    final_pos_raw = g("final_position")
-    if final_pos_raw == 1 or final_pos_raw == '1':
-        final_position_str = "Consegnato"
-    elif final_pos_raw == 0 or final_pos_raw == '0':
-        final_position_str = "In transito"
-    elif final_pos_raw is None or final_pos_raw == '':
-        final_position_str = "Da definire"
-    else:
-        final_position_str = str(final_pos_raw)
-    
-    # Ottieni info evento una volta sola
-    vettore = g("vettore") or ""
-    last_pos_code = g("last_position") or ""
-    
-    # Per BRT, estrai la descrizione prima del trattino per fare pattern matching
-    if vettore.upper() == 'BRT' and ' - ' in last_pos_code:
-        brt_description = last_pos_code.split(' - ')[0].strip()
-        event_info = get_event_info(vettore, brt_description)
-    else:
-        event_info = get_event_info(vettore, last_pos_code)
-    
-    return {
-        "id": g("id"),
-        "mitt_citta": mitt_citta,
-        "mitt_codice_nazione": mitt_codice_nazione,
-        "vettore": vettore,
-        "awb": g("awb"),
-        "data_spedizione": data_iso,
-        "last_position": event_info["nome"],
-        "last_position_color": event_info["colore"],
-        "final_position": final_position_str,
-        "servizio": servizio,
-        "tariffa": tariffa,
-        "iva": iva,
-        "totale": totale,
-        "num_colli": num_colli,
-        "peso": peso,
-        "dim1": dim1,
-        "dim2": dim2,
-        "dim3": dim3,
-        "mittente": {
-            "nome": mitt_nome,
-            "citta": mitt_citta,
-            "codice_nazione": mitt_codice_nazione,
-            "cliente": g("mitt_cliente") if "mitt_cliente" in idx else None,
-            "ragione_sociale": g("mitt_ragione_sociale") if "mitt_ragione_sociale" in idx else None,
-            "identificativo": g("mitt_identificativo") if "mitt_identificativo" in idx else None,
-            "indirizzo": pick("mitt_indirizzo", "mitt_indirizzo2", "mitt_indirizzo3"),
-            "indirizzo2": g("mitt_indirizzo2") if "mitt_indirizzo2" in idx else None,
-            "indirizzo3": g("mitt_indirizzo3") if "mitt_indirizzo3" in idx else None,
-            "civico": g("mitt_civico") if "mitt_civico" in idx else None,
-            "cap": pick("mitt_cap"),
-            "citta": mitt_citta,
-            "provincia": pick("mitt_provincia"),
-            "codice_nazione": mitt_codice_nazione,
-            "paese": pick("mitt_nazione", "mitt_codice_nazione"),
-            "contatto": pick("mitt_contatto"),
-            "telefono": pick("mitt_telefono", "mitt_cellulare"),
-            "cellulare": g("mitt_cellulare") if "mitt_cellulare" in idx else None,
-            "email": pick("mitt_email"),
-            "riferimento": g("mitt_riferimento") if "mitt_riferimento" in idx else None,
-            "partita_iva": g("mitt_partita_iva") if "mitt_partita_iva" in idx else None,
-            "eori": g("mitt_eori") if "mitt_eori" in idx else None,
-            "info": g("mitt_info") if "mitt_info" in idx else None,
-        },
-        "destinatario": {
-            "nome": dest_nome,
-            "cliente": g("dest_cliente") if "dest_cliente" in idx else None,
-            "ragione_sociale": g("dest_ragione_sociale") if "dest_ragione_sociale" in idx else None,
-            "identificativo": g("dest_identificativo") if "dest_identificativo" in idx else None,
-            "indirizzo": pick("dest_indirizzo", "dest_indirizzo2", "dest_indirizzo3"),
-            "indirizzo2": g("dest_indirizzo2") if "dest_indirizzo2" in idx else None,
-            "indirizzo3": g("dest_indirizzo3") if "dest_indirizzo3" in idx else None,
-            "civico": g("dest_civico") if "dest_civico" in idx else None,
-            "cap": pick("dest_cap"),
-            "citta": pick("dest_citta"),
-            "provincia": pick("dest_provincia"),
-            "codice_nazione": g("dest_codice_nazione") if "dest_codice_nazione" in idx else None,
-            "paese": pick("dest_nazione", "dest_codice_nazione"),
-            "contatto": pick("dest_contatto"),
-            "telefono": pick("dest_telefono", "dest_cellulare"),
-            "cellulare": g("dest_cellulare") if "dest_cellulare" in idx else None,
-            "email": pick("dest_email"),
-            "pagata_da": g("dest_pagata_da") if "dest_pagata_da" in idx else None,
-            "match_code": g("dest_match_code") if "dest_match_code" in idx else None,
-            "riferimento": g("dest_riferimento") if "dest_riferimento" in idx else None,
-            "partita_iva": g("dest_partita_iva") if "dest_partita_iva" in idx else None,
-            "info": g("dest_info") if "dest_info" in idx else None,
-        },
-    }
-
 @app.route('/form-spedizione')
 def serve_form_spedizione():
     with db_cursor() as (conn, cur):
-        cur.execute("SELECT * FROM spedizioni ORDER BY id DESC LIMIT 1")
+        cur.execute(f"SELECT {spedizioni_schema.projection(FORM_FIELDS)} FROM spedizioni ORDER BY id DESC LIMIT 1")
         row = cur.fetchone()
         desc = [d[0] for d in cur.description]
         record = dict(zip(desc, row)) if row else {}
@@ -581,7 +422,7 @@ def serve_form_spedizione():
 def serve_form_spedizione_id(spedizione_id):
     with db_cursor() as (conn, cur):
         # Prendi tutti i campi della spedizione
-        cur.execute("SELECT * FROM spedizioni WHERE id = %s", (spedizione_id,))
+        cur.execute(f"SELECT {spedizioni_schema.projection(FORM_FIELDS)} FROM spedizioni WHERE id = %s", (spedizione_id,))
         row = cur.fetchone()
         desc = [d[0] for d in cur.description]
         record = dict(zip(desc, row)) if row else {}
@@ -594,19 +435,34 @@ def serve_form_spedizione_id(spedizione_id):
 
 @app.get("/api/spedizioni")
 def spedizioni():
+    """
+    Lista spedizioni filtrata e ordinata.
+    
+    Due modalità di paginazione:
+     - page/page_size (OFFSET), con total_items e total_pages
+     - keyset: passare cursor (vuoto per la prima pagina, poi il next_cursor
+       ricevuto). Il costo non dipende dalla profondità della pagina;
+       total_items viene calcolato solo con include_total=1.
+    
+    Con q i risultati sono ordinati per rilevanza, salvo sort_by esplicito.
+    """
     try:
         page = max(int(request.args.get("page", 1)), 1)
         page_size = min(max(int(request.args.get("page_size", 25)), 1), 200)
     except Exception:
         return jsonify({"detail": "page/page_size non validi"}), 400
 
-    sort_by = request.args.get("sort_by", "data_spedizione")
+    # sort_by=relevance (default quando c'è q) ordina per rilevanza della ricerca full-text
+    q = request.args.get("q") or None
+    sort_by = request.args.get("sort_by") or ("relevance" if q else "data_spedizione")
     sort_dir = request.args.get("sort_dir", "desc").lower()
+    by_relevance = sort_by == "relevance"
+    if by_relevance:
+        sort_by = "data_spedizione"
     sort_col = SORT_MAP.get(sort_by)
     if not sort_col: return jsonify({"detail": f"sort_by non valido: {sort_by}"}), 400
     if sort_dir not in ALLOWED_DIR: return jsonify({"detail": f"sort_dir non valido: {sort_dir}"}), 400
 
-    q = request.args.get("q") or None
     vettore = request.args.get("vettore") or None
     awb = request.args.get("awb") or None
     mos = request.args.get("mos") or None
@@ -618,15 +474,26 @@ def spedizioni():
 
     # Filtro per spedizioni in transito - di default mostra solo final_position = 0
     final_position = request.args.get('final_position', '0')
-    where_sql, params = _build_where_and_params(q, vettore, awb, mos, date_from, date_to, final_position)
-    sql_count = f"SELECT COUNT(*) FROM spedizioni{where_sql}"
+    where_sql, params, relevance = _build_where_and_params(q, vettore, awb, mos, date_from, date_to, final_position)
+    # count=estimated: per le viste senza filtri usa la stima dalle statistiche della tabella
+    estimated = request.args.get("count") == "estimated" and not where_sql
+
+    # In modalità keyset l'ordinamento per rilevanza non è disponibile (si usa data_spedizione)
+    cursor_param = request.args.get("cursor")
+    if cursor_param is not None:
+        return _spedizioni_keyset(cursor_param, page_size, sort_by, sort_col, sort_dir,
+                                  where_sql, params)
+
     offset = (page - 1) * page_size
-    # Use SELECT * so optional billing/service columns (if present) are returned
+    order_sql, order_params = f"{sort_col} {sort_dir}", []
+    if by_relevance and relevance:
+        order_sql, order_params = f"{relevance[0]} DESC, id DESC", list(relevance[1])
+    # Solo le colonne lette dal mapper (quelle opzionali se presenti nella tabella)
     sql_list = f"""
-        SELECT *
+        SELECT {spedizioni_schema.projection(LIST_FIELDS)}
         FROM spedizioni
         {where_sql}
-        ORDER BY {sort_col} {sort_dir}
+        ORDER BY {order_sql}
         LIMIT %s OFFSET %s
     """
 
@@ -635,15 +502,14 @@ def spedizioni():
 
     try:
         with db_cursor() as (conn, cur):
-            cur.execute(sql_count, params)
-            total_items = int(cur.fetchone()[0])
-
-            cur.execute(sql_list, params + [page_size, offset])
-            rows = cur.fetchall()
-            desc = [d[0] for d in cur.description]
-            idx = {name: i for i, name in enumerate(desc)}
-            for row in rows:
-                items.append(_row_to_item(row, idx))
+            counts = count_cache.get_count_cache()
+            total_items = counts.estimate(cur, "spedizioni") if estimated else None
+            if total_items is None:
+                estimated = False
+                total_items = counts.count(cur, "spedizioni", where_sql, params)
+
+            cur.execute(sql_list, params + order_params + [page_size, offset])
+            items = row_mapper.get_mapper(cur.description).map_rows(cur.fetchall(), get_event_info)
     except mysql.connector.Error as e:
         # DB connection/auth error: log and return a small demo dataset so the UI can function.
         LOG.exception("Database error while serving /api/spedizioni")
@@ -681,13 +547,80 @@ def spedizioni():
         return jsonify({"detail": "Internal server error"}), 500
 
     total_pages = max(1, (total_items + page_size - 1) // page_size)
-    return jsonify({
+    response = {
         "items": items,
         "page": page,
         "page_size": page_size,
         "total_items": total_items,
         "total_pages": total_pages
-    })
+    }
+    if estimated:
+        response["total_is_estimate"] = True
+    return jsonify(response)
+
+
+def _spedizioni_keyset(cursor_param, page_size, sort_by, sort_col, sort_dir, where_sql, params):
+    """Pagina di /api/spedizioni in modalità keyset (WHERE (col, id) < (...) invece di OFFSET)"""
+    segments: List[Tuple[str, List[Any]]] = [("", [])]
+    if cursor_param:
+        try:
+            value, last_id = _decode_cursor(cursor_param, sort_by, sort_dir)
+        except ValueError as e:
+            return jsonify({"detail": str(e)}), 400
+        segments = _keyset_segments(sort_col, sort_dir, value, last_id)
+
+    order_sql = f"{sort_col} {sort_dir}" if sort_col == "id" else f"{sort_col} {sort_dir}, id {sort_dir}"
+
+    def segment_sql(seek_sql: str) -> str:
+        where = where_sql
+        if seek_sql:
+            where = f"{where_sql} AND {seek_sql}" if where_sql else f" WHERE {seek_sql}"
+        return f"""
+        SELECT {spedizioni_schema.projection(LIST_FIELDS)}
+        FROM spedizioni
+        {where}
+        ORDER BY {order_sql}
+        LIMIT %s
+    """
+
+    items: List[Dict[str, Any]] = []
+    total_items = None
+    next_cursor = None
+    try:
+        with db_cursor() as (conn, cur):
+            if request.args.get("include_total") == "1":
+                total_items = count_cache.get_count_cache().count(cur, "spedizioni", where_sql, params)
+
+            # Una riga in più per sapere se esiste una pagina successiva; i segmenti
+            # successivi (es. le righe NULL) solo se la pagina non è ancora piena
+            rows = []
+            for seek_sql, seek_params in segments:
+                cur.execute(segment_sql(seek_sql), list(params) + seek_params + [page_size + 1 - len(rows)])
+                rows.extend(cur.fetchall())
+                if len(rows) > page_size:
+                    break
+            mapper = row_mapper.get_mapper(cur.description)
+            idx = mapper.index
+
+            has_more = len(rows) > page_size
+            rows = rows[:page_size]
+            items = mapper.map_rows(rows, get_event_info)
+            if has_more and rows:
+                last = rows[-1]
+                next_cursor = _encode_cursor(sort_by, sort_dir, last[idx[sort_col]], last[idx["id"]])
+    except Exception:
+        LOG.exception("Unexpected error while serving /api/spedizioni (cursor)")
+        return jsonify({"detail": "Internal server error"}), 500
+
+    response = {
+        "items": items,
+        "page_size": page_size,
+        "next_cursor": next_cursor,
+        "has_more": next_cursor is not None,
+    }
+    if total_items is not None:
+        response["total_items"] = total_items
+    return jsonify(response)
 
 
 @app.route('/api/spedizioni/<int:item_id>', methods=['GET'])
@@ -813,15 +746,14 @@ def update_spedizione(item_id: int):
         with db_cursor() as (conn, cur):
             cur.execute(sql, params)
             conn.commit()
+            count_cache.invalidate()
 
-            # return the updated row (use SELECT * to keep compatibility)
-            cur.execute("SELECT * FROM spedizioni WHERE id = %s", [item_id])
+            # return the updated row
+            cur.execute(f"SELECT {spedizioni_schema.projection(LIST_FIELDS)} FROM spedizioni WHERE id = %s", [item_id])
             row = cur.fetchone()
             if not row:
                 return jsonify({"detail": "Spedizione non trovata dopo aggiornamento"}), 404
-            desc = [d[0] for d in cur.description]
-            idx = {name: i for i, name in enumerate(desc)}
-            item = _row_to_item(row, idx)
+            item = row_mapper.get_mapper(cur.description).map_row(row, get_event_info)
             return jsonify(item), 200
     except mysql.connector.Error as e:
         LOG.exception("Database error during update /api/spedizioni/%s", item_id)
@@ -1148,13 +1080,164 @@ def track_tnt_shipment(tracking_number):
         }), 500
 
 
+def _format_tracking_events(vettore, events):
+    """
+    Trasforma gli eventi grezzi dei vettori nel formato che si aspetta il frontend
+    
+    Usata sia per gli eventi live sia per quelli letti da tracking_events,
+    così le mappature nome/colore sono sempre quelle correnti.
+    """
+    # Applica filtro eventi solo per BRT (che spesso ha eventi vuoti)
+    if vettore in ['BRT']:
+        valid_raw_events = []
+        for event in events:
+            # Controlla se l'evento ha almeno i campi base popolati
+            has_date = event.get('date') and str(event.get('date')).strip()
+            has_time = event.get('time') and str(event.get('time')).strip()
+            has_code = event.get('code') and str(event.get('code')).strip()
+            
+            if has_date and has_time and has_code:
+                valid_raw_events.append(event)
+        
+        LOG.info(f"🔍 Eventi BRT: {len(events)} totali, {len(valid_raw_events)} validi")
+    else:
+        # Per altri vettori, usa tutti gli eventi
+        valid_raw_events = events
+        LOG.info(f"🔍 Eventi {vettore}: {len(events)} totali")
+    
+    # Trasforma eventi nel formato che si aspetta il frontend
+    formatted_events = []
+    for event in valid_raw_events:  # Usa solo eventi validi
+        formatted_event = {}
+        
+        # Mappa i campi dal formato tracking service al formato frontend
+        # Supporta UPS, DHL, SDA, BRT e FedEx con campi diversi
+        
+        # Gestione data
+        if 'date' in event:
+            # Trasforma date - BRT usa DD.MM.YYYY, altri YYYY-MM-DD
+            date_str = event['date']
+            try:
+                from datetime import datetime
+                if '.' in date_str:  # Formato BRT: DD.MM.YYYY
+                    date_obj = datetime.strptime(date_str, '%d.%m.%Y')
+                    formatted_event['data'] = date_obj.strftime('%d/%m/%Y')
+                else:  # Formato standard: YYYY-MM-DD
+                    date_obj = datetime.strptime(date_str, '%Y-%m-%d')
+                    formatted_event['data'] = date_obj.strftime('%d/%m/%Y')
+            except:
+                formatted_event['data'] = date_str
+        elif 'data' in event:  # FedEx usa 'data'
+            # FedEx già formattata come YYYY-MM-DD, convertila in DD/MM/YYYY
+            try:
+                from datetime import datetime
+                date_obj = datetime.strptime(event['data'], '%Y-%m-%d')
+                formatted_event['data'] = date_obj.strftime('%d/%m/%Y')
+            except:
+                formatted_event['data'] = event['data']
+
+        # Gestione ora
+        if 'time' in event:
+            # Trasforma time - BRT usa HH.MM, altri HH:MM:SS
+            time_str = event['time']
+            if '.' in time_str:  # Formato BRT: HH.MM
+                formatted_event['ora'] = time_str.replace('.', ':')
+            elif len(time_str) > 5:  # Formato standard: HH:MM:SS
+                formatted_event['ora'] = time_str[:5]  # Prende solo HH:MM
+            else:
+                formatted_event['ora'] = time_str
+        elif 'ora' in event:  # FedEx usa 'ora'
+            formatted_event['ora'] = event['ora']
+            
+        # Gestione codice evento (diverso per ogni vettore)
+        event_code = None
+        if 'event_code' in event:
+            event_code = event['event_code']
+        elif 'status_code' in event:  # SDA usa status_code
+            event_code = event['status_code']
+        elif 'code' in event:  # BRT usa code
+            event_code = event['code']
+        elif 'codice' in event:  # FedEx usa codice
+            event_code = event['codice']
+        
+        if event_code:
+            formatted_event['codice'] = event_code
+            
+            # Ottieni informazioni complete (nome + colore)
+            event_info = get_event_info(vettore, event_code)
+            personalized_name = event_info['nome']
+            event_color = event_info['colore']
+            
+            # Se la mappatura restituisce solo il codice, usa la descrizione originale
+            if personalized_name == event_code:
+                # Per SDA prova con la descrizione completa per pattern matching
+                if vettore == 'SDA' and ('status_description' in event or 'synthesis_description' in event):
+                    description = event.get('synthesis_description') or event.get('status_description', '')
+                    if description:
+                        event_info = get_event_info(vettore, description)
+                        personalized_name = event_info['nome']
+                        event_color = event_info['colore']
+                
+                # Per BRT prova con la descrizione per pattern matching
+                if vettore == 'BRT' and 'description' in event:
+                    description = event.get('description', '')
+                    if description:
+                        event_info = get_event_info(vettore, description)
+                        personalized_name = event_info['nome']
+                        event_color = event_info['colore']
+                
+                # Per FedEx prova con la descrizione per pattern matching
+                if vettore in ['FEDEX', 'FED'] and 'descrizione' in event:
+                    description = event.get('descrizione', '')
+                    if description:
+                        event_info = get_event_info(vettore, description)
+                        personalized_name = event_info['nome']
+                        event_color = event_info['colore']
+                
+                # Fallback alla descrizione originale
+                if personalized_name == event_code and 'description' in event:
+                    personalized_name = event['description']
+                    event_color = '#000000'  # Colore default
+            
+            formatted_event['commento_personalizzato'] = personalized_name
+            
+            # Descrizione originale (varia per vettore)
+            original_description = (
+                event.get('description') or 
+                event.get('status_description') or 
+                event.get('synthesis_description') or 
+                event.get('descrizione') or  # FedEx usa descrizione
+                ''
+            )
+            formatted_event['commento'] = original_description
+            formatted_event['colore'] = event_color
+        
+        # Aggiungi location se disponibile
+        if 'location' in event:
+            formatted_event['location'] = event['location']
+        elif 'office_description' in event:  # SDA usa office_description
+            formatted_event['location'] = event['office_description']
+        elif 'luogo' in event:  # FedEx usa luogo
+            formatted_event['location'] = event['luogo']
+        
+        # Aggiungi l'evento formattato (già filtrato sopra)
+        formatted_events.append(formatted_event)
+    
+    return formatted_events
+
+
 @app.route('/api/spedizioni/<int:spedizione_id>/events', methods=['GET'])
 def get_spedizione_events(spedizione_id):
     """
     Ottiene gli eventi di tracking per una spedizione
     
+    Legge gli eventi salvati in tracking_events; chiama il vettore solo se
+    non sono mai stati sincronizzati o sono più vecchi di TRACKING_EVENTS_MAX_AGE
+    (oppure con ?refresh=1). Una timeline consegnata è definitiva e non scade.
+    Gli eventi live sono ordinati come quelli salvati (più recenti prima).
+    
     GET /api/spedizioni/123/events
-    Risposta: {"success": true, "events": [...]}
+    Risposta: {"success": true, "events": [...], "source": "db" | "api"}
     """
     try:
         # Connessione database
@@ -1168,210 +1251,76 @@ def get_spedizione_events(spedizione_id):
             
             cur.execute(query, (spedizione_id,))
             spedizione = cur.fetchone()
-            
-            if not spedizione:
-                return jsonify({
-                    "success": False,
-                    "error": "Spedizione non trovata"
-                }), 404
-            
-            # Ottieni eventi live dal tracking service
-            vettore = spedizione[0].upper() if spedizione[0] else ''
-            awb = spedizione[1] if spedizione[1] else ''
-            
-            if not awb or not vettore:
-                return jsonify({
-                    "success": False,
-                    "error": "AWB o vettore mancante"
-                }), 400
-            
-            # Recupera eventi tramite tracking
-            from tracking_service import TrackingService
-            tracking_service = TrackingService()
-            
-            if vettore in ['UPS']:
-                result = tracking_service.ups_client.track_shipment(awb)
-            elif vettore in ['DHL']:
-                result = tracking_service.dhl_client.track_shipment(awb)
-            elif vettore in ['SDA']:
-                result = tracking_service.sda_client.track(awb)
-            elif vettore in ['BRT']:
-                result = tracking_service.brt_client.track(awb)
-            elif vettore in ['FEDEX', 'FED']:  # Supporta sia FEDEX che FED
-                result = tracking_service.fedex_client.track_shipment(awb)
-            else:
-                return jsonify({
-                    "success": False,
-                    "error": f"Vettore {vettore} non supportato"
-                }), 400
-            
-            events = result.get('events', [])
-            
-            # Applica filtro eventi solo per BRT (che spesso ha eventi vuoti)
-            if vettore in ['BRT']:
-                valid_raw_events = []
-                for event in events:
-                    # Controlla se l'evento ha almeno i campi base popolati
-                    has_date = event.get('date') and str(event.get('date')).strip()
-                    has_time = event.get('time') and str(event.get('time')).strip()
-                    has_code = event.get('code') and str(event.get('code')).strip()
-                    
-                    if has_date and has_time and has_code:
-                        valid_raw_events.append(event)
-                
-                LOG.info(f"🔍 Eventi BRT: {len(events)} totali, {len(valid_raw_events)} validi")
-            else:
-                # Per altri vettori, usa tutti gli eventi
-                valid_raw_events = events
-                LOG.info(f"🔍 Eventi {vettore}: {len(events)} totali")
-            
-            # Trasforma eventi nel formato che si aspetta il frontend
-            formatted_events = []
-            for event in valid_raw_events:  # Usa solo eventi validi
-                formatted_event = {}
-                
-                # Mappa i campi dal formato tracking service al formato frontend
-                # Supporta UPS, DHL, SDA, BRT e FedEx con campi diversi
-                
-                # Gestione data
-                if 'date' in event:
-                    # Trasforma date - BRT usa DD.MM.YYYY, altri YYYY-MM-DD
-                    date_str = event['date']
-                    try:
-                        from datetime import datetime
-                        if '.' in date_str:  # Formato BRT: DD.MM.YYYY
-                            date_obj = datetime.strptime(date_str, '%d.%m.%Y')
-                            formatted_event['data'] = date_obj.strftime('%d/%m/%Y')
-                        else:  # Formato standard: YYYY-MM-DD
-                            date_obj = datetime.strptime(date_str, '%Y-%m-%d')
-                            formatted_event['data'] = date_obj.strftime('%d/%m/%Y')
-                    except:
-                        formatted_event['data'] = date_str
-                elif 'data' in event:  # FedEx usa 'data'
-                    # FedEx già formattata come YYYY-MM-DD, convertila in DD/MM/YYYY
-                    try:
-                        from datetime import datetime
-                        date_obj = datetime.strptime(event['data'], '%Y-%m-%d')
-                        formatted_event['data'] = date_obj.strftime('%d/%m/%Y')
-                    except:
-                        formatted_event['data'] = event['data']
-
-                # Gestione ora
-                if 'time' in event:
-                    # Trasforma time - BRT usa HH.MM, altri HH:MM:SS
-                    time_str = event['time']
-                    if '.' in time_str:  # Formato BRT: HH.MM
-                        formatted_event['ora'] = time_str.replace('.', ':')
-                    elif len(time_str) > 5:  # Formato standard: HH:MM:SS
-                        formatted_event['ora'] = time_str[:5]  # Prende solo HH:MM
-                    else:
-                        formatted_event['ora'] = time_str
-                elif 'ora' in event:  # FedEx usa 'ora'
-                    formatted_event['ora'] = event['ora']
-                    
-                # Gestione codice evento (diverso per ogni vettore)
-                event_code = None
-                if 'event_code' in event:
-                    event_code = event['event_code']
-                elif 'status_code' in event:  # SDA usa status_code
-                    event_code = event['status_code']
-                elif 'code' in event:  # BRT usa code
-                    event_code = event['code']
-                elif 'codice' in event:  # FedEx usa codice
-                    event_code = event['codice']
-                
-                if event_code:
-                    formatted_event['codice'] = event_code
-                    
-                    # Ottieni informazioni complete (nome + colore)
-                    event_info = get_event_info(vettore, event_code)
-                    personalized_name = event_info['nome']
-                    event_color = event_info['colore']
-                    
-                    # Se la mappatura restituisce solo il codice, usa la descrizione originale
-                    if personalized_name == event_code:
-                        # Per SDA prova con la descrizione completa per pattern matching
-                        if vettore == 'SDA' and ('status_description' in event or 'synthesis_description' in event):
-                            description = event.get('synthesis_description') or event.get('status_description', '')
-                            if description:
-                                event_info = get_event_info(vettore, description)
-                                personalized_name = event_info['nome']
-                                event_color = event_info['colore']
-                        
-                        # Per BRT prova con la descrizione per pattern matching
-                        if vettore == 'BRT' and 'description' in event:
-                            description = event.get('description', '')
-                            if description:
-                                event_info = get_event_info(vettore, description)
-                                personalized_name = event_info['nome']
-                                event_color = event_info['colore']
-                        
-                        # Per FedEx prova con la descrizione per pattern matching
-                        if vettore in ['FEDEX', 'FED'] and 'descrizione' in event:
-                            description = event.get('descrizione', '')
-                            if description:
-                                event_info = get_event_info(vettore, description)
-                                personalized_name = event_info['nome']
-                                event_color = event_info['colore']
-                            if description:
-                                event_info = get_event_info(vettore, description)
-                                personalized_name = event_info['nome']
-                                event_color = event_info['colore']
-                        
-                        # Fallback alla descrizione originale
-                        if personalized_name == event_code and 'description' in event:
-                            personalized_name = event['description']
-                            event_color = '#000000'  # Colore default
-                    
-                    formatted_event['commento_personalizzato'] = personalized_name
-                    
-                    # Descrizione originale (varia per vettore)
-                    original_description = (
-                        event.get('description') or 
-                        event.get('status_description') or 
-                        event.get('synthesis_description') or 
-                        event.get('descrizione') or  # FedEx usa descrizione
-                        ''
-                    )
-                    formatted_event['commento'] = original_description
-                    formatted_event['colore'] = event_color
-                
-                # Aggiungi location se disponibile
-                if 'location' in event:
-                    formatted_event['location'] = event['location']
-                elif 'office_description' in event:  # SDA usa office_description
-                    formatted_event['location'] = event['office_description']
-                elif 'luogo' in event:  # FedEx usa luogo
-                    formatted_event['location'] = event['luogo']
-                
-                # Aggiungi l'evento formattato (già filtrato sopra)
-                formatted_events.append(formatted_event)
-            
-            # Sostituisci gli eventi con quelli formattati
-            events = formatted_events
-            
-            # Salva gli eventi nel database per future richieste
-            # Nota: salvataggio eventi rimosso per compatibilità con schema DB locale
-            # if events:
-            #     import json
-            #     try:
-            #         events_json = json.dumps(events, ensure_ascii=False)
-            #         update_query = """
-            #         UPDATE spedizioni
-            #         SET tracking_events = %s 
-            #         WHERE id = %s
-            #         """
-            #         cur.execute(update_query, (events_json, spedizione_id))
-            #         conn.commit()
-            #     except Exception as e:
-            #         LOG.warning(f"Errore salvataggio eventi per spedizione {spedizione_id}: {e}")
-            
+        
+        if not spedizione:
+            return jsonify({
+                "success": False,
+                "error": "Spedizione non trovata"
+            }), 404
+        
+        vettore = spedizione[0].upper() if spedizione[0] else ''
+        awb = spedizione[1] if spedizione[1] else ''
+        
+        if not awb or not vettore:
+            return jsonify({
+                "success": False,
+                "error": "AWB o vettore mancante"
+            }), 400
+        
+        if vettore not in ['UPS', 'DHL', 'SDA', 'BRT', 'FEDEX', 'FED', 'TNT']:
+            return jsonify({
+                "success": False,
+                "error": f"Vettore {vettore} non supportato"
+            }), 400
+        
+        # Eventi salvati dai cicli di tracking
+        stored_events, synced_at = [], None
+        try:
+            stored_events, synced_at = tracking_events.load_events(spedizione_id)
+        except Exception as e:
+            LOG.warning(f"Eventi salvati non disponibili per spedizione {spedizione_id}: {e}")
+        
+        force_refresh = request.args.get('refresh') == '1'
+        delivered = bool(stored_events) and is_delivered(vettore, {'events': stored_events})
+        if not force_refresh and (delivered or not tracking_events.is_stale(synced_at)):
+            return jsonify({
+                "success": True,
+                "events": _format_tracking_events(vettore, stored_events),
+                "source": "db",
+                "synced_at": synced_at.isoformat() if synced_at else None
+            }), 200
+        
+        # Dati assenti o vecchi: recupera eventi live dal vettore
+        from tracking_service import TrackingService
+        tracking_service = TrackingService()
+        if force_refresh:
+            get_tracking_cache().invalidate(vettore, awb)
+        tracking = tracking_service._get_tracking_data(vettore, awb)
+        
+        if tracking.get('error') and synced_at is not None:
+            # Vettore non raggiungibile: meglio eventi vecchi che nessun evento
+            LOG.warning(f"Tracking live {vettore} {awb} fallito, uso eventi salvati: {tracking['error']}")
             return jsonify({
                 "success": True,
-                "events": events,
-                "source": "api"
+                "events": _format_tracking_events(vettore, stored_events),
+                "source": "db",
+                "stale": True,
+                "synced_at": synced_at.isoformat()
             }), 200
         
+        events = tracking.get('events', [])
+        
+        # Salva gli eventi nel database per future richieste (nell'ordine del
+        # vettore, come i cicli di tracking)
+        if not tracking.get('error'):
+            tracking_service._save_events(spedizione_id, vettore, events)
+        
+        return jsonify({
+            "success": True,
+            "events": _format_tracking_events(vettore, tracking_events.sort_events(events)),
+            "source": "api"
+        }), 200
+        
     except Exception as e:
         LOG.exception(f"Errore recupero eventi spedizione {spedizione_id}")
         return jsonify({
@@ -1380,6 +1329,21 @@ def get_spedizione_events(spedizione_id):
         }), 500
 
 
+@app.route('/api/tracking/refresh-status', methods=['GET'])
+def tracking_refresh_status():
+    """
+    Stato dell'aggiornamento tracking automatico avviato dalla dashboard
+    
+    GET /api/tracking/refresh-status
+    Risposta: {"running": false, "finished_at": "...", "age_seconds": 42.0, "last_cycle": {...}, ...}
+    """
+    try:
+        return jsonify(get_coordinator().get_status()), 200
+    except Exception as e:
+        LOG.exception("Errore lettura stato refresh tracking")
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route('/api/tracking/update-all-transit', methods=['POST'])
 def update_all_transit_tracking():
     """
@@ -1390,7 +1354,7 @@ def update_all_transit_tracking():
     Risposta: {"success": true, "updated_count": 15, "message": "Aggiornate 15 spedizioni"}
     """
     try:
-        from tracking_service import TrackingService
+        from tracking_executor import TrackingExecutor
         
         # Connessione database
         with db_cursor() as (conn, cursor):
@@ -1411,50 +1375,31 @@ def update_all_transit_tracking():
             
             cursor.execute(query)
             spedizioni = cursor.fetchall()
-            
-            if not spedizioni:
-                return jsonify({
-                    "success": True,
-                    "updated_count": 0,
-                    "message": "Nessuna spedizione in transito trovata"
-                }), 200
         
-            tracking_service = TrackingService()
-            updated_count = 0
-            
-            LOG.info(f"🔄 Inizio aggiornamento {len(spedizioni)} spedizioni in transito")
-            
-            for spedizione in spedizioni:
-                try:
-                    # fetchall() restituisce tuple, non dizionari
-                    spedizione_id = spedizione[0]  # id
-                    vettore = spedizione[1]  # vettore
-                    awb = spedizione[2]  # awb
-                    
-                    LOG.info(f"📦 Aggiornamento spedizione {spedizione_id}: {vettore} {awb}")
-                    
-                    # Usa il servizio di tracking
-                    result = tracking_service.update_tracking(spedizione_id)
-                    
-                    if result.get('success'):
-                        updated_count += 1
-                        LOG.info(f"✅ Spedizione {spedizione_id} aggiornata")
-                    else:
-                        LOG.warning(f"⚠️ Spedizione {spedizione_id}: {result.get('error', 'Errore sconosciuto')}")
-                        
-                except Exception as e:
-                    LOG.exception(f"❌ Errore aggiornamento spedizione {spedizione[0]}: {e}")
-                    continue
-            
-            LOG.info(f"🎯 Aggiornamento completato: {updated_count}/{len(spedizioni)} spedizioni")
-            
+        if not spedizioni:
             return jsonify({
                 "success": True,
-                "updated_count": updated_count,
-                "total_processed": len(spedizioni),
-                "message": f"Aggiornate {updated_count} su {len(spedizioni)} spedizioni in transito"
+                "updated_count": 0,
+                "message": "Nessuna spedizione in transito trovata"
             }), 200
         
+        LOG.info(f"🔄 Inizio aggiornamento {len(spedizioni)} spedizioni in transito")
+        
+        # fetchall() restituisce tuple (id, vettore, awb); l'executor raggruppa
+        # per vettore e usa le richieste multi-AWB dove disponibili (DHL)
+        shipments = [{"id": row[0], "vettore": row[1], "awb": row[2]} for row in spedizioni]
+        cycle = TrackingExecutor().run(shipments)
+        updated_count = cycle["updated"]
+        
+        LOG.info(f"🎯 Aggiornamento completato: {updated_count}/{len(spedizioni)} spedizioni")
+        
+        return jsonify({
+            "success": True,
+            "updated_count": updated_count,
+            "total_processed": len(spedizioni),
+            "message": f"Aggiornate {updated_count} su {len(spedizioni)} spedizioni in transito"
+        }), 200
+        
     except Exception as e:
         LOG.exception("Errore aggiornamento tracking globale")
         return jsonify({
@@ -1467,7 +1412,242 @@ def update_all_transit_tracking():
 def debug_mappings():
     """Endpoint debug per vedere le mappature caricate"""
     try:
-        return jsonify(event_mappings), 200
+        return jsonify(event_index.get_index().to_dict()), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/debug/db-pool', methods=['GET'])
+def debug_db_pool():
+    """Endpoint debug con le metriche del pool di connessioni MySQL di questo processo"""
+    try:
+        return jsonify(get_pool_stats()), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/quotes', methods=['POST'])
+def quotes():
+    """
+    Preventivo multi-corriere: tutte le sorgenti in parallelo entro una deadline
+
+    POST /api/quotes?sort=price|transit&deadline=8&stream=0|1&cache=1|0
+    Body: {"origin_country": "IT", "origin_postal": "00185", "destination_country": "DE",
+           "destination_postal": "10115", "parcels": [{"weight_kg": 2, "length_cm": 30, ...}]}
+
+    Risposta: {"rates": [...], "cheapest": {...}, "fastest": {...}, "sources": {...}, "partial": false}
+    Con stream=1 risponde in NDJSON: una riga per sorgente appena disponibile
+    ({"type": "source", ...}) e una riga finale {"type": "summary", ...}.
+    Con cache=0 tutte le sorgenti vengono richieste ai corrieri (e la cache aggiornata).
+    """
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data, dict):
+        return jsonify({"error": "payload JSON non valido"}), 400
+    try:
+        spec = quote_aggregator.ShipmentSpec.from_dict(data)
+        deadline = float(request.args.get('deadline', data.get('deadline') or 0))
+        sources = quote_aggregator.parse_sources(data.get('sources'))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    sort = request.args.get('sort', data.get('sort', 'price'))
+    if sort not in quote_aggregator.SORT_KEYS:
+        return jsonify({"error": f"sort non valido: {sort}"}), 400
+    use_cache = request.args.get('cache', '1') != '0'
+    aggregator = quote_aggregator.get_aggregator()
+
+    if request.args.get('stream') == '1':
+        def generate():
+            start = time.monotonic()
+            results = []
+            for result in aggregator.iter_quotes(spec, deadline, sources, use_cache):
+                results.append(result)
+                yield json.dumps({"type": "source", **result.to_dict()}) + "\n"
+            summary = aggregator.summarize(results, sort, time.monotonic() - start)
+            yield json.dumps({"type": "summary", **summary}) + "\n"
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                        headers={'X-Accel-Buffering': 'no'})
+
+    try:
+        return jsonify(aggregator.quote(spec, deadline, sort, sources, use_cache=use_cache)), 200
+    except Exception as e:
+        LOG.exception("Errore preventivo multi-corriere")
+        return jsonify({"error": str(e)}), 500
+
+def _text_lines(stream):
+    # Righe di testo da uno stream binario (body o file caricato) senza leggerlo tutto
+    for line in stream:
+        yield line.decode('utf-8-sig', errors='replace')
+
+@app.route('/api/quotes/batch', methods=['POST'])
+def quotes_batch():
+    """
+    Preventivi multi-corriere per un elenco di spedizioni, in streaming NDJSON
+
+    POST /api/quotes/batch?sort=price|transit&deadline=8&sources=UPS,DHL&cache=1|0&concurrency=4
+    Body (uno tra):
+      - text/csv: intestazione + una spedizione per riga (colonne come /api/quotes, più `ref`)
+      - application/x-ndjson: un oggetto spedizione per riga
+      - application/json: lista di spedizioni o {"shipments": [...]}
+      - multipart/form-data con campo `file` (.csv, .ndjson/.jsonl o .json)
+
+    Risposta application/x-ndjson, una riga per spedizione appena quotata:
+      {"type": "quote", "row": 0, "ref": ..., "rates": [...], "cheapest": {...}, ...}
+      {"type": "error", "row": 3, "ref": ..., "error": "..."}
+    e una riga finale {"type": "summary", "rows": n, "quoted": n, "errors": n, "elapsed_ms": ...}.
+    Le righe sono lette man mano (QUOTE_BATCH_CONCURRENCY spedizioni in corso, al massimo
+    QUOTE_BATCH_MAX_ROWS righe): la memoria non cresce con la dimensione del file.
+    """
+    sort = request.args.get('sort', 'price')
+    if sort not in quote_aggregator.SORT_KEYS:
+        return jsonify({"error": f"sort non valido: {sort}"}), 400
+    try:
+        deadline = float(request.args.get('deadline', 0))
+        concurrency = int(request.args.get('concurrency', 0)) or None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    sources = [s.strip().upper() for s in request.args.get('sources', '').split(',') if s.strip()] or None
+    use_cache = request.args.get('cache', '1') != '0'
+
+    mimetype = request.mimetype or ''
+    stream, name = request.stream, ''
+    if mimetype == 'multipart/form-data':
+        upload = request.files.get('file')
+        if upload is None:
+            return jsonify({"error": "campo file mancante"}), 400
+        stream, name = upload.stream, (upload.filename or '').lower()
+
+    if mimetype == 'text/csv' or name.endswith('.csv'):
+        records = quote_aggregator.records_from_csv(_text_lines(stream))
+    elif mimetype in ('application/x-ndjson', 'application/jsonl') or name.endswith(('.ndjson', '.jsonl')):
+        records = quote_aggregator.records_from_ndjson(_text_lines(stream))
+    elif mimetype == 'application/json' or name.endswith('.json'):
+        try:
+            data = json.load(stream) if name else request.get_json(silent=True)
+        except ValueError:
+            data = None
+        records = data.get('shipments') if isinstance(data, dict) else data
+        if not isinstance(records, list):
+            return jsonify({"error": "payload JSON non valido: lista di spedizioni o {\"shipments\": [...]}"}), 400
+    else:
+        return jsonify({"error": f"formato non supportato: {mimetype or name}"}), 415
+
+    aggregator = quote_aggregator.get_aggregator()
+
+    def generate():
+        start = time.monotonic()
+        counts = {'quote': 0, 'error': 0}
+        try:
+            for line in aggregator.iter_batch(records, deadline, sort, sources, use_cache, concurrency):
+                counts[line['type']] += 1
+                yield json.dumps(line, default=str) + "\n"
+        except Exception as e:
+            # Input non leggibile (es. CSV malformato): riga di errore e riepilogo invece di troncare lo stream
+            LOG.exception("Errore batch preventivi")
+            counts['error'] += 1
+            yield json.dumps({"type": "error", "row": None, "ref": None, "error": str(e)}) + "\n"
+        yield json.dumps({"type": "summary", "rows": counts['quote'] + counts['error'], "quoted": counts['quote'],
+                          "errors": counts['error'], "elapsed_ms": round((time.monotonic() - start) * 1000, 1)}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no'})
+
+@app.route('/api/quotes/bulk', methods=['GET', 'POST'])
+def quotes_bulk():
+    """
+    Tariffe di listino in blocco (bulk_pricer, NumPy) per ricalcoli e margini
+
+    POST /api/quotes/bulk
+    Body: {"shipments": [{"weight_kg": 2, "length_cm": 30, ..., "destination_country": "DE"}, ...]}
+          oppure {"columns": {"weight_kg": [...], "destination_country": [...], ...}}
+    Risposta: {"count": n, "services": [...], "rows": [{"chargeable_kg", "prices", "cheapest", ...}]}
+
+    GET /api/quotes/bulk?days=30&limit=50000&rows=0|1
+    Spedizioni degli ultimi `days` giorni: fatturato (tariffa_base) contro il
+    servizio più economico di listino, per vettore; con rows=1 anche le righe.
+    """
+    if not bulk_pricer.available():
+        return jsonify({"error": "NumPy non installato: calcolo tariffe in blocco non disponibile"}), 503
+    start = time.monotonic()
+    try:
+        if request.method == 'POST':
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict) or not (data.get('shipments') or data.get('columns')):
+                return jsonify({"error": "payload JSON non valido: indicare shipments o columns"}), 400
+            if data.get('shipments'):
+                columns = bulk_pricer.columns_from_records(data['shipments'])
+            else:
+                columns = data['columns']
+            batch = bulk_pricer.price(columns)
+            return jsonify({
+                "count": len(batch['chargeable_kg']),
+                "elapsed_ms": round((time.monotonic() - start) * 1000, 1),
+                "services": bulk_pricer.SERVICES,
+                "rows": bulk_pricer.to_records(batch),
+            }), 200
+
+        days = max(1, int(request.args.get('days', 30)))
+        limit = max(1, int(request.args.get('limit', bulk_pricer.MAX_ROWS)))
+        columns, meta = bulk_pricer.load_history(days, limit)
+        batch = bulk_pricer.price(columns)
+        result = {
+            "count": len(meta),
+            "days": days,
+            "elapsed_ms": round((time.monotonic() - start) * 1000, 1),
+            "services": bulk_pricer.SERVICES,
+            "summary": bulk_pricer.margin_summary(batch, meta),
+        }
+        if request.args.get('rows') == '1':
+            result["rows"] = bulk_pricer.to_records(batch, meta)
+        return jsonify(result), 200
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        LOG.exception("Errore calcolo tariffe in blocco")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/debug/count-cache', methods=['GET'])
+def debug_count_cache():
+    """Endpoint debug con le statistiche della cache dei totali di questo processo"""
+    try:
+        return jsonify(count_cache.get_count_cache().get_statistics()), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/debug/endpoints', methods=['GET'])
+def debug_endpoints():
+    """Endpoint debug con endpoint in uso, latenze ed errori dei servizi multi-URL (TNT) di questo processo"""
+    try:
+        return jsonify(endpoint_health.get_statistics()), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/debug/oauth-tokens', methods=['GET'])
+def debug_oauth_tokens():
+    """Endpoint debug con scadenze e rinnovi dei token OAuth di questo processo (senza i token)"""
+    try:
+        return jsonify(token_manager.get_manager().get_statistics()), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/debug/tracking-cache', methods=['GET'])
+def debug_tracking_cache():
+    """Endpoint debug con hit ratio e occupazione della cache tracking di questo processo"""
+    try:
+        return jsonify(get_tracking_cache().get_statistics()), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/debug/quote-cache', methods=['GET'])
+def debug_quote_cache():
+    """Endpoint debug con hit ratio e occupazione della cache preventivi di questo processo"""
+    try:
+        return jsonify(quote_cache.get_cache().get_statistics()), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/debug/quote-policy', methods=['GET'])
+def debug_quote_policy():
+    """Endpoint debug con latenze, hedging ed esiti delle fasi dei preventivi UPS di questo processo"""
+    try:
+        return jsonify(quote_policy.get_statistics()), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -1498,14 +1678,13 @@ def debug_static():
 
 @app.route('/api/debug/reload-mappings', methods=['POST'])
 def reload_mappings():
-    """Endpoint per forzare il reload delle mappature"""
+    """Ricarica codici_tracking in tutti i worker (incrementa la versione dell'indice)"""
     try:
-        global event_mappings
-        event_mappings = {}  # Pulisci cache
-        load_tracking_codes()  # Ricarica
+        index = event_index.reload()
         return jsonify({
             "success": True,
-            "message": f"Mappature ricaricate: {len(event_mappings)} vettori"
+            "version": index.version,
+            "message": f"Mappature ricaricate: {len(index.to_dict())} vettori"
         }), 200
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
@@ -1537,8 +1716,8 @@ def get_record(record_id):
     try:
         with db_cursor() as (conn, cur):
             # Query per ottenere un record specifico per ID
-            query = """
-            SELECT * FROM spedizioni 
+            query = f"""
+            SELECT {spedizioni_schema.record_projection()} FROM spedizioni 
             WHERE id = %s
             """
             LOG.info(f"🔍 Eseguo query: {query} con ID: {record_id}")
@@ -1577,8 +1756,8 @@ def get_last_record():
     try:
         with db_cursor() as (conn, cur):
             # Query per ottenere l'ultimo record (ID più alto)
-            query = """
-            SELECT * FROM spedizioni 
+            query = f"""
+            SELECT {spedizioni_schema.record_projection()} FROM spedizioni 
             ORDER BY id DESC 
             LIMIT 1
             """
@@ -1675,6 +1854,15 @@ if __name__ == "__main__":
         LOG.info("🔄 Servizio tracking automatico avviato (ogni 30 minuti)")
     except Exception as e:
         LOG.warning("⚠️ Impossibile avviare servizio tracking automatico: %s", e)
+
+    # Preriscaldamento notturno della cache preventivi (QUOTE_WARM_HOUR)
+    try:
+        quote_warmer = quote_cache.QuoteCacheWarmer()
+        if quote_warmer.start():
+            import atexit
+            atexit.register(quote_warmer.stop)
+    except Exception as e:
+        LOG.warning("⚠️ Impossibile avviare preriscaldamento preventivi: %s", e)
     
        
     
@@ -13,6 +13,7 @@ from datetime import datetime, timedelta
 from typing import List, Dict, Any
 from db_connector import cursor as db_cursor
 from tracking_service import TrackingService
+from tracking_executor import TrackingExecutor
 
 LOG = logging.getLogger(__name__)
 
@@ -24,6 +25,7 @@ class BackgroundTrackingService:
         self.interval_minutes = interval_minutes
         self.interval_seconds = interval_minutes * 60
         self.tracking_service = TrackingService()
+        self.executor = TrackingExecutor(self.tracking_service)
         self.running = False
         self.thread = None
     
@@ -77,23 +79,9 @@ class BackgroundTrackingService:
             shipments = self._get_active_shipments()
             LOG.info("📦 Trovate %d spedizioni da aggiornare", len(shipments))
             
-            updated_count = 0
-            for shipment in shipments:
-                try:
-                    result = self.tracking_service.update_tracking(shipment['id'])
-                    if result['success']:
-                        updated_count += 1
-                        LOG.debug("✅ Aggiornato ID %d: %s", shipment['id'], result['last_position'])
-                    else:
-                        LOG.debug("⚠️ Errore ID %d: %s", shipment['id'], result['error'])
-                        
-                except Exception as e:
-                    LOG.warning("❌ Errore aggiornamento spedizione ID %d: %s", shipment['id'], str(e))
-                
-                # Pausa breve tra le chiamate per non sovraccaricare le API
-                time.sleep(1)
-            
-            return updated_count
+            # Fan-out parallelo per vettore: la durata segue il vettore più lento
+            cycle = self.executor.run(shipments)
+            return cycle['updated']
             
         except Exception as e:
             LOG.exception("Errore aggiornamento spedizioni")
@@ -104,7 +92,7 @@ class BackgroundTrackingService:
         Ottiene lista spedizioni attive da aggiornare
         
         Criteri:
-        - Vettore UPS, DHL, SDA o BRT
+        - Vettore UPS, DHL, SDA, BRT, FedEx o TNT
         - AWB non vuoto
         - Non consegnate (final_position != 1)
         - Aggiornate nelle ultime 2 settimane
@@ -115,7 +103,7 @@ class BackgroundTrackingService:
                 SELECT id, vettore, awb, last_position
                 FROM spedizioni 
                 WHERE 
-                    vettore IN ('UPS', 'DHL', 'SDA', 'BRT')
+                    vettore IN ('UPS', 'DHL', 'SDA', 'BRT', 'FEDEX', 'FED', 'TNT')
                     AND awb IS NOT NULL 
                     AND awb != ''
                     AND (final_position IS NULL OR final_position != 1)
@@ -142,6 +130,13 @@ class BackgroundTrackingService:
             LOG.exception("Errore query spedizioni attive")
             return []
 
+    def get_metrics(self) -> Dict[str, Any]:
+        """Metriche dell'ultimo ciclo (durata totale e per vettore)"""
+        metrics = self.executor.get_metrics()
+        metrics['running'] = self.running
+        metrics['interval_minutes'] = self.interval_minutes
+        return metrics
+
 
 def main():
     """Avvia il servizio di background"""
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Benchmark connessioni HTTP per sweep di tracking
+
+Confronta, per ogni sweep di N richieste eseguite con la concorrenza del
+vettore:
+ - "nuova connessione": una requests.Session per richiesta (come il vecchio
+   client DHL con "Connection: close"), quindi un handshake per richiesta
+ - "registro": la sessione keep-alive di http_transport.get_session()
+
+Conta le connessioni aperte (handshake) e il tempo per sweep. Senza URL usa
+un server HTTP locale che conta anche le connessioni accettate; con un URL
+https misura anche il costo reale dell'handshake TLS.
+
+Uso:
+    python benchmarks/http_sessions_bench.py [url] [richieste_per_sweep] [sweep] [vettore]
+"""
+
+import os
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+import urllib3.connection  # noqa: E402
+
+import http_transport  # noqa: E402
+from http_transport import HttpRequest  # noqa: E402
+
+_connects = 0
+_connects_lock = threading.Lock()
+_original_connect = urllib3.connection.HTTPConnection.connect
+
+
+def _counting_connect(self):
+    global _connects
+    with _connects_lock:
+        _connects += 1
+    return _original_connect(self)
+
+
+# Conta gli handshake lato client (vale anche per HTTPSConnection)
+urllib3.connection.HTTPConnection.connect = _counting_connect
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    accepted = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with _Handler.lock:
+            _Handler.accepted += 1
+
+    def do_GET(self):
+        body = b'{"status": "ok"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _fresh_connection(carrier: str, url: str) -> int:
+    with requests.Session() as session:
+        req = HttpRequest(carrier, "GET", url, rate_limited=False)
+        return http_transport.request(req, session=session).status_code
+
+
+def _registry(carrier: str, url: str) -> int:
+    return http_transport.request(HttpRequest(carrier, "GET", url, rate_limited=False)).status_code
+
+
+def _sweep(fn, carrier: str, url: str, requests_per_sweep: int, workers: int):
+    global _connects
+    with _connects_lock:
+        _connects = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        statuses = list(pool.map(lambda _: fn(carrier, url), range(requests_per_sweep)))
+    elapsed = time.perf_counter() - start
+    errors = sum(1 for s in statuses if s >= 400)
+    return _connects, elapsed, errors
+
+
+def main():
+    url = sys.argv[1] if len(sys.argv) > 1 and not sys.argv[1].isdigit() else None
+    numbers = [a for a in sys.argv[1:] if a.isdigit()]
+    requests_per_sweep = int(numbers[0]) if numbers else 50
+    sweeps = int(numbers[1]) if len(numbers) > 1 else 5
+    carrier = sys.argv[-1].upper() if len(sys.argv) > 1 and sys.argv[-1].isalpha() else "DHL"
+
+    server = None
+    if url is None:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/track"
+
+    config = http_transport.get_config(carrier)
+    workers = min(config.pool_size, requests_per_sweep)
+    print(f"URL: {url}")
+    print(f"Vettore {carrier}: pool {config.pool_size}, {requests_per_sweep} richieste per sweep "
+          f"con {workers} thread, {sweeps} sweep")
+
+    for label, fn in (("nuova connessione", _fresh_connection), ("registro", _registry)):
+        http_transport.close_sessions()
+        accepted_before = _Handler.accepted
+        total_connects, total_time = 0, 0.0
+        for i in range(sweeps):
+            connects, elapsed, errors = _sweep(fn, carrier, url, requests_per_sweep, workers)
+            total_connects += connects
+            total_time += elapsed
+            print(f"  {label:18} sweep {i + 1}: {connects:4d} handshake, {elapsed * 1000:8.1f} ms"
+                  + (f", {errors} errori" if errors else ""))
+        line = (f"{label:18} media: {total_connects / sweeps:6.1f} handshake/sweep, "
+                f"{total_time / sweeps * 1000:8.1f} ms/sweep")
+        if server is not None:
+            line += f" (server: {_Handler.accepted - accepted_before} connessioni accettate)"
+        print(line)
+
+    http_transport.close_sessions()
+    if server is not None:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Benchmark conversione righe /api/spedizioni -> JSON
+
+Confronta la conversione precedente (_row_to_item, introspezione per riga)
+con row_mapper su pagine sintetiche di page_size righe (default 200).
+
+Uso:
+    python benchmarks/row_mapper_bench.py [page_size] [ripetizioni]
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+from datetime import date, datetime
+from typing import Any, Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import row_mapper  # noqa: E402
+
+LOG = logging.getLogger("bench")
+
+COLUMNS = [
+    "id", "awb", "vettore", "data_spedizione", "last_position", "last_position_update", "final_position",
+    "servizio", "tariffa", "iva", "totale", "num_colli", "peso", "dim1", "dim2", "dim3",
+    "mitt_cliente", "mitt_ragione_sociale", "mitt_identificativo", "mitt_contatto", "mitt_indirizzo",
+    "mitt_indirizzo2", "mitt_indirizzo3", "mitt_civico", "mitt_cap", "mitt_citta", "mitt_provincia",
+    "mitt_nazione", "mitt_codice_nazione", "mitt_telefono", "mitt_cellulare", "mitt_email",
+    "mitt_riferimento", "mitt_partita_iva", "mitt_eori", "mitt_info",
+    "dest_cliente", "dest_ragione_sociale", "dest_identificativo", "dest_contatto", "dest_indirizzo",
+    "dest_indirizzo2", "dest_indirizzo3", "dest_civico", "dest_cap", "dest_citta", "dest_provincia",
+    "dest_nazione", "dest_codice_nazione", "dest_telefono", "dest_cellulare", "dest_email",
+    "dest_pagata_da", "dest_match_code", "dest_riferimento", "dest_partita_iva", "dest_info",
+]
+
+CARRIERS = [("DHL", "OK"), ("UPS", "IT"), ("BRT", "CONSEGNATA - MILANO"), ("FEDEX", "DL"), ("SDA", "IN TRANSITO")]
+
+MAPPINGS = {
+    "DHL": {"OK": {"nome": "Consegnata", "colore": "#28a745"}},
+    "FEDEX": {"DL": {"nome": "Consegnata", "colore": "#28a745"}},
+    "BRT": {"CONSEGNATA": {"nome": "Consegnata", "colore": "#28a745"}},
+}
+
+
+def get_event_info(vettore, descrizione):
+    """Stessa logica (e stessi log di debug) di api_server.get_event_info"""
+    if not vettore or not descrizione:
+        return {'nome': descrizione or '', 'colore': '#000000'}
+    vettore = vettore.upper()
+    LOG.info(f"🔍 DEBUG get_event_info: vettore='{vettore}', descrizione='{descrizione}'")
+    LOG.info(f"🔍 DEBUG mappature disponibili per {vettore}: {list(MAPPINGS.get(vettore, {}).keys())}")
+    if descrizione in MAPPINGS.get(vettore, {}):
+        mapping = MAPPINGS[vettore][descrizione]
+        return {'nome': mapping.get('nome', descrizione), 'colore': mapping.get('colore', '#000000')}
+    return {'nome': descrizione, 'colore': '#000000'}
+
+
+def make_rows(n):
+    rows = []
+    for i in range(n):
+        vettore, code = CARRIERS[i % len(CARRIERS)]
+        values = {c: f"{c}-{i}" for c in COLUMNS}
+        values.update({
+            "id": i + 1, "awb": f"{1000000000 + i}", "vettore": vettore, "last_position": code,
+            "data_spedizione": date(2026, 1, 1 + i % 28), "last_position_update": datetime(2026, 1, 2),
+            "final_position": i % 2, "mitt_ragione_sociale": "" if i % 3 else "ACME SRL",
+            "dest_indirizzo2": None, "num_colli": 1 + i % 4, "peso": 2.5,
+        })
+        rows.append(tuple(values[c] for c in COLUMNS))
+    return rows
+
+
+# Implementazione precedente, per confronto
+def _row_to_item(row, idx: Dict[str, int]) -> Dict[str, Any]:
+    def g(c): return row[idx[c]]
+    v = g("data_spedizione")
+    if isinstance(v, datetime):
+        data_iso = v.isoformat()
+    elif isinstance(v, date):
+        data_iso = datetime(v.year, v.month, v.day).isoformat()
+    else:
+        data_iso = str(v) if v is not None else None
+
+    # helper to pick the first non-empty value from candidate column names
+    def pick(first, *candidates):
+        v = g(first) if first in idx else None
+        if v:
+            return v
+        for c in candidates:
+            if c in idx:
+                vv = g(c)
+                if vv:
+                    return vv
+        return None
+    id = pick("id")
+    mitt_nome = pick("mitt_ragione_sociale", "mitt_cliente", "mitt_contatto", "mitt_citta", "mitt_codice_nazione")
+    mitt_citta = g("mitt_citta") if "mitt_citta" in idx else None
+    mitt_codice_nazione = g("mitt_codice_nazione") if "mitt_codice_nazione" in idx else None
+    dest_nome = pick("dest_ragione_sociale", "dest_cliente", "dest_contatto", "dest_citta", "dest_codice_nazione")
+    
+    # optional service/billing fields (if present in the result set)
+    servizio = pick("servizio", "service", "product", "tipo_servizio", "service_code")
+    tariffa = pick("tariffa", "price", "fare", "rate", "amount_before_tax", "tariff", "prezzo")
+    iva = pick("iva", "vat", "tax", "tax_amount", "iva_amount")
+    totale = pick("totale", "total", "amount", "grand_total", "totale_da_pagare", "prezzo_totale")
+
+    # shipment detail: number of pieces, weight and three dimension fields
+    num_colli = pick("num_colli", "colli", "pieces")
+    peso = pick("peso", "weight", "total_weight", "peso_kg")
+    dim1 = pick("dim1", "dim_lunghezza", "lunghezza", "length")
+    dim2 = pick("dim2", "dim_larghezza", "larghezza", "width")
+    dim3 = pick("dim3", "dim_altezza", "altezza", "height")
+
+    # Converti final_position da numero a stringa leggibile
+    final_pos_raw = g("final_position")
+    if final_pos_raw == 1 or final_pos_raw == '1':
+        final_position_str = "Consegnato"
+    elif final_pos_raw == 0 or final_pos_raw == '0':
+        final_position_str = "In transito"
+    elif final_pos_raw is None or final_pos_raw == '':
+        final_position_str = "Da definire"
+    else:
+        final_position_str = str(final_pos_raw)
+    
+    # Ottieni info evento una volta sola
+    vettore = g("vettore") or ""
+    last_pos_code = g("last_position") or ""
+    
+    # Per BRT, estrai la descrizione prima del trattino per fare pattern matching
+    if vettore.upper() == 'BRT' and ' - ' in last_pos_code:
+        brt_description = last_pos_code.split(' - ')[0].strip()
+        event_info = get_event_info(vettore, brt_description)
+    else:
+        event_info = get_event_info(vettore, last_pos_code)
+    
+    return {
+        "id": g("id"),
+        "mitt_citta": mitt_citta,
+        "mitt_codice_nazione": mitt_codice_nazione,
+        "vettore": vettore,
+        "awb": g("awb"),
+        "data_spedizione": data_iso,
+        "last_position": event_info["nome"],
+        "last_position_color": event_info["colore"],
+        "final_position": final_position_str,
+        "servizio": servizio,
+        "tariffa": tariffa,
+        "iva": iva,
+        "totale": totale,
+        "num_colli": num_colli,
+        "peso": peso,
+        "dim1": dim1,
+        "dim2": dim2,
+        "dim3": dim3,
+        "mittente": {
+            "nome": mitt_nome,
+            "citta": mitt_citta,
+            "codice_nazione": mitt_codice_nazione,
+            "cliente": g("mitt_cliente") if "mitt_cliente" in idx else None,
+            "ragione_sociale": g("mitt_ragione_sociale") if "mitt_ragione_sociale" in idx else None,
+            "identificativo": g("mitt_identificativo") if "mitt_identificativo" in idx else None,
+            "indirizzo": pick("mitt_indirizzo", "mitt_indirizzo2", "mitt_indirizzo3"),
+            "indirizzo2": g("mitt_indirizzo2") if "mitt_indirizzo2" in idx else None,
+            "indirizzo3": g("mitt_indirizzo3") if "mitt_indirizzo3" in idx else None,
+            "civico": g("mitt_civico") if "mitt_civico" in idx else None,
+            "cap": pick("mitt_cap"),
+            "citta": mitt_citta,
+            "provincia": pick("mitt_provincia"),
+            "codice_nazione": mitt_codice_nazione,
+            "paese": pick("mitt_nazione", "mitt_codice_nazione"),
+            "contatto": pick("mitt_contatto"),
+            "telefono": pick("mitt_telefono", "mitt_cellulare"),
+            "cellulare": g("mitt_cellulare") if "mitt_cellulare" in idx else None,
+            "email": pick("mitt_email"),
+            "riferimento": g("mitt_riferimento") if "mitt_riferimento" in idx else None,
+            "partita_iva": g("mitt_partita_iva") if "mitt_partita_iva" in idx else None,
+            "eori": g("mitt_eori") if "mitt_eori" in idx else None,
+            "info": g("mitt_info") if "mitt_info" in idx else None,
+        },
+        "destinatario": {
+            "nome": dest_nome,
+            "cliente": g("dest_cliente") if "dest_cliente" in idx else None,
+            "ragione_sociale": g("dest_ragione_sociale") if "dest_ragione_sociale" in idx else None,
+            "identificativo": g("dest_identificativo") if "dest_identificativo" in idx else None,
+            "indirizzo": pick("dest_indirizzo", "dest_indirizzo2", "dest_indirizzo3"),
+            "indirizzo2": g("dest_indirizzo2") if "dest_indirizzo2" in idx else None,
+            "indirizzo3": g("dest_indirizzo3") if "dest_indirizzo3" in idx else None,
+            "civico": g("dest_civico") if "dest_civico" in idx else None,
+            "cap": pick("dest_cap"),
+            "citta": pick("dest_citta"),
+            "provincia": pick("dest_provincia"),
+            "codice_nazione": g("dest_codice_nazione") if "dest_codice_nazione" in idx else None,
+            "paese": pick("dest_nazione", "dest_codice_nazione"),
+            "contatto": pick("dest_contatto"),
+            "telefono": pick("dest_telefono", "dest_cellulare"),
+            "cellulare": g("dest_cellulare") if "dest_cellulare" in idx else None,
+            "email": pick("dest_email"),
+            "pagata_da": g("dest_pagata_da") if "dest_pagata_da" in idx else None,
+            "match_code": g("dest_match_code") if "dest_match_code" in idx else None,
+            "riferimento": g("dest_riferimento") if "dest_riferimento" in idx else None,
+            "partita_iva": g("dest_partita_iva") if "dest_partita_iva" in idx else None,
+            "info": g("dest_info") if "dest_info" in idx else None,
+        },
+    }
+
+
+def bench(label, fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.process_time()
+        fn()
+        best = min(best, time.process_time() - start)
+    print(f"{label:<28} {best * 1000:8.2f} ms CPU")
+    return best
+
+
+def main():
+    page_size = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    logging.basicConfig(level=logging.WARNING)
+
+    rows = make_rows(page_size)
+    description = [(c,) for c in COLUMNS]
+
+    def legacy():
+        idx = {name: i for i, name in enumerate(c[0] for c in description)}
+        return [_row_to_item(row, idx) for row in rows]
+
+    def compiled():
+        return row_mapper.get_mapper(description).map_rows(rows, get_event_info)
+
+    assert legacy() == compiled(), "I due mapper producono risultati diversi"
+
+    print(f"page_size={page_size}, migliore di {repeat} ripetizioni")
+    old = bench("_row_to_item", legacy, repeat)
+    new = bench("row_mapper", compiled, repeat)
+    bench("_row_to_item + json", lambda: json.dumps(legacy(), default=str), repeat)
+    bench("row_mapper + json", lambda: json.dumps(compiled(), default=str), repeat)
+    print(f"speedup conversione: {old / new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,9 @@ import logging
 import requests
 from typing import Dict, List, Optional
 from datetime import datetime
+import http_transport
+from http_transport import HttpRequest
+from rate_limiter import get_limiter
 
 
 class BRTTracking:
@@ -28,6 +31,9 @@ class BRTTracking:
         self.base_url = base_url.rstrip('/')
         self.debug = debug
         
+        # Rate limit condiviso con gli altri client BRT (thread e processi)
+        self.rate_limiter = get_limiter('BRT')
+        
         # Setup logging
         log_level = logging.DEBUG if debug else logging.INFO
         logging.basicConfig(level=log_level)
@@ -43,6 +49,14 @@ class BRTTracking:
         Returns:
             Dict con le informazioni di tracking
         """
+        return http_transport.run(self._track_flow(parcel_id))
+    
+    async def track_async(self, parcel_id: str) -> Dict:
+        """Variante asyncio di track()"""
+        return await http_transport.run_async(self._track_flow(parcel_id))
+    
+    def _track_flow(self, parcel_id: str):
+        """Flow della chiamata di tracking (vedi http_transport)"""
         try:
             # Costruisci URL endpoint
             url = f"{self.base_url}/parcelID/{parcel_id}"
@@ -59,8 +73,8 @@ class BRTTracking:
                 self.logger.debug(f"BRT Tracking URL: {url}")
                 self.logger.debug(f"BRT Headers: {headers}")
             
-            # Chiamata API
-            response = requests.get(url, headers=headers, timeout=30)
+            # Chiamata API (il trasporto applica il rate limit BRT)
+            response = yield HttpRequest('BRT', 'GET', url, headers=headers, timeout=30)
             
             if self.debug:
                 self.logger.debug(f"BRT Response Status: {response.status_code}")
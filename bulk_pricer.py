@@ -0,0 +1,305 @@
+"""
+Bulk Pricer - Tariffe di listino per migliaia di spedizioni in un passaggio NumPy
+
+I client calcolano le tariffe simulate una spedizione alla volta
+(UPSQuoteClientN._generate_simulation, SpediamoproQuoteClient._get_simulated_rates).
+Per ricalcoli e analisi dei margini sullo storico questo modulo applica gli
+stessi listini (UPS_A65C50_SIMULATED_RATES, SPEDIAMOPRO_SIMULATED_RATES in
+config.py) a colonne di spedizioni:
+ - peso volumetrico (L x P x H / divisore del vettore) e peso tassabile,
+   con le stesse regole di dim_weight (buste: solo peso reale)
+ - prezzo di ogni servizio come matrice spedizioni x servizi (NaN se il
+   servizio non è disponibile, es. buste internazionali SpediamoPro)
+ - servizio più economico per spedizione
+
+Come nei client, i prezzi sono calcolati sul peso tassabile. I listini non
+hanno la stessa base (UPS A65c50 senza IVA, SpediamoPro IVA inclusa): come
+nell'aggregatore, servizio più economico e margini usano l'imponibile
+('prices'); 'list_prices' riporta i prezzi come li restituiscono i client.
+
+NumPy è opzionale: senza, available() è False e price() solleva RuntimeError.
+
+Uso:
+    batch = price(columns_from_records(shipments))
+    batch['prices'][:, batch['services'].index('SPEDIAMOPRO:SDAEXP')]
+"""
+
+import logging
+from datetime import date, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # opzionale: senza NumPy il calcolo in blocco non è disponibile
+    np = None
+
+from config import (
+    UPS_A65C50_SIMULATED_RATES, UPS_A65C50_SIMULATED_PER_KG, UPS_A65C50_ENVELOPE_DISCOUNT,
+    SPEDIAMOPRO_SIMULATED_RATES, SPEDIAMOPRO_ENVELOPE_INTL_SERVICE, SPEDIAMOPRO_DISTANCE_FACTOR,
+    SPEDIAMOPRO_WEIGHT_FACTOR, SPEDIAMOPRO_DOCUMENTS_DISCOUNT, SPEDIAMOPRO_VAT, volumetric_divisor,
+)
+
+LOG = logging.getLogger(__name__)
+
+# Colonne accettate e valori di default (stessi default di quote_aggregator.Parcel)
+COLUMNS = {
+    'origin_country': 'IT',
+    'destination_country': 'IT',
+    'origin_city': '',
+    'destination_city': '',
+    'weight_kg': None,
+    'length_cm': 30.0,
+    'width_cm': 20.0,
+    'height_cm': 15.0,
+    'is_envelope': False,
+    'is_documents': False,
+}
+
+# Righe massime per una richiesta (POST) o per una lettura dello storico
+MAX_ROWS = 200000
+
+
+def _service_list() -> List[Dict[str, Any]]:
+    services = [
+        {'id': f"UPS_A65C50:{code}", 'source': 'UPS_A65C50', 'carrier': 'UPS', 'service_code': code,
+         'service_name': info['name'], 'delivery_days': info['days'], 'vat_included': False}
+        for code, info in UPS_A65C50_SIMULATED_RATES.items()
+    ]
+    services += [
+        {'id': f"SPEDIAMOPRO:{code}", 'source': 'SPEDIAMOPRO', 'carrier': info['carrier'], 'service_code': code,
+         'service_name': info['name'], 'delivery_days': info['days'], 'vat_included': True}
+        for code, info in SPEDIAMOPRO_SIMULATED_RATES.items()
+    ]
+    return services
+
+
+# Colonne della matrice dei prezzi, nell'ordine
+SERVICES = _service_list()
+SERVICE_IDS = [s['id'] for s in SERVICES]
+
+
+def available() -> bool:
+    """True se NumPy è installato"""
+    return np is not None
+
+
+def columns_from_records(records: Iterable[Dict[str, Any]]) -> Dict[str, list]:
+    """
+    Converte una lista di spedizioni (dict come il JSON di /api/quotes) in colonne
+
+    Raises:
+        ValueError: Se una spedizione non è un oggetto o non ha un peso
+    """
+    columns: Dict[str, list] = {name: [] for name in COLUMNS}
+    for index, record in enumerate(records):
+        if not isinstance(record, dict):
+            raise ValueError(f"Spedizione {index}: attesa un oggetto JSON")
+        for name, default in COLUMNS.items():
+            value = record.get(name, default)
+            if name == 'weight_kg' and value is None:
+                value = record.get('weight')
+            columns[name].append(default if value is None else value)
+        if columns['weight_kg'][-1] is None:
+            raise ValueError(f"Spedizione {index}: weight_kg mancante")
+    return columns
+
+
+def _float_column(columns: Dict[str, Any], name: str, n: int):
+    value = columns.get(name, COLUMNS[name])
+    if value is None:
+        raise ValueError(f"Colonna {name} mancante")
+    array = np.asarray(value, dtype=float)
+    return np.broadcast_to(array, (n,)) if array.ndim == 0 else array
+
+
+def _bool_column(columns: Dict[str, Any], name: str, n: int):
+    array = np.asarray(columns.get(name, COLUMNS[name]), dtype=bool)
+    return np.broadcast_to(array, (n,)) if array.ndim == 0 else array
+
+
+def _text_column(columns: Dict[str, Any], name: str, n: int):
+    value = columns.get(name, COLUMNS[name])
+    if isinstance(value, str):
+        value = [value] * n
+    return np.char.upper(np.char.strip(np.asarray(value, dtype=str)))
+
+
+def price(columns: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Prezzi di listino di tutti i servizi per un blocco di spedizioni
+
+    Args:
+        columns: Colonne di COLUMNS (liste o array della stessa lunghezza,
+                 oppure scalari applicati a tutte le righe); weight_kg obbligatoria
+
+    Returns:
+        Dict con 'volumetric_kg', 'chargeable_kg' (array n), 'prices' (matrice
+        n x servizi dell'imponibile, NaN se non disponibile), 'list_prices'
+        (stessa matrice con i prezzi dei client, SpediamoPro IVA inclusa),
+        'cheapest' (indice del servizio sull'imponibile), 'services' (id delle colonne)
+
+    Raises:
+        RuntimeError: Se NumPy non è installato
+        ValueError: Se le colonne non sono valide
+    """
+    if np is None:
+        raise RuntimeError("NumPy non installato: calcolo tariffe in blocco non disponibile")
+    if not isinstance(columns, dict):
+        raise ValueError("Colonne non valide: atteso un oggetto con le colonne")
+
+    weight = np.asarray(columns.get('weight_kg'), dtype=float)
+    if weight.ndim != 1:
+        raise ValueError("weight_kg deve essere una lista di pesi")
+    n = len(weight)
+    if n > MAX_ROWS:
+        raise ValueError(f"Massimo {MAX_ROWS} spedizioni per blocco")
+    if n and np.any(~(weight > 0) | ~np.isfinite(weight)):
+        raise ValueError("Il peso di ogni spedizione deve essere un numero maggiore di 0")
+
+    try:
+        dims = [_float_column(columns, name, n) for name in ('length_cm', 'width_cm', 'height_cm')]
+        volume = dims[0] * dims[1] * dims[2]
+        envelope = _bool_column(columns, 'is_envelope', n)
+        documents = _bool_column(columns, 'is_documents', n)
+        international = _text_column(columns, 'destination_country', n) != 'IT'
+        same_city = _text_column(columns, 'origin_city', n) == _text_column(columns, 'destination_city', n)
+    except ValueError as e:
+        # Es. colonne di lunghezza diversa o valori non numerici
+        raise ValueError(f"Colonne non valide: {e}") from e
+    # NaN o infiniti darebbero righe senza prezzi (nanargmin) o Infinity nel JSON
+    if n and any(np.any(~(dim >= 0) | ~np.isfinite(dim)) for dim in dims):
+        raise ValueError("Le dimensioni di ogni spedizione devono essere numeri non negativi")
+
+    def chargeable_for(carrier=None):
+        # Come dim_weight.chargeable_weight: buste a peso reale, pacchi max(reale, volumetrico)
+        return np.where(envelope, weight, np.maximum(weight, volume / volumetric_divisor(carrier)))
+
+    volumetric = np.where(envelope, 0.0, volume / volumetric_divisor())
+    chargeable = chargeable_for()
+
+    # UPS A65c50: base + peso x tariffa/kg, sconto per buste fino a 1 kg
+    ups_weight = chargeable_for('UPS')
+    ups_base = np.array([info['base'] for info in UPS_A65C50_SIMULATED_RATES.values()])
+    ups_discount = np.where(envelope & (ups_weight <= 1.0), UPS_A65C50_ENVELOPE_DISCOUNT, 1.0)
+    ups = (ups_base[None, :] + ups_weight[:, None] * UPS_A65C50_SIMULATED_PER_KG) * ups_discount[:, None]
+
+    # SpediamoPro: base x distanza x peso x documenti (imponibile; il listino è IVA inclusa)
+    spm_codes = list(SPEDIAMOPRO_SIMULATED_RATES)
+    spm_base = np.array([info['base'] for info in SPEDIAMOPRO_SIMULATED_RATES.values()])
+    factor = (np.where(same_city, 1.0, SPEDIAMOPRO_DISTANCE_FACTOR)
+              * np.maximum(1.0, chargeable_for('SPEDIAMOPRO') * SPEDIAMOPRO_WEIGHT_FACTOR)
+              * np.where(documents, SPEDIAMOPRO_DOCUMENTS_DISCOUNT, 1.0))
+    spm = spm_base[None, :] * factor[:, None]
+    # Buste internazionali: solo il servizio lettere
+    envelope_only = np.array([code == SPEDIAMOPRO_ENVELOPE_INTL_SERVICE for code in spm_codes])
+    spm = np.where((envelope & international)[:, None] & ~envelope_only[None, :], np.nan, spm)
+
+    prices = np.round(np.hstack([ups, spm]), 2)
+    list_prices = np.round(np.hstack([ups, spm * SPEDIAMOPRO_VAT]), 2)
+    if n and np.any(np.isinf(list_prices)):
+        raise ValueError("Peso o dimensioni fuori scala")
+    return {
+        'services': SERVICE_IDS,
+        'volumetric_kg': np.round(volumetric, 3),
+        'chargeable_kg': np.round(chargeable, 3),
+        'prices': prices,
+        'list_prices': list_prices,
+        # Ogni riga ha almeno i servizi UPS, quindi nanargmin non trova righe tutte NaN
+        'cheapest': np.nanargmin(prices, axis=1) if n else np.zeros(0, dtype=int),
+    }
+
+
+def to_records(batch: Dict[str, Any], extra: Optional[Sequence[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """Righe JSON del risultato di price(), con i campi di `extra` (es. id) in testa"""
+    services = batch['services']
+    prices = batch['prices'].tolist()
+    list_prices = batch['list_prices'].tolist()
+    rows = []
+    for i, (volumetric, chargeable, cheapest) in enumerate(zip(batch['volumetric_kg'].tolist(),
+                                                               batch['chargeable_kg'].tolist(),
+                                                               batch['cheapest'].tolist())):
+        row = dict(extra[i]) if extra is not None else {}
+        row_prices = {sid: p for sid, p in zip(services, prices[i]) if p == p}  # p != p: NaN
+        row.update({
+            'volumetric_kg': volumetric,
+            'chargeable_kg': chargeable,
+            'prices': row_prices,
+            'list_prices': {sid: p for sid, p in zip(services, list_prices[i]) if p == p},
+            'cheapest': services[cheapest],
+            'cheapest_cost': row_prices[services[cheapest]],
+        })
+        rows.append(row)
+    return rows
+
+
+def _number(value: Any) -> float:
+    try:
+        return float(str(value).replace(',', '.'))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def load_history(days: int = 30, limit: int = MAX_ROWS):
+    """
+    Spedizioni degli ultimi `days` giorni come colonne per price()
+
+    Returns:
+        (colonne, righe con id/awb/vettore/servizio/tariffa_base)
+    """
+    import spedizioni_schema
+    from db_connector import cursor as db_cursor
+
+    table_columns = set(spedizioni_schema.get_columns() or ())
+    dims = next((d for d in (('dim_lunghezza', 'dim_larghezza', 'dim_altezza'), ('dim1', 'dim2', 'dim3'))
+                 if table_columns.issuperset(d)), ())
+    fields = ['id', 'awb', 'vettore', 'servizio', 'tariffa_base', 'mitt_codice_nazione', 'dest_codice_nazione',
+              'mitt_citta', 'dest_citta', 'peso', 'num_colli', *dims]
+    since = date.today() - timedelta(days=days)
+    with db_cursor() as (conn, cur):
+        cur.execute(
+            f"SELECT {', '.join(fields)} FROM spedizioni WHERE data_spedizione >= %s AND peso > 0 "
+            "ORDER BY data_spedizione DESC LIMIT %s",
+            (since, min(limit, MAX_ROWS))
+        )
+        rows = cur.fetchall()
+
+    columns: Dict[str, list] = {name: [] for name in COLUMNS}
+    meta = []
+    for row in rows:
+        record = dict(zip(fields, row))
+        # `peso` e le dimensioni sono della spedizione: quotata come collo unico
+        size = [_number(record.get(d)) for d in dims]
+        columns['origin_country'].append(str(record['mitt_codice_nazione'] or 'IT'))
+        columns['destination_country'].append(str(record['dest_codice_nazione'] or 'IT'))
+        columns['origin_city'].append(str(record['mitt_citta'] or ''))
+        columns['destination_city'].append(str(record['dest_citta'] or ''))
+        columns['weight_kg'].append(_number(record['peso']))
+        for name, value, default in zip(('length_cm', 'width_cm', 'height_cm'), size or (0, 0, 0), (30.0, 20.0, 15.0)):
+            columns[name].append(value if value > 0 else default)
+        columns['is_envelope'].append(False)
+        columns['is_documents'].append(False)
+        billed = _number(record['tariffa_base'])
+        meta.append({'id': record['id'], 'awb': record['awb'], 'vettore': record['vettore'],
+                     'servizio': record['servizio'], 'tariffa_base': billed if billed > 0 else None})
+    return columns, meta
+
+
+def margin_summary(batch: Dict[str, Any], meta: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
+    """Totali fatturato (tariffa_base, imponibile) contro l'imponibile del servizio più economico, per vettore"""
+    cheapest = batch['prices'][np.arange(len(meta)), batch['cheapest']] if len(meta) else np.zeros(0)
+    billed = np.array([m['tariffa_base'] if m['tariffa_base'] is not None else np.nan for m in meta], dtype=float)
+    carriers = np.array([str(m['vettore'] or '').upper() for m in meta], dtype=str)
+    summary = {}
+    for carrier in sorted(set(carriers.tolist())):
+        mask = (carriers == carrier) & ~np.isnan(billed)
+        total_billed = float(billed[mask].sum())
+        total_cost = float(cheapest[mask].sum())
+        summary[carrier or '-'] = {
+            'shipments': int((carriers == carrier).sum()),
+            'billed_shipments': int(mask.sum()),
+            'billed': round(total_billed, 2),
+            'list_cost': round(total_cost, 2),
+            'margin': round(total_billed - total_cost, 2),
+            'margin_pct': round((total_billed - total_cost) / total_billed * 100, 1) if total_billed else None,
+        }
+    return summary
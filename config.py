@@ -3,7 +3,7 @@ Configuration file for DHL and UPS API
 """
 
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional
 from dotenv import load_dotenv
 
@@ -187,4 +187,336 @@ DEFAULT_SPEDIAMOPRO_CONFIG = SpediamoproConfig(
     password="",  # Inserire password Spediamo Pro
     authcode="",  # Inserire authCode Spediamo Pro
     use_testing=True  # Use testing environment for development
-)
\ No newline at end of file
+)
+
+# Limiti di default per vettore: (richieste al secondo, burst)
+DEFAULT_RATE_LIMITS = {
+    'UPS': (1.0, 2),
+    'DHL': (5.0, 10),
+    'FEDEX': (5.0, 10),
+    'SDA': (5.0, 10),
+    'BRT': (5.0, 10),
+    'TNT': (2.0, 4),
+}
+
+
+def _int_env(name: str, default: int) -> int:
+    value = os.getenv(name)
+    if value is None or value.strip() == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+def _float_env(name: str, default: float) -> float:
+    value = os.getenv(name)
+    if value is None or value.strip() == '':
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return default
+
+
+@dataclass
+class RateLimitConfig:
+    """Configurazione del token bucket per le API di un vettore"""
+
+    carrier: str
+    rate: float = 1.0  # Token (richieste) aggiunti al secondo, <= 0 disabilita il limite
+    burst: int = 1     # Richieste consecutive consentite senza attesa
+
+    @classmethod
+    def from_env(cls, carrier: str) -> 'RateLimitConfig':
+        """Create configuration from RATE_LIMIT_<CARRIER>_RATE / _BURST environment variables"""
+        carrier = carrier.upper()
+        default_rate, default_burst = DEFAULT_RATE_LIMITS.get(carrier, (1.0, 1))
+
+        return cls(
+            carrier=carrier,
+            rate=_float_env(f'RATE_LIMIT_{carrier}_RATE', default_rate),
+            burst=_int_env(f'RATE_LIMIT_{carrier}_BURST', default_burst)
+        )
+
+
+# TTL (secondi) delle risposte di tracking in cache per vettore
+DEFAULT_TRACKING_CACHE_TTL = {
+    'UPS': 900,
+    'DHL': 600,
+    'FEDEX': 600,
+    'SDA': 600,
+    'BRT': 600,
+    'TNT': 600,
+}
+
+
+@dataclass
+class TrackingCacheConfig:
+    """Configurazione della cache delle risposte di tracking"""
+
+    ttl: dict                              # TTL in secondi per vettore (0 disabilita la cache)
+    delivered_ttl: int = 30 * 24 * 3600    # Spedizioni consegnate: lo stato non cambia più
+    max_bytes: int = 32 * 1024 * 1024      # Budget di memoria della cache locale (LRU)
+    shared: bool = False                   # Condividi la cache tra i worker tramite shared_state
+
+    @classmethod
+    def from_env(cls) -> 'TrackingCacheConfig':
+        """Create configuration from TRACKING_CACHE_* environment variables"""
+        ttl = {
+            carrier: _int_env(f'TRACKING_CACHE_TTL_{carrier}', default)
+            for carrier, default in DEFAULT_TRACKING_CACHE_TTL.items()
+        }
+        return cls(
+            ttl=ttl,
+            delivered_ttl=_int_env('TRACKING_CACHE_DELIVERED_TTL', 30 * 24 * 3600),
+            max_bytes=_int_env('TRACKING_CACHE_MAX_BYTES', 32 * 1024 * 1024),
+            shared=os.getenv('TRACKING_CACHE_SHARED', '0') == '1'
+        )
+
+
+# Timeout (secondi) di default delle chiamate HTTP per vettore
+DEFAULT_HTTP_TIMEOUTS = {
+    'UPS': 30,
+    'DHL': 30,
+    'FEDEX': 30,
+    'SDA': 30,
+    'BRT': 30,
+    'TNT': 30,
+}
+
+# Richieste di tracking parallele per vettore (sovrascrivibili con
+# TRACKING_CONCURRENCY_<VETTORE>); dimensionano anche i pool HTTP
+DEFAULT_TRACKING_CONCURRENCY = {
+    'UPS': 1,
+    'DHL': 4,
+    'SDA': 4,
+    'BRT': 4,
+    'FEDEX': 4,
+    'TNT': 2,
+}
+
+
+# Retry automatici (errori di connessione e 5xx) per vettore; per DHL vale
+# ancora DHL_MAX_RETRIES
+DEFAULT_HTTP_RETRIES = {
+    'DHL': _int_env('DHL_MAX_RETRIES', 3),
+}
+
+# Connessioni keep-alive oltre al limite di concorrenza del tracking
+# (chiamate dalle pagine web mentre gira un ciclo di aggiornamento)
+HTTP_POOL_HEADROOM = 2
+
+
+@dataclass
+class HttpTransportConfig:
+    """Configurazione del trasporto HTTP (sync e async) verso le API di un vettore"""
+
+    carrier: str
+    timeout: float = 30.0   # Timeout totale di una richiesta se il client non ne indica uno
+    pool_size: int = 10     # Connessioni keep-alive per host
+    max_inflight: int = 10  # Richieste contemporanee per vettore (modalità async)
+    retries: int = 2        # Retry su errori di connessione e risposte 500/502/503/504
+    retry_backoff: float = 0.5  # Attesa tra i retry: backoff * 2^(n-1) secondi
+
+    @classmethod
+    def from_env(cls, carrier: str) -> 'HttpTransportConfig':
+        """
+        Create configuration from HTTP_TIMEOUT_<CARRIER>, HTTP_POOL_SIZE_<CARRIER>,
+        HTTP_MAX_INFLIGHT_<CARRIER>, HTTP_RETRIES_<CARRIER>, HTTP_RETRY_BACKOFF_<CARRIER>
+
+        Il pool di default è il limite di concorrenza del tracking
+        (TRACKING_CONCURRENCY_<CARRIER>) più HTTP_POOL_HEADROOM.
+        """
+        carrier = carrier.upper()
+        default_timeout = DEFAULT_HTTP_TIMEOUTS.get(carrier, 30)
+        concurrency = _int_env(f'TRACKING_CONCURRENCY_{carrier}', DEFAULT_TRACKING_CONCURRENCY.get(carrier, 4))
+        default_pool = max(1, concurrency) + HTTP_POOL_HEADROOM
+
+        return cls(
+            carrier=carrier,
+            timeout=_float_env(f'HTTP_TIMEOUT_{carrier}', float(default_timeout)),
+            pool_size=max(1, _int_env(f'HTTP_POOL_SIZE_{carrier}', default_pool)),
+            max_inflight=max(1, _int_env(f'HTTP_MAX_INFLIGHT_{carrier}', 10)),
+            retries=max(0, _int_env(f'HTTP_RETRIES_{carrier}', DEFAULT_HTTP_RETRIES.get(carrier, 2))),
+            retry_backoff=_float_env(f'HTTP_RETRY_BACKOFF_{carrier}', 0.5)
+        )
+
+
+# Sorgenti di preventivi interrogate dall'aggregatore
+QUOTE_SOURCES = ('UPS', 'UPS_A65C50', 'DHL', 'SPEDIAMOPRO')
+
+# Aliquota IVA per riportare le tariffe dei corrieri allo stesso imponibile
+QUOTE_VAT_RATE = 0.22
+
+
+@dataclass
+class QuoteConfig:
+    """Configurazione dell'aggregatore di preventivi multi-corriere"""
+
+    sources: tuple = QUOTE_SOURCES  # Sorgenti interrogate in parallelo
+    deadline: float = 8.0           # Secondi massimi per un preventivo (risultati parziali oltre)
+    max_deadline: float = 30.0      # Deadline massima richiedibile da un client
+    source_workers: int = 8         # Chiamate in corso per sorgente (pool separato per sorgente)
+    batch_concurrency: int = 4      # Spedizioni quotate in parallelo da un batch
+    batch_max_rows: int = 10000     # Righe massime di un batch
+
+    @classmethod
+    def from_env(cls) -> 'QuoteConfig':
+        """Create configuration from QUOTE_SOURCES, QUOTE_DEADLINE, QUOTE_MAX_DEADLINE, QUOTE_SOURCE_WORKERS, QUOTE_BATCH_*"""
+        sources = os.getenv('QUOTE_SOURCES')
+        return cls(
+            sources=tuple(s.strip().upper() for s in sources.split(',') if s.strip()) if sources else QUOTE_SOURCES,
+            deadline=_float_env('QUOTE_DEADLINE', 8.0),
+            max_deadline=_float_env('QUOTE_MAX_DEADLINE', 30.0),
+            source_workers=max(1, _int_env('QUOTE_SOURCE_WORKERS', 8)),
+            batch_concurrency=max(1, _int_env('QUOTE_BATCH_CONCURRENCY', 4)),
+            batch_max_rows=max(1, _int_env('QUOTE_BATCH_MAX_ROWS', 10000))
+        )
+
+
+# Scaglioni di peso tassabile per la cache dei preventivi: (fino a kg, passo kg)
+DEFAULT_QUOTE_WEIGHT_STEPS = ((10, 0.5), (70, 1.0))
+
+
+@dataclass
+class QuoteCacheConfig:
+    """Configurazione della cache dei preventivi per tratta e scaglione di peso"""
+
+    enabled: bool = True
+    postal_prefix: int = 3              # Cifre del CAP che identificano la tratta
+    rollover_hour: int = 0              # Ora da cui vale il listino del giorno (scadenza delle voci)
+    max_entries: int = 20000            # Voci della cache locale (LRU)
+    shared: bool = False                # Condividi la cache tra i worker tramite shared_state
+    bracket_pricing: bool = False       # Quota a fine scaglione e servi la risposta a tutto lo scaglione
+    warm_hour: int = 1                  # Ora del preriscaldamento notturno (-1 disattiva)
+    warm_top: int = 100                 # Tratte più frequenti da preriscaldare
+    warm_days: int = 90                 # Storico di spedizioni considerato
+
+    @classmethod
+    def from_env(cls) -> 'QuoteCacheConfig':
+        """Create configuration from QUOTE_CACHE_* / QUOTE_WARM_* environment variables"""
+        return cls(
+            enabled=os.getenv('QUOTE_CACHE_ENABLED', '1') == '1',
+            postal_prefix=max(0, _int_env('QUOTE_CACHE_POSTAL_PREFIX', 3)),
+            rollover_hour=min(23, max(0, _int_env('QUOTE_CACHE_ROLLOVER_HOUR', 0))),
+            max_entries=max(1, _int_env('QUOTE_CACHE_MAX_ENTRIES', 20000)),
+            shared=os.getenv('QUOTE_CACHE_SHARED', '0') == '1',
+            bracket_pricing=os.getenv('QUOTE_CACHE_BRACKET_PRICING', '0') == '1',
+            warm_hour=min(23, _int_env('QUOTE_WARM_HOUR', 1)),
+            warm_top=max(0, _int_env('QUOTE_WARM_TOP', 100)),
+            warm_days=max(1, _int_env('QUOTE_WARM_DAYS', 90))
+        )
+
+
+# Listini simulati (fallback senza API), usati dai client e da bulk_pricer
+UPS_A65C50_SIMULATED_RATES = {
+    '11': {'name': 'UPS Standard', 'base': 18.50, 'days': '2-3'},
+    '65': {'name': 'UPS Saver', 'base': 23.80, 'days': '1-2'},
+    '08': {'name': 'UPS Worldwide Expedited', 'base': 27.20, 'days': '3-5'},
+    '07': {'name': 'UPS Worldwide Express', 'base': 34.80, 'days': '1-3'}
+}
+UPS_A65C50_SIMULATED_PER_KG = 2.5
+UPS_A65C50_ENVELOPE_DISCOUNT = 0.85     # Buste fino a 1 kg
+
+# Tariffe base per kg senza IVA
+SPEDIAMOPRO_SIMULATED_RATES = {
+    'INPOSTSTD': {'carrier': 'InPost', 'name': 'InPost Point to Point', 'base': 3.87, 'days': '2-4 giorni'},  # InPost reale: 3.87 + IVA = 4.72
+    'BRTPUDO': {'carrier': 'BRT', 'name': 'BRT Fermopoint', 'base': 4.50, 'days': '2-4 giorni'},
+    'BRTDPD': {'carrier': 'BRT', 'name': 'DPD Standard', 'base': 5.20, 'days': '2-3 giorni'},
+    'SDAEXP': {'carrier': 'SDA', 'name': 'SDA Express', 'base': 6.80, 'days': '1-2 giorni'},
+    'BRTEXP': {'carrier': 'BRT', 'name': 'BRT Express', 'base': 7.20, 'days': '1-2 giorni'},
+    'BRTEUEXP': {'carrier': 'BRT', 'name': 'EuroExpress', 'base': 8.50, 'days': '1-2 giorni'},
+    'UPSSTD': {'carrier': 'UPS', 'name': 'UPS Standard', 'base': 9.80, 'days': '2-3 giorni'},
+    'UPSEXPSAVER': {'carrier': 'UPS', 'name': 'UPS Express Saver', 'base': 12.09, 'days': '1-2 giorni'},  # TUA TARIFFA
+    'UPSENVEXPSAVER': {'carrier': 'UPS', 'name': 'UPS Lettere Express Saver', 'base': 12.09, 'days': '1-2 giorni'}
+}
+SPEDIAMOPRO_ENVELOPE_INTL_SERVICE = 'UPSENVEXPSAVER'   # Unico servizio per buste internazionali
+SPEDIAMOPRO_DISTANCE_FACTOR = 1.1      # Città diverse
+SPEDIAMOPRO_WEIGHT_FACTOR = 0.3        # Peso ha meno impatto: max(1, peso * fattore)
+SPEDIAMOPRO_DOCUMENTS_DISCOUNT = 0.78  # Sconto documenti 22%
+SPEDIAMOPRO_VAT = 1.22                 # IVA 22%
+
+
+# Divisore del peso volumetrico (cm3 per kg) per vettore, sovrascrivibile con VOLUMETRIC_DIVISOR_<VETTORE>
+DEFAULT_VOLUMETRIC_DIVISOR = 5000
+DEFAULT_VOLUMETRIC_DIVISORS = {
+    'UPS': 5000,
+    'DHL': 5000,
+    'SPEDIAMOPRO': 5000,
+}
+
+
+def volumetric_divisor(carrier: str = None) -> int:
+    """Divisore del peso volumetrico del vettore (VOLUMETRIC_DIVISOR_<VETTORE>)"""
+    if not carrier:
+        return DEFAULT_VOLUMETRIC_DIVISOR
+    carrier = carrier.upper()
+    default = DEFAULT_VOLUMETRIC_DIVISORS.get(carrier, DEFAULT_VOLUMETRIC_DIVISOR)
+    return max(1, _int_env(f'VOLUMETRIC_DIVISOR_{carrier}', default))
+
+
+# Budget (secondi) delle fasi dei preventivi UPS, sovrascrivibili con QUOTE_BUDGET_<FASE>
+DEFAULT_QUOTE_STAGE_BUDGETS = {
+    'SHIPPING': 15.0,       # Shipping API (breakdown dettagliato)
+    'RATE_ESTIMATE': 25.0,  # Rating + stima di IVA e supplementi
+}
+DEFAULT_QUOTE_STAGE_BUDGET = 10.0
+
+# Le fasi dei preventivi rapidi sono quote della deadline dell'aggregatore
+# (QUOTE_DEADLINE): anche eseguite in serie finiscono prima che la sorgente
+# venga scartata, con un margine per parsing e risposta
+QUOTE_DEADLINE_STAGE_SHARES = {
+    'REST': 0.4,            # Rating API OAuth
+    'XML': 0.35,            # Rating API XML
+    'SIMULATION': 0.15,     # Listino simulato
+}
+
+
+def quote_stage_budgets(deadline: float) -> dict:
+    """Budget di default delle fasi per una deadline dell'aggregatore"""
+    budgets = dict(DEFAULT_QUOTE_STAGE_BUDGETS)
+    for stage, share in QUOTE_DEADLINE_STAGE_SHARES.items():
+        budgets[stage] = round(deadline * share, 3)
+    return budgets
+
+
+@dataclass
+class QuotePolicyConfig:
+    """Configurazione della catena di fallback con richieste hedged dei preventivi"""
+
+    hedging: bool = True            # Avvia la fase successiva in parallelo oltre il percentile di latenza
+    percentile: float = 95.0        # Percentile delle latenze recenti dopo cui partire in parallelo
+    min_hedge_delay: float = 0.25   # Attesa minima prima di una richiesta in parallelo
+    min_samples: int = 20           # Campioni necessari per usare il percentile (prima: il budget)
+    window: int = 200               # Latenze recenti considerate per fase
+    max_workers: int = 24           # Thread del pool di ogni policy (due fasi per chiamata in corso)
+    budgets: dict = field(default_factory=lambda: quote_stage_budgets(8.0))
+
+    def budget(self, stage: str) -> float:
+        """Secondi di attesa massima della fase prima di passare alla successiva"""
+        return self.budgets.get(stage.upper(), DEFAULT_QUOTE_STAGE_BUDGET)
+
+    @classmethod
+    def from_env(cls) -> 'QuotePolicyConfig':
+        """
+        Create configuration from QUOTE_HEDGING, QUOTE_HEDGE_*, QUOTE_BUDGET_<FASE>
+
+        Senza QUOTE_BUDGET_<FASE> i budget di REST, XML e SIMULATION sono
+        ricavati da QUOTE_DEADLINE (QUOTE_DEADLINE_STAGE_SHARES).
+        """
+        defaults = quote_stage_budgets(max(0.1, _float_env('QUOTE_DEADLINE', 8.0)))
+        return cls(
+            hedging=os.getenv('QUOTE_HEDGING', '1') == '1',
+            percentile=min(100.0, max(1.0, _float_env('QUOTE_HEDGE_PERCENTILE', 95.0))),
+            min_hedge_delay=max(0.0, _float_env('QUOTE_HEDGE_MIN_DELAY', 0.25)),
+            min_samples=max(1, _int_env('QUOTE_HEDGE_MIN_SAMPLES', 20)),
+            window=max(1, _int_env('QUOTE_HEDGE_WINDOW', 200)),
+            # Ogni chiamata della sorgente (interattiva o di un batch) ha al più
+            # due fasi di rete in corso insieme (REST e XML hedged)
+            max_workers=max(1, _int_env('QUOTE_POLICY_MAX_WORKERS', 2 * (
+                max(1, _int_env('QUOTE_SOURCE_WORKERS', 8)) + max(1, _int_env('QUOTE_BATCH_CONCURRENCY', 4))))),
+            budgets={stage: max(0.1, _float_env(f'QUOTE_BUDGET_{stage}', default))
+                     for stage, default in defaults.items()}
+        )
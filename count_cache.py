@@ -0,0 +1,152 @@
+"""
+Count Cache - Totali in cache per le liste paginate
+
+`SELECT COUNT(*) FROM spedizioni {where}` serve solo a calcolare il numero di
+pagine, ma su una tabella grande costa una scansione a ogni click. Questo
+modulo tiene in cache i totali per (tabella, filtro normalizzato) per
+COUNT_CACHE_TTL secondi (default 30).
+
+Le scritture su `spedizioni` chiamano invalidate(): la generazione della
+cache è salvata in shared_state, quindi l'invalidazione vale per tutti i
+worker della macchina.
+
+Per le viste senza filtri è disponibile una stima (opt-in) dalle statistiche
+della tabella (information_schema.TABLES.TABLE_ROWS), che non legge righe.
+"""
+
+import os
+import time
+import logging
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import shared_state
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_TTL = 30
+
+_NAMESPACE = 'count_cache'
+_GENERATION_KEY = 'generation'
+# La generazione non deve scadere
+_GENERATION_TTL = 10 * 365 * 24 * 3600
+
+
+def _ttl_from_env() -> int:
+    value = os.getenv('COUNT_CACHE_TTL')
+    if value is None:
+        return DEFAULT_TTL
+    try:
+        return max(0, int(value))
+    except ValueError:
+        LOG.warning("Valore COUNT_CACHE_TTL non valido: %s", value)
+        return DEFAULT_TTL
+
+
+class CountCache:
+    """Cache dei COUNT(*) per filtro, invalidata dalle scritture"""
+
+    def __init__(self, ttl: Optional[int] = None):
+        self.ttl = _ttl_from_env() if ttl is None else ttl
+        self._entries: Dict[Tuple, Tuple[int, float]] = {}
+        self._lock = threading.Lock()
+        self._local_generation = 0
+        self._shared = True
+        self.stats = {'hits': 0, 'misses': 0, 'estimates': 0, 'invalidations': 0}
+
+    def _generation(self) -> int:
+        if self._shared:
+            try:
+                value = shared_state.kv_get(_NAMESPACE, _GENERATION_KEY)
+                return int(value) if value is not None else 0
+            except sqlite3.Error as e:
+                LOG.warning("Count cache: stato condiviso non disponibile (%s), invalidazione solo locale", e)
+                self._shared = False
+        return self._local_generation
+
+    def invalidate(self) -> None:
+        """Da chiamare dopo ogni scrittura su spedizioni"""
+        with self._lock:
+            self._entries.clear()
+            self._local_generation += 1
+            self.stats['invalidations'] += 1
+        if self._shared:
+            try:
+                shared_state.kv_incr(_NAMESPACE, _GENERATION_KEY, _GENERATION_TTL)
+            except sqlite3.Error as e:
+                LOG.warning("Count cache: invalidazione condivisa fallita (%s)", e)
+                self._shared = False
+
+    def count(self, cur, table: str, where_sql: str, params: List[Any]) -> int:
+        """
+        COUNT(*) con cache
+
+        Args:
+            cur: Cursore MySQL aperto
+            table: Tabella (nome fisso, non input utente)
+            where_sql: Clausola WHERE già costruita (stringa vuota se nessun filtro)
+            params: Parametri della clausola WHERE
+        """
+        key = (self._generation(), table, where_sql.strip(), tuple(str(p) for p in params))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.stats['hits'] += 1
+                return entry[0]
+            self.stats['misses'] += 1
+
+        cur.execute(f"SELECT COUNT(*) FROM {table}{where_sql}", params)
+        total = int(cur.fetchone()[0])
+
+        if self.ttl > 0:
+            with self._lock:
+                # Elimina le voci scadute o di generazioni precedenti
+                for old_key in [k for k, v in self._entries.items() if v[1] <= now or k[0] != key[0]]:
+                    del self._entries[old_key]
+                self._entries[key] = (total, now + self.ttl)
+        return total
+
+    def estimate(self, cur, table: str) -> Optional[int]:
+        """Numero di righe stimato dalle statistiche InnoDB (None se non disponibile)"""
+        cur.execute(
+            """SELECT TABLE_ROWS FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s""",
+            (table,)
+        )
+        row = cur.fetchone()
+        if not row or row[0] is None:
+            return None
+        with self._lock:
+            self.stats['estimates'] += 1
+        return int(row[0])
+
+    def get_statistics(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self._entries)
+        stats['ttl'] = self.ttl
+        stats['shared'] = self._shared
+        return stats
+
+
+_cache: Optional[CountCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_count_cache() -> CountCache:
+    """Restituisce la count cache (unica per processo)"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = CountCache()
+        return _cache
+
+
+def invalidate() -> None:
+    """Invalida i totali in cache dopo una scrittura su spedizioni"""
+    try:
+        get_count_cache().invalidate()
+    except Exception:
+        LOG.exception("Errore invalidazione count cache")
@@ -2,13 +2,23 @@
 
 Reads DB credentials from .env and exposes:
  - get_conn(dbname=None) -> mysql.connector connection
- - cursor() context manager yielding a cursor
+ - cursor() context manager yielding a cursor (connections come from a pool)
+ - get_pool_stats() -> metrics of the connection pools of this process
  - test_connection() entrypoint for quick verification
 
+Pool settings (env):
+ - DB_POOL_SIZE: max connections per database (default 10, 0 disables pooling)
+ - DB_POOL_TIMEOUT: seconds to wait for a free connection (default 30)
+ - DB_POOL_RECYCLE: max age in seconds of a pooled connection (default 3600)
+ - DB_POOL_PING_AFTER: idle seconds after which a connection is pinged before reuse (default 30)
+
 Run this file directly to test the connection (it will print DB and MySQL version).
 """
 import os
+import threading
+import time
 import traceback
+from collections import deque
 from contextlib import contextmanager
 
 from dotenv import load_dotenv
@@ -71,9 +81,226 @@ def get_conn(dbname=None):
         raise
 
 
+def _int_env(key: str, default: int) -> int:
+    try:
+        return int(_env((key,), default))
+    except (TypeError, ValueError):
+        return default
+
+
+class _PooledConnection:
+    """A pooled mysql connection plus the timestamps used for health checks."""
+
+    __slots__ = ('conn', 'created_at', 'last_used')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class ConnectionPool:
+    """Thread-safe pool of mysql.connector connections for one database.
+
+    Idle connections are reused LIFO. On checkout a connection older than
+    `recycle` seconds is replaced and one idle for more than `ping_after`
+    seconds is pinged first; on release the open transaction is rolled back so
+    the next user starts from a clean state. Connections that raised a
+    database error are discarded instead of being returned to the pool.
+    """
+
+    def __init__(self, dbname=None, size=10, timeout=30.0, recycle=3600, ping_after=30):
+        self.dbname = dbname
+        self.size = max(1, int(size))
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+
+        self._idle = deque()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+        self.stats = {
+            'created': 0,
+            'reused': 0,
+            'checkouts': 0,
+            'discarded': 0,
+            'recycled': 0,
+            'ping_failures': 0,
+            'timeouts': 0,
+            'in_use': 0,
+            'wait_seconds': 0.0,
+        }
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def acquire(self):
+        """Return a live connection, waiting up to `timeout` seconds for a free slot."""
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            self._count('timeouts')
+            raise RuntimeError(f'DB pool exhausted: no free connection within {self.timeout}s (size={self.size})')
+        self._count('wait_seconds', time.monotonic() - start)
+
+        try:
+            pooled = self._checkout_idle()
+            if pooled is None:
+                pooled = _PooledConnection(get_conn(self.dbname))
+                self._count('created')
+            else:
+                self._count('reused')
+        except BaseException:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self.stats['checkouts'] += 1
+            self.stats['in_use'] += 1
+        return pooled
+
+    def _checkout_idle(self):
+        """Pop idle connections until a healthy one is found (None if pool is empty)."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                pooled = self._idle.pop()
+
+            now = time.monotonic()
+            if self.recycle and now - pooled.created_at > self.recycle:
+                self._count('recycled')
+                self._close(pooled)
+                continue
+            if now - pooled.last_used > self.ping_after:
+                try:
+                    pooled.conn.ping(reconnect=False)
+                except Exception:
+                    self._count('ping_failures')
+                    self._close(pooled)
+                    continue
+            return pooled
+
+    def release(self, pooled, discard=False):
+        """Give a connection back to the pool (or close it when `discard` is set)."""
+        try:
+            if not discard:
+                try:
+                    pooled.conn.rollback()
+                except Exception:
+                    discard = True
+            if discard:
+                self._count('discarded')
+                self._close(pooled)
+            else:
+                pooled.last_used = time.monotonic()
+                with self._lock:
+                    self._idle.append(pooled)
+        finally:
+            with self._lock:
+                self.stats['in_use'] -= 1
+            self._slots.release()
+
+    @staticmethod
+    def _close(pooled):
+        try:
+            pooled.conn.close()
+        except Exception:
+            pass
+
+    def close_all(self):
+        """Close all idle connections (connections in use are closed on release)."""
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for pooled in idle:
+            self._close(pooled)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['idle'] = len(self._idle)
+        stats['size'] = self.size
+        stats['wait_seconds'] = round(stats['wait_seconds'], 3)
+        return stats
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(dbname=None):
+    """Return the pool for `dbname` in this process, or None if pooling is disabled.
+
+    Pools are keyed by pid so that forked workers never share sockets.
+    """
+    size = _int_env('DB_POOL_SIZE', 10)
+    if size <= 0:
+        return None
+    key = (dbname or _env(('DB_NAME', 'DB_DATABASE')), os.getpid())
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(
+                dbname,
+                size=size,
+                timeout=_int_env('DB_POOL_TIMEOUT', 30),
+                recycle=_int_env('DB_POOL_RECYCLE', 3600),
+                ping_after=_int_env('DB_POOL_PING_AFTER', 30),
+            )
+            _pools[key] = pool
+        return pool
+
+
+def get_pool_stats():
+    """Return {database: stats} for the pools created in this process."""
+    pid = os.getpid()
+    with _pools_lock:
+        pools = [(key[0], pool) for key, pool in _pools.items() if key[1] == pid]
+    return {str(name): pool.get_stats() for name, pool in pools}
+
+
+def _is_connection_error(exc):
+    """True for mysql errors after which the connection should not be reused."""
+    mysql = _get_mysql_module()
+    if mysql is None:
+        return False
+    return isinstance(exc, (mysql.errors.InterfaceError, mysql.errors.OperationalError))
+
+
 @contextmanager
 def cursor(dbname=None):
-    """Context manager yielding (conn, cur). Ensures close in finally."""
+    """Context manager yielding (conn, cur).
+
+    The connection is taken from the process pool and given back on exit
+    (uncommitted changes are rolled back). With DB_POOL_SIZE=0 a new
+    connection is opened and closed as before.
+    """
+    pool = get_pool(dbname)
+    if pool is None:
+        with _unpooled_cursor(dbname) as conn_cur:
+            yield conn_cur
+        return
+
+    pooled = pool.acquire()
+    cur = None
+    discard = False
+    try:
+        cur = pooled.conn.cursor()
+        yield pooled.conn, cur
+    except Exception as e:
+        discard = _is_connection_error(e)
+        raise
+    finally:
+        try:
+            if cur:
+                cur.close()
+        except Exception:
+            discard = True
+        pool.release(pooled, discard=discard)
+
+
+@contextmanager
+def _unpooled_cursor(dbname=None):
     conn = None
     cur = None
     try:
@@ -9,6 +9,7 @@ from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 from dataclasses import dataclass
 from config import DHLConfig
+from dim_weight import normalize_packages, summarize
 
 
 @dataclass
@@ -29,12 +30,16 @@ class ShipmentQuoteRequest:
     shipment_date: str = None  # Format: DD-MM-YYYY
     is_dutiable: bool = False  # True per merce, False per documenti
     pieces: int = 1  # Numero di colli
+    packages: Optional[List[Dict]] = None  # Colli con peso e dimensioni propri (sostituisce pieces)
     
     def __post_init__(self):
         if self.shipment_date is None:
             # Default to tomorrow in YYYY-MM-DD format (DHL standard)
             tomorrow = datetime.now() + timedelta(days=1)
             self.shipment_date = tomorrow.strftime("%Y-%m-%d")
+        if self.packages:
+            self.packages = normalize_packages(self.packages)
+            self.pieces = len(self.packages)
 
 
 class DHLQuoteClient:
@@ -92,7 +97,10 @@ class DHLQuoteClient:
                 print("=" * 80)
             
             # Parse response
-            return self._parse_quote_response(response.text)
+            result = self._parse_quote_response(response.text)
+            if quote_request.packages and 'error' not in result:
+                result['packages_info'] = summarize(quote_request.packages, 'DHL')
+            return result
             
         except requests.exceptions.RequestException as e:
             return {
@@ -115,16 +123,22 @@ class DHLQuoteClient:
         Returns:
             String XML per la richiesta preventivo
         """
-        # Generate pieces XML based on number of pieces
+        # Un Piece per collo; senza `packages` colli identici con il peso diviso in parti uguali
+        packages = quote_request.packages or [{
+            'weight_kg': quote_request.weight_kg / quote_request.pieces,
+            'length_cm': quote_request.length_cm,
+            'width_cm': quote_request.width_cm,
+            'height_cm': quote_request.height_cm,
+        }] * quote_request.pieces
         pieces_xml = ""
-        for i in range(quote_request.pieces):
+        for i, package in enumerate(packages):
             pieces_xml += f"""
                 <Piece>
                     <PieceID>{i + 1}</PieceID>
-                    <Height>{quote_request.height_cm}</Height>
-                    <Depth>{quote_request.length_cm}</Depth>
-                    <Width>{quote_request.width_cm}</Width>
-                    <Weight>{quote_request.weight_kg / quote_request.pieces:.2f}</Weight>
+                    <Height>{package['height_cm']:g}</Height>
+                    <Depth>{package['length_cm']:g}</Depth>
+                    <Width>{package['width_cm']:g}</Width>
+                    <Weight>{package['weight_kg']:.2f}</Weight>
                 </Piece>"""
 
         xml_template = f"""<?xml version="1.0" encoding="UTF-8"?>
@@ -214,6 +228,7 @@ class DHLQuoteClient:
                 shipping_charge = self._get_text_safe(quote, "ShippingCharge", "0")
                 weight_charge = self._get_text_safe(quote, "WeightCharge", "0")
                 weight_charge_tax = self._get_text_safe(quote, "WeightChargeTax", "0")
+                total_tax = self._get_text_safe(quote, "TotalTaxAmount", weight_charge_tax)
                 
                 # Calculate total price
                 total_price = float(shipping_charge) if shipping_charge else 0.0
@@ -243,7 +258,8 @@ class DHLQuoteClient:
                     'total_price': f"{total_price:.2f}€",
                     'currency': currency,
                     'delivery_info': delivery_info,
-                    'raw_price': total_price
+                    'raw_price': total_price,
+                    'tax_amount': float(total_tax or 0)
                 })
             
             # Sort by price
@@ -3,53 +3,50 @@ DHL Tracking API Client - SOLO per tracking AWB
 """
 
 import ssl
+import asyncio
 import xml.etree.ElementTree as ET
 from datetime import datetime
-from typing import Dict
+from typing import Dict, List
 
 import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util import Retry
 
 from config import DHLConfig
+import http_transport
+from http_transport import HttpRequest
+from rate_limiter import get_limiter
+from tracking_cache import cached_tracking, cached_tracking_async, get_cache
 
+USER_AGENT = "DHLTrackingClient/2026 (+https://example.local)"
 
-class _TLS12HttpAdapter(HTTPAdapter):
-    """HTTPAdapter che forza l'uso di TLS 1.2 e accetta cipher legacy DHL."""
 
-    def __init__(self, *args, **kwargs):
-        self._ssl_context = self._build_ssl_context()
-        super().__init__(*args, **kwargs)
+def _build_ssl_context() -> ssl.SSLContext:
+    """SSL context DHL: TLS >= 1.2 con cipher legacy"""
+    ctx = ssl.create_default_context()
+    # Assicura TLS >= 1.2 (alcuni endpoint DHL rifiutano negoziazioni diverse)
+    if hasattr(ctx, "minimum_version"):
+        ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+    else:  # fallback per vecchie versioni Python
+        ctx.options |= getattr(ssl, "OP_NO_TLSv1", 0)
+        ctx.options |= getattr(ssl, "OP_NO_TLSv1_1", 0)
+    # Alcuni cluster DHL richiedono cipher legacy -> abbassiamo SECLEVEL
+    try:
+        ctx.set_ciphers("DEFAULT:@SECLEVEL=1")
+    except ssl.SSLError:
+        # se l'installazione OpenSSL non supporta la direttiva, ignoriamo
+        pass
+    return ctx
 
-    @staticmethod
-    def _build_ssl_context() -> ssl.SSLContext:
-        ctx = ssl.create_default_context()
-        # Assicura TLS >= 1.2 (alcuni endpoint DHL rifiutano negoziazioni diverse)
-        if hasattr(ctx, "minimum_version"):
-            ctx.minimum_version = ssl.TLSVersion.TLSv1_2
-        else:  # fallback per vecchie versioni Python
-            ctx.options |= getattr(ssl, "OP_NO_TLSv1", 0)
-            ctx.options |= getattr(ssl, "OP_NO_TLSv1_1", 0)
-        # Alcuni cluster DHL richiedono cipher legacy -> abbassiamo SECLEVEL
-        try:
-            ctx.set_ciphers("DEFAULT:@SECLEVEL=1")
-        except ssl.SSLError:
-            # se l'installazione OpenSSL non supporta la direttiva, ignoriamo
-            pass
-        return ctx
-
-    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
-        pool_kwargs["ssl_context"] = self._ssl_context
-        return super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
 
-    def proxy_manager_for(self, proxy, **proxy_kwargs):
-        proxy_kwargs["ssl_context"] = self._ssl_context
-        return super().proxy_manager_for(proxy, **proxy_kwargs)
+# La sessione DHL del registro (sync) e le sessioni async usano questo context
+http_transport.register_ssl_context('DHL', _build_ssl_context())
 
 
 class DHLTrackingClient:
     """Client DHL per tracking spedizioni"""
     
+    # Numero massimo di AWBNumber accettati in una KnownTrackingRequest XML-PI
+    MAX_AWB_PER_REQUEST = 10
+    
     def __init__(self, config=None):
         """Inizializza client tracking"""
         if config is None:
@@ -60,22 +57,12 @@ class DHLTrackingClient:
         self.debug = getattr(config, 'debug', False)
         self.timeout = getattr(config, 'timeout', 30)
         self.max_retries = getattr(config, 'max_retries', 3)
-
-        retry_strategy = Retry(
-            total=self.max_retries,
-            backoff_factor=0.7,
-            status_forcelist=[500, 502, 503, 504],
-            allowed_methods=["POST"]
-        )
-        self.session = requests.Session()
-        adapter = _TLS12HttpAdapter(max_retries=retry_strategy)
-        self.session.mount("https://", adapter)
-        self.session.mount("http://", adapter)
-        self.session.headers.update({
-            "User-Agent": "DHLTrackingClient/2026 (+https://example.local)",
-            "Connection": "close",
-        })
+        self.rate_limiter = get_limiter('DHL')
+        # Sessione keep-alive condivisa (TLS 1.2 + cipher legacy); i retry sui
+        # 5xx secondo HTTP_RETRIES_DHL sono applicati da http_transport.run
+        self.session = http_transport.get_session('DHL')
     
+    @cached_tracking('DHL')
     def track_shipment(self, awb_number: str) -> Dict:
         """
         Traccia una spedizione DHL
@@ -86,9 +73,55 @@ class DHLTrackingClient:
         Returns:
             Dict con informazioni tracking o errore
         """
+        return self._track_chunk([awb_number])[awb_number]
+    
+    @cached_tracking_async('DHL')
+    async def track_shipment_async(self, awb_number: str) -> Dict:
+        """Variante asyncio di track_shipment()"""
+        return (await http_transport.run_async(self._track_chunk_flow([awb_number])))[awb_number]
+    
+    def track_many(self, awb_numbers: List[str]) -> Dict[str, Dict]:
+        """
+        Traccia più spedizioni DHL con una richiesta ogni MAX_AWB_PER_REQUEST AWB
+        
+        Args:
+            awb_numbers: Lista di AWB da tracciare (i duplicati vengono ignorati)
+            
+        Returns:
+            Dict AWB -> risultato (stesso formato di track_shipment)
+        """
+        unique_awbs = list(dict.fromkeys(awb for awb in awb_numbers if awb))
+        cache = get_cache()
+        results = cache.get_many('DHL', unique_awbs)
+        missing = [awb for awb in unique_awbs if awb not in results]
+        for i in range(0, len(missing), self.MAX_AWB_PER_REQUEST):
+            chunk_results = self._track_chunk(missing[i:i + self.MAX_AWB_PER_REQUEST])
+            cache.set_many('DHL', chunk_results)
+            results.update(chunk_results)
+        return results
+    
+    async def track_many_async(self, awb_numbers: List[str]) -> Dict[str, Dict]:
+        """Variante asyncio di track_many(): i gruppi di AWB sono richiesti in parallelo"""
+        unique_awbs = list(dict.fromkeys(awb for awb in awb_numbers if awb))
+        cache = get_cache()
+        results = cache.get_many('DHL', unique_awbs)
+        missing = [awb for awb in unique_awbs if awb not in results]
+        chunks = [missing[i:i + self.MAX_AWB_PER_REQUEST] for i in range(0, len(missing), self.MAX_AWB_PER_REQUEST)]
+        for chunk_results in await asyncio.gather(*(http_transport.run_async(self._track_chunk_flow(chunk))
+                                                    for chunk in chunks)):
+            cache.set_many('DHL', chunk_results)
+            results.update(chunk_results)
+        return results
+    
+    def _track_chunk(self, awb_numbers: List[str]) -> Dict[str, Dict]:
+        """Invia una singola KnownTrackingRequest per un gruppo di AWB"""
+        return http_transport.run(self._track_chunk_flow(awb_numbers))
+    
+    def _track_chunk_flow(self, awb_numbers: List[str]):
+        """Flow di _track_chunk (vedi http_transport)"""
         try:
             # Create XML request
-            xml_request = self._create_tracking_xml(awb_number)
+            xml_request = self._create_tracking_xml(awb_numbers)
             
             # Debug: mostra richiesta XML se abilitato
             if self.debug:
@@ -101,15 +134,16 @@ class DHLTrackingClient:
             headers = {
                 'Content-Type': 'application/xml',
                 'Accept': 'application/xml',
-                'Connection': 'close',
+                'User-Agent': USER_AGENT,
             }
             
-            # Make API request
-            response = self.session.post(
-                self.base_url,
+            # Make API request (il trasporto rispetta il rate limit condiviso DHL)
+            response = yield HttpRequest(
+                'DHL', 'POST', self.base_url,
                 data=xml_request.encode('utf-8'),
                 headers=headers,
-                timeout=self.timeout
+                timeout=self.timeout,
+                idempotent=True  # Interrogazione: il trasporto può ripeterla
             )
             
             # Debug: mostra risposta XML se abilitato
@@ -120,27 +154,25 @@ class DHLTrackingClient:
                 print("=" * 50)
             
             if response.status_code == 200:
-                return self._parse_tracking_response(response.text, awb_number)
+                return self._parse_tracking_response_many(response.text, awb_numbers)
             else:
-                return {
-                    'error': f'HTTP {response.status_code}',
-                    'tracking_number': awb_number
-                }
+                return self._error_results(awb_numbers, f'HTTP {response.status_code}')
                 
         except requests.exceptions.RequestException as exc:
-            return {
-                'error': f'Connessione DHL fallita: {exc}',
-                'tracking_number': awb_number
-            }
+            return self._error_results(awb_numbers, f'Connessione DHL fallita: {exc}')
         except Exception as e:
-            return {
-                'error': str(e),
-                'tracking_number': awb_number
-            }
+            return self._error_results(awb_numbers, str(e))
+    
+    def _error_results(self, awb_numbers: List[str], error: str) -> Dict[str, Dict]:
+        """Stesso errore per tutti gli AWB di una richiesta"""
+        return {awb: {'error': error, 'tracking_number': awb} for awb in awb_numbers}
     
-    def _create_tracking_xml(self, awb_number: str) -> str:
-        """Crea XML per richiesta tracking"""
+    def _create_tracking_xml(self, awb_numbers) -> str:
+        """Crea XML per richiesta tracking (uno o più AWB)"""
+        if isinstance(awb_numbers, str):
+            awb_numbers = [awb_numbers]
         message_time = datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + '+01:00'
+        awb_elements = "\n".join(f"    <AWBNumber>{awb}</AWBNumber>" for awb in awb_numbers)
         
         return f'''<?xml version="1.0" encoding="UTF-8"?>
 <req:KnownTrackingRequest xmlns:req="http://www.dhl.com" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.dhl.com track-req.xsd">
@@ -153,12 +185,16 @@ class DHLTrackingClient:
         </ServiceHeader>
     </Request>
     <LanguageCode>en</LanguageCode>
-    <AWBNumber>{awb_number}</AWBNumber>
+{awb_elements}
     <LevelOfDetails>ALL_CHECK_POINTS</LevelOfDetails>
 </req:KnownTrackingRequest>'''
     
     def _parse_tracking_response(self, xml_response: str, awb_number: str) -> Dict:
         """Parse risposta XML tracking"""
+        return self._parse_tracking_response_many(xml_response, [awb_number])[awb_number]
+    
+    def _parse_tracking_response_many(self, xml_response: str, awb_numbers: List[str]) -> Dict[str, Dict]:
+        """Parse risposta XML tracking e suddivide i blocchi AWBInfo per AWB"""
         try:
             root = ET.fromstring(xml_response)
             
@@ -168,107 +204,134 @@ class DHLTrackingClient:
                 if '}' in elem.tag:
                     elem.tag = elem.tag.split('}')[1]
             
-            # Controlla errori
-            error_elements = root.findall('.//Condition')
-            if error_elements:
-                error_code = error_elements[0].find('.//ConditionCode')
-                error_data = error_elements[0].find('.//ConditionData')
-                
-                error_code_text = error_code.text if error_code is not None else 'Unknown'
-                error_data_text = error_data.text if error_data is not None else 'No details'
-                
-                return {
-                    'error': f'DHL Error: {error_code_text}: {error_data_text}',
-                    'tracking_number': awb_number
-                }
+            awb_infos = root.findall('.//AWBInfo')
+            if not awb_infos:
+                # Errore a livello di richiesta (es. credenziali): vale per tutti gli AWB
+                error = self._condition_error(root) or 'DHL Error: nessun AWBInfo nella risposta'
+                return self._error_results(awb_numbers, error)
+            
+            # Gli AWB nella risposta possono avere spazi diversi da quelli richiesti
+            requested = {awb.strip(): awb for awb in awb_numbers}
+            results = {}
+            for awb_info in awb_infos:
+                number_elem = awb_info.find('AWBNumber')
+                number = (number_elem.text or '').strip() if number_elem is not None else ''
+                if not number and len(awb_numbers) == 1:
+                    number = awb_numbers[0].strip()
+                awb = requested.get(number)
+                if awb is not None:
+                    results[awb] = self._parse_awb_info(awb_info, awb)
             
-            # Estrai informazioni tracking
-            result = {
-                'tracking_number': awb_number,
-                'status_description': 'Unknown',
-                'events': [],
-                'origin': {},
-                'destination': {}
+            for awb in awb_numbers:
+                if awb not in results:
+                    results[awb] = {
+                        'error': 'DHL Error: AWB non presente nella risposta',
+                        'tracking_number': awb
+                    }
+            return results
+            
+        except Exception as e:
+            return self._error_results(awb_numbers, f'Parse error: {str(e)}')
+    
+    def _condition_error(self, element) -> str:
+        """Restituisce il messaggio della prima Condition sotto element (o '' se assente)"""
+        error_elements = element.findall('.//Condition')
+        if not error_elements:
+            return ''
+        error_code = error_elements[0].find('.//ConditionCode')
+        error_data = error_elements[0].find('.//ConditionData')
+        
+        error_code_text = error_code.text if error_code is not None else 'Unknown'
+        error_data_text = error_data.text if error_data is not None else 'No details'
+        return f'DHL Error: {error_code_text}: {error_data_text}'
+    
+    def _parse_awb_info(self, awb_info, awb_number: str) -> Dict:
+        """Estrae status, origine/destinazione ed eventi da un blocco AWBInfo"""
+        # Controlla errori (es. AWB non trovato)
+        error = self._condition_error(awb_info)
+        if error:
+            return {
+                'error': error,
+                'tracking_number': awb_number
             }
+        
+        # Estrai informazioni tracking
+        result = {
+            'tracking_number': awb_number,
+            'status_description': 'Unknown',
+            'events': [],
+            'origin': {},
+            'destination': {}
+        }
+        
+        # Status
+        status_elem = awb_info.find('.//ActionStatus')
+        if status_elem is not None:
+            result['status_description'] = status_elem.text
+        
+        # Shipment info
+        shipment_info = awb_info.find('.//ShipmentInfo')
+        if shipment_info is not None:
+            
+            # Origin
+            origin_elem = shipment_info.find('.//OriginServiceArea')
+            if origin_elem is not None:
+                origin_desc = origin_elem.find('.//Description')
+                if origin_desc is not None:
+                    result['origin']['description'] = origin_desc.text
+            
+            # Destination
+            dest_elem = shipment_info.find('.//DestinationServiceArea')
+            if dest_elem is not None:
+                dest_desc = dest_elem.find('.//Description')
+                if dest_desc is not None:
+                    result['destination']['description'] = dest_desc.text
+        
+            # Eventi
+            events = []
+            shipment_events = shipment_info.findall('.//ShipmentEvent')
             
-            # Trova AWBInfo
-            awb_info = root.find('.//AWBInfo')
-            if awb_info is not None:
+            for event in shipment_events:
+                event_data = {}
                 
-                # Status
-                status_elem = awb_info.find('.//ActionStatus')
-                if status_elem is not None:
-                    result['status_description'] = status_elem.text
+                date_elem = event.find('.//Date')
+                time_elem = event.find('.//Time')
                 
-                # Shipment info
-                shipment_info = awb_info.find('.//ShipmentInfo')
-                if shipment_info is not None:
-                    
-                    # Origin
-                    origin_elem = shipment_info.find('.//OriginServiceArea')
-                    if origin_elem is not None:
-                        origin_desc = origin_elem.find('.//Description')
-                        if origin_desc is not None:
-                            result['origin']['description'] = origin_desc.text
-                    
-                    # Destination
-                    dest_elem = shipment_info.find('.//DestinationServiceArea')
-                    if dest_elem is not None:
-                        dest_desc = dest_elem.find('.//Description')
-                        if dest_desc is not None:
-                            result['destination']['description'] = dest_desc.text
+                if date_elem is not None:
+                    event_data['date'] = date_elem.text
+                if time_elem is not None:
+                    event_data['time'] = time_elem.text
                 
-                    # Eventi
-                    events = []
-                    shipment_events = shipment_info.findall('.//ShipmentEvent')
-                    
-                    for event in shipment_events:
-                        event_data = {}
-                        
-                        date_elem = event.find('.//Date')
-                        time_elem = event.find('.//Time')
-                        
-                        if date_elem is not None:
-                            event_data['date'] = date_elem.text
-                        if time_elem is not None:
-                            event_data['time'] = time_elem.text
-                        
-                        # Location
-                        location_elem = event.find('.//ServiceArea')
-                        if location_elem is not None:
-                            desc_elem = location_elem.find('.//Description')
-                            if desc_elem is not None:
-                                event_data['location'] = desc_elem.text
-                        
-                        # Description (dal ServiceEvent)
-                        service_event = event.find('.//ServiceEvent')
-                        if service_event is not None:
-                            desc_elem = service_event.find('.//Description')
-                            if desc_elem is not None:
-                                event_data['description'] = desc_elem.text
-                            
-                            # Event code
-                            code_elem = service_event.find('.//EventCode')
-                            if code_elem is not None:
-                                event_data['event_code'] = code_elem.text
-                        
-                        events.append(event_data)
-                    
-                    result['events'] = events
+                # Location
+                location_elem = event.find('.//ServiceArea')
+                if location_elem is not None:
+                    desc_elem = location_elem.find('.//Description')
+                    if desc_elem is not None:
+                        event_data['location'] = desc_elem.text
+                
+                # Description (dal ServiceEvent)
+                service_event = event.find('.//ServiceEvent')
+                if service_event is not None:
+                    desc_elem = service_event.find('.//Description')
+                    if desc_elem is not None:
+                        event_data['description'] = desc_elem.text
                     
-                    # Trova l'ultimo evento per lo status attuale
-                    if events:
-                        last_event = events[-1]
-                        if last_event.get('description'):
-                            result['status_description'] = last_event['description']
+                    # Event code
+                    code_elem = service_event.find('.//EventCode')
+                    if code_elem is not None:
+                        event_data['event_code'] = code_elem.text
+                
+                events.append(event_data)
             
-            return result
+            result['events'] = events
             
-        except Exception as e:
-            return {
-                'error': f'Parse error: {str(e)}',
-                'tracking_number': awb_number
-            }
+            # Trova l'ultimo evento per lo status attuale
+            if events:
+                last_event = events[-1]
+                if last_event.get('description'):
+                    result['status_description'] = last_event['description']
+        
+        return result
 
 
 if __name__ == "__main__":
@@ -277,9 +340,10 @@ if __name__ == "__main__":
     awb_list = get_awb_in_transit('DHL')
     print(f"Trovati {len(awb_list)} AWB in transito.")
     client = DHLTrackingClient()
+    results = client.track_many(awb_list)
     for i, awb in enumerate(awb_list, 1):
         print(f"\n--- {i}/{len(awb_list)} AWB: {awb} ---")
-        result = client.track_shipment(awb)
+        result = results[awb]
         if 'error' in result:
             status = f"ERRORE: {result['error']}"
             print(f"❌ Errore: {result['error']}")
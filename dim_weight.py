@@ -0,0 +1,112 @@
+"""
+Dim Weight - Peso volumetrico, tassabile e di fatturazione dei colli
+
+Calcolo unico usato dai client UPS, DHL e SpediamoPro, dalla cache dei
+preventivi e da bulk_pricer:
+ - peso volumetrico = L x P x H (cm) / divisore del vettore
+   (VOLUMETRIC_DIVISOR_<VETTORE>, default 5000)
+ - peso tassabile di un collo = max(peso reale, volumetrico); per le buste
+   solo il peso reale
+ - peso di fatturazione = somma dei pesi tassabili dei colli arrotondati
+   per eccesso al mezzo chilo (come UPS e DHL)
+
+I client usano nomi diversi per i colli (weight_kg/weight, length_cm/length,
+...): normalize_packages li porta tutti allo stesso formato.
+
+Uso:
+    packages = normalize_packages(packages)
+    info = summarize(packages, 'UPS')
+    info['billing_weight_kg']
+"""
+
+import math
+from typing import Any, Dict, Iterable, List, Optional
+
+from config import volumetric_divisor
+
+# Arrotondamento del peso di fatturazione (kg)
+BILLING_STEP = 0.5
+
+# Dimensioni standard di una busta (formato C4/A4)
+ENVELOPE_SIZE = {'length_cm': 25.0, 'width_cm': 35.0, 'height_cm': 1.0}
+
+_DEFAULT_SIZE = {'length_cm': 30.0, 'width_cm': 20.0, 'height_cm': 15.0}
+
+
+def round_up(weight: float, step: float = BILLING_STEP) -> float:
+    """Arrotonda per eccesso al passo (round() evita che 2.0000001 passi al passo successivo)"""
+    return round(math.ceil(round(weight / step, 6)) * step, 3)
+
+
+def volumetric_weight(length_cm: float, width_cm: float, height_cm: float,
+                      divisor: Optional[int] = None) -> float:
+    """Peso volumetrico in kg"""
+    return length_cm * width_cm * height_cm / (divisor or volumetric_divisor())
+
+
+def chargeable_weight(weight_kg: float, length_cm: float, width_cm: float, height_cm: float,
+                      is_envelope: bool = False, divisor: Optional[int] = None) -> float:
+    """Peso tassabile di un collo: il maggiore tra reale e volumetrico (buste: il reale)"""
+    if is_envelope:
+        return weight_kg
+    return max(weight_kg, volumetric_weight(length_cm, width_cm, height_cm, divisor))
+
+
+def _number(package: Dict[str, Any], *names: str, default: Optional[float] = None) -> Optional[float]:
+    for name in names:
+        value = package.get(name)
+        if value not in (None, ''):
+            return float(value)
+    return default
+
+
+def normalize_packages(packages: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Colli nel formato comune {weight_kg, length_cm, width_cm, height_cm, is_envelope, value}
+
+    Accetta anche weight/length/width/height (SpediamoPro); dimensioni
+    mancanti: 30x20x15 per i pacchi, ENVELOPE_SIZE per le buste.
+
+    Raises:
+        ValueError: Se un collo non ha un peso maggiore di 0
+    """
+    result = []
+    for package in packages:
+        is_envelope = bool(package.get('is_envelope', False))
+        defaults = ENVELOPE_SIZE if is_envelope else _DEFAULT_SIZE
+        weight = _number(package, 'weight_kg', 'weight', default=0.0)
+        if weight <= 0:
+            raise ValueError("Il peso di ogni collo deve essere maggiore di 0")
+        result.append({
+            'weight_kg': weight,
+            'length_cm': _number(package, 'length_cm', 'length', default=defaults['length_cm']),
+            'width_cm': _number(package, 'width_cm', 'width', default=defaults['width_cm']),
+            'height_cm': _number(package, 'height_cm', 'height', default=defaults['height_cm']),
+            'is_envelope': is_envelope,
+            'value': _number(package, 'value', default=0.0),
+        })
+    return result
+
+
+def summarize(packages: List[Dict[str, Any]], carrier: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Pesi della spedizione (colli già normalizzati)
+
+    Returns:
+        Dict con num_packages, total_weight_kg (reale), volumetric_weight_kg,
+        chargeable_weight_kg (somma dei tassabili), billing_weight_kg
+        (tassabili arrotondati al mezzo chilo), is_envelope, is_multi_package
+    """
+    divisor = volumetric_divisor(carrier)
+    volumetric = [0.0 if p['is_envelope'] else
+                  volumetric_weight(p['length_cm'], p['width_cm'], p['height_cm'], divisor) for p in packages]
+    chargeable = [max(p['weight_kg'], v) for p, v in zip(packages, volumetric)]
+    return {
+        'num_packages': len(packages),
+        'total_weight_kg': round(sum(p['weight_kg'] for p in packages), 3),
+        'volumetric_weight_kg': round(sum(volumetric), 3),
+        'chargeable_weight_kg': round(sum(chargeable), 3),
+        'billing_weight_kg': round(sum(round_up(w) for w in chargeable), 3),
+        'is_envelope': bool(packages) and all(p['is_envelope'] for p in packages),
+        'is_multi_package': len(packages) > 1,
+    }
@@ -0,0 +1,188 @@
+"""
+Endpoint Health - Scelta dell'endpoint funzionante tra più alternative
+
+Alcuni vettori (TNT) espongono lo stesso servizio su più URL e non è noto a
+priori quale risponde. Il registro ricorda per processo l'ultimo endpoint
+che ha risposto correttamente e lo usa da solo finché funziona: a regime
+una richiesta per AWB invece di un tentativo per ogni URL.
+
+Le alternative vengono riprovate solo:
+ - quando l'endpoint preferito fallisce (errore di rete, status o risposta
+   non valida)
+ - dopo ENDPOINT_TTL secondi dalla scelta, ripartendo dall'ordine configurato
+   (così un endpoint prioritario tornato disponibile viene ripreso)
+
+Un endpoint fallito viene saltato per `cooldown` secondi (salvo che siano
+falliti tutti). Per ogni endpoint sono tenute latenza ed errori.
+
+Uso:
+    registry = get_registry('TNT', endpoints)
+    for endpoint in registry.candidates():
+        start = time.monotonic()
+        ...
+        registry.record_success(endpoint, time.monotonic() - start)  # oppure record_failure()
+"""
+
+import time
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_TTL = 1800
+DEFAULT_COOLDOWN = 300
+
+
+class _EndpointStats:
+    """Contatori di un endpoint"""
+
+    __slots__ = ('requests', 'successes', 'errors', 'consecutive_errors', 'total_latency',
+                 'last_latency', 'last_error', 'last_success_at', 'last_error_at', 'down_until')
+
+    def __init__(self):
+        self.requests = 0
+        self.successes = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.total_latency = 0.0
+        self.last_latency: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.last_success_at: Optional[float] = None
+        self.last_error_at: Optional[float] = None
+        self.down_until = 0.0
+
+    def to_dict(self, now: float) -> Dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'successes': self.successes,
+            'errors': self.errors,
+            'consecutive_errors': self.consecutive_errors,
+            'avg_latency_ms': round(self.total_latency / self.successes * 1000, 1) if self.successes else None,
+            'last_latency_ms': round(self.last_latency * 1000, 1) if self.last_latency is not None else None,
+            'last_error': self.last_error,
+            'seconds_since_success': round(time.time() - self.last_success_at) if self.last_success_at else None,
+            'seconds_since_error': round(time.time() - self.last_error_at) if self.last_error_at else None,
+            'cooldown_remaining': max(0, round(self.down_until - now)),
+        }
+
+
+class EndpointRegistry:
+    """Endpoint preferito e stato di salute delle alternative di un servizio"""
+
+    def __init__(self, name: str, endpoints: Sequence[str], ttl: float = DEFAULT_TTL,
+                 cooldown: float = DEFAULT_COOLDOWN):
+        """
+        Args:
+            name: Nome del servizio (per log e statistiche)
+            endpoints: URL in ordine di priorità
+            ttl: Secondi dopo cui l'endpoint preferito viene riverificato
+            cooldown: Secondi per cui un endpoint fallito viene saltato
+        """
+        if not endpoints:
+            raise ValueError(f"Nessun endpoint configurato per {name}")
+        self.name = name
+        self.endpoints = tuple(dict.fromkeys(endpoints))
+        self.ttl = ttl
+        self.cooldown = cooldown
+        self._stats = {endpoint: _EndpointStats() for endpoint in self.endpoints}
+        self._preferred: Optional[str] = None
+        self._preferred_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def preferred(self) -> Optional[str]:
+        """Endpoint attualmente in uso (None se da scoprire)"""
+        with self._lock:
+            return self._preferred
+
+    def candidates(self) -> List[str]:
+        """
+        Endpoint da provare in ordine
+
+        Returns:
+            Il preferito seguito dalle alternative non in cooldown; scaduto il
+            TTL (o senza preferito) l'ordine configurato
+        """
+        now = time.monotonic()
+        with self._lock:
+            available = [e for e in self.endpoints if self._stats[e].down_until <= now]
+            if not available:
+                # Tutti falliti di recente: meglio riprovarli che rinunciare
+                available = list(self.endpoints)
+            preferred = self._preferred if now < self._preferred_until else None
+        if preferred is None:
+            return available
+        return [preferred] + [e for e in available if e != preferred]
+
+    def record_success(self, endpoint: str, latency: float) -> None:
+        """Registra una risposta valida: l'endpoint diventa il preferito"""
+        now = time.monotonic()
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                return
+            stats.requests += 1
+            stats.successes += 1
+            stats.consecutive_errors = 0
+            stats.total_latency += latency
+            stats.last_latency = latency
+            stats.last_success_at = time.time()
+            stats.down_until = 0.0
+            changed = endpoint != self._preferred
+            if changed or now >= self._preferred_until:
+                self._preferred = endpoint
+                self._preferred_until = now + self.ttl
+        if changed:
+            LOG.info("✅ %s: endpoint in uso %s", self.name, endpoint)
+
+    def record_failure(self, endpoint: str, error: str) -> None:
+        """Registra un errore: l'endpoint va in cooldown e, se era il preferito, viene abbandonato"""
+        now = time.monotonic()
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                return
+            stats.requests += 1
+            stats.errors += 1
+            stats.consecutive_errors += 1
+            stats.last_error = error
+            stats.last_error_at = time.time()
+            stats.down_until = now + self.cooldown
+            if endpoint == self._preferred:
+                self._preferred = None
+                self._preferred_until = 0.0
+        LOG.warning("⚠️ %s: endpoint %s non disponibile (%s)", self.name, endpoint, error)
+
+    def get_statistics(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'name': self.name,
+                'preferred': self._preferred,
+                'preferred_ttl_remaining': max(0, round(self._preferred_until - now)) if self._preferred else 0,
+                'ttl': self.ttl,
+                'cooldown': self.cooldown,
+                'endpoints': {e: self._stats[e].to_dict(now) for e in self.endpoints},
+            }
+
+
+_registries: Dict[str, EndpointRegistry] = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(name: str, endpoints: Sequence[str], ttl: float = DEFAULT_TTL,
+                 cooldown: float = DEFAULT_COOLDOWN) -> EndpointRegistry:
+    """Registro del servizio (unico per processo, condiviso tra le istanze dei client)"""
+    with _registries_lock:
+        registry = _registries.get(name)
+        if registry is None or registry.endpoints != tuple(dict.fromkeys(endpoints)):
+            registry = _registries[name] = EndpointRegistry(name, endpoints, ttl, cooldown)
+        return registry
+
+
+def get_statistics() -> Dict[str, Any]:
+    """Statistiche di tutti i registri di questo processo"""
+    with _registries_lock:
+        registries = list(_registries.values())
+    return {registry.name: registry.get_statistics() for registry in registries}
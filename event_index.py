@@ -0,0 +1,228 @@
+"""
+Event Index - Mappature dei codici evento (codici_tracking) in memoria
+
+La tabella `codici_tracking` (vettore, codice, nome, colore) viene caricata
+in un indice immutabile per vettore con chiavi normalizzate (maiuscolo,
+spazi compattati). La ricerca prova nell'ordine:
+ 1. match esatto del codice/descrizione (dict, O(1))
+ 2. prefisso: la chiave più lunga (>= PREFIX_MIN_LENGTH caratteri) con cui
+    inizia la descrizione, es. "CONSEGNATA" per "CONSEGNATA - MILANO"
+ 3. pattern: codici con caratteri jolly `*` o `%`, es. "IN CONSEGNA%"
+
+Il ricaricamento sostituisce l'indice in un'unica assegnazione: le richieste
+in corso vedono il vecchio indice o il nuovo, mai uno parziale. La versione è
+salvata in shared_state, quindi reload() in un worker fa ricaricare anche gli
+altri worker (controllo ogni VERSION_CHECK_INTERVAL secondi).
+
+Le ricerche non scrivono log.
+"""
+
+import re
+import time
+import logging
+import sqlite3
+import threading
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import shared_state
+from db_connector import cursor as db_cursor
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_COLOR = '#000000'
+
+# Lunghezza minima delle chiavi usate per il match per prefisso (evita che
+# codici di 2-3 caratteri catturino descrizioni libere)
+PREFIX_MIN_LENGTH = 4
+
+# Ogni quanti secondi controllare la versione condivisa
+VERSION_CHECK_INTERVAL = 10
+
+# Se il caricamento fallisce riprova dopo questi secondi
+RETRY_INTERVAL = 30
+
+_NAMESPACE = 'event_index'
+_VERSION_KEY = 'version'
+_VERSION_TTL = 10 * 365 * 24 * 3600
+
+_WILDCARDS = ('*', '%')
+_SPACES_RE = re.compile(r'\s+')
+
+
+def normalize(text: Any) -> str:
+    """Chiave di ricerca: maiuscolo e spazi compattati"""
+    return _SPACES_RE.sub(' ', str(text)).strip().upper()
+
+
+def _pattern_regex(key: str):
+    parts = re.split(r'[*%]', key)
+    return re.compile('^' + '.*'.join(re.escape(p) for p in parts) + '$')
+
+
+class _CarrierIndex:
+    """Mappature di un vettore: esatte, per prefisso e pattern"""
+
+    __slots__ = ('exact', 'prefixes', 'patterns')
+
+    def __init__(self, entries: Dict[str, Tuple[str, str]]):
+        exact = {}
+        patterns = []
+        for key, info in entries.items():
+            if any(w in key for w in _WILDCARDS):
+                patterns.append((_pattern_regex(key), info))
+            else:
+                exact[key] = info
+        self.exact = MappingProxyType(exact)
+        # Chiavi più lunghe prima: vince il prefisso più specifico
+        self.prefixes = tuple(sorted(((k, v) for k, v in exact.items() if len(k) >= PREFIX_MIN_LENGTH),
+                                     key=lambda kv: len(kv[0]), reverse=True))
+        self.patterns = tuple(patterns)
+
+    def find(self, key: str) -> Optional[Tuple[str, str]]:
+        info = self.exact.get(key)
+        if info is not None:
+            return info
+        for prefix, info in self.prefixes:
+            # Il prefisso deve terminare su un confine di parola
+            if key.startswith(prefix) and not key[len(prefix)].isalnum():
+                return info
+        for regex, info in self.patterns:
+            if regex.match(key):
+                return info
+        return None
+
+
+class EventIndex:
+    """Indice immutabile vettore -> mappature, costruito dalle righe di codici_tracking"""
+
+    def __init__(self, rows: Iterable[Tuple[Any, ...]] = (), version: int = 0):
+        """
+        Args:
+            rows: Righe (vettore, codice, nome, colore) in ordine di id: a parità
+                  di chiave vince l'ultima
+            version: Versione condivisa da cui è stato costruito
+        """
+        raw: Dict[str, Dict[str, Dict[str, str]]] = {}
+        entries: Dict[str, Dict[str, Tuple[str, str]]] = {}
+        count = 0
+        for row in rows:
+            vettore, codice, nome = row[0], row[1], row[2]
+            colore = (row[3] if len(row) > 3 else None) or DEFAULT_COLOR
+            if not vettore or codice is None:
+                continue
+            vettore = vettore.upper()
+            raw.setdefault(vettore, {})[codice] = {'nome': nome, 'colore': colore}
+            entries.setdefault(vettore, {})[normalize(codice)] = (nome, colore)
+            count += 1
+
+        self.version = version
+        self.size = count
+        self.loaded_at = time.time()
+        self._raw = raw
+        self._carriers = MappingProxyType({v: _CarrierIndex(e) for v, e in entries.items()})
+
+    def find(self, vettore: str, descrizione: Any) -> Optional[Tuple[str, str]]:
+        """(nome, colore) per codice o descrizione, None se non mappato"""
+        carrier = self._carriers.get(vettore.upper())
+        if carrier is None:
+            return None
+        return carrier.find(normalize(descrizione))
+
+    def find_exact(self, vettore: str, codice: Any) -> Optional[Tuple[str, str]]:
+        """(nome, colore) solo per match esatto del codice"""
+        carrier = self._carriers.get(vettore.upper())
+        if carrier is None:
+            return None
+        return carrier.exact.get(normalize(codice))
+
+    def to_dict(self) -> Dict[str, Dict[str, Dict[str, str]]]:
+        """Mappature con i codici originali (vettore -> codice -> {nome, colore})"""
+        return {vettore: {codice: dict(info) for codice, info in codes.items()}
+                for vettore, codes in self._raw.items()}
+
+
+_index = EventIndex()
+_loaded = False
+_next_check = 0.0
+_load_lock = threading.Lock()
+
+
+def _shared_version() -> int:
+    try:
+        value = shared_state.kv_get(_NAMESPACE, _VERSION_KEY)
+    except sqlite3.Error as e:
+        LOG.warning("Versione mappature eventi non disponibile: %s", e)
+        return _index.version
+    return int(value) if value is not None else 0
+
+
+def _load(version: int) -> EventIndex:
+    with db_cursor() as (conn, cur):
+        # Ordina per ID per prendere sempre l'ultimo inserito in caso di duplicati
+        cur.execute("SELECT vettore, codice, nome, colore FROM codici_tracking ORDER BY id")
+        rows = cur.fetchall()
+    return EventIndex(rows, version)
+
+
+def _refresh(force_version: Optional[int] = None) -> EventIndex:
+    """Ricarica l'indice se la versione condivisa è cambiata (o se forzato)"""
+    global _index, _loaded, _next_check
+    with _load_lock:
+        now = time.monotonic()
+        if force_version is None and now < _next_check:
+            return _index
+        version = _shared_version() if force_version is None else force_version
+        if force_version is None and _loaded and version == _index.version:
+            _next_check = now + VERSION_CHECK_INTERVAL
+            return _index
+        try:
+            index = _load(version)
+        except Exception as e:
+            LOG.warning("⚠️ Caricamento mappature eventi fallito: %s", e)
+            _next_check = now + RETRY_INTERVAL
+            return _index
+        _index, _loaded = index, True
+        _next_check = now + VERSION_CHECK_INTERVAL
+        LOG.info(f"🎯 Caricate {index.size} mappature eventi con colori (versione {version})")
+        return index
+
+
+def get_index() -> EventIndex:
+    """Indice corrente (caricato al primo uso, ricaricato se la versione cambia)"""
+    if time.monotonic() < _next_check:
+        return _index
+    return _refresh()
+
+
+def reload() -> EventIndex:
+    """Incrementa la versione condivisa e ricarica: tutti i worker useranno le nuove mappature"""
+    try:
+        version = shared_state.kv_incr(_NAMESPACE, _VERSION_KEY, _VERSION_TTL)
+    except sqlite3.Error as e:
+        LOG.warning("Versione mappature eventi non aggiornata (solo questo processo): %s", e)
+        version = _index.version + 1
+    return _refresh(force_version=version)
+
+
+def lookup(vettore: str, descrizione: Any) -> Dict[str, str]:
+    """
+    Nome personalizzato e colore per un codice o una descrizione evento
+
+    Returns:
+        {'nome', 'colore'} - se non mappato la descrizione originale e colore default
+    """
+    if not vettore or not descrizione:
+        return {'nome': descrizione or '', 'colore': DEFAULT_COLOR}
+    info = get_index().find(vettore, descrizione)
+    if info is None:
+        return {'nome': descrizione, 'colore': DEFAULT_COLOR}
+    return {'nome': info[0], 'colore': info[1]}
+
+
+def display_name(vettore: str, codice: Any) -> Any:
+    """Nome personalizzato per un codice evento (solo match esatto), altrimenti il codice"""
+    info = get_index().find_exact(vettore or '', codice) if codice is not None else None
+    if info is None or not info[0]:
+        return codice
+    return info[0]
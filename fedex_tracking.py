@@ -3,17 +3,26 @@ FedEx Tracking API Client
 Gestisce le chiamate API per il tracking delle spedizioni FedEx
 """
 
-import requests
 import os
-from datetime import datetime, timedelta
+import asyncio
+from datetime import datetime
 from typing import List, Dict, Any
 import json
 from dotenv import load_dotenv
+import http_transport
+from http_transport import HttpRequest
+from rate_limiter import get_limiter
+import token_manager
+from token_manager import TokenError
+from tracking_cache import cached_tracking, cached_tracking_async, get_cache
 
 # Carica variabili d'ambiente
 load_dotenv()
 
 class FedExTracking:
+    # Numero massimo di tracking number per richiesta (limite API Track FedEx)
+    MAX_TRACKING_NUMBERS_PER_REQUEST = 30
+    
     def __init__(self):
         """Inizializza il client FedEx con le credenziali dal file .env"""
         self.debug = os.getenv('FEDEX_API_DEBUG', '0') == '1'
@@ -26,9 +35,11 @@ class FedExTracking:
         self.client_secret = os.getenv('FEDEX_AUTH_SECRET_TRANSIT_ID_PROD')
         self.grant_type = os.getenv('FEDEX_AUTH_GRANT_TYPE', 'client_credentials')
         
-        # Token di accesso (verrà ottenuto dinamicamente)
-        self.access_token = None
-        self.token_expires_at = None
+        # Rate limit condiviso con gli altri client FedEx (thread e processi)
+        self.rate_limiter = get_limiter('FEDEX')
+        
+        # Token di accesso condiviso tra istanze e worker, rinnovato in background
+        self._token_name = token_manager.register('FEDEX', self.client_id, self._fetch_token_flow)
         
         if self.debug:
             print(f"🔧 FedEx API Debug: URL={self.base_url}")
@@ -37,56 +48,49 @@ class FedExTracking:
     
     def get_access_token(self) -> str:
         """Ottiene un token di accesso OAuth per le API FedEx"""
+        return http_transport.run(self._access_token_flow())
+    
+    def _access_token_flow(self):
+        """Flow di get_access_token: token condiviso (token_manager), None se non disponibile"""
         try:
-            # Controlla se abbiamo già un token valido
-            if self.access_token and self.token_expires_at:
-                if datetime.now() < self.token_expires_at:
-                    return self.access_token
-            
-            # URL per ottenere il token
-            token_url = f"{self.base_url}oauth/token"
-            
-            headers = {
-                'Content-Type': 'application/x-www-form-urlencoded'
-            }
-            
-            data = {
-                'grant_type': self.grant_type,
-                'client_id': self.client_id,
-                'client_secret': self.client_secret
-            }
-            
+            return (yield from token_manager.token_flow(self._token_name))
+        except TokenError as e:
             if self.debug:
-                print(f"🔧 FedEx Token Request: {token_url}")
-                print(f"🔧 FedEx Token Data: {data}")
-            
-            response = requests.post(token_url, headers=headers, data=data)
-            
-            if self.debug:
-                print(f"🔧 FedEx Token Response Status: {response.status_code}")
-                print(f"🔧 FedEx Token Response Headers: {dict(response.headers)}")
-                print(f"🔧 FedEx Token Response Body: {response.text}")
-            
-            if response.status_code == 200:
-                token_data = response.json()
-                self.access_token = token_data.get('access_token')
-                expires_in = token_data.get('expires_in', 3600)  # Default 1 ora
-                self.token_expires_at = datetime.now() + timedelta(seconds=expires_in)
-                
-                if self.debug:
-                    print(f"✅ FedEx Token ottenuto: {self.access_token[:20]}...")
-                
-                return self.access_token
-            else:
-                if self.debug:
-                    print(f"❌ FedEx Token Error: {response.status_code} - {response.text}")
-                return None
-                
-        except Exception as e:
-            if self.debug:
-                print(f"❌ FedEx Token Exception: {str(e)}")
+                print(f"❌ FedEx Token Error: {str(e)}")
             return None
     
+    def _fetch_token_flow(self):
+        """Flow che richiede un nuovo token OAuth (usato da token_manager)"""
+        # URL per ottenere il token
+        token_url = f"{self.base_url}oauth/token"
+        
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded'
+        }
+        
+        data = {
+            'grant_type': self.grant_type,
+            'client_id': self.client_id,
+            'client_secret': self.client_secret
+        }
+        
+        if self.debug:
+            print(f"🔧 FedEx Token Request: {token_url}")
+        
+        response = yield HttpRequest('FEDEX', 'POST', token_url, headers=headers, data=data,
+                                     rate_limited=False)
+        
+        if self.debug:
+            print(f"🔧 FedEx Token Response Status: {response.status_code}")
+        
+        if response.status_code != 200:
+            raise TokenError(f"FedEx OAuth {response.status_code} - {response.text}")
+        
+        token_data = response.json()
+        # Default 1 ora
+        return token_data.get('access_token'), token_data.get('expires_in', 3600)
+    
+    @cached_tracking('FEDEX')
     def track_shipment(self, tracking_number: str) -> Dict[str, Any]:
         """
         Esegue il tracking di una spedizione FedEx
@@ -97,13 +101,63 @@ class FedExTracking:
         Returns:
             Dizionario con risultati tracking in formato standardizzato
         """
+        return self._track_chunk([tracking_number])[tracking_number]
+    
+    @cached_tracking_async('FEDEX')
+    async def track_shipment_async(self, tracking_number: str) -> Dict[str, Any]:
+        """Variante asyncio di track_shipment()"""
+        return (await http_transport.run_async(self._track_chunk_flow([tracking_number])))[tracking_number]
+    
+    def track_shipments(self, tracking_numbers: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Esegue il tracking di più spedizioni FedEx
+        
+        I numeri vengono raggruppati in richieste da MAX_TRACKING_NUMBERS_PER_REQUEST
+        (limite dell'API Track FedEx).
+        
+        Args:
+            tracking_numbers: Lista di numeri di tracking FedEx
+            
+        Returns:
+            Dizionario numero di tracking -> risultato (stesso formato di track_shipment)
+        """
+        numbers = list(dict.fromkeys(n for n in tracking_numbers if n))
+        cache = get_cache()
+        results = cache.get_many('FEDEX', numbers)
+        missing = [n for n in numbers if n not in results]
+        for i in range(0, len(missing), self.MAX_TRACKING_NUMBERS_PER_REQUEST):
+            chunk_results = self._track_chunk(missing[i:i + self.MAX_TRACKING_NUMBERS_PER_REQUEST])
+            cache.set_many('FEDEX', chunk_results)
+            results.update(chunk_results)
+        return results
+    
+    async def track_shipments_async(self, tracking_numbers: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Variante asyncio di track_shipments(): i gruppi di numeri sono richiesti in parallelo"""
+        numbers = list(dict.fromkeys(n for n in tracking_numbers if n))
+        cache = get_cache()
+        results = cache.get_many('FEDEX', numbers)
+        missing = [n for n in numbers if n not in results]
+        size = self.MAX_TRACKING_NUMBERS_PER_REQUEST
+        chunks = [missing[i:i + size] for i in range(0, len(missing), size)]
+        for chunk_results in await asyncio.gather(*(http_transport.run_async(self._track_chunk_flow(chunk))
+                                                    for chunk in chunks)):
+            cache.set_many('FEDEX', chunk_results)
+            results.update(chunk_results)
+        return results
+    
+    def _track_chunk(self, tracking_numbers: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Una singola richiesta trackingnumbers per al massimo 30 numeri"""
+        return http_transport.run(self._track_chunk_flow(tracking_numbers))
+    
+    def _track_chunk_flow(self, tracking_numbers: List[str]):
+        """Flow di _track_chunk (vedi http_transport)"""
         try:
             # Ottieni token di accesso
-            token = self.get_access_token()
+            token = yield from self._access_token_flow()
             if not token:
                 if self.debug:
                     print("❌ FedEx: Impossibile ottenere token di accesso")
-                return {'success': False, 'error': 'Impossibile ottenere token OAuth'}
+                return self._error_results(tracking_numbers, 'Impossibile ottenere token OAuth')
             
             # URL per tracking
             tracking_url = f"{self.base_url}track/v1/trackingnumbers"
@@ -123,6 +177,7 @@ class FedExTracking:
                             "trackingNumber": tracking_number
                         }
                     }
+                    for tracking_number in tracking_numbers
                 ]
             }
             
@@ -130,38 +185,72 @@ class FedExTracking:
                 print(f"🔧 FedEx Tracking Request: {tracking_url}")
                 print(f"🔧 FedEx Tracking Payload: {json.dumps(payload, indent=2)}")
             
-            response = requests.post(tracking_url, headers=headers, json=payload)
+            response = yield HttpRequest('FEDEX', 'POST', tracking_url, headers=headers, json=payload,
+                                         idempotent=True)
             
             if self.debug:
                 print(f"🔧 FedEx Response Status: {response.status_code}")
                 print(f"🔧 FedEx Response: {response.text[:500]}...")
             
-            if response.status_code == 200:
-                data = response.json()
-                events = self._parse_tracking_response(data, tracking_number)
+            if response.status_code != 200:
+                if response.status_code == 401:
+                    # Token revocato: la prossima richiesta ne ottiene uno nuovo
+                    token_manager.invalidate(self._token_name)
+                if self.debug:
+                    print(f"❌ FedEx Tracking Error: {response.status_code} - {response.text}")
+                return self._error_results(tracking_numbers, f'{response.status_code} - {response.text}')
+            
+            data = response.json()
+            
+            # Ridistribuisce completeTrackResults per numero di tracking
+            by_number: Dict[str, List[Dict]] = {}
+            complete_track_results = data.get('output', {}).get('completeTrackResults', [])
+            for track_result in complete_track_results:
+                number = track_result.get('trackingNumber')
+                if number is None and len(tracking_numbers) == 1:
+                    number = tracking_numbers[0]
+                by_number.setdefault(number, []).append(track_result)
+            
+            results = {}
+            for tracking_number in tracking_numbers:
+                track_results = by_number.get(tracking_number, [])
+                events = self._parse_tracking_response(
+                    {'output': {'completeTrackResults': track_results}}, tracking_number
+                )
                 
                 if events:
                     # Determina lo status principale dall'ultimo evento
-                    latest_event = events[0] if events else {}
+                    latest_event = events[0]
                     status = latest_event.get('descrizione', 'In transito')
                     
-                    return {
+                    results[tracking_number] = {
                         'success': True,
                         'status': status,
                         'description': f"FedEx tracking per {tracking_number}",
                         'events': events
                     }
                 else:
-                    return {'success': False, 'error': 'Nessun evento trovato'}
-            else:
-                if self.debug:
-                    print(f"❌ FedEx Tracking Error: {response.status_code} - {response.text}")
-                return {'success': False, 'error': f'{response.status_code} - {response.text}'}
+                    error = self._extract_track_error(track_results) or 'Nessun evento trovato'
+                    results[tracking_number] = {'success': False, 'error': error}
+            return results
                 
         except Exception as e:
             if self.debug:
                 print(f"❌ FedEx Tracking Exception: {str(e)}")
-            return {'success': False, 'error': str(e)}
+            return self._error_results(tracking_numbers, str(e))
+    
+    def _error_results(self, tracking_numbers: List[str], error: str) -> Dict[str, Dict[str, Any]]:
+        """Stesso errore per tutti i numeri di una richiesta fallita"""
+        return {tracking_number: {'success': False, 'error': error} for tracking_number in tracking_numbers}
+    
+    def _extract_track_error(self, complete_track_results: List[Dict]) -> str:
+        """Messaggio di errore FedEx per singolo numero (es. TRACKING.TRACKINGNUMBER.NOTFOUND)"""
+        for track_result in complete_track_results:
+            for result in track_result.get('trackResults', []):
+                error = result.get('error')
+                if error:
+                    return error.get('message') or error.get('code') or ''
+        return ''
     
     def _parse_tracking_response(self, data: Dict, tracking_number: str) -> List[Dict[str, Any]]:
         """
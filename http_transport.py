@@ -0,0 +1,517 @@
+"""
+HTTP Transport - Trasporto HTTP sync/async per i client dei vettori
+
+I client descrivono le chiamate come "flow": generatori che producono
+HttpRequest (o Sleep) e ricevono la risposta, con la stessa logica di
+parsing e gestione errori per le due modalità:
+
+    def _track_flow(self, awb):
+        response = yield HttpRequest('BRT', 'GET', url, headers=headers)
+        return self._parse(response)
+
+    def track(self, awb):                  # API sincrona (invariata)
+        return http_transport.run(self._track_flow(awb))
+
+    async def track_async(self, awb):      # variante asyncio
+        return await http_transport.run_async(self._track_flow(awb))
+
+Il trasporto:
+ - applica il rate limit del vettore (rate_limiter) prima di ogni richiesta
+ - usa connessioni keep-alive: una requests.Session per vettore in modalità
+   sync (registro di processo, un pool urllib3 per host del vettore), una
+   aiohttp.ClientSession per vettore e per event loop in async
+ - dimensiona i pool sul limite di concorrenza del vettore
+ - ripete con backoff le richieste fallite (HttpTransportConfig.retries), con
+   un nuovo token del rate limit per ogni tentativo: connessioni non stabilite
+   sempre, timeout, connessioni interrotte e 500/502/503/504 solo per le
+   richieste idempotenti (GET/HEAD/... o HttpRequest(idempotent=True), es. le
+   interrogazioni di tracking in POST)
+ - usa TLS >= 1.2 con l'SSL context del vettore (register_ssl_context), sia in
+   sync che in async
+ - applica il timeout di default del vettore
+ - in async limita le richieste contemporanee per vettore (HTTP_MAX_INFLIGHT_<VETTORE>)
+ - opzionalmente tiene in cache la risoluzione DNS degli host dei vettori
+   (HTTP_DNS_CACHE_TTL secondi, 0 = disattivata)
+
+Con le sessioni keep-alive un ciclo di tracking apre al massimo pool_size
+connessioni per host invece di un handshake TCP+TLS per richiesta
+(vedi benchmarks/http_sessions_bench.py).
+
+aiohttp è opzionale: se non è installato le richieste async vengono eseguite
+con la sessione sync in un thread (asyncio.to_thread), sempre con il limite
+di richieste contemporanee.
+
+Gli errori di rete async sono convertiti nelle eccezioni di requests
+(Timeout, ConnectionError), quindi i flow gestiscono un solo tipo di errore.
+"""
+
+import os
+import ssl
+import json
+import time
+import socket
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass, replace
+from typing import Any, Dict, Generator, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.exceptions import NewConnectionError
+
+from config import HttpTransportConfig
+from rate_limiter import get_limiter
+
+try:
+    import aiohttp
+except ImportError:  # opzionale: senza aiohttp si usa la sessione sync in un thread
+    aiohttp = None
+
+LOG = logging.getLogger(__name__)
+
+
+@dataclass
+class HttpRequest:
+    """Richiesta prodotta da un flow"""
+
+    carrier: str
+    method: str
+    url: str
+    headers: Optional[Dict[str, str]] = None
+    params: Optional[Dict[str, Any]] = None
+    data: Any = None
+    json: Any = None
+    auth: Optional[tuple] = None
+    timeout: Optional[float] = None
+    rate_limited: bool = True  # False per le chiamate di autenticazione
+    idempotent: Optional[bool] = None  # None: dal metodo; True per le interrogazioni in POST
+
+
+@dataclass
+class Sleep:
+    """Pausa richiesta da un flow (es. backoff dopo un 429)"""
+
+    seconds: float
+
+
+class HttpResponse:
+    """Risposta async con la stessa interfaccia usata dai client di requests.Response"""
+
+    def __init__(self, status_code: int, headers: Dict[str, str], content: bytes,
+                 url: str, encoding: Optional[str] = None):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.url = url
+        self.encoding = encoding or 'utf-8'
+        self.reason = ''
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding, errors='replace')
+
+    def json(self) -> Any:
+        return json.loads(self.text)
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            kind = 'Client' if self.status_code < 500 else 'Server'
+            raise requests.exceptions.HTTPError(
+                f"{self.status_code} {kind} Error for url: {self.url}", response=self
+            )
+
+
+# Status per cui il trasporto ripete le richieste idempotenti (429 resta ai
+# client, che applicano il proprio backoff)
+RETRY_STATUSES = (500, 502, 503, 504)
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+_configs: Dict[str, HttpTransportConfig] = {}
+_sessions: Dict[str, requests.Session] = {}
+_ssl_contexts: Dict[str, ssl.SSLContext] = {}
+_sync_lock = threading.Lock()
+
+
+class TLSHttpAdapter(HTTPAdapter):
+    """HTTPAdapter che usa un SSLContext dato (TLS >= 1.2, cipher del vettore)"""
+
+    def __init__(self, ssl_context: ssl.SSLContext, *args, **kwargs):
+        self._ssl_context = ssl_context
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs["ssl_context"] = self._ssl_context
+        return super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        proxy_kwargs["ssl_context"] = self._ssl_context
+        return super().proxy_manager_for(proxy, **proxy_kwargs)
+
+
+def register_ssl_context(carrier: str, context: ssl.SSLContext) -> None:
+    """SSL context dedicato del vettore (es. cipher legacy DHL), per sync e async"""
+    name = carrier.strip().upper()
+    with _sync_lock:
+        _ssl_contexts[name] = context
+        # Una sessione creata prima della registrazione userebbe il context di default
+        session = _sessions.pop(name, None)
+    if session is not None:
+        session.close()
+
+
+def _default_ssl_context() -> ssl.SSLContext:
+    context = ssl.create_default_context()
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return context
+
+
+def get_config(carrier: str) -> HttpTransportConfig:
+    """Configurazione del trasporto del vettore (letta una volta per processo)"""
+    name = carrier.strip().upper()
+    with _sync_lock:
+        config = _configs.get(name)
+        if config is None:
+            config = _configs[name] = HttpTransportConfig.from_env(name)
+        return config
+
+
+def get_session(carrier: str) -> requests.Session:
+    """
+    requests.Session keep-alive del vettore (una per processo)
+
+    L'adapter tiene un pool di pool_size connessioni per ogni host del
+    vettore (es. endpoint OAuth e tracking) con l'SSL context del vettore.
+    urllib3 non ripete le richieste: i retry sono in run/run_async, che
+    passano dal rate limit a ogni tentativo.
+    """
+    name = carrier.strip().upper()
+    config = get_config(name)
+    _install_dns_cache()
+    with _sync_lock:
+        session = _sessions.get(name)
+        if session is None:
+            session = requests.Session()
+            adapter = TLSHttpAdapter(
+                _ssl_contexts.get(name) or _default_ssl_context(),
+                pool_connections=4, pool_maxsize=config.pool_size
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[name] = session
+            LOG.debug("Sessione HTTP %s: pool %d, retry %d", name, config.pool_size, config.retries)
+        return session
+
+
+def close_sessions() -> None:
+    """Chiude le sessioni sync del registro (le prossime richieste ne aprono di nuove)"""
+    with _sync_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
+
+
+# Cache DNS (opt-in): solo per gli host contattati dal trasporto
+_dns_ttl = max(0, int(os.getenv('HTTP_DNS_CACHE_TTL', '0') or 0))
+_dns_hosts: Set[str] = set()
+_dns_cache: Dict[Tuple, Tuple[float, Any]] = {}
+_dns_lock = threading.Lock()
+_dns_installed = False
+_system_getaddrinfo = socket.getaddrinfo
+
+
+def _cached_getaddrinfo(host, *args, **kwargs):
+    if host not in _dns_hosts:
+        return _system_getaddrinfo(host, *args, **kwargs)
+    key = (host, args, tuple(sorted(kwargs.items())))
+    now = time.monotonic()
+    with _dns_lock:
+        entry = _dns_cache.get(key)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+    try:
+        result = _system_getaddrinfo(host, *args, **kwargs)
+    except socket.gaierror:
+        if entry is None:
+            raise
+        # Resolver non raggiungibile: meglio l'indirizzo precedente che un errore
+        LOG.warning("⚠️ Risoluzione DNS di %s fallita, uso l'indirizzo in cache", host)
+        return entry[1]
+    with _dns_lock:
+        _dns_cache[key] = (now + _dns_ttl, result)
+    return result
+
+
+def _install_dns_cache() -> None:
+    global _dns_installed
+    if _dns_ttl <= 0 or _dns_installed:
+        return
+    with _dns_lock:
+        if not _dns_installed:
+            socket.getaddrinfo = _cached_getaddrinfo
+            _dns_installed = True
+            LOG.info("🌐 Cache DNS host vettori attiva (TTL %ds)", _dns_ttl)
+
+
+def _remember_host(url: str) -> None:
+    if _dns_ttl > 0:
+        host = urlsplit(url).hostname
+        if host and host not in _dns_hosts:
+            with _dns_lock:
+                _dns_hosts.add(host)
+
+
+def request(req: HttpRequest, session: Optional[requests.Session] = None) -> requests.Response:
+    """Esegue una richiesta in modo sincrono (rate limit incluso)"""
+    if req.rate_limited:
+        get_limiter(req.carrier).acquire()
+    _remember_host(req.url)
+    session = session or get_session(req.carrier)
+    timeout = req.timeout if req.timeout is not None else get_config(req.carrier).timeout
+    return session.request(
+        req.method, req.url, headers=req.headers, params=req.params, data=req.data,
+        json=req.json, auth=req.auth, timeout=timeout
+    )
+
+
+def _not_sent(error: requests.exceptions.RequestException) -> bool:
+    """True se la connessione non è stata stabilita (la richiesta non è partita)"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.SSLError):
+        return False
+    cause = error.__cause__
+    if aiohttp is not None and isinstance(cause, aiohttp.ClientConnectorError):
+        return not isinstance(cause, aiohttp.ClientSSLError)
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _retry_reason(req: HttpRequest, response=None,
+                  error: Optional[requests.exceptions.RequestException] = None) -> Optional[str]:
+    """Motivo per ripetere la richiesta, None se l'esito va restituito al flow"""
+    if isinstance(error, requests.exceptions.SSLError):
+        return None     # Certificato/cipher: ripetere non cambia l'esito
+    if error is not None and _not_sent(error):
+        return f"connessione non riuscita ({error})"
+    idempotent = req.idempotent if req.idempotent is not None else req.method.upper() in IDEMPOTENT_METHODS
+    if not idempotent:
+        # Una POST già inviata potrebbe essere stata eseguita dal vettore
+        return None
+    if error is not None:
+        if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+            return str(error)
+        return None
+    if response.status_code in RETRY_STATUSES:
+        return f"HTTP {response.status_code}"
+    return None
+
+
+def _retry_delay(req: HttpRequest, attempt: int, reason: str) -> float:
+    config = get_config(req.carrier)
+    delay = config.retry_backoff * 2 ** (attempt - 1)
+    LOG.warning("⚠️ %s %s: retry %d/%d tra %.1fs - %s",
+                config.carrier, req.method, attempt, config.retries, delay, reason)
+    return delay
+
+
+def _send(req: HttpRequest, session: Optional[requests.Session] = None):
+    """request() con i retry del vettore: ogni tentativo riprende un token del rate limit"""
+    retries = get_config(req.carrier).retries
+    attempt = 0
+    while True:
+        try:
+            response = request(req, session)
+        except requests.exceptions.RequestException as e:
+            reason = _retry_reason(req, error=e)
+            if reason is None or attempt >= retries:
+                raise
+        else:
+            reason = _retry_reason(req, response)
+            if reason is None or attempt >= retries:
+                return response
+            response.close()
+        attempt += 1
+        time.sleep(_retry_delay(req, attempt, reason))
+
+
+def run(flow: Generator, session: Optional[requests.Session] = None) -> Any:
+    """
+    Esegue un flow in modo sincrono
+
+    Args:
+        flow: Generatore che produce HttpRequest/Sleep
+        session: Sessione da usare al posto di quella del registro
+
+    Returns:
+        Il valore restituito dal flow
+    """
+    value, error = None, None
+    while True:
+        try:
+            step = flow.throw(error) if error is not None else flow.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value, error = None, None
+        if isinstance(step, Sleep):
+            time.sleep(step.seconds)
+            continue
+        try:
+            value = _send(step, session)
+        except requests.exceptions.RequestException as e:
+            error = e
+
+
+class _LoopState:
+    """Sessioni aiohttp e semafori per vettore di un event loop"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.hook = None    # Async generator chiuso allo shutdown del loop
+        self.sessions: Dict[str, Any] = {}
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def semaphore(self, carrier: str) -> asyncio.Semaphore:
+        sem = self.semaphores.get(carrier)
+        if sem is None:
+            sem = self.semaphores[carrier] = asyncio.Semaphore(get_config(carrier).max_inflight)
+        return sem
+
+    def session(self, carrier: str):
+        session = self.sessions.get(carrier)
+        if session is None or session.closed:
+            config = get_config(carrier)
+            context = _ssl_contexts.get(carrier) or _default_ssl_context()
+            connector = aiohttp.TCPConnector(
+                limit=config.pool_size, limit_per_host=config.pool_size, ssl=context,
+                ttl_dns_cache=_dns_ttl or 10
+            )
+            session = self.sessions[carrier] = aiohttp.ClientSession(connector=connector)
+        return session
+
+
+    async def close(self) -> None:
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        for session in sessions:
+            await session.close()
+
+
+# Stato per id(loop): le ClientSession tengono un riferimento al loop, quindi
+# con il loop come chiave debole le voci non verrebbero mai rimosse. Lo stato
+# viene tolto e le sessioni chiuse quando il loop termina (hook su
+# shutdown_asyncgens, chiamato da asyncio.run) o da close_async().
+_loop_states: Dict[int, _LoopState] = {}
+
+
+async def _shutdown_hook(state: _LoopState):
+    try:
+        yield
+    finally:
+        if _loop_states.get(id(state.loop)) is state:
+            del _loop_states[id(state.loop)]
+        await state.close()
+
+
+async def _loop_state() -> _LoopState:
+    loop = asyncio.get_running_loop()
+    state = _loop_states.get(id(loop))
+    if state is None:
+        # Loop chiusi senza shutdown_asyncgens: si rilasciano i riferimenti
+        for key, closed in list(_loop_states.items()):
+            if closed.loop.is_closed():
+                del _loop_states[key]
+        state = _loop_states[id(loop)] = _LoopState(loop)
+        hook = _shutdown_hook(state)
+        await hook.asend(None)  # Generatore registrato sul loop fino allo shutdown
+        state.hook = hook
+    return state
+
+
+async def request_async(req: HttpRequest):
+    """
+    Esegue una richiesta dentro l'event loop
+
+    Returns:
+        HttpResponse (con aiohttp) o requests.Response (fallback con thread)
+    """
+    carrier = req.carrier.strip().upper()
+    state = await _loop_state()
+    if req.rate_limited:
+        await get_limiter(carrier).acquire_async()
+
+    async with state.semaphore(carrier):
+        if aiohttp is None:
+            return await asyncio.to_thread(request, replace(req, rate_limited=False))
+
+        timeout = req.timeout if req.timeout is not None else get_config(carrier).timeout
+        kwargs: Dict[str, Any] = {'headers': req.headers, 'params': req.params,
+                                  'timeout': aiohttp.ClientTimeout(total=timeout)}
+        if req.json is not None:
+            kwargs['json'] = req.json
+        elif req.data is not None:
+            kwargs['data'] = req.data
+        if req.auth is not None:
+            kwargs['auth'] = aiohttp.BasicAuth(*req.auth)
+
+        try:
+            async with state.session(carrier).request(req.method, req.url, **kwargs) as response:
+                content = await response.read()
+                return HttpResponse(response.status, dict(response.headers), content,
+                                    str(response.url), response.charset)
+        except asyncio.TimeoutError as e:
+            raise requests.exceptions.Timeout(f"Timeout {carrier} dopo {timeout}s: {req.url}") from e
+        except aiohttp.ClientError as e:
+            raise requests.exceptions.ConnectionError(f"Errore connessione {carrier}: {e}") from e
+
+
+async def _send_async(req: HttpRequest):
+    """request_async() con i retry del vettore (stessa politica di _send)"""
+    retries = get_config(req.carrier).retries
+    attempt = 0
+    while True:
+        try:
+            response = await request_async(req)
+        except requests.exceptions.RequestException as e:
+            reason = _retry_reason(req, error=e)
+            if reason is None or attempt >= retries:
+                raise
+        else:
+            reason = _retry_reason(req, response)
+            if reason is None or attempt >= retries:
+                return response
+        attempt += 1
+        await asyncio.sleep(_retry_delay(req, attempt, reason))
+
+
+async def run_async(flow: Generator) -> Any:
+    """Esegue un flow dentro l'event loop (stessa semantica di run)"""
+    value, error = None, None
+    while True:
+        try:
+            step = flow.throw(error) if error is not None else flow.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value, error = None, None
+        if isinstance(step, Sleep):
+            await asyncio.sleep(step.seconds)
+            continue
+        try:
+            value = await _send_async(step)
+        except requests.exceptions.RequestException as e:
+            error = e
+
+
+async def close_async() -> None:
+    """Chiude le sessioni aiohttp dell'event loop corrente (da chiamare prima di chiudere il loop)"""
+    state = _loop_states.get(id(asyncio.get_running_loop()))
+    if state is None:
+        return
+    await state.hook.aclose()
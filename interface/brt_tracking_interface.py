@@ -9,6 +9,8 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from typing import Dict, List, Optional
 from brt_tracking import BRTTracking
+import http_transport
+from tracking_cache import cached_tracking, cached_tracking_async
 
 
 class BRTTrackingInterface:
@@ -42,6 +44,7 @@ class BRTTrackingInterface:
         if self.debug:
             self.logger.setLevel(logging.DEBUG)
     
+    @cached_tracking('BRT')
     def track(self, waybill_number: str) -> Dict:
         """
         Traccia una spedizione BRT
@@ -52,6 +55,15 @@ class BRTTrackingInterface:
         Returns:
             Dict standardizzato con informazioni di tracking
         """
+        return http_transport.run(self._track_flow(waybill_number))
+    
+    @cached_tracking_async('BRT')
+    async def track_async(self, waybill_number: str) -> Dict:
+        """Variante asyncio di track()"""
+        return await http_transport.run_async(self._track_flow(waybill_number))
+    
+    def _track_flow(self, waybill_number: str):
+        """Flow del tracking (vedi http_transport)"""
         try:
             # Valida input
             if not waybill_number or not waybill_number.strip():
@@ -67,7 +79,7 @@ class BRTTrackingInterface:
                 self.logger.info(f"🔍 Tracking BRT: {waybill_number}")
             
             # Esegui tracking
-            result = self.client.track(waybill_number)
+            result = yield from self.client._track_flow(waybill_number)
             
             if result.get('success'):
                 # Standardizza formato risposta
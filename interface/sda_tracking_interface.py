@@ -15,6 +15,8 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from typing import Dict, Any, Optional
 from sda_tracking import SDATracking
+import http_transport
+from tracking_cache import cached_tracking, cached_tracking_async
 
 class SDATrackingInterface:
     """
@@ -34,6 +36,7 @@ class SDATrackingInterface:
         self.sda_client = SDATracking(environment=environment)
         self.logger = logging.getLogger(__name__)
     
+    @cached_tracking('SDA')
     def track(self, waybill_number: str) -> Dict[str, Any]:
         """
         Esegue il tracking di una spedizione SDA.
@@ -44,11 +47,20 @@ class SDATrackingInterface:
         Returns:
             Dict[str, Any]: Risultato tracking standardizzato
         """
+        return http_transport.run(self._track_flow(waybill_number))
+    
+    @cached_tracking_async('SDA')
+    async def track_async(self, waybill_number: str) -> Dict[str, Any]:
+        """Variante asyncio di track()"""
+        return await http_transport.run_async(self._track_flow(waybill_number))
+    
+    def _track_flow(self, waybill_number: str):
+        """Flow del tracking (vedi http_transport)"""
         try:
             self.logger.info(f"🔍 Tracking SDA: {waybill_number}")
             
             # Chiama l'API SDA
-            result = self.sda_client.track_shipment(waybill_number, full_tracking=True)
+            result = yield from self.sda_client._track_flow(waybill_number, full_tracking=True)
             
             if result['success']:
                 # Standardizza la risposta per compatibilità con TrackingService
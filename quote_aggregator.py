@@ -0,0 +1,731 @@
+"""
+Quote Aggregator - Preventivi multi-corriere in parallelo con deadline
+
+Per una spedizione (ShipmentSpec) interroga in parallelo tutte le sorgenti
+di preventivi configurate (QUOTE_SOURCES):
+ - UPS          UPSQuoteClient.get_quote
+ - UPS_A65C50   UPSQuoteClientN.get_quote (account A65c50)
+ - DHL          DHLQuoteClient.get_quote
+ - SPEDIAMOPRO  SpediamoproQuoteClient.get_simulation (SDA, BRT, UPS, InPost)
+
+Le risposte dei client vengono convertite in un unico schema (Rate) e
+restituite man mano che arrivano (iter_quotes). Oltre la deadline
+(QUOTE_DEADLINE) le sorgenti mancanti risultano 'timeout' e il preventivo
+è parziale: il tempo di risposta è quello del corriere più lento entro la
+deadline, non la somma.
+
+Le risposte sono in cache per tratta e scaglione di peso (quote_cache): le
+sorgenti in cache rispondono subito, senza passare dal pool di thread.
+
+Per elenchi di spedizioni (CSV/NDJSON, /api/quotes/batch) iter_batch quota
+QUOTE_BATCH_CONCURRENCY spedizioni alla volta leggendo le righe man mano e
+restituisce ogni preventivo appena pronto.
+
+Uso:
+    result = get_aggregator().quote(ShipmentSpec.from_dict(payload))
+    result['rates']  # ordinate per prezzo, poi giorni di consegna
+
+    for line in get_aggregator().iter_batch(records_from_csv(lines)):
+        ...
+"""
+
+import re
+import csv
+import json
+import math
+import time
+import logging
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed, wait
+)
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+import quote_cache
+from config import QUOTE_VAT_RATE, QuoteConfig
+
+LOG = logging.getLogger(__name__)
+
+SORT_KEYS = ('price', 'transit')
+
+
+@dataclass
+class Parcel:
+    """Collo di una spedizione"""
+
+    weight_kg: float
+    length_cm: float = 30
+    width_cm: float = 20
+    height_cm: float = 15
+    is_envelope: bool = False
+    value: float = 0.0
+
+
+def _finite(value: Any, name: str) -> float:
+    """Numero finito da un valore JSON/CSV (ValueError per NaN, infinito o non numerico)"""
+    if isinstance(value, bool):
+        raise ValueError(f"{name} non è un numero")
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} non è un numero: {value!r}")
+    if not math.isfinite(number):
+        raise ValueError(f"{name} deve essere un numero finito")
+    return number
+
+
+def parse_sources(value: Any) -> Optional[List[str]]:
+    """
+    Sorgenti richieste dal JSON delle API (None: tutte quelle configurate)
+
+    Raises:
+        ValueError: Se non è una lista di stringhe
+    """
+    if value is None:
+        return None
+    if not isinstance(value, list) or not all(isinstance(s, str) for s in value):
+        raise ValueError("sources deve essere una lista di nomi di sorgente")
+    return [s.strip().upper() for s in value if s.strip()] or None
+
+
+@dataclass
+class ShipmentSpec:
+    """Spedizione da quotare (stessi dati per tutti i corrieri)"""
+
+    origin_country: str
+    origin_postal: str
+    destination_country: str
+    destination_postal: str
+    parcels: List[Parcel]
+    origin_city: str = ''
+    destination_city: str = ''
+    value_eur: float = 0.0
+    is_documents: bool = False
+
+    @property
+    def total_weight(self) -> float:
+        return sum(p.weight_kg for p in self.parcels)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'ShipmentSpec':
+        """
+        Crea la spedizione dal JSON delle API
+
+        Accetta `parcels` (o `packages`) come lista di colli, oppure i campi
+        singoli weight_kg/length_cm/width_cm/height_cm.
+
+        Raises:
+            ValueError: Se mancano campi obbligatori o i valori non sono validi
+        """
+        missing = [k for k in ('origin_country', 'origin_postal', 'destination_country', 'destination_postal')
+                   if not str(data.get(k) or '').strip()]
+        if missing:
+            raise ValueError(f"Campi obbligatori mancanti: {', '.join(missing)}")
+
+        raw_parcels = data.get('parcels') or data.get('packages')
+        if not raw_parcels:
+            if data.get('weight_kg') is None:
+                raise ValueError("Indicare parcels oppure weight_kg")
+            raw_parcels = [data]
+        if not isinstance(raw_parcels, list) or not all(isinstance(raw, dict) for raw in raw_parcels):
+            raise ValueError("parcels deve essere una lista di oggetti collo")
+        parcels = []
+        for index, raw in enumerate(raw_parcels):
+            parcel = Parcel(
+                weight_kg=_finite(raw.get('weight_kg', raw.get('weight', 0)), f"parcels[{index}].weight_kg"),
+                length_cm=_finite(raw.get('length_cm', raw.get('length', 30)), f"parcels[{index}].length_cm"),
+                width_cm=_finite(raw.get('width_cm', raw.get('width', 20)), f"parcels[{index}].width_cm"),
+                height_cm=_finite(raw.get('height_cm', raw.get('height', 15)), f"parcels[{index}].height_cm"),
+                is_envelope=bool(raw.get('is_envelope', False)),
+                value=_finite(raw.get('value', 0) or 0, f"parcels[{index}].value"),
+            )
+            if parcel.weight_kg <= 0:
+                raise ValueError("Il peso di ogni collo deve essere maggiore di 0")
+            if min(parcel.length_cm, parcel.width_cm, parcel.height_cm) < 0 or parcel.value < 0:
+                raise ValueError("Dimensioni e valore dei colli non possono essere negativi")
+            parcels.append(parcel)
+
+        return cls(
+            origin_country=str(data['origin_country']).strip().upper(),
+            origin_postal=str(data['origin_postal']).strip(),
+            destination_country=str(data['destination_country']).strip().upper(),
+            destination_postal=str(data['destination_postal']).strip(),
+            parcels=parcels,
+            origin_city=str(data.get('origin_city') or '').strip(),
+            destination_city=str(data.get('destination_city') or '').strip(),
+            value_eur=_finite(data.get('value_eur') or 0, 'value_eur'),
+            is_documents=bool(data.get('is_documents', False)),
+        )
+
+
+@dataclass
+class Rate:
+    """Tariffa di un servizio nello schema comune"""
+
+    source: str                  # Sorgente (UPS, UPS_A65C50, DHL, SPEDIAMOPRO)
+    carrier: str                 # Corriere che esegue la spedizione
+    service_code: str
+    service_name: str
+    total_cost: float
+    currency: str = 'EUR'
+    transit_days: Optional[int] = None
+    delivery_info: str = ''
+    rate_type: str = ''
+    simulated: bool = False
+    vat_included: bool = False          # total_cost comprende l'IVA
+    net_price: Optional[float] = None   # Imponibile: base comune per ordinare le sorgenti
+
+    def __post_init__(self):
+        if self.net_price is None:
+            self.net_price = net_of_vat(self.total_cost) if self.vat_included else self.total_cost
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+@dataclass
+class SourceResult:
+    """Esito di una sorgente"""
+
+    source: str
+    status: str                  # 'ok', 'error' o 'timeout'
+    rates: List[Rate] = field(default_factory=list)
+    elapsed_ms: Optional[float] = None
+    error: Optional[str] = None
+    cached: bool = False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'source': self.source,
+            'status': self.status,
+            'rates': [r.to_dict() for r in self.rates],
+            'elapsed_ms': self.elapsed_ms,
+            'error': self.error,
+            'cached': self.cached,
+        }
+
+
+def net_of_vat(total: float) -> float:
+    """Imponibile di un prezzo IVA inclusa (aliquota QUOTE_VAT_RATE)"""
+    return round(total / (1 + QUOTE_VAT_RATE), 2)
+
+
+_DAYS_RE = re.compile(r'(\d+)')
+
+
+def transit_days(value: Any) -> Optional[int]:
+    """Giorni di consegna da '2', '2-3' (caso peggiore), '1 giorni', '... (3 giorni lavorativi)'"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    numbers = _DAYS_RE.findall(str(value))
+    return max(int(n) for n in numbers) if numbers else None
+
+
+def _money(value: Any) -> Optional[float]:
+    try:
+        return round(float(value), 2)
+    except (TypeError, ValueError):
+        return None
+
+
+# --- adapter delle sorgenti ----------------------------------------------
+
+def _ups_packages(spec: ShipmentSpec) -> List[Dict[str, Any]]:
+    return [{'weight_kg': p.weight_kg, 'length_cm': p.length_cm, 'width_cm': p.width_cm,
+             'height_cm': p.height_cm, 'is_envelope': p.is_envelope} for p in spec.parcels]
+
+
+def _ups_rates(source: str, result: Dict[str, Any]) -> List[Rate]:
+    if result.get('error'):
+        raise RuntimeError(result['error'])
+    simulated = result.get('api_type') == 'Simulation' or result.get('quote_source') == 'SIMULATION'
+    rates = []
+    for r in result.get('rates', []):
+        cost = _money(r.get('total_cost'))
+        if cost is None:
+            continue
+        # UPSQuoteClient aggiunge sempre l'IVA, UPSQuoteClientN solo se presente nella risposta UPS
+        vat_included = bool(_money(r.get('iva_amount')))
+        rates.append(Rate(
+            source=source, carrier='UPS',
+            service_code=str(r.get('service_code', '')),
+            service_name=r.get('service_name', ''),
+            total_cost=cost,
+            currency=r.get('currency') or result.get('currency') or 'EUR',
+            transit_days=transit_days(r.get('delivery_days')),
+            delivery_info=str(r.get('delivery_days') or ''),
+            rate_type=r.get('rate_type', ''),
+            simulated=simulated or 'Simulated' in str(r.get('rate_type', '')),
+            vat_included=vat_included,
+            net_price=_money(r.get('base_cost')) if vat_included else cost,
+        ))
+    return rates
+
+
+def _quote_ups(client, spec: ShipmentSpec) -> List[Rate]:
+    return _ups_rates('UPS', client.get_quote(
+        spec.origin_country, spec.origin_postal, spec.destination_country, spec.destination_postal,
+        packages=_ups_packages(spec)
+    ))
+
+
+def _quote_ups_a65c50(client, spec: ShipmentSpec) -> List[Rate]:
+    return _ups_rates('UPS_A65C50', client.get_quote(
+        spec.origin_country, spec.origin_postal, spec.destination_country, spec.destination_postal,
+        packages=_ups_packages(spec)
+    ))
+
+
+_DHL_DAYS_RE = re.compile(r'\((\d+) giorni')
+
+
+def _dhl_transit_days(delivery_info: str) -> Optional[int]:
+    # delivery_info: "Consegna: 2026-01-15 entro le 12:00 (2 giorni lavorativi)"
+    match = _DHL_DAYS_RE.search(delivery_info or '')
+    return int(match.group(1)) if match else None
+
+
+def _quote_dhl(client, spec: ShipmentSpec) -> List[Rate]:
+    from dhl_quote import ShipmentQuoteRequest
+
+    first = spec.parcels[0]
+    result = client.get_quote(ShipmentQuoteRequest(
+        origin_country=spec.origin_country, origin_city=spec.origin_city,
+        origin_postal_code=spec.origin_postal,
+        destination_country=spec.destination_country, destination_city=spec.destination_city,
+        destination_postal_code=spec.destination_postal,
+        weight_kg=spec.total_weight,
+        length_cm=first.length_cm, width_cm=first.width_cm, height_cm=first.height_cm,
+        declared_value=spec.value_eur,
+        is_dutiable=not spec.is_documents,
+        packages=_ups_packages(spec),
+    ))
+    if result.get('error'):
+        raise RuntimeError(result['error'])
+    rates = []
+    for s in result.get('services', []):
+        cost = round(float(s.get('raw_price', 0)), 2)
+        # raw_price è comprensivo di tasse: imponibile dall'importo tasse DHL se presente
+        tax = _money(s.get('tax_amount'))
+        rates.append(Rate(
+            source='DHL', carrier='DHL',
+            service_code=s.get('service_code', ''), service_name=s.get('service_name', ''),
+            total_cost=cost, currency=s.get('currency', 'EUR'),
+            transit_days=_dhl_transit_days(s.get('delivery_info', '')),
+            delivery_info=s.get('delivery_info', ''),
+            rate_type=result.get('customer_code_used', ''),
+            vat_included=True,
+            net_price=round(cost - tax, 2) if tax is not None else None,
+        ))
+    return rates
+
+
+def _quote_spediamopro(client, spec: ShipmentSpec) -> List[Rate]:
+    packages = [{'weight': p.weight_kg, 'length': p.length_cm, 'width': p.width_cm, 'height': p.height_cm,
+                 'is_envelope': p.is_envelope, 'value': p.value} for p in spec.parcels]
+    result = client.get_simulation(
+        spec.origin_country, spec.origin_postal, spec.origin_city,
+        spec.destination_country, spec.destination_postal, spec.destination_city,
+        packages, value_eur=spec.value_eur, is_documents=spec.is_documents
+    )
+    if result.get('error'):
+        raise RuntimeError(result['error'])
+    # Le tariffe simulate (API non disponibile, solo in debug) hanno una nota e delivery_time
+    simulated = 'SIMULATE' in str(result.get('note', '')).upper()
+    rates = []
+    for r in result.get('rates', []):
+        cost = _money(r.get('total_cost'))
+        if cost is None:
+            continue
+        days = r.get('delivery_days') or r.get('delivery_time')
+        # Tariffe IVA inclusa: imponibile dalla risposta se il prezzo non è stato personalizzato
+        net = _money((r.get('details') or {}).get('tariffa_iva_esclusa'))
+        if not net or _money(r.get('original_price', cost)) != cost:
+            net = None
+        rates.append(Rate(
+            source='SPEDIAMOPRO', carrier=(r.get('carrier') or 'SPEDIAMOPRO').upper(),
+            service_code=r.get('service_code', ''), service_name=r.get('service_name', ''),
+            total_cost=cost, currency=r.get('currency', 'EUR'),
+            transit_days=transit_days(days),
+            delivery_info=str(r.get('delivery_date') or days or ''),
+            rate_type='SpediamoPro',
+            simulated=simulated,
+            vat_included=True,
+            net_price=net,
+        ))
+    return rates
+
+
+def _ups_client():
+    from ups_quote import UPSQuoteClient
+    return UPSQuoteClient()
+
+
+def _ups_a65c50_client():
+    from ups_quote_n import UPSQuoteClientN
+    return UPSQuoteClientN()
+
+
+def _dhl_client():
+    from dhl_quote import DHLQuoteClient
+    return DHLQuoteClient()
+
+
+def _spediamopro_client():
+    from spediamopro_quote import SpediamoproQuoteClient
+    return SpediamoproQuoteClient()
+
+
+# Sorgente -> (costruttore del client, adapter)
+SOURCES: Dict[str, tuple] = {
+    'UPS': (_ups_client, _quote_ups),
+    'UPS_A65C50': (_ups_a65c50_client, _quote_ups_a65c50),
+    'DHL': (_dhl_client, _quote_dhl),
+    'SPEDIAMOPRO': (_spediamopro_client, _quote_spediamopro),
+}
+
+
+def rank(rates: List[Rate], sort: str = 'price') -> List[Rate]:
+    """
+    Ordina le tariffe
+
+    Args:
+        sort: 'price' (imponibile, poi giorni) o 'transit' (giorni, poi imponibile);
+              le tariffe in valute diverse da EUR e quelle simulate vanno in fondo
+
+    Il prezzo confrontato è net_price: le sorgenti riportano totali con e senza IVA.
+    """
+    def days(r: Rate) -> float:
+        return r.transit_days if r.transit_days is not None else float('inf')
+
+    if sort == 'transit':
+        key = lambda r: (r.simulated, r.currency != 'EUR', days(r), r.net_price)  # noqa: E731
+    else:
+        key = lambda r: (r.simulated, r.currency != 'EUR', r.net_price, days(r))  # noqa: E731
+    return sorted(rates, key=key)
+
+
+class _SourcePools:
+    """
+    Un pool di thread per sorgente con al massimo `workers` chiamate in corso
+
+    Le chiamate oltre la deadline proseguono in background fino al timeout
+    HTTP del client: con pool separati una sorgente lenta occupa solo i
+    propri thread, e a pool pieno le nuove richieste per quella sorgente
+    falliscono subito invece di accodarsi (e di ritardare le altre sorgenti).
+    """
+
+    def __init__(self, workers: int, prefix: str, reject: bool = True):
+        self.workers = workers
+        self.prefix = prefix
+        self.reject = reject        # False: a pool pieno le chiamate si accodano (batch)
+        self._pools: Dict[str, ThreadPoolExecutor] = {}
+        self._inflight: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, source: str, fn: Callable, *args) -> Optional[Future]:
+        """Future della chiamata, o None se la sorgente ha già `workers` chiamate in corso"""
+        with self._lock:
+            if self.reject and self._inflight.get(source, 0) >= self.workers:
+                LOG.warning("⚠️ %s: %d chiamate %s già in corso, richiesta rifiutata", self.prefix, self.workers, source)
+                return None
+            self._inflight[source] = self._inflight.get(source, 0) + 1
+            pool = self._pools.get(source)
+            if pool is None:
+                pool = self._pools[source] = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix=f"{self.prefix}-{source.lower()}")
+        future = pool.submit(fn, *args)
+        future.add_done_callback(lambda _: self._release(source))
+        return future
+
+    def _release(self, source: str) -> None:
+        with self._lock:
+            self._inflight[source] -= 1
+
+
+class QuoteAggregator:
+    """Interroga le sorgenti di preventivi in parallelo entro una deadline"""
+
+    def __init__(self, config: Optional[QuoteConfig] = None):
+        self.config = config or QuoteConfig.from_env()
+        unknown = [s for s in self.config.sources if s not in SOURCES]
+        if unknown:
+            LOG.warning("Sorgenti preventivi sconosciute ignorate: %s", ', '.join(unknown))
+        self.sources = tuple(s for s in self.config.sources if s in SOURCES)
+        # Pool per sorgente, separati per le richieste interattive e per i batch
+        self._pools = _SourcePools(self.config.source_workers, 'quote')
+        self._batch_pools = _SourcePools(self.config.batch_concurrency, 'quote-batch', reject=False)
+        self._clients: Dict[str, Any] = {}
+        self._clients_lock = threading.Lock()
+
+    def _client(self, source: str):
+        # Un client per sorgente, creato al primo uso (sessioni e token riusati)
+        with self._clients_lock:
+            client = self._clients.get(source)
+            if client is None:
+                client = self._clients[source] = SOURCES[source][0]()
+                # Oltre la deadline massima la risposta non serve: il thread si libera al timeout HTTP
+                config = getattr(client, 'config', None)
+                if getattr(config, 'timeout', None):
+                    config.timeout = min(config.timeout, self.config.max_deadline)
+                    session = getattr(client, 'session', None)
+                    if session is not None and hasattr(session, 'timeout'):
+                        session.timeout = config.timeout
+            return client
+
+    def _cached(self, source: str, spec: ShipmentSpec) -> Optional[SourceResult]:
+        start = time.monotonic()
+        cache = quote_cache.get_cache()
+        if not cache.serves(spec):
+            return None
+        rates = cache.get(source, cache.key(source, spec))
+        if rates is None:
+            return None
+        return SourceResult(source, 'ok', [Rate(**r) for r in rates],
+                            round((time.monotonic() - start) * 1000, 1), cached=True)
+
+    def _run_source(self, source: str, spec: ShipmentSpec) -> SourceResult:
+        start = time.monotonic()
+        cache = quote_cache.get_cache()
+        try:
+            if cache.serves(spec):
+                # Senza QUOTE_CACHE_BRACKET_PRICING la spedizione è già a fine scaglione (normalize non la cambia)
+                key = cache.key(source, spec)
+                rates = SOURCES[source][1](self._client(source), quote_cache.normalize(spec))
+                cache.set(source, key, [r.to_dict() for r in rates])
+            else:
+                rates = SOURCES[source][1](self._client(source), spec)
+            return SourceResult(source, 'ok', rates, round((time.monotonic() - start) * 1000, 1))
+        except Exception as e:
+            LOG.warning("⚠️ Preventivo %s fallito: %s", source, e)
+            return SourceResult(source, 'error', [], round((time.monotonic() - start) * 1000, 1), str(e))
+
+    def effective_deadline(self, deadline: Optional[float] = None) -> float:
+        if deadline is None or not math.isfinite(deadline) or deadline <= 0:
+            return self.config.deadline
+        return min(float(deadline), self.config.max_deadline)
+
+    def select(self, sources: Optional[List[str]] = None) -> List[str]:
+        return [s for s in (sources or self.sources) if s in SOURCES]
+
+    def submit(self, spec: ShipmentSpec, sources: Optional[List[str]] = None,
+               batch: bool = False) -> Dict[str, Optional[Future]]:
+        """Avvia le chiamate alle sorgenti: sorgente -> future (None se il suo pool è pieno)"""
+        pools = self._batch_pools if batch else self._pools
+        return {s: pools.submit(s, self._run_source, s, spec) for s in self.select(sources)}
+
+    def iter_quotes(self, spec: ShipmentSpec, deadline: Optional[float] = None,
+                    sources: Optional[List[str]] = None, use_cache: bool = True,
+                    batch: bool = False) -> Iterator[SourceResult]:
+        """
+        Risultati delle sorgenti nell'ordine di arrivo
+
+        Prima le sorgenti in cache, poi le altre man mano che rispondono. Allo
+        scadere della deadline restituisce un SourceResult 'timeout' per ogni
+        sorgente ancora in corso (le chiamate proseguono in background).
+        Con use_cache=False tutte le sorgenti vengono richieste e la cache aggiornata.
+        Con batch=True le chiamate usano i pool riservati ai batch.
+        """
+        limit = self.effective_deadline(deadline)
+        missing = []
+        for source in self.select(sources):
+            result = self._cached(source, spec) if use_cache else None
+            if result is None:
+                missing.append(source)
+            else:
+                yield result
+        if not missing:
+            return
+        futures = {}
+        for source, future in self.submit(spec, missing, batch).items():
+            if future is None:
+                yield SourceResult(source, 'error', [], 0.0, f"Troppe richieste in corso per {source}")
+            else:
+                futures[future] = source
+        pending = dict(futures)
+        try:
+            for future in as_completed(futures, timeout=limit):
+                pending.pop(future, None)
+                yield future.result()
+        except FutureTimeoutError:
+            for future, source in pending.items():
+                future.cancel()
+                yield SourceResult(source, 'timeout', [], round(limit * 1000, 1),
+                                   f"Nessuna risposta entro {limit:g}s")
+
+    def quote(self, spec: ShipmentSpec, deadline: Optional[float] = None, sort: str = 'price',
+              sources: Optional[List[str]] = None,
+              on_result: Optional[Callable[[SourceResult], None]] = None,
+              use_cache: bool = True, batch: bool = False) -> Dict[str, Any]:
+        """
+        Preventivo aggregato
+
+        Args:
+            spec: Spedizione
+            deadline: Secondi massimi (default QUOTE_DEADLINE, al massimo QUOTE_MAX_DEADLINE)
+            sort: 'price' o 'transit'
+            sources: Sottoinsieme di sorgenti (default tutte quelle configurate)
+            on_result: Chiamata per ogni sorgente appena disponibile
+            use_cache: False per ignorare la cache (le risposte la aggiornano comunque)
+            batch: True per usare i pool riservati ai batch
+
+        Returns:
+            Dict con rates ordinate, cheapest/fastest, esito per sorgente e flag partial
+        """
+        start = time.monotonic()
+        results = []
+        for result in self.iter_quotes(spec, deadline, sources, use_cache, batch):
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+        return self.summarize(results, sort, time.monotonic() - start)
+
+    @staticmethod
+    def summarize(results: List[SourceResult], sort: str = 'price', elapsed: float = 0.0) -> Dict[str, Any]:
+        """Combina gli esiti delle sorgenti in un preventivo ordinato"""
+        rates = rank([r for result in results for r in result.rates], sort)
+        # cheapest/fastest solo tra tariffe reali in EUR
+        real = [r for r in rates if not r.simulated and r.currency == 'EUR']
+        cheapest = min(real, key=lambda r: r.net_price, default=None)
+        fastest = min((r for r in real if r.transit_days is not None),
+                      key=lambda r: (r.transit_days, r.net_price), default=None)
+        return {
+            'rates': [r.to_dict() for r in rates],
+            'cheapest': cheapest.to_dict() if cheapest else None,
+            'fastest': fastest.to_dict() if fastest else None,
+            'sources': {r.source: {'status': r.status, 'elapsed_ms': r.elapsed_ms, 'error': r.error,
+                                   'rates': len(r.rates), 'cached': r.cached} for r in results},
+            'partial': any(r.status != 'ok' for r in results),
+            'elapsed_ms': round(elapsed * 1000, 1),
+            'sort': sort,
+        }
+
+    def iter_batch(self, records: Iterable[Any], deadline: Optional[float] = None, sort: str = 'price',
+                   sources: Optional[List[str]] = None, use_cache: bool = True,
+                   concurrency: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Preventivi di un elenco di spedizioni, uno per riga appena pronto
+
+        Le righe sono lette da `records` solo quando c'è una slot libera (al
+        massimo `concurrency` spedizioni in corso, default QUOTE_BATCH_CONCURRENCY):
+        la memoria resta costante anche per file da migliaia di righe.
+
+        Args:
+            records: Dict come per ShipmentSpec.from_dict (campo opzionale 'ref'
+                     riportato nella risposta); un'eccezione al posto del dict
+                     indica una riga non leggibile
+
+        Yields:
+            {'type': 'quote', 'row', 'ref', ...summarize()} oppure
+            {'type': 'error', 'row', 'ref', 'error'} nell'ordine di completamento
+        """
+        concurrency = max(1, min(concurrency or self.config.batch_concurrency, self.config.batch_concurrency))
+        pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='quote-batch')
+        pending: Dict[Future, tuple] = {}
+
+        def line(future: Future, row: int, ref: Any) -> Dict[str, Any]:
+            try:
+                return {'type': 'quote', 'row': row, 'ref': ref, **future.result()}
+            except Exception as e:
+                return {'type': 'error', 'row': row, 'ref': ref, 'error': str(e)}
+
+        try:
+            for row, record in enumerate(records):
+                if row >= self.config.batch_max_rows:
+                    yield {'type': 'error', 'row': row, 'ref': None,
+                           'error': f"Limite di {self.config.batch_max_rows} righe: le successive sono ignorate"}
+                    break
+                ref = record.get('ref') if isinstance(record, dict) else None
+                try:
+                    if isinstance(record, Exception):
+                        raise record
+                    if not isinstance(record, dict):
+                        raise ValueError("Ogni spedizione deve essere un oggetto JSON")
+                    spec = ShipmentSpec.from_dict(record)
+                except Exception as e:
+                    # Una riga non valida produce la sua riga di errore senza interrompere il batch
+                    yield {'type': 'error', 'row': row, 'ref': ref, 'error': str(e)}
+                    continue
+                pending[pool.submit(self.quote, spec, deadline, sort, sources,
+                                    use_cache=use_cache, batch=True)] = (row, ref)
+                if len(pending) >= concurrency:
+                    # Tutte le slot occupate: aspetta prima di leggere altre righe
+                    wait(pending, return_when=FIRST_COMPLETED)
+                for future in [f for f in pending if f.done()]:
+                    yield line(future, *pending.pop(future))
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield line(future, *pending.pop(future))
+        finally:
+            # Client disconnesso o batch interrotto: le spedizioni non avviate vengono annullate
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+# --- lettura dei batch ------------------------------------------------------
+
+_BOOL_FIELDS = ('is_envelope', 'is_documents')
+_NUMBER_FIELDS = ('weight_kg', 'weight', 'length_cm', 'length', 'width_cm', 'width',
+                  'height_cm', 'height', 'value', 'value_eur')
+_TRUE_VALUES = ('1', 'true', 'si', 'sì', 'yes', 'y', 'x')
+
+
+def _csv_record(row: Dict[Optional[str], Any]) -> Dict[str, Any]:
+    record = {}
+    for key, value in row.items():
+        if key is None or not isinstance(value, str) or not value.strip():
+            continue  # colonne in più o celle vuote (valgono i default)
+        key, value = key.strip().lower(), value.strip()
+        if key in _BOOL_FIELDS:
+            record[key] = value.lower() in _TRUE_VALUES
+        elif key in _NUMBER_FIELDS:
+            record[key] = value.replace(',', '.')  # virgola decimale (Excel italiano)
+        else:
+            record[key] = value
+    return record
+
+
+def records_from_csv(lines: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    """
+    Spedizioni da un CSV con intestazione, lette riga per riga
+
+    Colonne come i campi di ShipmentSpec.from_dict (origin_country,
+    origin_postal, destination_country, destination_postal, weight_kg,
+    length_cm, ..., ref); separatore ',' o ';' riconosciuto dall'intestazione.
+    """
+    lines = iter(lines)
+    header = next(lines, '')
+    delimiter = ';' if header.count(';') > header.count(',') else ','
+    fieldnames = next(csv.reader([header], delimiter=delimiter), [])
+    for row in csv.DictReader(lines, fieldnames=fieldnames, delimiter=delimiter):
+        record = _csv_record(row)
+        if record:
+            yield record
+
+
+def records_from_ndjson(lines: Iterable[str]) -> Iterator[Any]:
+    """Spedizioni da NDJSON (un oggetto per riga); le righe non valide diventano ValueError"""
+    for number, text in enumerate(lines, 1):
+        text = text.strip()
+        if not text:
+            continue
+        try:
+            yield json.loads(text)
+        except ValueError as e:
+            yield ValueError(f"Riga {number}: JSON non valido ({e})")
+
+
+_aggregator: Optional[QuoteAggregator] = None
+_aggregator_lock = threading.Lock()
+
+
+def get_aggregator() -> QuoteAggregator:
+    """Restituisce l'aggregatore (unico per processo, pool di thread condiviso)"""
+    global _aggregator
+    with _aggregator_lock:
+        if _aggregator is None:
+            _aggregator = QuoteAggregator()
+        return _aggregator
@@ -0,0 +1,388 @@
+"""
+Quote Cache - Preventivi in cache per tratta e scaglione di peso
+
+I preventivi si ripetono quasi sempre sulle stesse tratte e sugli stessi
+pesi: la cache li conserva per sorgente con chiave normalizzata
+ - tratta: paese + prime QUOTE_CACHE_POSTAL_PREFIX cifre del CAP di
+   origine e destinazione (0 = solo il paese)
+ - scaglione del peso tassabile (max tra peso reale e volumetrico) di ogni
+   collo, arrotondato per eccesso (0.5 kg fino a 10 kg, 1 kg oltre:
+   DEFAULT_QUOTE_WEIGHT_STEPS)
+ - documenti/merce e valore dichiarato
+
+Il corriere viene sempre interrogato con il peso reale, quindi la cache
+serve solo le spedizioni con ogni collo già a fine scaglione (on_bracket,
+es. 2.5 kg o 31 kg): il prezzo è identico a quello senza cache. Con
+QUOTE_CACHE_BRACKET_PRICING=1 il corriere viene invece interrogato a fine
+scaglione (normalize) e la risposta vale per tutta la chiave: più hit, ma
+prezzi arrotondati per eccesso fino a un passo di peso. Le voci valgono fino al cambio di listino
+giornaliero (QUOTE_CACHE_ROLLOVER_HOUR) e la data del listino è parte della
+chiave. Sono salvate solo risposte con tariffe reali (no errori o simulazioni).
+
+La cache locale è un LRU in memoria (QUOTE_CACHE_MAX_ENTRIES); con
+QUOTE_CACHE_SHARED=1 anche su shared_state, condivisa tra i worker.
+
+QuoteCacheWarmer preriscalda ogni notte (QUOTE_WARM_HOUR) le QUOTE_WARM_TOP
+tratte più frequenti degli ultimi QUOTE_WARM_DAYS giorni di spedizioni.
+
+Uso:
+    python quote_cache.py --warm [tratte]
+"""
+
+import json
+import math
+import time
+import logging
+import sqlite3
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import replace
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import dim_weight
+import shared_state
+from config import DEFAULT_QUOTE_WEIGHT_STEPS, QuoteCacheConfig
+
+LOG = logging.getLogger(__name__)
+
+_NAMESPACE = 'quotes'
+
+# Versione dello schema delle tariffe in cache (quote_aggregator.Rate): le voci
+# salvate con uno schema precedente non vengono più lette
+SCHEMA_VERSION = 1
+
+# Righe di spedizioni lette al massimo per scegliere le tratte da preriscaldare
+WARM_SCAN_LIMIT = 50000
+
+
+def chargeable_weight(parcel) -> float:
+    """Peso tassabile di un collo (dim_weight, divisore di default)"""
+    return dim_weight.chargeable_weight(parcel.weight_kg, parcel.length_cm, parcel.width_cm,
+                                        parcel.height_cm, parcel.is_envelope)
+
+
+def weight_bracket(weight: float, steps: Sequence[Tuple[float, float]] = DEFAULT_QUOTE_WEIGHT_STEPS) -> float:
+    """Peso di fine scaglione (arrotondato per eccesso al passo della fascia)"""
+    step = steps[-1][1]
+    for limit, fascia_step in steps:
+        if weight <= limit:
+            step = fascia_step
+            break
+    # round() evita che 2.0000001 (errori float) passi allo scaglione successivo
+    return round(max(1, math.ceil(round(weight / step, 6))) * step, 3)
+
+
+def _postal(value: str, prefix: int) -> str:
+    value = ''.join(str(value or '').split()).upper()
+    return value[:prefix] if prefix > 0 else ''
+
+
+def normalize(spec):
+    """Spedizione con il peso di ogni collo portato a fine scaglione (da inviare al corriere)"""
+    return replace(spec, parcels=[replace(p, weight_kg=weight_bracket(chargeable_weight(p)))
+                                  for p in spec.parcels])
+
+
+def on_bracket(spec) -> bool:
+    """True se il peso reale di ogni collo è già quello di fine scaglione (normalize non lo cambia)"""
+    return all(abs(p.weight_kg - weight_bracket(chargeable_weight(p))) < 1e-6 for p in spec.parcels)
+
+
+class QuoteCache:
+    """Cache LRU dei preventivi per sorgente, tratta e scaglione, valida per il giorno di listino"""
+
+    def __init__(self, config: Optional[QuoteCacheConfig] = None):
+        self.config = config or QuoteCacheConfig.from_env()
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()  # chiave -> (tariffe, scadenza)
+        self._lock = threading.Lock()
+        self._shared = self.config.shared
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.enabled
+
+    def serves(self, spec) -> bool:
+        """True se la spedizione può leggere e scrivere la cache senza alterarne il prezzo"""
+        return self.enabled and (self.config.bracket_pricing or on_bracket(spec))
+
+    def _count(self, source: str, key: str) -> None:
+        with self._lock:
+            stats = self.stats.setdefault(source, {'hits': 0, 'shared_hits': 0, 'misses': 0,
+                                                  'stores': 0, 'evictions': 0})
+            stats[key] += 1
+
+    def tariff_day(self, now: Optional[float] = None) -> date:
+        """Giorno di listino in vigore (cambia alle QUOTE_CACHE_ROLLOVER_HOUR)"""
+        moment = datetime.fromtimestamp(time.time() if now is None else now)
+        return (moment - timedelta(hours=self.config.rollover_hour)).date()
+
+    def expires_at(self, now: Optional[float] = None) -> float:
+        """Timestamp del prossimo cambio di listino"""
+        day = self.tariff_day(now) + timedelta(days=1)
+        return datetime(day.year, day.month, day.day, self.config.rollover_hour).timestamp()
+
+    def lane_key(self, spec) -> str:
+        """Tratta, scaglioni dei colli e tipo di merce (senza sorgente e giorno)"""
+        prefix = self.config.postal_prefix
+        lane = (f"{spec.origin_country}{_postal(spec.origin_postal, prefix)}-"
+                f"{spec.destination_country}{_postal(spec.destination_postal, prefix)}")
+        brackets = sorted((weight_bracket(chargeable_weight(p)), p.is_envelope) for p in spec.parcels)
+        parcels = '+'.join(f"{weight:g}{'E' if envelope else ''}" for weight, envelope in brackets)
+        return f"{lane}:{parcels}:{'D' if spec.is_documents else 'P'}:{spec.value_eur:g}"
+
+    def key(self, source: str, spec, now: Optional[float] = None) -> str:
+        return f"{source}:v{SCHEMA_VERSION}:{self.tariff_day(now).isoformat()}:{self.lane_key(spec)}"
+
+    def get(self, source: str, key: str) -> Optional[List[Dict[str, Any]]]:
+        """Tariffe in cache (copie dei dict) o None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None:
+            self._count(source, 'hits')
+            return [dict(rate) for rate in entry[0]]
+
+        if self._shared:
+            try:
+                payload = shared_state.kv_get(_NAMESPACE, key)
+            except sqlite3.Error as e:
+                LOG.warning("Cache preventivi condivisa non disponibile (%s), uso solo cache locale", e)
+                self._shared = False
+                payload = None
+            if payload is not None:
+                rates = json.loads(payload)
+                self._store_local(source, key, rates, self.expires_at(now))
+                self._count(source, 'shared_hits')
+                return [dict(rate) for rate in rates]
+
+        self._count(source, 'misses')
+        return None
+
+    def set(self, source: str, key: str, rates: List[Dict[str, Any]]) -> None:
+        """Salva le tariffe se reali (almeno una e nessuna simulata)"""
+        if not rates or any(rate.get('simulated') for rate in rates):
+            return
+        now = time.time()
+        expires = self.expires_at(now)
+        rates = [dict(rate) for rate in rates]
+        self._store_local(source, key, rates, expires)
+        self._count(source, 'stores')
+        if self._shared:
+            try:
+                shared_state.kv_set(_NAMESPACE, key, json.dumps(rates, ensure_ascii=False), expires - now)
+            except sqlite3.Error as e:
+                LOG.warning("Cache preventivi condivisa non disponibile (%s), uso solo cache locale", e)
+                self._shared = False
+
+    def _store_local(self, source: str, key: str, rates: List[Dict[str, Any]], expires: float) -> None:
+        evicted = 0
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (rates, expires)
+            while len(self._entries) > self.config.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+        for _ in range(evicted):
+            self._count(source, 'evictions')
+
+    def clear(self) -> None:
+        """Svuota la cache locale"""
+        with self._lock:
+            self._entries.clear()
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Hit ratio per sorgente e occupazione della cache locale"""
+        with self._lock:
+            sources = {source: dict(stats) for source, stats in self.stats.items()}
+            entries = len(self._entries)
+
+        for stats in sources.values():
+            lookups = stats['hits'] + stats['shared_hits'] + stats['misses']
+            stats['hit_ratio'] = round((stats['hits'] + stats['shared_hits']) / lookups, 3) if lookups else 0.0
+
+        hits = sum(s['hits'] + s['shared_hits'] for s in sources.values())
+        lookups = hits + sum(s['misses'] for s in sources.values())
+        return {
+            'enabled': self.config.enabled,
+            'entries': entries,
+            'max_entries': self.config.max_entries,
+            'shared': self._shared,
+            'tariff_day': self.tariff_day().isoformat(),
+            'expires_in': round(self.expires_at() - time.time()),
+            'hit_ratio': round(hits / lookups, 3) if lookups else 0.0,
+            'sources': sources,
+        }
+
+
+_cache: Optional[QuoteCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> QuoteCache:
+    """Restituisce la cache (unica per processo)"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = QuoteCache()
+        return _cache
+
+
+# --- preriscaldamento -----------------------------------------------------
+
+def _number(value: Any) -> float:
+    try:
+        return float(str(value).replace(',', '.'))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def top_lanes(top: int, days: int) -> List[Any]:
+    """
+    Spedizioni rappresentative delle tratte più frequenti nello storico
+
+    Le spedizioni sono raggruppate per lane_key (tratta + scaglioni); per ogni
+    gruppo viene restituita la più recente.
+    """
+    import spedizioni_schema
+    from db_connector import cursor as db_cursor
+    from quote_aggregator import Parcel, ShipmentSpec
+
+    columns = set(spedizioni_schema.get_columns() or ())
+    dims = next((d for d in (('dim_lunghezza', 'dim_larghezza', 'dim_altezza'), ('dim1', 'dim2', 'dim3'))
+                 if columns.issuperset(d)), ())
+    fields = ['mitt_codice_nazione', 'mitt_cap', 'dest_codice_nazione', 'dest_cap', 'peso', 'num_colli', *dims]
+    since = date.today() - timedelta(days=days)
+    with db_cursor() as (conn, cur):
+        cur.execute(
+            f"SELECT {', '.join(fields)} FROM spedizioni "
+            "WHERE data_spedizione >= %s AND peso > 0 AND mitt_cap <> '' AND dest_cap <> '' "
+            "ORDER BY data_spedizione DESC LIMIT %s",
+            (since, WARM_SCAN_LIMIT)
+        )
+        rows = cur.fetchall()
+
+    cache = get_cache()
+    counts: Counter = Counter()
+    samples: Dict[str, Any] = {}
+    for row in rows:
+        origin, origin_cap, dest, dest_cap, weight, colli = row[:6]
+        if not origin or not dest:
+            continue
+        colli = max(1, int(_number(colli) or 1))
+        size = {}
+        if dims and all(_number(v) > 0 for v in row[6:9]):
+            size = dict(zip(('length_cm', 'width_cm', 'height_cm'), (_number(v) for v in row[6:9])))
+        # `peso` è il totale della spedizione: ripartito sui colli
+        parcel = Parcel(weight_kg=_number(weight) / colli, **size)
+        spec = ShipmentSpec(
+            origin_country=str(origin).strip().upper(), origin_postal=str(origin_cap).strip(),
+            destination_country=str(dest).strip().upper(), destination_postal=str(dest_cap).strip(),
+            parcels=[parcel] * colli,
+        )
+        key = cache.lane_key(spec)
+        counts[key] += 1
+        samples.setdefault(key, spec)
+    return [samples[key] for key, _ in counts.most_common(top)]
+
+
+def warm(top: Optional[int] = None, days: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Preriscalda la cache con le tratte più frequenti
+
+    Returns:
+        Dict con tratte considerate, sorgenti interrogate, già in cache ed errori
+    """
+    from quote_aggregator import get_aggregator
+
+    cache = get_cache()
+    top = cache.config.warm_top if top is None else top
+    days = cache.config.warm_days if days is None else days
+    start = time.monotonic()
+    summary = {'lanes': 0, 'fetched': 0, 'cached': 0, 'errors': 0}
+    if not cache.enabled or top <= 0:
+        return summary
+
+    aggregator = get_aggregator()
+    for spec in top_lanes(top, days):
+        summary['lanes'] += 1
+        # A fine scaglione, così la voce è servibile anche senza QUOTE_CACHE_BRACKET_PRICING
+        result = aggregator.quote(normalize(spec))
+        for source in result['sources'].values():
+            if source['status'] != 'ok':
+                summary['errors'] += 1
+            elif source.get('cached'):
+                summary['cached'] += 1
+            else:
+                summary['fetched'] += 1
+    summary['elapsed_s'] = round(time.monotonic() - start, 1)
+    LOG.info("🔥 Cache preventivi preriscaldata: %d tratte, %d richieste ai corrieri, %d già in cache, %d errori",
+             summary['lanes'], summary['fetched'], summary['cached'], summary['errors'])
+    return summary
+
+
+class QuoteCacheWarmer:
+    """Preriscaldamento notturno della cache (un thread, una volta per giorno di listino)"""
+
+    def __init__(self, cache: Optional[QuoteCache] = None):
+        self.cache = cache or get_cache()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> bool:
+        """Avvia il thread (False se disattivato con QUOTE_WARM_HOUR=-1 o cache spenta)"""
+        if self.cache.config.warm_hour < 0 or not self.cache.enabled:
+            return False
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run_loop, name="quote-warmer", daemon=True)
+            self._thread.start()
+            LOG.info("🚀 Preriscaldamento preventivi pianificato alle %02d:00", self.cache.config.warm_hour)
+        return True
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def seconds_until_next_run(self, now: Optional[datetime] = None) -> float:
+        now = now or datetime.now()
+        run = now.replace(hour=self.cache.config.warm_hour, minute=0, second=0, microsecond=0)
+        if run <= now:
+            run += timedelta(days=1)
+        return (run - now).total_seconds()
+
+    def _claim(self) -> bool:
+        # Con la cache condivisa basta un worker per giorno di listino
+        if not self.cache.config.shared:
+            return True
+        try:
+            return shared_state.kv_add(_NAMESPACE, f"warm:{self.cache.tariff_day().isoformat()}", '1', 24 * 3600)
+        except sqlite3.Error:
+            return True
+
+    def _run_loop(self) -> None:
+        while not self._stop.wait(self.seconds_until_next_run()):
+            if not self._claim():
+                continue
+            try:
+                warm()
+            except Exception as e:
+                LOG.error("❌ Preriscaldamento preventivi fallito: %s", e)
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    if "--warm" in sys.argv:
+        numbers = [int(a) for a in sys.argv[1:] if a.isdigit()]
+        print(warm(top=numbers[0] if numbers else None))
+    else:
+        print(json.dumps(get_cache().get_statistics(), indent=2))
+        print("Usa --warm [tratte] per preriscaldare la cache")
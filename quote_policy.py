@@ -0,0 +1,342 @@
+"""
+Quote Policy - Catena di fallback con richieste hedged per i preventivi
+
+I client UPS hanno più modi di ottenere una tariffa (Rating REST OAuth,
+Rating XML, listino simulato; Shipping API o stima per i dettagliati).
+Provandoli in serie, un endpoint lento fa attendere l'intero timeout prima
+che parta l'alternativa. La policy esegue le fasi in ordine con:
+ - un budget per fase (QUOTE_BUDGET_<FASE>): oltre il budget la fase viene
+   abbandonata e parte la successiva
+ - richieste hedged: se una fase non ha risposto entro il percentile
+   QUOTE_HEDGE_PERCENTILE (default p95) delle sue latenze recenti, la fase
+   successiva parte in parallelo; vince la prima risposta valida
+ - fasi di ultima istanza (hedge=False, es. simulazione): partono solo
+   quando le fasi in corso sono fallite o hanno esaurito il budget
+
+Finché una fase non ha QUOTE_HEDGE_MIN_SAMPLES latenze si attende il
+budget. Con QUOTE_HEDGING=0 le fasi tornano seriali (ognuna limitata al
+suo budget). Latenze ed esiti sono tenuti per processo.
+
+Ogni policy ha un proprio pool (QUOTE_POLICY_MAX_WORKERS, default due fasi
+per ogni chiamata in corso della sorgente). Il budget di una fase parte
+quando un thread la esegue: una fase ancora in coda oltre il budget viene
+annullata, una già partita prosegue in background e non viene usata (i
+client limitano il timeout HTTP al budget della fase). Le fasi di ultima
+istanza sono locali (es. listino simulato) e girano nel thread del chiamante,
+quindi rispondono anche con il pool saturo.
+
+Uso:
+    result, trace = get_policy('UPS_A65C50').run([
+        Stage('REST', lambda: ...),
+        Stage('SIMULATION', lambda: ..., hedge=False),
+    ])
+    result['quote_source'] = trace['source']
+"""
+
+import math
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from config import QuotePolicyConfig
+
+LOG = logging.getLogger(__name__)
+
+
+class QuotePolicyTimeout(RuntimeError):
+    """Nessuna fase ha dato una risposta entro il proprio budget"""
+
+
+@dataclass
+class Stage:
+    """Fase della catena: nome (per budget, statistiche e tag) e chiamata"""
+
+    name: str
+    call: Callable[[], Any]
+    hedge: bool = True      # False: ultima istanza locale, eseguita nel thread del chiamante
+
+
+def has_rates(result: Any) -> bool:
+    """Risposta valida per i preventivi: dict senza errore e con almeno una tariffa"""
+    return isinstance(result, dict) and not result.get('error') and bool(result.get('rates'))
+
+
+class _StageStats:
+    """Latenze ed esiti di una fase"""
+
+    __slots__ = ('latencies', 'started', 'wins', 'hedged', 'errors', 'invalid', 'abandoned', 'last_error')
+
+    def __init__(self, window: int):
+        self.latencies = deque(maxlen=window)
+        self.started = 0
+        self.wins = 0
+        self.hedged = 0
+        self.errors = 0
+        self.invalid = 0
+        self.abandoned = 0
+        self.last_error: Optional[str] = None
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+    def to_dict(self, p: float) -> Dict[str, Any]:
+        value = self.percentile(p)
+        return {
+            'started': self.started,
+            'wins': self.wins,
+            'hedged': self.hedged,
+            'errors': self.errors,
+            'invalid': self.invalid,
+            'abandoned': self.abandoned,
+            'samples': len(self.latencies),
+            f'p{p:g}_ms': round(value * 1000, 1) if value is not None else None,
+            'last_error': self.last_error,
+        }
+
+
+class _StartedCall:
+    """Chiamata di una fase che registra quando un thread del pool la esegue"""
+
+    __slots__ = ('call', 'submitted_at', 'started_at')
+
+    def __init__(self, call: Callable[[], Any]):
+        self.call = call
+        self.submitted_at = time.monotonic()
+        self.started_at: Optional[float] = None
+
+    @property
+    def budget_start(self) -> float:
+        """Inizio del budget: esecuzione della fase (in coda: invio al pool)"""
+        return self.started_at if self.started_at is not None else self.submitted_at
+
+    def __call__(self) -> Any:
+        self.started_at = time.monotonic()
+        return self.call()
+
+
+class QuotePolicy:
+    """Esecuzione di una catena di fasi con budget e richieste hedged"""
+
+    def __init__(self, name: str, config: Optional[QuotePolicyConfig] = None):
+        self.name = name
+        self.config = config or QuotePolicyConfig.from_env()
+        self._stats: Dict[str, _StageStats] = {}
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Pool proprio della policy: una sorgente lenta non occupa i thread delle altre
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.config.max_workers,
+                                                    thread_name_prefix=f'quote-stage-{self.name.lower()}')
+            return self._executor
+
+    def _stage_stats(self, stage: str) -> _StageStats:
+        stats = self._stats.get(stage)
+        if stats is None:
+            stats = self._stats[stage] = _StageStats(self.config.window)
+        return stats
+
+    def budget(self, stage: str) -> float:
+        return self.config.budget(stage)
+
+    def hedge_delay(self, stage: str) -> float:
+        """Secondi dopo cui, senza risposta, parte in parallelo la fase successiva"""
+        budget = self.budget(stage)
+        if not self.config.hedging:
+            return budget
+        with self._lock:
+            stats = self._stage_stats(stage)
+            value = stats.percentile(self.config.percentile) if len(stats.latencies) >= self.config.min_samples else None
+        if value is None:
+            return budget
+        return min(budget, max(self.config.min_hedge_delay, value))
+
+    def run(self, stages: List[Stage], is_valid: Callable[[Any], bool] = has_rates) -> Tuple[Any, Dict[str, Any]]:
+        """
+        Esegue le fasi e restituisce la prima risposta valida
+
+        Returns:
+            (risposta, trace): trace con 'source' (fase vincente), 'hedged'
+            (più fasi in corso insieme), 'elapsed_ms' e l'esito di ogni fase
+            ('won', 'error', 'invalid', 'abandoned', 'skipped')
+
+        Raises:
+            L'eccezione dell'ultima fase se tutte sono fallite con eccezione,
+            QuotePolicyTimeout se nessuna ha risposto entro il budget.
+            Se almeno una fase ha dato una risposta non valida (diversa da
+            None), restituisce l'ultima di queste (es. il dict con 'error').
+        """
+        if not stages:
+            raise ValueError("Nessuna fase di preventivo")
+        executor = self._get_executor()
+        start = time.monotonic()
+        outcome = {stage.name: 'skipped' for stage in stages}
+        running: Dict[Future, Tuple[int, _StartedCall]] = {}  # future -> (indice fase, chiamata)
+        launched: List[float] = []                      # avvio di ogni fase avviata
+        last_invalid: Optional[Tuple[str, Any]] = None
+        last_error: Optional[BaseException] = None
+        hedged = False
+
+        def launch(index: int) -> None:
+            nonlocal hedged
+            stage = stages[index]
+            now = time.monotonic()
+            if running:
+                hedged = True
+            with self._lock:
+                stats = self._stage_stats(stage.name)
+                stats.started += 1
+                if running:
+                    stats.hedged += 1
+            if running:
+                LOG.info("⏱️ %s: %s in parallelo (nessuna risposta dopo %.2fs)",
+                         self.name, stage.name, now - launched[-1])
+            launched.append(now)
+            call = _StartedCall(stage.call)
+            if stage.hedge:
+                future = executor.submit(call)
+            else:
+                # Ultima istanza locale: nel thread del chiamante, senza attendere il pool
+                future = Future()
+                try:
+                    future.set_result(call())
+                except Exception as e:
+                    future.set_exception(e)
+            running[future] = (index, call)
+            outcome[stage.name] = 'running'
+
+        def next_launch_at() -> Optional[float]:
+            index = len(launched)
+            if index >= len(stages):
+                return None
+            if not running:
+                return time.monotonic()
+            if not stages[index].hedge:
+                # Ultima istanza: quando tutte le fasi in corso hanno esaurito il budget
+                return max(call.budget_start + self.budget(stages[i].name) for i, call in running.values())
+            if all(i != index - 1 for i, _ in running.values()):
+                # Fase precedente già conclusa senza risposta valida
+                return time.monotonic()
+            return launched[index - 1] + self.hedge_delay(stages[index - 1].name)
+
+        def trace(source: Optional[str]) -> Dict[str, Any]:
+            return {
+                'policy': self.name,
+                'source': source,
+                'hedged': hedged,
+                'elapsed_ms': round((time.monotonic() - start) * 1000, 1),
+                'stages': dict(outcome),
+            }
+
+        def abandon() -> None:
+            with self._lock:
+                for future, (index, _) in running.items():
+                    future.cancel()     # Le fasi ancora in coda non occupano il pool
+                    name = stages[index].name
+                    outcome[name] = 'abandoned'
+                    self._stage_stats(name).abandoned += 1
+            running.clear()
+
+        launch(0)
+        while running or len(launched) < len(stages):
+            now = time.monotonic()
+            # Fasi oltre il budget: annullate se in coda, altrimenti abbandonate
+            # (proseguono in background fino al timeout HTTP)
+            for future, (index, call) in list(running.items()):
+                if not future.done() and now - call.budget_start >= self.budget(stages[index].name):
+                    name = stages[index].name
+                    del running[future]
+                    future.cancel()
+                    outcome[name] = 'abandoned'
+                    with self._lock:
+                        self._stage_stats(name).abandoned += 1
+                    LOG.warning("⚠️ %s: %s oltre il budget di %.1fs", self.name, name, self.budget(name))
+
+            launch_at = next_launch_at()
+            if launch_at is not None and launch_at <= time.monotonic():
+                launch(len(launched))
+                continue
+            if not running:
+                break
+
+            deadlines = [call.budget_start + self.budget(stages[i].name) for i, call in running.values()]
+            if launch_at is not None:
+                deadlines.append(launch_at)
+            done, _ = wait(list(running), timeout=max(0.0, min(deadlines) - time.monotonic()),
+                           return_when=FIRST_COMPLETED)
+
+            for future in done:
+                index, call = running.pop(future)
+                name = stages[index].name
+                latency = time.monotonic() - call.budget_start
+                try:
+                    result = future.result()
+                except Exception as e:
+                    outcome[name] = 'error'
+                    last_error = e
+                    with self._lock:
+                        stats = self._stage_stats(name)
+                        stats.errors += 1
+                        stats.last_error = str(e)
+                    LOG.warning("⚠️ %s: %s fallita: %s", self.name, name, e)
+                    continue
+                if not is_valid(result):
+                    outcome[name] = 'invalid'
+                    if result is not None:
+                        last_invalid = (name, result)
+                    with self._lock:
+                        self._stage_stats(name).invalid += 1
+                    continue
+                outcome[name] = 'won'
+                with self._lock:
+                    stats = self._stage_stats(name)
+                    stats.wins += 1
+                    stats.latencies.append(latency)
+                abandon()
+                return result, trace(name)
+
+        if last_invalid is not None:
+            return last_invalid[1], trace(last_invalid[0])
+        if last_error is not None:
+            raise last_error
+        raise QuotePolicyTimeout(f"{self.name}: nessuna risposta valida entro il budget delle fasi")
+
+    def get_statistics(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = {name: stats.to_dict(self.config.percentile) for name, stats in self._stats.items()}
+        return {
+            'name': self.name,
+            'hedging': self.config.hedging,
+            'percentile': self.config.percentile,
+            'stages': {name: dict(data, budget=self.budget(name), hedge_delay=round(self.hedge_delay(name), 3))
+                       for name, data in stages.items()},
+        }
+
+
+_policies: Dict[str, QuotePolicy] = {}
+_policies_lock = threading.Lock()
+
+
+def get_policy(name: str) -> QuotePolicy:
+    """Policy del servizio (unica per processo, condivisa tra le istanze dei client)"""
+    with _policies_lock:
+        policy = _policies.get(name)
+        if policy is None:
+            policy = _policies[name] = QuotePolicy(name)
+        return policy
+
+
+def get_statistics() -> Dict[str, Any]:
+    """Statistiche di tutte le policy di questo processo"""
+    with _policies_lock:
+        policies = list(_policies.values())
+    return {policy.name: policy.get_statistics() for policy in policies}
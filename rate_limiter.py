@@ -0,0 +1,198 @@
+"""
+Rate limiter token bucket per le API dei vettori
+
+Ogni vettore ha un bucket con velocità di ricarica (richieste/secondo) e
+capacità massima (burst) configurabili tramite RateLimitConfig. Lo stato dei
+bucket è salvato in shared_state, quindi il limite è condiviso tra tutti i
+client, i thread e i worker gunicorn della stessa macchina.
+
+Uso:
+    limiter = get_limiter('UPS')
+    limiter.acquire()   # blocca finché non c'è un token disponibile
+    await limiter.acquire_async()   # stessa cosa dentro un event loop
+"""
+
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+import shared_state
+from config import RateLimitConfig
+
+LOG = logging.getLogger(__name__)
+
+_TABLE_DDL = """
+CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+# Attesa massima tra due tentativi: il bucket può essere svuotato da altri processi
+_MAX_SLEEP = 1.0
+
+
+class RateLimitTimeout(Exception):
+    """Token non disponibile entro il timeout richiesto"""
+
+
+class TokenBucketLimiter:
+    """Token bucket condiviso tra thread e processi"""
+
+    def __init__(self, name: str, rate: float, burst: int):
+        """
+        Args:
+            name: Nome del bucket (di solito il vettore)
+            rate: Token aggiunti al secondo (<= 0 disabilita il limite)
+            burst: Numero massimo di token accumulabili
+        """
+        self.name = name
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+
+        # Fallback locale se il file condiviso non è utilizzabile
+        self._local_lock = threading.Lock()
+        self._local_tokens = float(self.burst)
+        self._local_updated = time.time()
+        self._shared = True
+
+        # Statistiche
+        self.acquired = 0
+        self.total_wait = 0.0
+
+    def acquire(self, tokens: float = 1.0, timeout: Optional[float] = None) -> float:
+        """
+        Attende finché non sono disponibili `tokens` token e li consuma
+
+        Args:
+            tokens: Token da consumare (1 per richiesta)
+            timeout: Attesa massima in secondi (None = senza limite)
+
+        Returns:
+            Secondi di attesa effettivi
+
+        Raises:
+            RateLimitTimeout: Se il timeout scade prima di ottenere i token
+        """
+        if self.rate <= 0:
+            return 0.0
+
+        start = time.monotonic()
+        while True:
+            wait = self._try_acquire(tokens)
+            waited = time.monotonic() - start
+            if wait <= 0:
+                with self._local_lock:
+                    self.acquired += 1
+                    self.total_wait += waited
+                return waited
+            if timeout is not None and waited + wait > timeout:
+                raise RateLimitTimeout(f"Rate limit {self.name}: token non disponibile entro {timeout}s")
+            time.sleep(min(wait, _MAX_SLEEP))
+
+    async def acquire_async(self, tokens: float = 1.0, timeout: Optional[float] = None) -> float:
+        """
+        Come acquire(), ma attende con asyncio.sleep senza bloccare l'event loop
+
+        Con lo stato condiviso la transazione SQLite gira in un thread
+        (asyncio.to_thread): un lock tenuto da un altro processo non ferma il loop.
+        """
+        if self.rate <= 0:
+            return 0.0
+
+        start = time.monotonic()
+        while True:
+            if self._shared:
+                wait = await asyncio.to_thread(self._try_acquire, tokens)
+            else:
+                wait = self._try_acquire(tokens)
+            waited = time.monotonic() - start
+            if wait <= 0:
+                with self._local_lock:
+                    self.acquired += 1
+                    self.total_wait += waited
+                return waited
+            if timeout is not None and waited + wait > timeout:
+                raise RateLimitTimeout(f"Rate limit {self.name}: token non disponibile entro {timeout}s")
+            await asyncio.sleep(min(wait, _MAX_SLEEP))
+
+    def _try_acquire(self, tokens: float) -> float:
+        """Prova a consumare i token. Restituisce 0 se riuscito, altrimenti i secondi da attendere"""
+        if self._shared:
+            try:
+                return self._try_acquire_shared(tokens)
+            except sqlite3.Error as e:
+                LOG.warning("Rate limiter %s: stato condiviso non disponibile (%s), uso limite locale", self.name, e)
+                self._shared = False
+        return self._try_acquire_local(tokens)
+
+    def _refill(self, current: float, updated_at: float, now: float) -> float:
+        return min(float(self.burst), current + max(0.0, now - updated_at) * self.rate)
+
+    def _try_acquire_shared(self, tokens: float) -> float:
+        shared_state.ensure_table('rate_limit_buckets', _TABLE_DDL)
+        with shared_state.transaction() as conn:
+            now = time.time()
+            row = conn.execute(
+                "SELECT tokens, updated_at FROM rate_limit_buckets WHERE name = ?", (self.name,)
+            ).fetchone()
+            available = self._refill(row[0], row[1], now) if row else float(self.burst)
+
+            if available >= tokens:
+                available -= tokens
+                wait = 0.0
+            else:
+                wait = (tokens - available) / self.rate
+
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limit_buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                (self.name, available, now)
+            )
+            return wait
+
+    def _try_acquire_local(self, tokens: float) -> float:
+        with self._local_lock:
+            now = time.time()
+            self._local_tokens = self._refill(self._local_tokens, self._local_updated, now)
+            self._local_updated = now
+            if self._local_tokens >= tokens:
+                self._local_tokens -= tokens
+                return 0.0
+            return (tokens - self._local_tokens) / self.rate
+
+    def get_statistics(self) -> Dict:
+        """Statistiche di utilizzo del bucket in questo processo"""
+        return {
+            'name': self.name,
+            'rate': self.rate,
+            'burst': self.burst,
+            'shared': self._shared,
+            'acquired': self.acquired,
+            'total_wait_seconds': round(self.total_wait, 3),
+        }
+
+
+_limiters: Dict[str, TokenBucketLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(carrier: str) -> TokenBucketLimiter:
+    """Restituisce il limiter (unico per processo) del vettore indicato"""
+    name = carrier.strip().upper()
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            config = RateLimitConfig.from_env(name)
+            limiter = TokenBucketLimiter(name, config.rate, config.burst)
+            _limiters[name] = limiter
+        return limiter
+
+
+def get_all_statistics() -> Dict[str, Dict]:
+    """Statistiche di tutti i limiter creati in questo processo"""
+    with _limiters_lock:
+        return {name: limiter.get_statistics() for name, limiter in _limiters.items()}
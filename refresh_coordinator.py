@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Refresh Coordinator - Aggiornamento tracking single-flight per processo
+
+Le visite alla dashboard chiedono un aggiornamento del tracking invece di
+avviarne uno proprio. Il coordinatore esegue al massimo un ciclo alla volta:
+ - se un ciclo è già in corso la richiesta si unisce a quello
+ - se l'ultimo ciclo è più recente di TRACKING_REFRESH_MIN_AGE secondi
+   la richiesta viene scartata
+ - altrimenti avvia un nuovo ciclo in un thread in background
+
+Lo stato del ciclo è disponibile con get_status() per la UI.
+"""
+
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from db_connector import cursor as db_cursor
+
+LOG = logging.getLogger(__name__)
+
+# Età minima (secondi) dell'ultimo ciclo prima di avviarne un altro
+DEFAULT_MIN_AGE = 300
+
+
+def _min_age_from_env() -> int:
+    value = os.getenv("TRACKING_REFRESH_MIN_AGE")
+    if value is None:
+        return DEFAULT_MIN_AGE
+    try:
+        return max(0, int(value))
+    except ValueError:
+        LOG.warning("Valore TRACKING_REFRESH_MIN_AGE non valido: %s", value)
+        return DEFAULT_MIN_AGE
+
+
+class RefreshCoordinator:
+    """Coordina gli aggiornamenti tracking richiesti dalle pagine (uno alla volta)"""
+
+    def __init__(self, min_age: Optional[int] = None, executor=None):
+        """
+        Args:
+            min_age: Secondi minimi tra due cicli (default TRACKING_REFRESH_MIN_AGE)
+            executor: TrackingExecutor da usare (creato al primo ciclo se None)
+        """
+        self.min_age = _min_age_from_env() if min_age is None else max(0, int(min_age))
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+        # Stato esposto alla UI
+        self.running = False
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self._finished_monotonic: Optional[float] = None
+        self.last_cycle: Dict[str, Any] = {}
+        self.last_error: Optional[str] = None
+        self.requests = {"started": 0, "joined": 0, "skipped": 0}
+
+    def request_refresh(self, force: bool = False) -> Dict[str, Any]:
+        """
+        Chiede un aggiornamento del tracking delle spedizioni in transito
+
+        Args:
+            force: Ignora l'età minima dell'ultimo ciclo
+
+        Returns:
+            Dict con 'action' ('started', 'joined' o 'skipped') e lo stato corrente
+        """
+        with self._lock:
+            if self.running:
+                action = "joined"
+            elif (not force and self._finished_monotonic is not None
+                  and time.monotonic() - self._finished_monotonic < self.min_age):
+                action = "skipped"
+            else:
+                action = "started"
+                self.running = True
+                self.started_at = datetime.now()
+                self.last_error = None
+                self._thread = threading.Thread(target=self._run, name="tracking-refresh", daemon=True)
+                self._thread.start()
+            self.requests[action] += 1
+
+        LOG.debug("Richiesta refresh tracking: %s", action)
+        status = self.get_status()
+        status["action"] = action
+        return status
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Attende la fine del ciclo in corso. Restituisce False se il timeout scade"""
+        thread = self._thread
+        if thread is None:
+            return True
+        thread.join(timeout)
+        return not thread.is_alive()
+
+    def _run(self) -> None:
+        try:
+            shipments = self._load_shipments()
+            LOG.info(f"🔄 Aggiornamento tracking per {len(shipments)} spedizioni in transito")
+            cycle = self._get_executor().run(shipments)
+            with self._lock:
+                self.last_cycle = cycle
+            LOG.info(f"✅ Aggiornamento tracking completato")
+        except Exception as e:
+            LOG.error(f"❌ Errore aggiornamento tracking automatico: {e}")
+            with self._lock:
+                self.last_error = str(e)
+        finally:
+            with self._lock:
+                self.running = False
+                self.finished_at = datetime.now()
+                self._finished_monotonic = time.monotonic()
+
+    def _get_executor(self):
+        if self._executor is None:
+            from tracking_executor import TrackingExecutor
+            self._executor = TrackingExecutor()
+        return self._executor
+
+    def _load_shipments(self) -> List[Dict[str, Any]]:
+        """Spedizioni in transito (final_position = 0) con vettore e AWB"""
+        with db_cursor() as (conn, cur):
+            cur.execute("""
+                SELECT id, vettore, awb FROM spedizioni
+                WHERE final_position = 0
+                AND awb IS NOT NULL
+                AND vettore IS NOT NULL
+                ORDER BY data_spedizione DESC
+            """)
+            return [{"id": row[0], "vettore": row[1], "awb": row[2]} for row in cur.fetchall()]
+
+    def get_status(self) -> Dict[str, Any]:
+        """Stato dell'ultimo ciclo e contatori delle richieste"""
+        with self._lock:
+            age = None
+            if self._finished_monotonic is not None:
+                age = round(time.monotonic() - self._finished_monotonic, 1)
+            cycle = self.last_cycle
+            return {
+                "running": self.running,
+                "started_at": self.started_at.isoformat() if self.started_at else None,
+                "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+                "age_seconds": age,
+                "min_age_seconds": self.min_age,
+                "last_error": self.last_error,
+                "last_cycle": {
+                    key: cycle.get(key)
+                    for key in ("duration_seconds", "total", "updated", "failed", "skipped")
+                } if cycle else {},
+                "requests": dict(self.requests),
+            }
+
+
+_coordinator: Optional[RefreshCoordinator] = None
+_coordinator_lock = threading.Lock()
+
+
+def get_coordinator() -> RefreshCoordinator:
+    """Restituisce il coordinatore unico del processo"""
+    global _coordinator
+    with _coordinator_lock:
+        if _coordinator is None:
+            _coordinator = RefreshCoordinator()
+        return _coordinator
@@ -0,0 +1,224 @@
+"""
+Row Mapper - Conversione compilata righe `spedizioni` -> JSON
+
+Il piano colonna -> campo (indici delle colonne, campi assenti, liste di
+alternative) viene calcolato una volta per forma del risultato (nomi delle
+colonne di cursor.description) e tenuto in cache; ogni riga viene poi
+convertita con soli accessi per indice.
+
+Le informazioni evento (nome + colore di last_position) sono calcolate una
+volta per coppia (vettore, codice) per ogni pagina.
+
+Uso:
+    mapper = get_mapper(cur.description)
+    items = mapper.map_rows(cur.fetchall(), get_event_info)
+"""
+
+import functools
+from datetime import datetime, date
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Modalità dei campi:
+#  - 'get': valore della colonna (None se la colonna manca)
+#  - 'pick': primo valore non vuoto tra le colonne candidate (None se nessuno)
+_TOP_FIELDS = (
+    ("servizio", "pick", ("servizio", "service", "product", "tipo_servizio", "service_code")),
+    ("tariffa", "pick", ("tariffa", "price", "fare", "rate", "amount_before_tax", "tariff", "prezzo")),
+    ("iva", "pick", ("iva", "vat", "tax", "tax_amount", "iva_amount")),
+    ("totale", "pick", ("totale", "total", "amount", "grand_total", "totale_da_pagare", "prezzo_totale")),
+    ("num_colli", "pick", ("num_colli", "colli", "pieces")),
+    ("peso", "pick", ("peso", "weight", "total_weight", "peso_kg")),
+    ("dim1", "pick", ("dim1", "dim_lunghezza", "lunghezza", "length")),
+    ("dim2", "pick", ("dim2", "dim_larghezza", "larghezza", "width")),
+    ("dim3", "pick", ("dim3", "dim_altezza", "altezza", "height")),
+)
+
+_MITTENTE_FIELDS = (
+    ("nome", "pick", ("mitt_ragione_sociale", "mitt_cliente", "mitt_contatto", "mitt_citta", "mitt_codice_nazione")),
+    ("citta", "get", ("mitt_citta",)),
+    ("codice_nazione", "get", ("mitt_codice_nazione",)),
+    ("cliente", "get", ("mitt_cliente",)),
+    ("ragione_sociale", "get", ("mitt_ragione_sociale",)),
+    ("identificativo", "get", ("mitt_identificativo",)),
+    ("indirizzo", "pick", ("mitt_indirizzo", "mitt_indirizzo2", "mitt_indirizzo3")),
+    ("indirizzo2", "get", ("mitt_indirizzo2",)),
+    ("indirizzo3", "get", ("mitt_indirizzo3",)),
+    ("civico", "get", ("mitt_civico",)),
+    ("cap", "pick", ("mitt_cap",)),
+    ("provincia", "pick", ("mitt_provincia",)),
+    ("paese", "pick", ("mitt_nazione", "mitt_codice_nazione")),
+    ("contatto", "pick", ("mitt_contatto",)),
+    ("telefono", "pick", ("mitt_telefono", "mitt_cellulare")),
+    ("cellulare", "get", ("mitt_cellulare",)),
+    ("email", "pick", ("mitt_email",)),
+    ("riferimento", "get", ("mitt_riferimento",)),
+    ("partita_iva", "get", ("mitt_partita_iva",)),
+    ("eori", "get", ("mitt_eori",)),
+    ("info", "get", ("mitt_info",)),
+)
+
+_DESTINATARIO_FIELDS = (
+    ("nome", "pick", ("dest_ragione_sociale", "dest_cliente", "dest_contatto", "dest_citta", "dest_codice_nazione")),
+    ("cliente", "get", ("dest_cliente",)),
+    ("ragione_sociale", "get", ("dest_ragione_sociale",)),
+    ("identificativo", "get", ("dest_identificativo",)),
+    ("indirizzo", "pick", ("dest_indirizzo", "dest_indirizzo2", "dest_indirizzo3")),
+    ("indirizzo2", "get", ("dest_indirizzo2",)),
+    ("indirizzo3", "get", ("dest_indirizzo3",)),
+    ("civico", "get", ("dest_civico",)),
+    ("cap", "pick", ("dest_cap",)),
+    ("citta", "pick", ("dest_citta",)),
+    ("provincia", "pick", ("dest_provincia",)),
+    ("codice_nazione", "get", ("dest_codice_nazione",)),
+    ("paese", "pick", ("dest_nazione", "dest_codice_nazione")),
+    ("contatto", "pick", ("dest_contatto",)),
+    ("telefono", "pick", ("dest_telefono", "dest_cellulare")),
+    ("cellulare", "get", ("dest_cellulare",)),
+    ("email", "pick", ("dest_email",)),
+    ("pagata_da", "get", ("dest_pagata_da",)),
+    ("match_code", "get", ("dest_match_code",)),
+    ("riferimento", "get", ("dest_riferimento",)),
+    ("partita_iva", "get", ("dest_partita_iva",)),
+    ("info", "get", ("dest_info",)),
+)
+
+# Colonne lette dal mapper (per proiettare la SELECT solo su queste)
+SOURCE_COLUMNS = tuple(dict.fromkeys(
+    ["id", "awb", "vettore", "last_position", "final_position", "data_spedizione",
+     "mitt_citta", "mitt_codice_nazione"]
+    + [c for fields in (_TOP_FIELDS, _MITTENTE_FIELDS, _DESTINATARIO_FIELDS) for _, _, cols in fields for c in cols]
+))
+
+# (chiave, indici) - 'get' ha al massimo un indice, 'pick' la lista delle candidate presenti
+_Plan = Tuple[Tuple[str, bool, Tuple[int, ...]], ...]
+
+
+def _compile(fields, idx: Dict[str, int]) -> _Plan:
+    plan = []
+    for key, mode, columns in fields:
+        indexes = tuple(idx[c] for c in columns if c in idx)
+        if mode == "get":
+            indexes = indexes[:1]
+        plan.append((key, mode == "pick", indexes))
+    return tuple(plan)
+
+
+def _apply(plan: _Plan, row: Sequence[Any]) -> Dict[str, Any]:
+    out = {}
+    for key, pick, indexes in plan:
+        value = None
+        if pick:
+            for i in indexes:
+                if row[i]:
+                    value = row[i]
+                    break
+        elif indexes:
+            value = row[indexes[0]]
+        out[key] = value
+    return out
+
+
+def _format_date(v: Any) -> Optional[str]:
+    if isinstance(v, datetime):
+        return v.isoformat()
+    if isinstance(v, date):
+        return datetime(v.year, v.month, v.day).isoformat()
+    return str(v) if v is not None else None
+
+
+def _format_final_position(v: Any) -> str:
+    """Converte final_position da numero a stringa leggibile"""
+    if v == 1 or v == '1':
+        return "Consegnato"
+    if v == 0 or v == '0':
+        return "In transito"
+    if v is None or v == '':
+        return "Da definire"
+    return str(v)
+
+
+def _event_key(vettore: str, last_position: str) -> str:
+    # Per BRT la descrizione prima del trattino è quella usata nelle mappature
+    if vettore.upper() == 'BRT' and ' - ' in last_position:
+        return last_position.split(' - ')[0].strip()
+    return last_position
+
+
+class RowMapper:
+    """Piano di conversione per una forma di risultato (lista di colonne)"""
+
+    def __init__(self, columns: Sequence[str]):
+        idx = {name: i for i, name in enumerate(columns)}
+        self.columns = tuple(columns)
+        self.index = idx
+
+        def col(name):
+            return idx.get(name)
+
+        self._id = col("id")
+        self._awb = col("awb")
+        self._vettore = col("vettore")
+        self._last_position = col("last_position")
+        self._final_position = col("final_position")
+        self._data_spedizione = col("data_spedizione")
+        self._mitt_citta = col("mitt_citta")
+        self._mitt_codice_nazione = col("mitt_codice_nazione")
+        self._top = _compile(_TOP_FIELDS, idx)
+        self._mittente = _compile(_MITTENTE_FIELDS, idx)
+        self._destinatario = _compile(_DESTINATARIO_FIELDS, idx)
+
+    @staticmethod
+    def _get(row: Sequence[Any], i: Optional[int]) -> Any:
+        return row[i] if i is not None else None
+
+    def map_row(self, row: Sequence[Any], event_info: Callable[[str, str], Dict[str, str]]) -> Dict[str, Any]:
+        """
+        Converte una riga nel formato di /api/spedizioni
+
+        Args:
+            row: Riga del cursore
+            event_info: Funzione (vettore, codice) -> {'nome', 'colore'}
+        """
+        get = self._get
+        vettore = get(row, self._vettore) or ""
+        info = event_info(vettore, _event_key(vettore, get(row, self._last_position) or ""))
+
+        item = {
+            "id": get(row, self._id),
+            "mitt_citta": get(row, self._mitt_citta),
+            "mitt_codice_nazione": get(row, self._mitt_codice_nazione),
+            "vettore": vettore,
+            "awb": get(row, self._awb),
+            "data_spedizione": _format_date(get(row, self._data_spedizione)),
+            "last_position": info["nome"],
+            "last_position_color": info["colore"],
+            "final_position": _format_final_position(get(row, self._final_position)),
+        }
+        item.update(_apply(self._top, row))
+        item["mittente"] = _apply(self._mittente, row)
+        item["destinatario"] = _apply(self._destinatario, row)
+        return item
+
+    def map_rows(self, rows: Iterable[Sequence[Any]],
+                 event_info: Callable[[str, str], Dict[str, str]]) -> List[Dict[str, Any]]:
+        """Converte più righe calcolando le info evento una volta per (vettore, codice)"""
+        memo: Dict[Tuple[str, str], Dict[str, str]] = {}
+
+        def cached_event_info(vettore: str, codice: str) -> Dict[str, str]:
+            key = (vettore, codice)
+            info = memo.get(key)
+            if info is None:
+                info = memo[key] = event_info(vettore, codice)
+            return info
+
+        return [self.map_row(row, cached_event_info) for row in rows]
+
+
+@functools.lru_cache(maxsize=32)
+def _mapper_for(columns: Tuple[str, ...]) -> RowMapper:
+    return RowMapper(columns)
+
+
+def get_mapper(description: Sequence[Sequence[Any]]) -> RowMapper:
+    """Mapper (in cache) per il cursor.description di un risultato"""
+    return _mapper_for(tuple(d[0] for d in description))
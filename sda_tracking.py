@@ -13,9 +13,14 @@ import os
 import json
 import requests
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Dict, List, Optional, Any
 from dotenv import load_dotenv
+import http_transport
+from http_transport import HttpRequest
+from rate_limiter import get_limiter
+import token_manager
+from token_manager import TokenError
 
 # Carica variabili ambiente
 load_dotenv()
@@ -41,10 +46,6 @@ class SDATracking:
         self.environment = environment
         self.logger = logging.getLogger(__name__)
         
-        # Cache per il token di accesso
-        self.access_token = None
-        self.token_expires_at = None
-        
         # Configurazione environment
         if environment == 'prod':
             self.auth_url = os.getenv('SDA_AUTH_URL_PROD')
@@ -64,9 +65,16 @@ class SDATracking:
         self.grant_type = os.getenv('SDA_AUTH_GRANT_TYPE', 'client_credentials')
         self.debug = bool(int(os.getenv('SDA_API_DEBUG', '0')))
         
+        # Rate limit condiviso con gli altri client SDA (thread e processi)
+        self.rate_limiter = get_limiter('SDA')
+        
         # Validazione configurazione
         if not all([self.auth_url, self.base_url, self.client_id, self.client_secret]):
             raise ValueError(f"Configurazione SDA incompleta per environment '{environment}'")
+        
+        # Token di accesso condiviso tra istanze e worker, rinnovato in background
+        self._token_name = token_manager.register('SDA', f"{self.auth_url}|{self.client_id}",
+                                                  self._fetch_token_flow)
     
     def _get_access_token(self) -> str:
         """
@@ -79,11 +87,14 @@ class SDATracking:
         Raises:
             Exception: Se l'autenticazione fallisce
         """
-        # Controlla se il token è ancora valido
-        if (self.access_token and self.token_expires_at and 
-            datetime.now() < self.token_expires_at - timedelta(minutes=5)):
-            return self.access_token
-        
+        return http_transport.run(self._access_token_flow())
+    
+    def _access_token_flow(self):
+        """Flow di _get_access_token: token condiviso tra istanze e worker (token_manager)"""
+        return (yield from token_manager.token_flow(self._token_name))
+    
+    def _fetch_token_flow(self):
+        """Flow che richiede un nuovo token OAuth2 (usato da token_manager)"""
         # Richiedi nuovo token - API Poste Italiane ha formato specifico
         auth_data = {
             'grant_type': self.grant_type,
@@ -99,48 +110,42 @@ class SDATracking:
         
         if self.debug:
             self.logger.info(f"🔑 Richiesta token SDA: {self.auth_url}")
-            self.logger.debug(f"Auth data: {auth_data}")
         
         try:
-            response = requests.post(
-                self.auth_url,
+            response = yield HttpRequest(
+                'SDA', 'POST', self.auth_url,
                 json=auth_data,  # Usa json= invece di data= per inviare JSON
                 headers=headers,
-                timeout=30
+                timeout=30,
+                rate_limited=False
             )
-            
-            if response.status_code == 200:
-                token_data = response.json()
-                
-                if self.debug:
-                    self.logger.info(f"📋 Risposta token completa: {token_data}")
-                
-                # Poste Italiane potrebbe usare nomi diversi per il token
-                self.access_token = (
-                    token_data.get('access_token') or 
-                    token_data.get('accessToken') or
-                    token_data.get('token') or
-                    token_data.get('access')
-                )
-                
-                # Calcola scadenza token (default 1 ora se non specificato)
-                expires_in = token_data.get('expires_in', token_data.get('expiresIn', 3600))
-                self.token_expires_at = datetime.now() + timedelta(seconds=expires_in)
-                
-                if self.debug:
-                    self.logger.info(f"✅ Token SDA ottenuto: {self.access_token[:20] if self.access_token else 'NONE'}...")
-                    self.logger.info(f"✅ Scade: {self.token_expires_at}")
-                
-                return self.access_token
-            else:
-                error_msg = f"Errore autenticazione SDA: {response.status_code} - {response.text}"
-                self.logger.error(error_msg)
-                raise Exception(error_msg)
-                
         except requests.RequestException as e:
             error_msg = f"Errore connessione autenticazione SDA: {str(e)}"
             self.logger.error(error_msg)
-            raise Exception(error_msg)
+            raise TokenError(error_msg)
+        
+        if response.status_code != 200:
+            error_msg = f"Errore autenticazione SDA: {response.status_code} - {response.text}"
+            self.logger.error(error_msg)
+            raise TokenError(error_msg)
+        
+        token_data = response.json()
+        
+        # Poste Italiane potrebbe usare nomi diversi per il token
+        access_token = (
+            token_data.get('access_token') or 
+            token_data.get('accessToken') or
+            token_data.get('token') or
+            token_data.get('access')
+        )
+        
+        # Scadenza token (default 1 ora se non specificato)
+        expires_in = token_data.get('expires_in', token_data.get('expiresIn', 3600))
+        
+        if self.debug:
+            self.logger.info(f"✅ Token SDA ottenuto, scade tra {expires_in}s")
+        
+        return access_token, expires_in
     
     def track_shipment(self, waybill_number: str, full_tracking: bool = True) -> Dict[str, Any]:
         """
@@ -156,8 +161,16 @@ class SDATracking:
         Raises:
             Exception: Se il tracking fallisce
         """
+        return http_transport.run(self._track_flow(waybill_number, full_tracking))
+    
+    async def track_shipment_async(self, waybill_number: str, full_tracking: bool = True) -> Dict[str, Any]:
+        """Variante asyncio di track_shipment()"""
+        return await http_transport.run_async(self._track_flow(waybill_number, full_tracking))
+    
+    def _track_flow(self, waybill_number: str, full_tracking: bool = True):
+        """Flow di track_shipment (vedi http_transport)"""
         # Ottieni token di accesso
-        access_token = self._get_access_token()
+        access_token = yield from self._access_token_flow()
         
         # Parametri richiesta
         params = {
@@ -183,8 +196,8 @@ class SDATracking:
             self.logger.debug(f"Params: {params}")
         
         try:
-            response = requests.get(
-                tracking_url,
+            response = yield HttpRequest(
+                'SDA', 'GET', tracking_url,
                 params=params,
                 headers=headers,
                 timeout=30
@@ -198,6 +211,9 @@ class SDATracking:
                 data = response.json()
                 return self._parse_tracking_response(data, waybill_number)
             else:
+                if response.status_code == 401:
+                    # Token revocato: la prossima richiesta ne ottiene uno nuovo
+                    token_manager.invalidate(self._token_name)
                 error_msg = f"Errore tracking SDA {waybill_number}: {response.status_code} - {response.text}"
                 self.logger.error(error_msg)
                 raise Exception(error_msg)
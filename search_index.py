@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Search Index - Ricerca full-text per il filtro globale `q` di /api/spedizioni
+
+Invece di `col LIKE '%q%'` in OR su tutte le colonne di ricerca (scansione
+completa di `spedizioni`), la ricerca usa:
+ - la colonna generata STORED `search_text` (CONCAT_WS dei campi mittente,
+   destinatario, vettore, AWB e last_position) con indice FULLTEXT
+ - un percorso veloce per gli AWB: se q sembra un AWB e c'è almeno un AWB
+   con quel prefisso, `awb LIKE 'q%'` sull'indice B-tree di awb
+ - l'ordinamento per rilevanza MATCH ... AGAINST
+
+L'indice va creato una volta con:
+    python search_index.py --install
+
+Finché colonna e indice non esistono il filtro resta quello LIKE originale.
+"""
+
+import re
+import time
+import logging
+import threading
+from typing import Any, List, Optional, Tuple
+
+from db_connector import cursor as db_cursor
+
+LOG = logging.getLogger(__name__)
+
+SEARCH_COLUMN = "search_text"
+FULLTEXT_INDEX = "ft_spedizioni_search_text"
+AWB_INDEX = "idx_spedizioni_awb"
+
+# Campi concatenati in search_text (solo quelli presenti nella tabella)
+SEARCH_FIELDS = [
+    "awb", "vettore", "last_position",
+    "mitt_cliente", "mitt_ragione_sociale", "mitt_contatto", "mitt_indirizzo", "mitt_cap", "mitt_citta",
+    "mitt_provincia", "mitt_nazione", "mitt_telefono", "mitt_cellulare", "mitt_email",
+    "dest_cliente", "dest_ragione_sociale", "dest_contatto", "dest_indirizzo", "dest_cap", "dest_citta",
+    "dest_provincia", "dest_nazione", "dest_telefono", "dest_cellulare", "dest_email",
+]
+
+# innodb_ft_min_token_size di default: parole più corte non sono indicizzate
+MIN_TOKEN_SIZE = 3
+
+# Stopword InnoDB di default: non sono indicizzate, quindi non vanno richieste con '+'
+_STOPWORDS = {
+    "about", "are", "com", "for", "from", "how", "that", "the", "this", "was", "what",
+    "when", "where", "who", "will", "with", "und", "www",
+}
+
+# Un AWB è un'unica parola alfanumerica con almeno una cifra
+_AWB_RE = re.compile(r"^(?=.*\d)[A-Za-z0-9]{8,40}$")
+
+# Ricontrolla la presenza dell'indice ogni tanto (es. dopo --install a server avviato)
+_CHECK_INTERVAL = 300
+
+_state_lock = threading.Lock()
+_available: Optional[bool] = None
+_checked_at = 0.0
+
+
+def looks_like_awb(q: str) -> bool:
+    """True se la ricerca sembra un numero di spedizione"""
+    return bool(_AWB_RE.match(q.strip()))
+
+
+def is_available() -> bool:
+    """True se colonna search_text e indice FULLTEXT esistono (risultato in cache)"""
+    global _available, _checked_at
+    with _state_lock:
+        if _available is not None and time.monotonic() - _checked_at < _CHECK_INTERVAL:
+            return _available
+    try:
+        with db_cursor() as (conn, cur):
+            cur.execute(
+                """SELECT COUNT(*) FROM information_schema.STATISTICS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'spedizioni'
+                AND INDEX_NAME = %s""",
+                (FULLTEXT_INDEX,)
+            )
+            available = int(cur.fetchone()[0]) > 0
+    except Exception as e:
+        LOG.warning("Verifica indice full-text fallita: %s", e)
+        available = False
+    with _state_lock:
+        _available, _checked_at = available, time.monotonic()
+    return available
+
+
+def _awb_prefix_exists(q: str) -> bool:
+    """Probe sull'indice di awb: evita di trattare come AWB un numero di telefono o un CAP"""
+    try:
+        with db_cursor() as (conn, cur):
+            cur.execute("SELECT 1 FROM spedizioni WHERE awb LIKE %s LIMIT 1", (f"{q}%",))
+            return cur.fetchone() is not None
+    except Exception as e:
+        LOG.warning("Probe AWB fallito: %s", e)
+        return False
+
+
+def _tokens(q: str) -> List[str]:
+    # Il parser full-text divide sulle stesse classi di caratteri
+    return re.findall(r"\w+", q, flags=re.UNICODE)
+
+
+def _boolean_query(tokens: List[str]) -> str:
+    """Tutte le parole obbligatorie, ognuna come prefisso: '+mario* +rossi*'"""
+    return " ".join(f"+{token}*" for token in tokens)
+
+
+def build_condition(q: str, fallback_fields: List[str]) -> Tuple[str, List[Any], Optional[Tuple[str, List[Any]]]]:
+    """
+    Condizione WHERE per il filtro globale q
+
+    Args:
+        q: Testo cercato
+        fallback_fields: Colonne per il LIKE originale se l'indice non esiste
+
+    Returns:
+        Tupla (sql, params, rilevanza) - rilevanza è (espressione, params) da
+        usare in ORDER BY, oppure None se non disponibile
+    """
+    q = q.strip()
+
+    if looks_like_awb(q) and _awb_prefix_exists(q):
+        # Percorso veloce: prefisso sull'indice B-tree di awb
+        return "awb LIKE %s", [f"{q}%"], None
+
+    if not is_available():
+        like = f"%{q}%"
+        ors = " OR ".join([f"{f} LIKE %s" for f in fallback_fields])
+        return f"({ors})", [like] * len(fallback_fields), None
+
+    tokens = _tokens(q)
+    indexed = [t for t in tokens if len(t) >= MIN_TOKEN_SIZE and t.lower() not in _STOPWORDS]
+    short = [t for t in tokens if t not in indexed]
+
+    if not indexed:
+        # Solo parole non indicizzate: LIKE su una sola colonna invece che su tutte
+        return f"{SEARCH_COLUMN} LIKE %s", [f"%{q}%"], None
+
+    query = _boolean_query(indexed)
+    where = [f"MATCH({SEARCH_COLUMN}) AGAINST(%s IN BOOLEAN MODE)"]
+    params: List[Any] = [query]
+    for token in short:
+        where.append(f"{SEARCH_COLUMN} LIKE %s")
+        params.append(f"%{token}%")
+
+    relevance = (f"MATCH({SEARCH_COLUMN}) AGAINST(%s IN BOOLEAN MODE)", [query])
+    return "(" + " AND ".join(where) + ")", params, relevance
+
+
+def install() -> None:
+    """Crea colonna generata, indice FULLTEXT e indice su awb (operazione una tantum)"""
+    with db_cursor() as (conn, cur):
+        cur.execute(
+            """SELECT COLUMN_NAME FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'spedizioni'"""
+        )
+        existing = {row[0] for row in cur.fetchall()}
+        cur.execute(
+            """SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'spedizioni'"""
+        )
+        indexes = {row[0] for row in cur.fetchall()}
+
+        fields = [f for f in SEARCH_FIELDS if f in existing]
+        if SEARCH_COLUMN not in existing:
+            LOG.info("Creo colonna %s su %d campi", SEARCH_COLUMN, len(fields))
+            cur.execute(
+                f"ALTER TABLE spedizioni ADD COLUMN {SEARCH_COLUMN} TEXT "
+                f"GENERATED ALWAYS AS (CONCAT_WS(' ', {', '.join(fields)})) STORED"
+            )
+        if FULLTEXT_INDEX not in indexes:
+            LOG.info("Creo indice FULLTEXT %s", FULLTEXT_INDEX)
+            cur.execute(f"ALTER TABLE spedizioni ADD FULLTEXT INDEX {FULLTEXT_INDEX} ({SEARCH_COLUMN})")
+        if AWB_INDEX not in indexes:
+            LOG.info("Creo indice %s", AWB_INDEX)
+            cur.execute(f"ALTER TABLE spedizioni ADD INDEX {AWB_INDEX} (awb)")
+
+    global _available
+    with _state_lock:
+        _available = None
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    if "--install" in sys.argv:
+        install()
+        print("Indice di ricerca installato" if is_available() else "Indice di ricerca NON disponibile")
+    else:
+        print(f"Indice di ricerca disponibile: {is_available()}")
+        print("Usa --install per crearlo")
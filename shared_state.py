@@ -0,0 +1,197 @@
+"""
+Shared State - stato condiviso tra thread e processi
+
+Piccolo database SQLite locale usato per lo stato che deve essere condiviso
+tra i thread e tra i worker gunicorn dello stesso server (es. rate limiting
+dei vettori). Il file è configurabile con SHARED_STATE_DB; il default è in
+una directory privata dell'utente (<tmp>/docsparcels-<uid>, permessi 0700).
+Il file contiene token OAuth validi: viene creato con permessi 0600 (i file
+-wal/-shm di SQLite ereditano gli stessi) e non viene usato se appartiene a
+un altro utente o è leggibile da altri (errore sqlite3: i chiamanti passano
+allo stato locale del processo).
+
+Espone:
+ - transaction() context manager con lock in scrittura (BEGIN IMMEDIATE)
+ - ensure_table(name, ddl) per creare le tabelle una sola volta per processo
+ - kv_get / kv_set / kv_incr / kv_delete: chiave-valore con scadenza (cache condivise)
+ - kv_add: scrive solo se la chiave è assente o scaduta (lease tra processi)
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+DEFAULT_DB_DIR = os.path.join(tempfile.gettempdir(), f"docsparcels-{os.getuid() if hasattr(os, 'getuid') else 'user'}")
+DEFAULT_DB_PATH = os.path.join(DEFAULT_DB_DIR, 'shared_state.sqlite3')
+
+_local = threading.local()
+_tables_lock = threading.Lock()
+_tables_ready = set()
+_checked_paths = set()
+_checked_lock = threading.Lock()
+
+
+def get_db_path() -> str:
+    """Percorso del file SQLite condiviso"""
+    return os.getenv('SHARED_STATE_DB', DEFAULT_DB_PATH)
+
+
+def _check_private(st: os.stat_result, path: str, mode: int) -> None:
+    if hasattr(os, 'geteuid') and st.st_uid != os.geteuid():
+        raise sqlite3.OperationalError(f"{path} appartiene a un altro utente: stato condiviso non usato")
+    if st.st_mode & 0o077:
+        os.chmod(path, mode)
+
+
+def _prepare_path(path: str) -> None:
+    """Crea directory (se di default) e file con permessi privati, una volta per processo"""
+    key = (path, os.getpid())
+    if key in _checked_paths:
+        return
+    with _checked_lock:
+        if key in _checked_paths:
+            return
+        try:
+            if os.path.dirname(path) == DEFAULT_DB_DIR:
+                os.makedirs(DEFAULT_DB_DIR, mode=0o700, exist_ok=True)
+                _check_private(os.lstat(DEFAULT_DB_DIR), DEFAULT_DB_DIR, 0o700)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+            try:
+                _check_private(os.fstat(fd), path, 0o600)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            raise sqlite3.OperationalError(f"Stato condiviso {path} non utilizzabile: {e}") from e
+        _checked_paths.add(key)
+
+
+def _connect() -> sqlite3.Connection:
+    """Connessione per thread (sqlite3 non condivide le connessioni tra thread)"""
+    path = get_db_path()
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.path != path or _local.pid != os.getpid():
+        _prepare_path(path)
+        # isolation_level=None: le transazioni sono gestite esplicitamente
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _local.conn = conn
+        _local.path = path
+        _local.pid = os.getpid()
+    return conn
+
+
+@contextmanager
+def transaction():
+    """Context manager che restituisce una connessione dentro una transazione.
+
+    BEGIN IMMEDIATE prende subito il lock in scrittura, quindi la sequenza
+    lettura-modifica-scrittura è atomica anche tra processi diversi.
+    """
+    conn = _connect()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def ensure_table(name: str, ddl: str) -> None:
+    """Esegue la DDL (CREATE TABLE IF NOT EXISTS ...) una sola volta per processo"""
+    key = (get_db_path(), os.getpid(), name)
+    if key in _tables_ready:
+        return
+    with _tables_lock:
+        if key in _tables_ready:
+            return
+        _connect().execute(ddl)
+        _tables_ready.add(key)
+
+
+_KV_DDL = """
+CREATE TABLE IF NOT EXISTS kv_store (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+)
+"""
+
+
+def kv_get(namespace: str, key: str) -> Optional[str]:
+    """Valore non scaduto della chiave, o None"""
+    ensure_table('kv_store', _KV_DDL)
+    row = _connect().execute(
+        "SELECT value FROM kv_store WHERE namespace = ? AND key = ? AND expires_at > ?",
+        (namespace, key, time.time())
+    ).fetchone()
+    return row[0] if row else None
+
+
+def kv_set(namespace: str, key: str, value: str, ttl: float) -> None:
+    """Salva il valore con scadenza tra `ttl` secondi"""
+    ensure_table('kv_store', _KV_DDL)
+    with transaction() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO kv_store (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, value, time.time() + ttl)
+        )
+
+
+def kv_incr(namespace: str, key: str, ttl: float) -> int:
+    """Incrementa atomicamente un contatore intero (0 se assente) e restituisce il nuovo valore"""
+    ensure_table('kv_store', _KV_DDL)
+    with transaction() as conn:
+        row = conn.execute(
+            "SELECT value FROM kv_store WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (namespace, key, time.time())
+        ).fetchone()
+        value = int(row[0]) + 1 if row else 1
+        conn.execute(
+            "INSERT OR REPLACE INTO kv_store (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, str(value), time.time() + ttl)
+        )
+        return value
+
+
+def kv_add(namespace: str, key: str, value: str, ttl: float) -> bool:
+    """Salva il valore solo se la chiave è assente o scaduta. True se scritto"""
+    ensure_table('kv_store', _KV_DDL)
+    with transaction() as conn:
+        row = conn.execute(
+            "SELECT 1 FROM kv_store WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (namespace, key, time.time())
+        ).fetchone()
+        if row:
+            return False
+        conn.execute(
+            "INSERT OR REPLACE INTO kv_store (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, value, time.time() + ttl)
+        )
+        return True
+
+
+def kv_delete(namespace: str, key: str) -> None:
+    ensure_table('kv_store', _KV_DDL)
+    with transaction() as conn:
+        conn.execute("DELETE FROM kv_store WHERE namespace = ? AND key = ?", (namespace, key))
+
+
+def kv_purge_expired(namespace: Optional[str] = None) -> int:
+    """Elimina le chiavi scadute (di un namespace o di tutti). Restituisce il numero di righe eliminate"""
+    ensure_table('kv_store', _KV_DDL)
+    with transaction() as conn:
+        if namespace is None:
+            cur = conn.execute("DELETE FROM kv_store WHERE expires_at <= ?", (time.time(),))
+        else:
+            cur = conn.execute(
+                "DELETE FROM kv_store WHERE namespace = ? AND expires_at <= ?", (namespace, time.time())
+            )
+        return cur.rowcount
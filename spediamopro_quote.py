@@ -33,7 +33,14 @@ import json
 import time
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Union
-from config import SpediamoproConfig
+from config import (
+    SpediamoproConfig, SPEDIAMOPRO_SIMULATED_RATES, SPEDIAMOPRO_ENVELOPE_INTL_SERVICE,
+    SPEDIAMOPRO_DISTANCE_FACTOR, SPEDIAMOPRO_WEIGHT_FACTOR, SPEDIAMOPRO_DOCUMENTS_DISCOUNT, SPEDIAMOPRO_VAT
+)
+from dim_weight import ENVELOPE_SIZE, normalize_packages, summarize
+from http_transport import HttpRequest
+import token_manager
+from token_manager import TokenError
 
 
 class SpediamoproQuoteClient:
@@ -81,16 +88,22 @@ class SpediamoproQuoteClient:
         self.config = config or SpediamoproConfig.from_env()
         self.session = requests.Session()
         self.session.timeout = self.config.timeout
+        # JWT condiviso tra istanze e worker, rinnovato in background
+        self._token_name = token_manager.register(
+            'SPEDIAMOPRO', f"{self.config.effective_url}|{self.config.username}", self._fetch_token_flow
+        )
         
     def _get_jwt_token(self) -> str:
-        """Ottiene JWT token per autenticazione (valido 1 ora)"""
-        
-        # Controlla se abbiamo un token valido
-        if (self.config.token and self.config.token_expires_at and 
-            time.time() < self.config.token_expires_at - 60):  # Rinnova 1 min prima
-            return self.config.token
-        
-        # Richiedi nuovo token
+        """JWT token per autenticazione (valido 1 ora), condiviso e rinnovato in background"""
+        try:
+            token = token_manager.get_token(self._token_name)
+        except TokenError as e:
+            raise Exception(str(e))
+        self.config.token = token
+        return token
+    
+    def _fetch_token_flow(self):
+        """Flow di login che ottiene un nuovo JWT token (usato da token_manager)"""
         login_url = f"{self.config.effective_url}auth/login"
         
         login_data = {
@@ -107,10 +120,12 @@ class SpediamoproQuoteClient:
             print("=" * 50)
         
         try:
-            response = self.session.post(
-                login_url,
+            response = yield HttpRequest(
+                'SPEDIAMOPRO', 'POST', login_url,
                 json=login_data,
-                headers={'Content-Type': 'application/json'}
+                headers={'Content-Type': 'application/json'},
+                timeout=self.config.timeout,
+                rate_limited=False
             )
             
             response.raise_for_status()
@@ -119,15 +134,11 @@ class SpediamoproQuoteClient:
             if self.config.debug:
                 print(f"🔐 DEBUG - RISPOSTA JWT TOKEN:")
                 print("=" * 50)
-                print(f"Token ricevuto: {token_data.get('token', 'N/A')[:20]}...")
                 print(f"Expires in: 1 ora")
                 print("=" * 50)
             
-            # Salva token e scadenza (1 ora)
-            self.config.token = token_data.get('token', '')
-            self.config.token_expires_at = time.time() + 3600  # 1 ora
-            
-            return self.config.token
+            # Il token vale 1 ora
+            return token_data.get('token', ''), 3600
             
         except requests.exceptions.RequestException as e:
             error_msg = f"Errore login Spediamo Pro: {e}"
@@ -137,7 +148,7 @@ class SpediamoproQuoteClient:
                     error_msg += f" - {error_detail}"
                 except:
                     error_msg += f" - {e.response.text}"
-            raise Exception(error_msg)
+            raise TokenError(error_msg)
     
     def get_simulation(self,
                       origin_country: str,
@@ -179,9 +190,9 @@ class SpediamoproQuoteClient:
             # Per envelope mandiamo dimensioni standard UPS envelope
             if pkg.get('is_envelope', False):
                 collo_data = {
-                    "altezza": 1,      # 1 cm (envelope sottile)
-                    "larghezza": 35,   # 35 cm (formato C4/A4)  
-                    "profondita": 25,  # 25 cm (formato C4/A4)
+                    "altezza": ENVELOPE_SIZE['height_cm'],      # 1 cm (envelope sottile)
+                    "larghezza": ENVELOPE_SIZE['width_cm'],     # 35 cm (formato C4/A4)
+                    "profondita": ENVELOPE_SIZE['length_cm'],   # 25 cm (formato C4/A4)
                     "pesoReale": pkg['weight']
                 }
             else:
@@ -276,8 +287,8 @@ class SpediamoproQuoteClient:
             # Se c'è un errore API, usa tariffe simulate per testing
             if self.config.debug:
                 print(f"⚠️  API Error - Usando tariffe simulate per testing...")
-                # Calcola peso totale dai colli e verifica se ci sono envelope
-                total_weight = sum(pkg['weight'] for pkg in packages)
+                # Peso tassabile totale dai colli (reale o volumetrico) e verifica se ci sono envelope
+                total_weight = summarize(normalize_packages(packages), 'SPEDIAMOPRO')['chargeable_weight_kg']
                 has_envelope = any(pkg.get('is_envelope', False) for pkg in packages)
                 return self._get_simulated_rates(
                     origin_city, destination_city, total_weight, total_value, is_documents,
@@ -292,86 +303,37 @@ class SpediamoproQuoteClient:
         """Genera tariffe simulate per testing quando l'API ha problemi"""
         
         # Tariffe base realistiche per kg (senza IVA)
-        base_rates = {
-            'INPOSTSTD': 3.87,      # InPost reale: 3.87 + IVA = 4.72
-            'BRTPUDO': 4.50,        # BRT Fermopoint
-            'BRTDPD': 5.20,         # DPD Standard
-            'SDAEXP': 6.80,         # SDA Express
-            'BRTEXP': 7.20,         # BRT Express  
-            'BRTEUEXP': 8.50,       # EuroExpress
-            'UPSSTD': 9.80,         # UPS Standard
-            'UPSEXPSAVER': 12.09,   # UPS Express Saver - TUA TARIFFA
-            'UPSENVEXPSAVER': 12.09 # UPS Lettere Express Saver
-        }
+        base_rates = SPEDIAMOPRO_SIMULATED_RATES
         
         # Filtraggio corrieri per envelope internazionali
         is_international = destination_country and destination_country.upper() != 'IT'
         
         if has_envelope and is_international:
             # Per envelope internazionali, solo UPS Envelope Express Saver è disponibile
-            filtered_rates = {'UPSENVEXPSAVER': base_rates['UPSENVEXPSAVER']}
-            base_rates = filtered_rates
+            base_rates = {SPEDIAMOPRO_ENVELOPE_INTL_SERVICE: base_rates[SPEDIAMOPRO_ENVELOPE_INTL_SERVICE]}
             print(f"🌍 Envelope internazionale verso {destination_country}: Solo UPS Envelope Express Saver disponibile")
         
         # Calcola tariffe basate su peso e distanza (più realistiche)
-        distance_multiplier = 1.1 if origin_city.upper() != destination_city.upper() else 1.0
-        weight_multiplier = max(1.0, weight_kg * 0.3)  # Peso ha meno impatto
-        doc_discount = 0.78 if is_documents else 1.0  # Sconto documenti 22%
-        
-        # IVA 22%
-        iva_rate = 1.22
+        distance_multiplier = SPEDIAMOPRO_DISTANCE_FACTOR if origin_city.upper() != destination_city.upper() else 1.0
+        weight_multiplier = max(1.0, weight_kg * SPEDIAMOPRO_WEIGHT_FACTOR)  # Peso ha meno impatto
+        doc_discount = SPEDIAMOPRO_DOCUMENTS_DISCOUNT if is_documents else 1.0  # Sconto documenti 22%
         
         simulated_rates = []
         
-        for service_code, base_rate in base_rates.items():
+        for service_code, info in base_rates.items():
             # Calcola prezzo base (senza IVA)
-            price_no_vat = base_rate * distance_multiplier * weight_multiplier * doc_discount
+            price_no_vat = info['base'] * distance_multiplier * weight_multiplier * doc_discount
             
             # Aggiungi IVA
-            price = round(price_no_vat * iva_rate, 2)
-            
-            # Determina corriere e servizio
-            if service_code.startswith('SDA'):
-                carrier = 'SDA'
-                service_name = 'SDA Express'
-            elif service_code.startswith('BRT'):
-                carrier = 'BRT'
-                if 'PUDO' in service_code:
-                    service_name = 'BRT Fermopoint'
-                elif 'DPD' in service_code:
-                    service_name = 'DPD Standard'
-                elif 'EUEXP' in service_code:
-                    service_name = 'EuroExpress'
-                else:
-                    service_name = 'BRT Express'
-            elif service_code.startswith('UPS'):
-                carrier = 'UPS'
-                if 'EXPSAVER' in service_code:
-                    if 'ENV' in service_code:
-                        service_name = 'UPS Lettere Express Saver'
-                    else:
-                        service_name = 'UPS Express Saver'
-                else:
-                    service_name = 'UPS Standard'
-            else:  # INPOST
-                carrier = 'InPost'
-                service_name = 'InPost Point to Point'
-            
-            # Stima tempi di consegna
-            if 'EXPRESS' in service_code.upper() or 'EXP' in service_code:
-                delivery_time = "1-2 giorni"
-            elif 'PUDO' in service_code or 'INPOST' in service_code:
-                delivery_time = "2-4 giorni"
-            else:
-                delivery_time = "2-3 giorni"
+            price = round(price_no_vat * SPEDIAMOPRO_VAT, 2)
             
             simulated_rates.append({
                 'service_code': service_code,
-                'service_name': service_name,
-                'carrier': carrier,
+                'service_name': info['name'],
+                'carrier': info['carrier'],
                 'total_cost': price,
                 'currency': 'EUR',
-                'delivery_time': delivery_time,
+                'delivery_time': info['days'],
                 'service_type': 'express' if 'EXP' in service_code else 'standard'
             })
         
@@ -0,0 +1,176 @@
+"""
+Spedizioni Schema - Proiezione delle colonne di `spedizioni`
+
+`spedizioni` è una tabella molto larga (mitt_*, dest_*, fatturazione,
+dimensioni, search_text): con `SELECT *` ogni riga porta sul tunnel anche
+colonne che l'endpoint non usa. Questo modulo legge una volta per processo
+le colonne reali da information_schema e costruisce liste di colonne
+esplicite, intersecando i campi usati da ogni endpoint con lo schema.
+
+Se lo schema non è leggibile le proiezioni tornano `*` (comportamento
+originale) e la lettura viene ritentata alla richiesta successiva.
+
+Uso:
+    cur.execute(f"SELECT {projection(LIST_FIELDS)} FROM spedizioni WHERE ...")
+
+Gli indici (colonna, id) per la paginazione keyset di /api/spedizioni su
+ogni colonna di SORT_MAP vanno creati una volta con:
+    python spedizioni_schema.py --install-sort-indexes
+"""
+
+import logging
+import threading
+from typing import Iterable, List, Optional
+
+from db_connector import cursor as db_cursor
+
+LOG = logging.getLogger(__name__)
+
+TABLE = "spedizioni"
+
+# Mappa sicura per ORDER BY di /api/spedizioni (nomi colonna DB reali)
+SORT_MAP = {
+    "id": "id",
+    # use the sender/recipient official name fields that exist in the table
+    "mittente": "mitt_ragione_sociale",
+    "destinatario": "dest_ragione_sociale",
+    "vettore": "vettore",
+    "awb": "awb",
+    "data_spedizione": "data_spedizione",
+    "last_position": "last_position",
+    "final_position": "final_position",
+}
+
+# Tipi che MySQL indicizza solo per prefisso: un indice a prefisso non evita il filesort
+_PREFIX_ONLY_TYPES = ("text", "tinytext", "mediumtext", "longtext", "blob", "tinyblob", "mediumblob", "longblob")
+
+_lock = threading.Lock()
+_columns: Optional[List[str]] = None
+_generated: frozenset = frozenset()
+
+
+def _discover() -> Optional[List[str]]:
+    global _columns, _generated
+    try:
+        with db_cursor() as (conn, cur):
+            cur.execute(
+                """SELECT COLUMN_NAME, EXTRA FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+                ORDER BY ORDINAL_POSITION""",
+                (TABLE,)
+            )
+            rows = cur.fetchall()
+    except Exception as e:
+        LOG.warning("Lettura colonne di %s fallita, uso SELECT *: %s", TABLE, e)
+        return None
+    if not rows:
+        LOG.warning("Nessuna colonna trovata per %s, uso SELECT *", TABLE)
+        return None
+
+    with _lock:
+        _columns = [row[0] for row in rows]
+        _generated = frozenset(row[0] for row in rows if "GENERATED" in str(row[1] or "").upper())
+        LOG.info("Schema %s: %d colonne (%d generate)", TABLE, len(_columns), len(_generated))
+        return _columns
+
+
+def get_columns() -> Optional[List[str]]:
+    """Colonne reali di spedizioni nell'ordine della tabella (None se non disponibili)"""
+    with _lock:
+        if _columns is not None:
+            return _columns
+    return _discover()
+
+
+def refresh() -> Optional[List[str]]:
+    """Rilegge lo schema (es. dopo un ALTER TABLE a server avviato)"""
+    return _discover()
+
+
+def projection(fields: Iterable[str]) -> str:
+    """
+    Lista di colonne per la SELECT: i campi richiesti presenti nella tabella
+
+    Args:
+        fields: Colonne usate dall'endpoint (quelle assenti vengono ignorate)
+
+    Returns:
+        "`id`, `awb`, ..." nell'ordine della tabella, oppure "*" se lo schema non è noto
+    """
+    columns = get_columns()
+    if not columns:
+        return "*"
+    wanted = set(fields)
+    selected = [c for c in columns if c in wanted]
+    if not selected:
+        return "*"
+    return ", ".join(f"`{c}`" for c in selected)
+
+
+def record_projection() -> str:
+    """Tutte le colonne salvate, senza le colonne generate (es. search_text)"""
+    columns = get_columns()
+    if not columns:
+        return "*"
+    return ", ".join(f"`{c}`" for c in columns if c not in _generated)
+
+
+def sort_index_name(column: str) -> str:
+    return f"idx_{TABLE}_{column}_id"
+
+
+def install_sort_indexes() -> List[str]:
+    """
+    Crea gli indici (colonna, id) per le colonne di SORT_MAP (operazione una tantum)
+
+    Con l'indice ORDER BY col, id e la condizione keyset sono risolti con una
+    scansione di intervallo: una pagina profonda costa come la prima. Le
+    colonne già coperte da un indice che inizia con (col) o (col, id) e
+    quelle TEXT/BLOB vengono saltate.
+
+    Returns:
+        Nomi degli indici creati
+    """
+    created = []
+    with db_cursor() as (conn, cur):
+        cur.execute(
+            """SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s""",
+            (TABLE,)
+        )
+        types = {row[0]: str(row[1]).lower() for row in cur.fetchall()}
+        cur.execute(
+            """SELECT INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+            ORDER BY INDEX_NAME, SEQ_IN_INDEX""",
+            (TABLE,)
+        )
+        indexes = {}
+        for name, column in cur.fetchall():
+            indexes.setdefault(name, []).append(column)
+
+        for column in dict.fromkeys(SORT_MAP.values()):
+            if column == "id" or column not in types:
+                continue
+            if types[column] in _PREFIX_ONLY_TYPES:
+                LOG.warning("Colonna %s di tipo %s: indice di ordinamento non creato", column, types[column])
+                continue
+            # InnoDB accoda la chiave primaria: anche un indice su (col) ordina per (col, id)
+            if any(cols[:1] == [column] and cols[1:2] in ([], ["id"]) for cols in indexes.values()):
+                continue
+            name = sort_index_name(column)
+            LOG.info("Creo indice %s (%s, id)", name, column)
+            cur.execute(f"ALTER TABLE {TABLE} ADD INDEX {name} (`{column}`, id)")
+            created.append(name)
+    return created
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    if "--install-sort-indexes" in sys.argv:
+        created = install_sort_indexes()
+        print(f"Indici di ordinamento creati: {', '.join(created) if created else 'nessuno (già presenti)'}")
+    else:
+        print(f"Colonne di {TABLE}: {len(get_columns() or [])}")
+        print("Usa --install-sort-indexes per creare gli indici (colonna, id) della paginazione keyset")
@@ -10,13 +10,36 @@ import requests
 import xml.etree.ElementTree as ET
 from typing import Dict, List, Any, Optional
 import os
+import time
 from datetime import datetime
 import logging
+import http_transport
+from endpoint_health import get_registry
+from http_transport import HttpRequest
+from rate_limiter import get_limiter
+from tracking_cache import cached_tracking, cached_tracking_async
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Secondi per cui l'endpoint funzionante viene usato senza riverificare le
+# alternative, e per cui un endpoint fallito viene saltato
+ENDPOINT_TTL = 1800
+ENDPOINT_COOLDOWN = 300
+
+
+def _float_env(name: str, default: float) -> float:
+    value = os.getenv(name)
+    if value is None or value.strip() == '':
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        logger.warning("Invalid %s value: %s", name, value)
+        return default
+
+
 class TNTTrackingClient:
     """Client per tracking spedizioni TNT usando API XMLConnect"""
     
@@ -34,7 +57,13 @@ class TNTTrackingClient:
             "https://express.tnt.com/webservices/ExpressConnect"
         ]
         
-        self.endpoint = self.endpoints[0]  # Usa il primo come default
+        # Endpoint funzionante e statistiche condivisi dai client del processo
+        self.endpoint_registry = get_registry(
+            'TNT', self.endpoints,
+            ttl=_float_env('TNT_ENDPOINT_TTL', ENDPOINT_TTL),
+            cooldown=_float_env('TNT_ENDPOINT_COOLDOWN', ENDPOINT_COOLDOWN)
+        )
+        self.endpoint = self.endpoint_registry.preferred or self.endpoints[0]
         
         self.customer = os.getenv('TNT_CUSTOMER', 'D07938')
         self.user = os.getenv('TNT_USER', 'XMLUSER') 
@@ -42,6 +71,9 @@ class TNTTrackingClient:
         self.account_no = os.getenv('TNT_ACCOUNT_NO', '07054468')
         self.lang_id = 'IT'
         
+        # Rate limit condiviso con gli altri client TNT (thread e processi)
+        self.rate_limiter = get_limiter('TNT')
+        
         # Headers per richieste XML
         self.headers = {
             'Content-Type': 'application/xml; charset=utf-8',
@@ -55,6 +87,7 @@ class TNTTrackingClient:
         #logger.info(f"👤 Customer: {self.customer}")
         #logger.info(f"🏢 Account: {self.account_no}")
     
+    @cached_tracking('TNT')
     def track_shipment(self, awb_number: str) -> Dict[str, Any]:
         """
         Traccia una spedizione TNT usando il numero AWB
@@ -65,54 +98,63 @@ class TNTTrackingClient:
         Returns:
             Dict con informazioni di tracking
         """
+        return http_transport.run(self._track_flow(awb_number))
+    
+    @cached_tracking_async('TNT')
+    async def track_shipment_async(self, awb_number: str) -> Dict[str, Any]:
+        """Variante asyncio di track_shipment()"""
+        return await http_transport.run_async(self._track_flow(awb_number))
+    
+    def _track_flow(self, awb_number: str):
+        """Flow di track_shipment (vedi http_transport)"""
         try:
             logger.info(f"🔍 Tracking TNT AWB: {awb_number}")
             
             # Costruisci XML per richiesta tracking
             xml_request = self._build_tracking_xml(awb_number)
             
-            # Prova diversi endpoint TNT
-            for i, endpoint in enumerate(self.endpoints):
-                logger.info(f"� Tentativo {i+1}/{len(self.endpoints)} - Endpoint: {endpoint}")
+            # Prova l'endpoint che ha funzionato per ultimo; le alternative
+            # solo se fallisce o se è scaduto il TTL del registro
+            response = None
+            candidates = self.endpoint_registry.candidates()
+            for i, endpoint in enumerate(candidates):
+                logger.info(f"📡 Tentativo {i+1}/{len(candidates)} - Endpoint: {endpoint}")
                 
+                start = time.monotonic()
                 try:
-                    response = requests.post(
-                        endpoint,
+                    attempt = yield HttpRequest(
+                        'TNT', 'POST', endpoint,
                         data=xml_request,
                         headers=self.headers,
-                        timeout=30,
-                        verify=True
+                        timeout=30
                     )
-                    
-                    logger.info(f"📥 Risposta TNT: Status {response.status_code}")
-                    
-                    if response.status_code == 200:
-                        logger.info(f"✅ Endpoint funzionante trovato: {endpoint}")
-                        self.endpoint = endpoint  # Salva l'endpoint funzionante
-                        
-                        # Verifica se è XML valido
-                        try:
-                            ET.fromstring(response.text)
-                            logger.info(f"✅ Risposta XML valida ricevuta")
-                            break
-                        except ET.ParseError as e:
-                            logger.warning(f"⚠️ Risposta non è XML valido: {str(e)}")
-                            logger.debug(f"🔧 Response content: {response.text[:500]}...")
-                            # Continua a provare altri endpoint
-                            continue
-                    elif response.status_code == 404:
-                        logger.warning(f"⚠️ Endpoint {endpoint} non trovato (404)")
-                        continue
-                    else:
-                        logger.warning(f"⚠️ Endpoint {endpoint} - Status: {response.status_code}")
-                        continue
-                        
                 except requests.exceptions.RequestException as e:
-                    logger.warning(f"⚠️ Errore connessione endpoint {endpoint}: {str(e)}")
+                    self.endpoint_registry.record_failure(endpoint, f"connessione: {e}")
+                    continue
+                
+                logger.info(f"📥 Risposta TNT: Status {attempt.status_code}")
+                
+                if attempt.status_code != 200:
+                    self.endpoint_registry.record_failure(endpoint, f"HTTP {attempt.status_code}")
                     continue
+                
+                # Verifica se è XML valido
+                try:
+                    ET.fromstring(attempt.text)
+                except ET.ParseError as e:
+                    logger.debug(f"🔧 Response content: {attempt.text[:500]}...")
+                    self.endpoint_registry.record_failure(endpoint, f"XML non valido: {e}")
+                    continue
+                
+                elapsed = getattr(attempt, 'elapsed', None)
+                latency = elapsed.total_seconds() if elapsed is not None else time.monotonic() - start
+                self.endpoint_registry.record_success(endpoint, latency)
+                self.endpoint = endpoint
+                response = attempt
+                break
             
-            # Se nessun endpoint ha funzionato o restituito XML valido, usa modalità simulazione
-            if response.status_code != 200 or not hasattr(self, '_valid_xml_received'):
+            # Se nessun endpoint ha restituito XML valido, usa modalità simulazione
+            if response is None:
                 logger.warning(f"⚠️ TNT API non disponibile o risposta non valida - Modalità simulazione attiva")
                 return self._simulate_tnt_tracking(awb_number)
             
@@ -0,0 +1,384 @@
+"""
+Token Manager - Token OAuth condivisi tra client, thread e worker
+
+I client OAuth (UPS, FedEx, SDA, SpediamoPro) registrano un flow che
+ottiene un nuovo token e leggono il token con token_flow()/get_token():
+
+    self._token_name = token_manager.register('FEDEX', self.client_id, self._fetch_token_flow)
+    token = yield from token_manager.token_flow(self._token_name)
+
+    def _fetch_token_flow(self):
+        response = yield HttpRequest('FEDEX', 'POST', token_url, data=..., rate_limited=False)
+        return token, expires_in
+
+Il token è tenuto in memoria e in shared_state (namespace `oauth_tokens`),
+quindi una nuova istanza del client o un altro worker lo riusano senza
+richiederlo. Un thread in background rinnova i token usati di recente
+OAUTH_REFRESH_MARGIN secondi prima della scadenza (default 300, al massimo
+metà della durata): a regime le chiamate di quote e tracking non aspettano
+mai il server OAuth.
+
+Il rinnovo è single-flight: un lease in shared_state fa sì che un solo
+thread/processo chieda il token, gli altri attendono il risultato. Con
+OAUTH_TOKEN_SHARED=0 i token restano solo nel processo. Il file di
+shared_state contiene token validi: shared_state lo crea con permessi 0600
+in una directory privata dell'utente e rifiuta file di altri utenti (in quel
+caso i token restano nel processo).
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, Generator, Optional, Tuple
+
+import shared_state
+import http_transport
+from http_transport import Sleep
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_MARGIN = 300
+
+# Un token viene considerato scaduto questi secondi prima della scadenza reale
+EXPIRY_SKEW = 30
+
+# Durata massima del lease di rinnovo (oltre, un altro processo può riprovare)
+LEASE_TTL = 30
+
+# Attesa tra due controlli mentre un altro processo rinnova il token
+POLL_INTERVAL = 0.1
+
+# Un errore di rinnovo viene condiviso con chi attende per questi secondi
+ERROR_TTL = 5
+
+# Ogni quanti secondi il thread di rinnovo controlla le scadenze
+REFRESH_CHECK_INTERVAL = 30
+
+# I token non usati da questi secondi non vengono più rinnovati in background
+IDLE_TIMEOUT = 3600
+
+_NAMESPACE = 'oauth_tokens'
+
+TokenFlow = Callable[[], Generator[Any, Any, Tuple[str, float]]]
+
+
+class TokenError(Exception):
+    """Impossibile ottenere un token OAuth"""
+
+
+def _margin_from_env() -> int:
+    value = os.getenv('OAUTH_REFRESH_MARGIN')
+    if value is None:
+        return DEFAULT_REFRESH_MARGIN
+    try:
+        return max(0, int(value))
+    except ValueError:
+        LOG.warning("Valore OAUTH_REFRESH_MARGIN non valido: %s", value)
+        return DEFAULT_REFRESH_MARGIN
+
+
+class _Token:
+    __slots__ = ('value', 'expires_at', 'refresh_at')
+
+    def __init__(self, value: str, expires_at: float, refresh_at: float):
+        self.value = value
+        self.expires_at = expires_at
+        self.refresh_at = refresh_at
+
+    def usable(self, now: float) -> bool:
+        return now < self.expires_at - EXPIRY_SKEW
+
+
+class TokenManager:
+    """Cache dei token OAuth con rinnovo anticipato in background"""
+
+    def __init__(self, margin: Optional[int] = None, shared: Optional[bool] = None):
+        """
+        Args:
+            margin: Secondi di anticipo del rinnovo (default OAUTH_REFRESH_MARGIN)
+            shared: Condividi i token tra processi (default OAUTH_TOKEN_SHARED, attivo)
+        """
+        self.margin = _margin_from_env() if margin is None else margin
+        self._shared = os.getenv('OAUTH_TOKEN_SHARED', '1') == '1' if shared is None else shared
+        self._providers: Dict[str, TokenFlow] = {}
+        self._tokens: Dict[str, _Token] = {}
+        self._last_used: Dict[str, float] = {}
+        self._leases: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {'hits': 0, 'shared_hits': 0, 'fetches': 0, 'background_refreshes': 0,
+                      'waits': 0, 'errors': 0}
+
+    # --- registrazione -------------------------------------------------
+
+    def register(self, carrier: str, client_id: Optional[str], fetch: TokenFlow) -> str:
+        """
+        Registra il flow che ottiene un token per un account
+
+        Args:
+            carrier: Vettore (UPS, FEDEX, SDA, SPEDIAMOPRO)
+            client_id: Identificativo dell'account (i token di account diversi restano separati)
+            fetch: Funzione senza argomenti che restituisce un flow -> (token, expires_in)
+
+        Returns:
+            Nome del token da passare a token_flow()/get_token()
+        """
+        digest = hashlib.sha256((client_id or '').encode()).hexdigest()[:12]
+        name = f"{carrier.strip().upper()}:{digest}"
+        with self._lock:
+            # L'ultima istanza registrata fornisce le credenziali per i rinnovi
+            self._providers[name] = fetch
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._refresh_loop, name="oauth-refresh", daemon=True)
+                self._thread.start()
+        return name
+
+    # --- lettura -------------------------------------------------------
+
+    def token_flow(self, name: str):
+        """Flow: token valido (dalla cache se possibile, altrimenti lo richiede)"""
+        now = time.time()
+        with self._lock:
+            self._last_used[name] = now
+            token = self._tokens.get(name)
+            if token is not None and token.usable(now):
+                self.stats['hits'] += 1
+                if now >= token.refresh_at:
+                    self._wakeup.set()
+                return token.value
+
+        token = self._load_shared(name)
+        if token is not None and token.usable(now):
+            with self._lock:
+                self.stats['shared_hits'] += 1
+            return token.value
+
+        return (yield from self._fetch_flow(name, blocking=True))
+
+    def get_token(self, name: str) -> str:
+        """Token valido per le chiamate sincrone (solleva TokenError)"""
+        return http_transport.run(self.token_flow(name))
+
+    def invalidate(self, name: str) -> None:
+        """Scarta il token (es. dopo un 401): la prossima lettura ne chiede uno nuovo"""
+        with self._lock:
+            self._tokens.pop(name, None)
+        if self._shared:
+            try:
+                shared_state.kv_delete(_NAMESPACE, name)
+            except sqlite3.Error as e:
+                LOG.warning("Token OAuth %s: invalidazione condivisa fallita (%s)", name, e)
+
+    # --- rinnovo -------------------------------------------------------
+
+    def _fetch_flow(self, name: str, blocking: bool):
+        """Flow single-flight: ottiene il token o attende quello di un altro processo"""
+        fetch = self._providers.get(name)
+        if fetch is None:
+            raise TokenError(f"Token OAuth {name} non registrato")
+
+        with self._lock:
+            previous = self._tokens.get(name)
+        previous_expiry = previous.expires_at if previous is not None else 0.0
+        deadline = time.monotonic() + LEASE_TTL
+
+        while True:
+            if self._acquire_lease(name) or time.monotonic() > deadline:
+                break
+            if not blocking:
+                return None
+            with self._lock:
+                self.stats['waits'] += 1
+            yield Sleep(POLL_INTERVAL)
+
+            token = self._tokens.get(name) or self._load_shared(name)
+            if token is not None and token.usable(time.time()) and token.expires_at > previous_expiry:
+                self._store_local(name, token)
+                return token.value
+            error = self._shared_error(name)
+            if error:
+                raise TokenError(error)
+
+        try:
+            started = time.monotonic()
+            value, expires_in = yield from fetch()
+            if not value:
+                raise TokenError("risposta senza token")
+        except Exception as e:
+            with self._lock:
+                self.stats['errors'] += 1
+            self._share_error(name, str(e))
+            self._release_lease(name)
+            if isinstance(e, TokenError):
+                raise
+            raise TokenError(str(e)) from e
+
+        now = time.time()
+        lifetime = max(float(expires_in or 3600), 2 * EXPIRY_SKEW)
+        margin = min(self.margin, lifetime / 2)
+        token = _Token(value, now + lifetime, now + lifetime - margin)
+        self._store_local(name, token)
+        self._store_shared(name, token)
+        self._release_lease(name)
+        with self._lock:
+            self.stats['fetches'] += 1
+        LOG.info("🔑 Token OAuth %s rinnovato (%.0fs, %.0f ms)", name, lifetime,
+                 (time.monotonic() - started) * 1000)
+        return value
+
+    def _refresh_loop(self) -> None:
+        while True:
+            self._wakeup.wait(REFRESH_CHECK_INTERVAL)
+            self._wakeup.clear()
+            now = time.time()
+            with self._lock:
+                due = [name for name, used in self._last_used.items()
+                       if now - used < IDLE_TIMEOUT
+                       and (name not in self._tokens or now >= self._tokens[name].refresh_at)]
+            for name in due:
+                # Un altro worker potrebbe averlo già rinnovato
+                token = self._load_shared(name)
+                if token is not None and now < token.refresh_at:
+                    self._store_local(name, token)
+                    continue
+                try:
+                    if http_transport.run(self._fetch_flow(name, blocking=False)) is not None:
+                        with self._lock:
+                            self.stats['background_refreshes'] += 1
+                except Exception as e:
+                    LOG.warning("⚠️ Rinnovo in background del token OAuth %s fallito: %s", name, e)
+
+    # --- stato locale e condiviso -------------------------------------
+
+    def _store_local(self, name: str, token: _Token) -> None:
+        with self._lock:
+            current = self._tokens.get(name)
+            if current is None or token.expires_at >= current.expires_at:
+                self._tokens[name] = token
+
+    def _load_shared(self, name: str) -> Optional[_Token]:
+        if not self._shared:
+            return None
+        try:
+            value = shared_state.kv_get(_NAMESPACE, name)
+        except sqlite3.Error as e:
+            self._disable_shared(e)
+            return None
+        if value is None:
+            return None
+        try:
+            data = json.loads(value)
+            token = _Token(data['token'], float(data['expires_at']), float(data['refresh_at']))
+        except (ValueError, KeyError, TypeError):
+            return None
+        self._store_local(name, token)
+        return token
+
+    def _store_shared(self, name: str, token: _Token) -> None:
+        if not self._shared:
+            return
+        payload = json.dumps({'token': token.value, 'expires_at': token.expires_at,
+                              'refresh_at': token.refresh_at})
+        try:
+            shared_state.kv_set(_NAMESPACE, name, payload, max(1.0, token.expires_at - time.time()))
+        except sqlite3.Error as e:
+            self._disable_shared(e)
+
+    def _acquire_lease(self, name: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if self._leases.get(name, 0.0) > now:
+                return False
+            self._leases[name] = now + LEASE_TTL
+        if not self._shared:
+            return True
+        try:
+            if shared_state.kv_add(_NAMESPACE, f"lease:{name}", str(os.getpid()), LEASE_TTL):
+                return True
+        except sqlite3.Error as e:
+            self._disable_shared(e)
+            return True
+        with self._lock:
+            self._leases.pop(name, None)
+        return False
+
+    def _release_lease(self, name: str) -> None:
+        with self._lock:
+            self._leases.pop(name, None)
+        if self._shared:
+            try:
+                shared_state.kv_delete(_NAMESPACE, f"lease:{name}")
+            except sqlite3.Error as e:
+                self._disable_shared(e)
+
+    def _share_error(self, name: str, error: str) -> None:
+        if self._shared:
+            try:
+                shared_state.kv_set(_NAMESPACE, f"error:{name}", error, ERROR_TTL)
+            except sqlite3.Error as e:
+                self._disable_shared(e)
+
+    def _shared_error(self, name: str) -> Optional[str]:
+        if not self._shared:
+            return None
+        try:
+            return shared_state.kv_get(_NAMESPACE, f"error:{name}")
+        except sqlite3.Error as e:
+            self._disable_shared(e)
+            return None
+
+    def _disable_shared(self, error: Exception) -> None:
+        if self._shared:
+            LOG.warning("Token OAuth: stato condiviso non disponibile (%s), cache solo locale", error)
+            self._shared = False
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Statistiche e scadenze (senza i valori dei token)"""
+        now = time.time()
+        with self._lock:
+            stats = dict(self.stats)
+            stats['tokens'] = {
+                name: {
+                    'expires_in': round(token.expires_at - now),
+                    'refresh_in': round(token.refresh_at - now),
+                    'idle_seconds': round(now - self._last_used[name]) if name in self._last_used else None,
+                }
+                for name, token in self._tokens.items()
+            }
+        stats['margin'] = self.margin
+        stats['shared'] = self._shared
+        return stats
+
+
+_manager: Optional[TokenManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_manager() -> TokenManager:
+    """Restituisce il token manager (unico per processo)"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = TokenManager()
+        return _manager
+
+
+def register(carrier: str, client_id: Optional[str], fetch: TokenFlow) -> str:
+    return get_manager().register(carrier, client_id, fetch)
+
+
+def token_flow(name: str):
+    return get_manager().token_flow(name)
+
+
+def get_token(name: str) -> str:
+    return get_manager().get_token(name)
+
+
+def invalidate(name: str) -> None:
+    get_manager().invalidate(name)
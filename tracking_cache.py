@@ -0,0 +1,311 @@
+"""
+Cache delle risposte di tracking dei vettori
+
+Le risposte dei metodi track* dei client sono salvate per vettore+AWB:
+ - TTL per vettore (TrackingCacheConfig, TRACKING_CACHE_TTL_<VETTORE>)
+ - TTL lungo (TRACKING_CACHE_DELIVERED_TTL) per le spedizioni consegnate
+ - cache locale LRU limitata da un budget di memoria (TRACKING_CACHE_MAX_BYTES)
+ - con TRACKING_CACHE_SHARED=1 anche su shared_state, così i worker
+   gunicorn condividono le risposte
+
+Sono salvate solo le risposte valide: errori, "non trovato" e simulazioni
+vengono sempre richiesti di nuovo al vettore.
+
+Uso:
+    class UPSTrackingClient:
+        @cached_tracking('UPS')
+        def track_shipment(self, tracking_number, verbose=True): ...
+
+        @cached_tracking_async('UPS')
+        async def track_shipment_async(self, tracking_number, verbose=True): ...
+"""
+
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import functools
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import shared_state
+from config import TrackingCacheConfig
+from tracking_events import event_timestamp
+
+LOG = logging.getLogger(__name__)
+
+_NAMESPACE = 'tracking'
+
+# Stati/codici che indicano una spedizione consegnata
+_DELIVERED_WORDS = ('delivered', 'consegnato', 'consegnata')
+_NOT_DELIVERED_WORDS = ('not delivered', 'non consegnat', 'undelivered')
+_DELIVERED_CODES = {'DHL': {'OK'}, 'FEDEX': {'DL'}}
+
+
+def _carrier_key(carrier: str) -> str:
+    carrier = (carrier or '').strip().upper()
+    return 'FEDEX' if carrier == 'FED' else carrier
+
+
+def is_cacheable(result: Any) -> bool:
+    """True se la risposta è un tracking valido (non errori o simulazioni)"""
+    if not isinstance(result, dict):
+        return False
+    if result.get('error') or result.get('success') is False or result.get('simulation'):
+        return False
+    return result.get('status') not in ('error', 'not_found', 'no_tracking')
+
+
+def _latest_events(events: Any) -> List[Dict[str, Any]]:
+    """
+    Eventi più recenti della timeline
+
+    I client non usano lo stesso ordine (DHL dal più vecchio, gli altri dal
+    più recente): vale la data/ora dell'evento e, se nessun evento la ha,
+    si considerano entrambi gli estremi della lista.
+    """
+    events = [event for event in events or [] if isinstance(event, dict)]
+    stamped = [(event_timestamp(event), event) for event in events]
+    stamped = [(ts, event) for ts, event in stamped if ts is not None]
+    if not stamped:
+        return events if len(events) < 2 else [events[0], events[-1]]
+    newest = max(ts for ts, _ in stamped)
+    return [event for ts, event in stamped if ts == newest]
+
+
+def is_delivered(carrier: str, result: Dict[str, Any]) -> bool:
+    """Riconosce una spedizione consegnata dai campi di stato dei vari client"""
+    if result.get('delivered') is True:
+        return True
+
+    texts = [result.get('delivery_status'), result.get('current_status'),
+             result.get('status_description'), result.get('last_position')]
+    codes = _DELIVERED_CODES.get(_carrier_key(carrier), set())
+    for latest in _latest_events(result.get('events')):
+        texts += [latest.get('description'), latest.get('descrizione'), latest.get('status_description')]
+        code = latest.get('event_code') or latest.get('codice') or latest.get('code')
+        if code and str(code).upper() in codes:
+            return True
+
+    for text in texts:
+        if not isinstance(text, str):
+            continue
+        text = text.lower()
+        if any(word in text for word in _NOT_DELIVERED_WORDS):
+            continue
+        if any(word in text for word in _DELIVERED_WORDS):
+            return True
+    return False
+
+
+class TrackingCache:
+    """Cache LRU con TTL per vettore e backend condiviso opzionale"""
+
+    def __init__(self, config: Optional[TrackingCacheConfig] = None):
+        self.config = config or TrackingCacheConfig.from_env()
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()  # chiave -> (json, scadenza)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._shared = self.config.shared
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def _count(self, carrier: str, key: str, value: int = 1) -> None:
+        with self._lock:
+            stats = self.stats.setdefault(carrier, {'hits': 0, 'shared_hits': 0, 'misses': 0,
+                                                   'stores': 0, 'evictions': 0})
+            stats[key] += value
+
+    def _ttl(self, carrier: str, result: Dict[str, Any]) -> int:
+        ttl = self.config.ttl.get(carrier, 0)
+        if ttl > 0 and is_delivered(carrier, result):
+            return max(ttl, self.config.delivered_ttl)
+        return ttl
+
+    def get(self, carrier: str, awb: str) -> Optional[Dict[str, Any]]:
+        """Risposta in cache (copia) o None"""
+        carrier = _carrier_key(carrier)
+        key = f"{carrier}:{awb}"
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    payload = entry[0]
+                else:
+                    self._drop(key)
+                    payload = None
+            else:
+                payload = None
+
+        if payload is not None:
+            self._count(carrier, 'hits')
+            return json.loads(payload)
+
+        if self._shared:
+            try:
+                payload = shared_state.kv_get(_NAMESPACE, key)
+            except sqlite3.Error as e:
+                LOG.warning("Cache tracking condivisa non disponibile (%s), uso solo cache locale", e)
+                self._shared = False
+                payload = None
+            if payload is not None:
+                self._count(carrier, 'shared_hits')
+                result = json.loads(payload)
+                self._store_local(key, payload, self._ttl(carrier, result))
+                return result
+
+        self._count(carrier, 'misses')
+        return None
+
+    def set(self, carrier: str, awb: str, result: Dict[str, Any]) -> None:
+        """Salva la risposta se valida e se il vettore ha un TTL > 0"""
+        carrier = _carrier_key(carrier)
+        if not is_cacheable(result):
+            return
+        ttl = self._ttl(carrier, result)
+        if ttl <= 0:
+            return
+        try:
+            payload = json.dumps(result, ensure_ascii=False)
+        except (TypeError, ValueError):
+            return
+
+        key = f"{carrier}:{awb}"
+        self._store_local(key, payload, ttl)
+        self._count(carrier, 'stores')
+        if self._shared:
+            try:
+                shared_state.kv_set(_NAMESPACE, key, payload, ttl)
+            except sqlite3.Error as e:
+                LOG.warning("Cache tracking condivisa non disponibile (%s), uso solo cache locale", e)
+                self._shared = False
+
+    def get_many(self, carrier: str, awbs: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Risposte in cache per più AWB (solo quelli trovati)"""
+        hits = {}
+        for awb in awbs:
+            result = self.get(carrier, awb)
+            if result is not None:
+                hits[awb] = result
+        return hits
+
+    def set_many(self, carrier: str, results: Dict[str, Dict[str, Any]]) -> None:
+        for awb, result in results.items():
+            self.set(carrier, awb, result)
+
+    def get_or_fetch(self, carrier: str, awb: str, fetch: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        """Restituisce la risposta in cache o chiama `fetch` e salva il risultato"""
+        result = self.get(carrier, awb)
+        if result is not None:
+            return result
+        result = fetch()
+        self.set(carrier, awb, result)
+        return result
+
+    def invalidate(self, carrier: str, awb: str) -> None:
+        """Rimuove un AWB dalla cache (es. refresh forzato dall'utente)"""
+        key = f"{_carrier_key(carrier)}:{awb}"
+        with self._lock:
+            self._drop(key)
+        if self._shared:
+            try:
+                shared_state.kv_delete(_NAMESPACE, key)
+            except sqlite3.Error:
+                pass
+
+    def _store_local(self, key: str, payload: str, ttl: int) -> None:
+        size = len(payload)
+        if size > self.config.max_bytes:
+            return
+        evicted = []
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (payload, time.time() + ttl)
+            self._bytes += size
+            while self._bytes > self.config.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                evicted.append(oldest)
+        for oldest in evicted:
+            self._count(oldest.split(':', 1)[0], 'evictions')
+
+    def _drop(self, key: str) -> None:
+        """Rimuove una chiave dalla cache locale (chiamare con il lock)"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[0])
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Hit ratio per vettore e occupazione della cache locale"""
+        with self._lock:
+            carriers = {carrier: dict(stats) for carrier, stats in self.stats.items()}
+            entries, used = len(self._entries), self._bytes
+
+        for stats in carriers.values():
+            lookups = stats['hits'] + stats['shared_hits'] + stats['misses']
+            stats['hit_ratio'] = round((stats['hits'] + stats['shared_hits']) / lookups, 3) if lookups else 0.0
+
+        hits = sum(s['hits'] + s['shared_hits'] for s in carriers.values())
+        lookups = hits + sum(s['misses'] for s in carriers.values())
+        return {
+            'entries': entries,
+            'bytes': used,
+            'max_bytes': self.config.max_bytes,
+            'shared': self._shared,
+            'hit_ratio': round(hits / lookups, 3) if lookups else 0.0,
+            'carriers': carriers,
+        }
+
+
+_cache: Optional[TrackingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> TrackingCache:
+    """Restituisce la cache (unica per processo)"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = TrackingCache()
+        return _cache
+
+
+def cached_tracking(carrier: str):
+    """Decoratore per i metodi track(self, awb, ...) dei client: usa la cache per vettore+AWB"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, awb, *args, **kwargs):
+            return get_cache().get_or_fetch(carrier, awb, lambda: func(self, awb, *args, **kwargs))
+        return wrapper
+    return decorator
+
+
+def cached_tracking_async(carrier: str):
+    """
+    Come cached_tracking, per i metodi async track_async(self, awb, ...)
+
+    Con il backend condiviso letture e scritture su SQLite girano in un thread
+    (asyncio.to_thread) per non bloccare l'event loop.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, awb, *args, **kwargs):
+            cache = get_cache()
+            if cache._shared:
+                result = await asyncio.to_thread(cache.get, carrier, awb)
+            else:
+                result = cache.get(carrier, awb)
+            if result is not None:
+                return result
+            result = await func(self, awb, *args, **kwargs)
+            if cache._shared:
+                await asyncio.to_thread(cache.set, carrier, awb, result)
+            else:
+                cache.set(carrier, awb, result)
+            return result
+        return wrapper
+    return decorator
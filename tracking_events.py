@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Tracking Events - Archivio eventi di tracking su DB
+
+Salva gli eventi restituiti dai vettori nella tabella `tracking_events`
+(una riga per evento, indice su (spedizione_id, event_ts)) e tiene in
+`tracking_events_sync` l'ultimo timestamp salvato e l'ora dell'ultima
+sincronizzazione di ogni spedizione.
+
+Ogni evento è identificato da un hash stabile di vettore, codice,
+timestamp e località: i cicli di tracking inseriscono solo gli eventi non
+più vecchi dell'ultimo già salvato e i duplicati vengono scartati dal
+vincolo UNIQUE (spedizione_id, event_hash).
+
+L'evento grezzo del vettore è salvato in JSON, così la formattazione per il
+frontend (mappature nome/colore) resta quella applicata agli eventi live.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from db_connector import cursor as db_cursor
+
+LOG = logging.getLogger(__name__)
+
+# Età massima (secondi) degli eventi salvati prima di richiedere una chiamata live
+DEFAULT_MAX_AGE = 3600
+
+_TABLES_DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS tracking_events (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        spedizione_id INT NOT NULL,
+        vettore VARCHAR(16) NOT NULL,
+        event_hash CHAR(40) NOT NULL,
+        event_ts DATETIME NULL,
+        codice VARCHAR(64) NULL,
+        descrizione VARCHAR(512) NULL,
+        location VARCHAR(255) NULL,
+        raw_event TEXT NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE KEY uq_tracking_events_hash (spedizione_id, event_hash),
+        KEY idx_tracking_events_ts (spedizione_id, event_ts)
+    ) DEFAULT CHARSET=utf8mb4
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tracking_events_sync (
+        spedizione_id INT PRIMARY KEY,
+        last_event_ts DATETIME NULL,
+        synced_at DATETIME NOT NULL
+    ) DEFAULT CHARSET=utf8mb4
+    """,
+)
+
+# Formati data/ora usati dai client dei vettori
+_DATE_FORMATS = ("%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y", "%Y%m%d")
+_TIME_FORMATS = ("%H:%M:%S", "%H:%M", "%H%M%S")
+
+_tables_lock = threading.Lock()
+_tables_ready = False
+
+
+def get_max_age() -> int:
+    """Età massima degli eventi salvati (TRACKING_EVENTS_MAX_AGE, secondi)"""
+    value = os.getenv("TRACKING_EVENTS_MAX_AGE")
+    if value is None:
+        return DEFAULT_MAX_AGE
+    try:
+        return max(0, int(value))
+    except ValueError:
+        LOG.warning("Valore TRACKING_EVENTS_MAX_AGE non valido: %s", value)
+        return DEFAULT_MAX_AGE
+
+
+def ensure_tables(cur) -> None:
+    """Crea le tabelle eventi se mancano (una sola volta per processo)"""
+    global _tables_ready
+    if _tables_ready:
+        return
+    with _tables_lock:
+        if _tables_ready:
+            return
+        for ddl in _TABLES_DDL:
+            cur.execute(ddl)
+        _tables_ready = True
+
+
+def _parse_event_ts(date_str: Any, time_str: Any) -> Optional[datetime]:
+    date_str = str(date_str or '').strip()
+    time_str = str(time_str or '').strip().replace('.', ':')
+    if not date_str:
+        return None
+    for date_fmt in _DATE_FORMATS:
+        try:
+            day = datetime.strptime(date_str, date_fmt)
+        except ValueError:
+            continue
+        for time_fmt in _TIME_FORMATS:
+            try:
+                t = datetime.strptime(time_str, time_fmt)
+                return day.replace(hour=t.hour, minute=t.minute, second=t.second)
+            except ValueError:
+                continue
+        return day
+    return None
+
+
+def event_timestamp(event: Dict[str, Any]) -> Optional[datetime]:
+    """Data/ora di un evento grezzo del vettore (None se mancante o non riconosciuta)"""
+    return _parse_event_ts(event.get('date') or event.get('data'),
+                           event.get('time') or event.get('ora'))
+
+
+def sort_events(events: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Ordina gli eventi grezzi come load_events: più recenti prima, senza
+    timestamp in fondo, a parità di timestamp l'ultimo ricevuto prima
+    """
+    indexed = [(index, event) for index, event in enumerate(events or []) if isinstance(event, dict)]
+
+    def key(item):
+        index, event = item
+        event_ts = event_timestamp(event)
+        return (event_ts is not None, event_ts or datetime.min, index)
+
+    return [event for _, event in sorted(indexed, key=key, reverse=True)]
+
+
+def normalize_event(vettore: str, event: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Estrae i campi comuni da un evento grezzo del vettore
+
+    Returns:
+        Dict con codice, descrizione, location, event_ts (datetime o None) ed event_hash
+    """
+    codice = (event.get('event_code') or event.get('status_code')
+              or event.get('code') or event.get('codice') or '')
+    descrizione = (event.get('description') or event.get('status_description')
+                   or event.get('synthesis_description') or event.get('descrizione') or '')
+    location = (event.get('location') or event.get('office_description')
+                or event.get('luogo') or '')
+    event_ts = event_timestamp(event)
+
+    # Senza codice la descrizione distingue eventi diversi nello stesso istante
+    key = "|".join([
+        vettore.upper(),
+        str(codice) or str(descrizione),
+        event_ts.isoformat() if event_ts else f"{event.get('date') or event.get('data') or ''} {event.get('time') or event.get('ora') or ''}",
+        str(location),
+    ])
+    return {
+        'codice': str(codice)[:64],
+        'descrizione': str(descrizione)[:512],
+        'location': str(location)[:255],
+        'event_ts': event_ts,
+        'event_hash': hashlib.sha1(key.encode('utf-8')).hexdigest(),
+    }
+
+
+def store_events_many(cur, items: Iterable[Tuple[int, str, List[Dict[str, Any]]]]) -> int:
+    """
+    Salva gli eventi di più spedizioni usando il cursore (e la transazione) del chiamante
+
+    Inserisce solo gli eventi con timestamp >= all'ultimo salvato (o senza
+    timestamp); i duplicati sono ignorati grazie al vincolo su event_hash.
+    Aggiorna sempre synced_at, anche se non ci sono eventi nuovi.
+
+    Args:
+        cur: Cursore MySQL aperto (il commit resta al chiamante)
+        items: Tuple (spedizione_id, vettore, eventi grezzi)
+
+    Returns:
+        Numero di eventi candidati all'inserimento
+    """
+    items = list(items)
+    if not items:
+        return 0
+    ensure_tables(cur)
+
+    ids = [spedizione_id for spedizione_id, _, _ in items]
+    cur.execute(
+        f"SELECT spedizione_id, last_event_ts FROM tracking_events_sync "
+        f"WHERE spedizione_id IN ({', '.join(['%s'] * len(ids))})",
+        ids
+    )
+    last_ts = {row[0]: row[1] for row in cur.fetchall()}
+
+    now = datetime.now()
+    event_rows = []
+    sync_rows = []
+    for spedizione_id, vettore, events in items:
+        previous = last_ts.get(spedizione_id)
+        newest = previous
+        for event in events or []:
+            normalized = normalize_event(vettore, event)
+            event_ts = normalized['event_ts']
+            if previous is not None and event_ts is not None and event_ts < previous:
+                continue
+            if event_ts is not None and (newest is None or event_ts > newest):
+                newest = event_ts
+            event_rows.append((
+                spedizione_id, vettore.upper(), normalized['event_hash'], event_ts,
+                normalized['codice'], normalized['descrizione'], normalized['location'],
+                json.dumps(event, ensure_ascii=False, default=str),
+            ))
+        sync_rows.append((spedizione_id, newest, now))
+
+    if event_rows:
+        cur.executemany(
+            """INSERT IGNORE INTO tracking_events
+            (spedizione_id, vettore, event_hash, event_ts, codice, descrizione, location, raw_event)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+            event_rows
+        )
+    cur.executemany(
+        """INSERT INTO tracking_events_sync (spedizione_id, last_event_ts, synced_at)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE last_event_ts = VALUES(last_event_ts), synced_at = VALUES(synced_at)""",
+        sync_rows
+    )
+    return len(event_rows)
+
+
+def store_events(spedizione_id: int, vettore: str, events: List[Dict[str, Any]]) -> int:
+    """Salva gli eventi di una spedizione in una transazione propria"""
+    with db_cursor() as (conn, cur):
+        count = store_events_many(cur, [(spedizione_id, vettore, events)])
+        conn.commit()
+        return count
+
+
+def load_events(spedizione_id: int) -> Tuple[List[Dict[str, Any]], Optional[datetime]]:
+    """
+    Legge gli eventi salvati di una spedizione (più recenti prima)
+
+    Returns:
+        Tupla (eventi grezzi, synced_at) - synced_at None se mai sincronizzata
+    """
+    with db_cursor() as (conn, cur):
+        ensure_tables(cur)
+        cur.execute(
+            "SELECT synced_at FROM tracking_events_sync WHERE spedizione_id = %s",
+            (spedizione_id,)
+        )
+        row = cur.fetchone()
+        synced_at = row[0] if row else None
+
+        cur.execute(
+            """SELECT raw_event FROM tracking_events
+            WHERE spedizione_id = %s
+            ORDER BY event_ts IS NULL, event_ts DESC, id DESC""",
+            (spedizione_id,)
+        )
+        events = []
+        for (raw_event,) in cur.fetchall():
+            try:
+                events.append(json.loads(raw_event))
+            except (TypeError, ValueError):
+                continue
+        return events, synced_at
+
+
+def is_stale(synced_at: Optional[datetime], max_age: Optional[int] = None) -> bool:
+    """True se gli eventi non sono mai stati sincronizzati o sono più vecchi di max_age"""
+    if synced_at is None:
+        return True
+    max_age = get_max_age() if max_age is None else max_age
+    return (datetime.now() - synced_at).total_seconds() > max_age
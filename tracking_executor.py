@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Tracking Executor - Aggiornamento tracking concorrente per vettore
+
+Esegue il tracking di un insieme di spedizioni usando un pool di thread
+separato per ogni vettore (UPS, DHL, SDA, BRT, FedEx, TNT). Ogni vettore ha
+il proprio limite di concorrenza, così la durata di un ciclo dipende dal
+vettore più lento e non dalla somma di tutti.
+
+I risultati vengono accodati in un TrackingWriteBuffer e salvati sul DB a
+blocchi (una UPDATE multi-riga e un commit ogni N righe cambiate).
+"""
+
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from config import DEFAULT_TRACKING_CONCURRENCY
+from tracking_service import TrackingService
+from tracking_writer import TrackingWriteBuffer
+
+LOG = logging.getLogger(__name__)
+
+# Richieste parallele per vettore (sovrascrivibili con TRACKING_CONCURRENCY_<VETTORE>)
+DEFAULT_CONCURRENCY = DEFAULT_TRACKING_CONCURRENCY
+
+
+def normalize_carrier(vettore: Optional[str]) -> str:
+    """Normalizza il nome vettore usato come chiave dei pool (FED -> FEDEX)"""
+    carrier = (vettore or '').strip().upper()
+    return "FEDEX" if carrier == "FED" else carrier
+
+
+def _concurrency_from_env(carrier: str, default: int) -> int:
+    value = os.getenv(f"TRACKING_CONCURRENCY_{carrier}")
+    if value is None:
+        return default
+    try:
+        return max(1, int(value))
+    except ValueError:
+        LOG.warning("Valore TRACKING_CONCURRENCY_%s non valido: %s", carrier, value)
+        return default
+
+
+class TrackingExecutor:
+    """Esegue il tracking in parallelo con un pool limitato per ogni vettore"""
+
+    def __init__(self, tracking_service: Optional[TrackingService] = None,
+                 concurrency: Optional[Dict[str, int]] = None,
+                 write_batch_size: Optional[int] = None):
+        """
+        Args:
+            tracking_service: Servizio da usare (se None ne crea uno nuovo)
+            concurrency: Override dei limiti per vettore, es. {"DHL": 8}
+            write_batch_size: Righe per transazione di scrittura (default TRACKING_WRITE_BATCH)
+        """
+        self.tracking_service = tracking_service or TrackingService()
+        self.write_batch_size = write_batch_size
+        self.concurrency = {
+            carrier: _concurrency_from_env(carrier, limit)
+            for carrier, limit in DEFAULT_CONCURRENCY.items()
+        }
+        if concurrency:
+            self.concurrency.update({normalize_carrier(k): max(1, int(v)) for k, v in concurrency.items()})
+
+        self._lock = threading.Lock()
+        self.cycle_count = 0
+        self.last_cycle: Dict[str, Any] = {}
+
+    def run(self, shipments: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Aggiorna il tracking di una lista di spedizioni
+
+        Args:
+            shipments: Lista di dict con almeno 'id', 'vettore' e 'awb'
+
+        Returns:
+            Dict con le metriche del ciclo (durata totale e per vettore)
+        """
+        groups: Dict[str, List[Dict[str, Any]]] = {}
+        skipped = 0
+        for shipment in shipments:
+            carrier = normalize_carrier(shipment.get('vettore'))
+            if carrier not in self.concurrency or not shipment.get('awb'):
+                skipped += 1
+                continue
+            groups.setdefault(carrier, []).append(shipment)
+
+        started_at = datetime.now()
+        start = time.monotonic()
+        carriers = {
+            carrier: {"total": len(items), "updated": 0, "failed": 0,
+                      "duration_seconds": 0.0, "task_seconds": 0.0}
+            for carrier, items in groups.items()
+        }
+
+        # I vettori con API multi-AWB ricevono gruppi di spedizioni in una sola richiesta
+        chunks: Dict[str, List[List[Dict[str, Any]]]] = {}
+        for carrier, items in groups.items():
+            size = max(1, self.tracking_service.get_batch_size(carrier))
+            chunks[carrier] = [items[i:i + size] for i in range(0, len(items), size)]
+
+        writer = TrackingWriteBuffer(self.write_batch_size)
+        pools = {
+            carrier: ThreadPoolExecutor(max_workers=min(self.concurrency[carrier], len(carrier_chunks)),
+                                        thread_name_prefix=f"tracking-{carrier.lower()}")
+            for carrier, carrier_chunks in chunks.items()
+        }
+        # Spedizioni tracciate con successo: contate come aggiornate solo dopo il flush
+        succeeded: Dict[str, List[Any]] = {carrier: [] for carrier in groups}
+        try:
+            futures = {}
+            for carrier, carrier_chunks in chunks.items():
+                for chunk in carrier_chunks:
+                    future = pools[carrier].submit(self._track_chunk, carrier, chunk, writer)
+                    futures[future] = (carrier, chunk)
+
+            for future in as_completed(futures):
+                carrier, chunk = futures[future]
+                stats = carriers[carrier]
+                try:
+                    results, elapsed = future.result()
+                except Exception as e:
+                    error = {"success": False, "error": str(e)}
+                    results, elapsed = [(shipment, error) for shipment in chunk], 0.0
+
+                stats["task_seconds"] += elapsed
+                stats["duration_seconds"] = time.monotonic() - start
+                for shipment, result in results:
+                    if result.get('success'):
+                        succeeded[carrier].append(shipment['id'])
+                        LOG.debug("✅ Tracking ID %s: %s", shipment['id'], result.get('last_position'))
+                    else:
+                        stats["failed"] += 1
+                        LOG.debug("⚠️ Errore ID %s: %s", shipment['id'], result.get('error'))
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=True)
+            writer.flush()
+
+        not_written = writer.failed_ids()
+        for carrier, ids in succeeded.items():
+            lost = sum(1 for spedizione_id in ids if spedizione_id in not_written)
+            carriers[carrier]["updated"] += len(ids) - lost
+            carriers[carrier]["failed"] += lost
+
+        duration = time.monotonic() - start
+        cycle = {
+            "started_at": started_at.isoformat(),
+            "duration_seconds": round(duration, 3),
+            # Somma dei tempi delle singole chiamate: è la durata che avrebbe un ciclo sequenziale
+            "task_seconds": round(sum(c["task_seconds"] for c in carriers.values()), 3),
+            "total": sum(c["total"] for c in carriers.values()),
+            "updated": sum(c["updated"] for c in carriers.values()),
+            "failed": sum(c["failed"] for c in carriers.values()),
+            "skipped": skipped,
+            "writes": writer.get_statistics(),
+            "carriers": {
+                carrier: {k: round(v, 3) if isinstance(v, float) else v for k, v in stats.items()}
+                for carrier, stats in carriers.items()
+            },
+        }
+
+        with self._lock:
+            self.cycle_count += 1
+            self.last_cycle = cycle
+
+        LOG.info("⏱️ Ciclo tracking: %d/%d aggiornate in %.1fs (sequenziale stimato %.1fs)",
+                 cycle["updated"], cycle["total"], cycle["duration_seconds"], cycle["task_seconds"])
+        LOG.info("   DB: %d righe scritte, %d invariate, %d transazioni",
+                 cycle["writes"]["written"], cycle["writes"]["unchanged"], cycle["writes"]["transactions"])
+        for carrier, stats in cycle["carriers"].items():
+            LOG.info("   %s: %d/%d in %.1fs", carrier, stats["updated"], stats["total"], stats["duration_seconds"])
+
+        return cycle
+
+    def _track_chunk(self, carrier: str, shipments: List[Dict[str, Any]],
+                     writer: Optional[TrackingWriteBuffer] = None) -> tuple:
+        """
+        Interroga il vettore per un gruppo di spedizioni e accoda i risultati nel writer
+
+        Returns:
+            Tupla ([(spedizione, risultato), ...], secondi)
+        """
+        start = time.monotonic()
+        if len(shipments) == 1:
+            awb = shipments[0]['awb']
+            trackings = {awb: self.tracking_service._get_tracking_data(carrier, awb)}
+        else:
+            trackings = self.tracking_service._get_tracking_data_many(
+                carrier, [shipment['awb'] for shipment in shipments]
+            )
+
+        results = []
+        for shipment in shipments:
+            tracking = trackings.get(shipment['awb']) or {
+                'status': None, 'events': [], 'error': 'Nessun risultato dal vettore'
+            }
+            result = self.tracking_service.update_tracking_from_result(
+                shipment['id'], carrier, shipment['awb'], tracking, writer=writer
+            )
+            results.append((shipment, result))
+        return results, time.monotonic() - start
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Restituisce limiti di concorrenza e metriche dell'ultimo ciclo"""
+        with self._lock:
+            return {
+                "concurrency": dict(self.concurrency),
+                "cycle_count": self.cycle_count,
+                "last_cycle": dict(self.last_cycle),
+            }
@@ -9,6 +9,8 @@ Aggiorna automaticamente final_position quando la spedizione è consegnata.
 
 import logging
 from typing import Optional, Dict, Any
+import count_cache
+import tracking_events
 from db_connector import cursor as db_cursor
 from ups_tracking import UPSTrackingClient
 from dhl_tracking import DHLTrackingClient
@@ -99,7 +101,7 @@ class TrackingService:
         """
         try:
             if vettore == "UPS":
-                result = self.ups_client.track_shipment(awb)
+                result = self.ups_client.track_shipment(awb, verbose=False)
                 if result.get('error'):
                     LOG.warning(f"Errore tracking UPS {awb}: {result['error']}")
                     return {'tracking_data': (None, None, None), 'events': [], 'error': result['error']}
@@ -113,17 +115,7 @@ class TrackingService:
                 }
             
             elif vettore == "DHL":
-                result = self.dhl_client.track_shipment(awb)
-                if result.get('error'):
-                    LOG.warning(f"Errore tracking DHL {awb}: {result['error']}")
-                    return {'status': None, 'events': [], 'error': result['error']}
-                status = self._extract_dhl_status(result)
-                return {
-                    'success': True,
-                    'status': status,
-                    'events': result.get('events', []),
-                    'raw_result': result
-                }
+                return self._wrap_dhl_result(awb, self.dhl_client.track_shipment(awb))
             
             elif vettore == "SDA":
                 result = self.sda_client.track(awb)
@@ -152,20 +144,7 @@ class TrackingService:
                 }
             
             elif vettore in ["FEDEX", "FED"]:
-                result = self.fedex_client.track_shipment(awb)
-                if not result.get('success'):
-                    error_msg = result.get('error', 'Errore FedEx sconosciuto')
-                    LOG.warning(f"Errore tracking FedEx {awb}: {error_msg}")
-                    return {'status': None, 'events': [], 'error': error_msg}
-                
-                events = result.get('events', [])
-                status = self._extract_fedex_status(events)
-                return {
-                    'success': True,
-                    'status': status,
-                    'events': events,
-                    'raw_result': result
-                }
+                return self._wrap_fedex_result(awb, self.fedex_client.track_shipment(awb))
             
             elif vettore == "TNT":
                 result = self.tnt_client.track_shipment(awb)
@@ -200,6 +179,73 @@ class TrackingService:
                 'error': f"Errore interno: {str(e)}"
             }
 
+    def get_batch_size(self, vettore: str) -> int:
+        """Numero di AWB che il vettore accetta in una singola richiesta (1 = nessun batch)"""
+        if vettore == "DHL":
+            return self.dhl_client.MAX_AWB_PER_REQUEST
+        if vettore in ["FEDEX", "FED"]:
+            return self.fedex_client.MAX_TRACKING_NUMBERS_PER_REQUEST
+        return 1
+
+    def _get_tracking_data_many(self, vettore: str, awbs: list) -> Dict[str, Dict[str, Any]]:
+        """
+        Come _get_tracking_data ma per più AWB dello stesso vettore
+
+        Per i vettori con API multi-AWB (DHL, FedEx) usa una richiesta per gruppo di AWB,
+        per gli altri interroga un AWB alla volta.
+
+        Returns:
+            Dict AWB -> risultato nel formato di _get_tracking_data
+        """
+        if vettore == "DHL":
+            try:
+                results = self.dhl_client.track_many(awbs)
+                return {awb: self._wrap_dhl_result(awb, results[awb]) for awb in results}
+            except Exception as e:
+                LOG.exception("Errore tracking DHL multiplo")
+                error = {'success': False, 'status': None, 'events': [], 'error': f"Errore interno: {str(e)}"}
+                return {awb: dict(error) for awb in awbs}
+
+        if vettore in ["FEDEX", "FED"]:
+            try:
+                results = self.fedex_client.track_shipments(awbs)
+                return {awb: self._wrap_fedex_result(awb, results[awb]) for awb in results}
+            except Exception as e:
+                LOG.exception("Errore tracking FedEx multiplo")
+                error = {'success': False, 'status': None, 'events': [], 'error': f"Errore interno: {str(e)}"}
+                return {awb: dict(error) for awb in awbs}
+
+        return {awb: self._get_tracking_data(vettore, awb) for awb in dict.fromkeys(awbs)}
+
+    def _wrap_fedex_result(self, awb: str, result: Dict[str, Any]) -> Dict[str, Any]:
+        """Converte il risultato di FedExTracking nel formato di _get_tracking_data"""
+        if not result.get('success'):
+            error_msg = result.get('error', 'Errore FedEx sconosciuto')
+            LOG.warning(f"Errore tracking FedEx {awb}: {error_msg}")
+            return {'status': None, 'events': [], 'error': error_msg}
+        
+        events = result.get('events', [])
+        status = self._extract_fedex_status(events)
+        return {
+            'success': True,
+            'status': status,
+            'events': events,
+            'raw_result': result
+        }
+
+    def _wrap_dhl_result(self, awb: str, result: Dict[str, Any]) -> Dict[str, Any]:
+        """Converte il risultato di DHLTrackingClient nel formato di _get_tracking_data"""
+        if result.get('error'):
+            LOG.warning(f"Errore tracking DHL {awb}: {result['error']}")
+            return {'status': None, 'events': [], 'error': result['error']}
+        status = self._extract_dhl_status(result)
+        return {
+            'success': True,
+            'status': status,
+            'events': result.get('events', []),
+            'raw_result': result
+        }
+
     def _update_tracking_data(self, spedizione_id: int, last_position: str, events: list) -> bool:
         """Aggiorna last_position e final_position nel database"""
         try:
@@ -244,61 +290,159 @@ class TrackingService:
             LOG.exception("Errore lettura vettore per spedizione %s", spedizione_id)
             return None
 
-
-
-    def update_tracking_ups(self, spedizione_id: int) -> Dict[str, Any]:
-        """Aggiorna tracking specifico per UPS - dati grezzi"""
+    def _update_tracking_carrier(self, spedizione_id: int, vettore: str) -> Dict[str, Any]:
+        """Legge l'AWB, interroga il vettore e salva l'ultimo status sul DB"""
         try:
             spedizione_data = self._get_spedizione_data(spedizione_id)
             if not spedizione_data:
                 return {"success": False, "error": "Spedizione non trovata"}
-            
+
             awb = spedizione_data.get('awb', '')
             if not awb:
                 return {"success": False, "error": "AWB mancante"}
-            
-            # Tracking UPS
-            result = self.ups_client.track_shipment(awb, verbose=False)
-            if result.get('error'):
-                return {"success": False, "error": result['error'], "vettore": "UPS", "awb": awb}
-            
-            # Estrai dati grezzi
-            tracking_data = self._extract_ups_status(result)
-            description, date_str, time_str = tracking_data
-            
+
+            tracking = self._get_tracking_data(vettore, awb)
+            return self.update_tracking_from_result(spedizione_id, vettore, awb, tracking)
+
+        except Exception as e:
+            LOG.exception("Errore tracking %s spedizione %s", vettore, spedizione_id)
+            return {"success": False, "error": str(e)}
+
+    def update_tracking_from_result(self, spedizione_id: int, vettore: str, awb: str,
+                                    tracking: Dict[str, Any], writer=None) -> Dict[str, Any]:
+        """
+        Salva sul DB un risultato già ottenuto da _get_tracking_data
+
+        Usato sia dai metodi update_tracking_* sia dal TrackingExecutor,
+        che interroga i vettori in parallelo e salva i risultati man mano.
+
+        Args:
+            spedizione_id: ID della spedizione
+            vettore: UPS, DHL, SDA, BRT, FEDEX o TNT
+            awb: Numero tracking
+            tracking: Dict restituito da _get_tracking_data
+            writer: TrackingWriteBuffer opzionale; se presente l'aggiornamento
+                    viene accodato e scritto a blocchi invece che subito
+
+        Returns:
+            Dict con risultato operazione (stesso formato di update_tracking)
+        """
+        try:
+            if tracking.get('error') or not tracking.get('success'):
+                error_msg = tracking.get('error') or f"Errore {vettore}"
+                return {"success": False, "error": error_msg, "vettore": vettore, "awb": awb}
+
+            description, dt_obj = self._extract_last_position(vettore, tracking.get('raw_result') or {})
             if not description:
                 return {"success": False, "error": "Nessuno status ricevuto"}
-            
-            # Aggiorna database - SOLO DATI GREZZI
-            with db_cursor() as (conn, cur):
-                if date_str and time_str:
-                    from datetime import datetime
-                    dt_obj = datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M:%S")
-                    cur.execute(
-                        """UPDATE spedizioni 
-                        SET last_position = %s, last_position_update = %s 
-                        WHERE id = %s""",
-                        [description, dt_obj, spedizione_id]
-                    )
-                else:
-                    cur.execute(
-                        """UPDATE spedizioni 
-                        SET last_position = %s 
-                        WHERE id = %s""",
-                        [description, spedizione_id]
-                    )
-                conn.commit()
-                
-                if cur.rowcount > 0:
-                    LOG.info(f"✅ Tracking UPS {spedizione_id} aggiornato: {description}")
-                    return {"success": True, "last_position": description, "vettore": "UPS", "awb": awb}
-                else:
-                    return {"success": False, "error": "Errore aggiornamento database"}
-                    
+
+            events = tracking.get('events') or []
+            if writer is not None:
+                writer.add(spedizione_id, description, dt_obj)
+                writer.add_events(spedizione_id, vettore, events)
+                return {"success": True, "last_position": description, "vettore": vettore, "awb": awb}
+
+            self._save_events(spedizione_id, vettore, events)
+            if self._save_last_position(spedizione_id, description, dt_obj):
+                LOG.info(f"✅ Tracking {vettore} {spedizione_id} aggiornato: {description}")
+                return {"success": True, "last_position": description, "vettore": vettore, "awb": awb}
+            return {"success": False, "error": "Errore aggiornamento database"}
+
         except Exception as e:
-            LOG.exception("Errore tracking UPS spedizione %s", spedizione_id)
+            LOG.exception("Errore salvataggio tracking %s spedizione %s", vettore, spedizione_id)
             return {"success": False, "error": str(e)}
 
+    def _extract_last_position(self, vettore: str, result: Dict[str, Any]) -> tuple:
+        """Estrae (descrizione, datetime) dell'ultimo evento dal risultato grezzo del vettore
+
+        Returns:
+            tuple: (description, datetime) - datetime None se non disponibile
+        """
+        from datetime import datetime
+
+        description, date_str, time_str, fmt = None, '', '', None
+
+        if vettore == "UPS":
+            description, date_str, time_str = self._extract_ups_status(result)
+            fmt = "%Y-%m-%d %H:%M:%S"
+        elif vettore in ["FEDEX", "FED"]:
+            events = result.get('events', [])
+            if events:
+                description = events[0].get('descrizione', '')
+                date_str, time_str = events[0].get('data', ''), events[0].get('ora', '')
+            fmt = "%Y-%m-%d %H:%M"
+        elif vettore == "DHL":
+            events = result.get('events', [])
+            if events:
+                description = events[0].get('description', '')
+                date_str, time_str = events[0].get('date', ''), events[0].get('time', '')
+            fmt = "%Y-%m-%d %H:%M:%S"
+        elif vettore == "SDA":
+            description = result.get('last_position', '')
+        elif vettore == "BRT":
+            events = result.get('events', [])
+            if events:
+                description = events[0].get('description', '')
+                # BRT usa formato DD.MM.YYYY e HH.MM
+                date_str = events[0].get('date', '')
+                time_str = (events[0].get('time') or '').replace('.', ':')
+            fmt = "%d.%m.%Y %H:%M"
+        elif vettore == "TNT":
+            description = result.get('current_status', '')
+            # Se non c'è current_status, prova con il primo evento
+            if not description and result.get('events'):
+                description = result['events'][0].get('description', '')
+            last_update = result.get('last_update', '')
+            if last_update:
+                try:
+                    return (description, datetime.fromisoformat(last_update))
+                except ValueError:
+                    pass
+
+        dt_obj = None
+        if fmt and date_str and time_str:
+            try:
+                dt_obj = datetime.strptime(f"{date_str} {time_str}", fmt)
+            except ValueError:
+                LOG.warning(f"Data evento {vettore} non valida: {date_str} {time_str}")
+
+        return (description or None, dt_obj)
+
+    def _save_events(self, spedizione_id: int, vettore: str, events: list) -> None:
+        """Salva gli eventi in tracking_events (gli errori non bloccano l'aggiornamento)"""
+        try:
+            tracking_events.store_events(spedizione_id, vettore, events)
+        except Exception:
+            LOG.exception("Errore salvataggio eventi spedizione %s", spedizione_id)
+
+    def _save_last_position(self, spedizione_id: int, description: str, dt_obj=None) -> bool:
+        """Aggiorna last_position (e last_position_update se disponibile) - SOLO DATI GREZZI"""
+        with db_cursor() as (conn, cur):
+            if dt_obj is not None:
+                cur.execute(
+                    """UPDATE spedizioni
+                    SET last_position = %s, last_position_update = %s
+                    WHERE id = %s""",
+                    [description, dt_obj, spedizione_id]
+                )
+            else:
+                cur.execute(
+                    """UPDATE spedizioni
+                    SET last_position = %s
+                    WHERE id = %s""",
+                    [description, spedizione_id]
+                )
+            conn.commit()
+            updated = cur.rowcount > 0
+        if updated:
+            # last_position è tra i campi della ricerca globale
+            count_cache.invalidate()
+        return updated
+
+    def update_tracking_ups(self, spedizione_id: int) -> Dict[str, Any]:
+        """Aggiorna tracking specifico per UPS - dati grezzi"""
+        return self._update_tracking_carrier(spedizione_id, "UPS")
+
     def _extract_ups_status(self, ups_result: Dict[str, Any]) -> tuple:
             """Estrae description, date e time da risultato UPS per aggiornamento DB
             
@@ -334,63 +478,7 @@ class TrackingService:
 
     def update_tracking_fedex(self, spedizione_id: int) -> Dict[str, Any]:
         """Aggiorna tracking specifico per FedEx - dati grezzi"""
-        try:
-            spedizione_data = self._get_spedizione_data(spedizione_id)
-            if not spedizione_data:
-                return {"success": False, "error": "Spedizione non trovata"}
-            
-            awb = spedizione_data.get('awb', '')
-            if not awb:
-                return {"success": False, "error": "AWB mancante"}
-            
-            # Tracking FedEx
-            result = self.fedex_client.track_shipment(awb)
-            if not result.get('success'):
-                error_msg = result.get('error', 'Errore FedEx')
-                return {"success": False, "error": error_msg, "vettore": "FEDEX", "awb": awb}
-            
-            # Estrai primo evento (più recente)
-            events = result.get('events', [])
-            if not events:
-                return {"success": False, "error": "Nessun evento ricevuto"}
-            
-            latest_event = events[0]
-            description = latest_event.get('descrizione', '')
-            date_str = latest_event.get('data', '')
-            time_str = latest_event.get('ora', '')
-            
-            if not description:
-                return {"success": False, "error": "Nessuno status ricevuto"}
-            
-            # Aggiorna database - SOLO DATI GREZZI
-            with db_cursor() as (conn, cur):
-                if date_str and time_str:
-                    from datetime import datetime
-                    dt_obj = datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M")
-                    cur.execute(
-                        """UPDATE spedizioni 
-                        SET last_position = %s, last_position_update = %s 
-                        WHERE id = %s""",
-                        [description, dt_obj, spedizione_id]
-                    )
-                else:
-                    cur.execute(
-                        """UPDATE spedizioni 
-                        SET last_position = %s 
-                        WHERE id = %s""",
-                        [description, spedizione_id]
-                    )
-                conn.commit()
-                
-                if cur.rowcount > 0:
-                    LOG.info(f"✅ Tracking FedEx {spedizione_id} aggiornato: {description}")
-                    return {"success": True, "last_position": description, "vettore": "FEDEX", "awb": awb}
-                else:
-                    return {"success": False, "error": "Errore aggiornamento database"}
-                    
-        except Exception as e:
-            LOG.exception("Errore tracking FedEx spedizione %s", spedizione_id)
-            return {"success": False, "error": str(e)}
+        return self._update_tracking_carrier(spedizione_id, "FEDEX")
 
     def _extract_fedex_status(self, fedex_events: list) -> str:
         """Estrae il codice evento FedEx"""
@@ -416,62 +504,7 @@ class TrackingService:
 
     def update_tracking_dhl(self, spedizione_id: int) -> Dict[str, Any]:
         """Aggiorna tracking specifico per DHL - dati grezzi"""
-        try:
-            spedizione_data = self._get_spedizione_data(spedizione_id)
-            if not spedizione_data:
-                return {"success": False, "error": "Spedizione non trovata"}
-            
-            awb = spedizione_data.get('awb', '')
-            if not awb:
-                return {"success": False, "error": "AWB mancante"}
-            
-            # Tracking DHL
-            result = self.dhl_client.track_shipment(awb)
-            if result.get('error'):
-                return {"success": False, "error": result['error'], "vettore": "DHL", "awb": awb}
-            
-            # Estrai primo evento (più recente)
-            events = result.get('events', [])
-            if not events:
-                return {"success": False, "error": "Nessun evento ricevuto"}
-            
-            latest_event = events[0]
-            description = latest_event.get('description', '')
-            date_str = latest_event.get('date', '')
-            time_str = latest_event.get('time', '')
-            
-            if not description:
-                return {"success": False, "error": "Nessuno status ricevuto"}
-            
-            # Aggiorna database - SOLO DATI GREZZI
-            with db_cursor() as (conn, cur):
-                if date_str and time_str:
-                    from datetime import datetime
-                    dt_obj = datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M:%S")
-                    cur.execute(
-                        """UPDATE spedizioni 
-                        SET last_position = %s, last_position_update = %s 
-                        WHERE id = %s""",
-                        [description, dt_obj, spedizione_id]
-                    )
-                else:
-                    cur.execute(
-                        """UPDATE spedizioni 
-                        SET last_position = %s 
-                        WHERE id = %s""",
-                        [description, spedizione_id]
-                    )
-                conn.commit()
-                
-                if cur.rowcount > 0:
-                    LOG.info(f"✅ Tracking DHL {spedizione_id} aggiornato: {description}")
-                    return {"success": True, "last_position": description, "vettore": "DHL", "awb": awb}
-                else:
-                    return {"success": False, "error": "Errore aggiornamento database"}
-                    
-        except Exception as e:
-            LOG.exception("Errore tracking DHL spedizione %s", spedizione_id)
-            return {"success": False, "error": str(e)}
+        return self._update_tracking_carrier(spedizione_id, "DHL")
 
     def _extract_dhl_status(self, dhl_result: Dict[str, Any]) -> str:
         """Estrae il messaggio di status da risultato DHL"""
@@ -496,43 +529,7 @@ class TrackingService:
 
     def update_tracking_sda(self, spedizione_id: int) -> Dict[str, Any]:
         """Aggiorna tracking specifico per SDA"""
-        try:
-            spedizione_data = self._get_spedizione_data(spedizione_id)
-            if not spedizione_data:
-                return {"success": False, "error": "Spedizione non trovata"}
-            
-            awb = spedizione_data.get('awb', '')
-            if not awb:
-                return {"success": False, "error": "AWB mancante"}
-            
-            # Tracking SDA
-            result = self.sda_client.track(awb)
-            if not result.get('success'):
-                return {"success": False, "error": result.get('message', 'Errore SDA'), "vettore": "SDA", "awb": awb}
-            
-            last_position = result.get('last_position', '')
-            if not last_position:
-                return {"success": False, "error": "Nessuno status ricevuto"}
-            
-            # Aggiorna database
-            with db_cursor() as (conn, cur):
-                cur.execute(
-                    """UPDATE spedizioni 
-                    SET last_position = %s 
-                    WHERE id = %s""",
-                    [last_position, spedizione_id]
-                )
-                conn.commit()
-                
-                if cur.rowcount > 0:
-                    LOG.info(f"✅ Tracking SDA {spedizione_id} aggiornato: {last_position}")
-                    return {"success": True, "last_position": last_position, "vettore": "SDA", "awb": awb}
-                else:
-                    return {"success": False, "error": "Errore aggiornamento database"}
-                    
-        except Exception as e:
-            LOG.exception("Errore tracking SDA spedizione %s", spedizione_id)
-            return {"success": False, "error": str(e)}
+        return self._update_tracking_carrier(spedizione_id, "SDA")
 
     def _extract_sda_status(self, sda_result: Dict[str, Any]) -> str:
         """Estrae il messaggio di status da risultato SDA"""
@@ -550,64 +547,7 @@ class TrackingService:
 
     def update_tracking_brt(self, spedizione_id: int) -> Dict[str, Any]:
         """Aggiorna tracking specifico per BRT - dati grezzi"""
-        try:
-            spedizione_data = self._get_spedizione_data(spedizione_id)
-            if not spedizione_data:
-                return {"success": False, "error": "Spedizione non trovata"}
-            
-            awb = spedizione_data.get('awb', '')
-            if not awb:
-                return {"success": False, "error": "AWB mancante"}
-            
-            # Tracking BRT
-            result = self.brt_client.track(awb)
-            if not result.get('success'):
-                error_msg = result.get('message', 'Errore BRT')
-                return {"success": False, "error": error_msg, "vettore": "BRT", "awb": awb}
-            
-            # Estrai primo evento (più recente)
-            events = result.get('events', [])
-            if not events:
-                return {"success": False, "error": "Nessun evento ricevuto"}
-            
-            latest_event = events[0]
-            description = latest_event.get('description', '')
-            date_str = latest_event.get('date', '')
-            time_str = latest_event.get('time', '')
-            
-            if not description:
-                return {"success": False, "error": "Nessuno status ricevuto"}
-            
-            # Aggiorna database - SOLO DATI GREZZI
-            with db_cursor() as (conn, cur):
-                if date_str and time_str:
-                    from datetime import datetime
-                    # BRT usa formato DD.MM.YYYY e HH.MM
-                    dt_obj = datetime.strptime(f"{date_str} {time_str.replace('.', ':')}", "%d.%m.%Y %H:%M")
-                    cur.execute(
-                        """UPDATE spedizioni 
-                        SET last_position = %s, last_position_update = %s 
-                        WHERE id = %s""",
-                        [description, dt_obj, spedizione_id]
-                    )
-                else:
-                    cur.execute(
-                        """UPDATE spedizioni 
-                        SET last_position = %s 
-                        WHERE id = %s""",
-                        [description, spedizione_id]
-                    )
-                conn.commit()
-                
-                if cur.rowcount > 0:
-                    LOG.info(f"✅ Tracking BRT {spedizione_id} aggiornato: {description}")
-                    return {"success": True, "last_position": description, "vettore": "BRT", "awb": awb}
-                else:
-                    return {"success": False, "error": "Errore aggiornamento database"}
-                    
-        except Exception as e:
-            LOG.exception("Errore tracking BRT spedizione %s", spedizione_id)
-            return {"success": False, "error": str(e)}
+        return self._update_tracking_carrier(spedizione_id, "BRT")
 
     def _extract_brt_status(self, brt_result: Dict[str, Any]) -> str:
         """Estrae il messaggio di status da risultato BRT"""
@@ -625,73 +565,8 @@ class TrackingService:
 
     def update_tracking_tnt(self, spedizione_id: int) -> Dict[str, Any]:
         """Aggiorna tracking specifico per TNT - dati grezzi"""
-        try:
-            spedizione_data = self._get_spedizione_data(spedizione_id)
-            if not spedizione_data:
-                return {"success": False, "error": "Spedizione non trovata"}
-            
-            awb = spedizione_data.get('awb', '')
-            if not awb:
-                return {"success": False, "error": "AWB mancante"}
-            
-            # Tracking TNT
-            result = self.tnt_client.track_shipment(awb)
-            if result.get('status') != 'success':
-                error_msg = result.get('message', 'Errore TNT')
-                return {"success": False, "error": error_msg, "vettore": "TNT", "awb": awb}
-            
-            # Estrai status corrente
-            description = result.get('current_status', '')
-            
-            # Se non c'è current_status, prova con il primo evento
-            if not description:
-                events = result.get('events', [])
-                if events:
-                    latest_event = events[0]
-                    description = latest_event.get('description', '')
-            
-            if not description:
-                return {"success": False, "error": "Nessuno status ricevuto"}
-            
-            # Aggiorna database - SOLO DATI GREZZI
-            with db_cursor() as (conn, cur):
-                last_update = result.get('last_update', '')
-                if last_update:
-                    from datetime import datetime
-                    try:
-                        dt_obj = datetime.fromisoformat(last_update)
-                        cur.execute(
-                            """UPDATE spedizioni 
-                            SET last_position = %s, last_position_update = %s 
-                            WHERE id = %s""",
-                            [description, dt_obj, spedizione_id]
-                        )
-                    except:
-                        cur.execute(
-                            """UPDATE spedizioni 
-                            SET last_position = %s 
-                            WHERE id = %s""",
-                            [description, spedizione_id]
-                        )
-                else:
-                    cur.execute(
-                        """UPDATE spedizioni 
-                        SET last_position = %s 
-                        WHERE id = %s""",
-                        [description, spedizione_id]
-                    )
-                conn.commit()
-                
-                if cur.rowcount > 0:
-                    LOG.info(f"✅ Tracking TNT {spedizione_id} aggiornato: {description}")
-                    return {"success": True, "last_position": description, "vettore": "TNT", "awb": awb}
-                else:
-                    return {"success": False, "error": "Errore aggiornamento database"}
-                    
-        except Exception as e:
-            LOG.exception("Errore tracking TNT spedizione %s", spedizione_id)
-            return {"success": False, "error": str(e)}
-    
+        return self._update_tracking_carrier(spedizione_id, "TNT")
+
     def _extract_tnt_status(self, tnt_result: Dict[str, Any]) -> str:
         """Estrae il codice/status TNT"""
         try:
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Tracking Writer - Scrittura a blocchi dei risultati di tracking
+
+Raccoglie le tuple (id, last_position, last_position_update, final_position)
+prodotte da un ciclo di tracking e le salva su `spedizioni` con un'unica
+UPDATE multi-riga (CASE id WHEN ...) e un solo commit ogni N righe.
+Prima di scrivere confronta i valori con quelli già presenti sul DB e
+aggiorna solo le righe effettivamente cambiate. Gli eventi accodati con
+add_events vengono salvati in tracking_events nella stessa transazione.
+
+Uso:
+    writer = TrackingWriteBuffer(batch_size=100)
+    writer.add(spedizione_id, "Delivered", dt_obj)
+    ...
+    writer.flush()
+"""
+
+import os
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+import count_cache
+import tracking_events
+from db_connector import cursor as db_cursor
+
+LOG = logging.getLogger(__name__)
+
+# Righe per transazione (sovrascrivibile con TRACKING_WRITE_BATCH)
+DEFAULT_BATCH_SIZE = 100
+
+# Colonne aggiornabili nell'ordine della tupla (dopo l'id)
+COLUMNS = ("last_position", "last_position_update", "final_position")
+
+
+def _batch_size_from_env() -> int:
+    value = os.getenv("TRACKING_WRITE_BATCH")
+    if value is None:
+        return DEFAULT_BATCH_SIZE
+    try:
+        return max(1, int(value))
+    except ValueError:
+        LOG.warning("Valore TRACKING_WRITE_BATCH non valido: %s", value)
+        return DEFAULT_BATCH_SIZE
+
+
+class TrackingWriteBuffer:
+    """Buffer thread-safe di aggiornamenti last_position/final_position"""
+
+    def __init__(self, batch_size: Optional[int] = None):
+        """
+        Args:
+            batch_size: Righe per transazione (se None usa TRACKING_WRITE_BATCH)
+        """
+        self.batch_size = max(1, int(batch_size)) if batch_size else _batch_size_from_env()
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        # Serializza i flush: evita due transazioni concorrenti sulle stesse righe
+        self._flush_lock = threading.Lock()
+        # Spedizioni il cui blocco non è stato salvato (errore nella transazione)
+        self._failed: set = set()
+
+        # Statistiche
+        self.stats = {
+            "queued": 0,
+            "written": 0,
+            "unchanged": 0,
+            "missing": 0,
+            "transactions": 0,
+            "events": 0,
+            "errors": 0,
+        }
+
+    def add(self, spedizione_id: int, last_position: Optional[str] = None,
+            last_position_update=None, final_position: Optional[int] = None) -> None:
+        """
+        Accoda un aggiornamento. I valori None lasciano invariata la colonna.
+        Se la stessa spedizione è già in coda vince l'ultimo valore.
+        """
+        values = dict(zip(COLUMNS, (last_position, last_position_update, final_position)))
+        values = {column: value for column, value in values.items() if value is not None}
+        if not values:
+            return
+
+        with self._lock:
+            self._pending.setdefault(spedizione_id, {}).update(values)
+            self.stats["queued"] += 1
+            full = len(self._pending) >= self.batch_size
+
+        if full:
+            self.flush()
+
+    def add_events(self, spedizione_id: int, vettore: str, events: List[Dict[str, Any]]) -> None:
+        """Accoda gli eventi grezzi del vettore per tracking_events (sostituisce quelli già in coda)"""
+        with self._lock:
+            self._pending.setdefault(spedizione_id, {})["_events"] = (vettore, events)
+            full = len(self._pending) >= self.batch_size
+
+        if full:
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Scrive tutte le righe in coda, una transazione ogni batch_size righe
+
+        Returns:
+            Numero di righe effettivamente aggiornate
+        """
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        break
+                    ids = list(self._pending)[:self.batch_size]
+                    batch = {spedizione_id: self._pending.pop(spedizione_id) for spedizione_id in ids}
+                try:
+                    written += self._write_batch(batch)
+                except Exception:
+                    LOG.exception("Errore scrittura blocco tracking (%d righe)", len(batch))
+                    with self._lock:
+                        self.stats["errors"] += 1
+                        self._failed.update(batch)
+                else:
+                    with self._lock:
+                        self._failed.difference_update(batch)
+        return written
+
+    def failed_ids(self) -> set:
+        """Spedizioni accodate ma non salvate per un errore di scrittura (dopo flush)"""
+        with self._lock:
+            return set(self._failed)
+
+    def _write_batch(self, batch: Dict[int, Dict[str, Any]]) -> int:
+        """Confronta il blocco con il DB e aggiorna solo le righe cambiate in una transazione"""
+        events = [(spedizione_id, *values.pop("_events")) for spedizione_id, values in batch.items()
+                  if "_events" in values]
+        ids = [spedizione_id for spedizione_id, values in batch.items() if values]
+        current: Dict[int, Dict[str, Any]] = {}
+        changed: Dict[int, Dict[str, Any]] = {}
+        stored_events = 0
+
+        with db_cursor() as (conn, cur):
+            if events:
+                try:
+                    # La DDL fa un commit implicito: va eseguita prima della UPDATE
+                    tracking_events.ensure_tables(cur)
+                except Exception:
+                    LOG.exception("Tabelle tracking_events non disponibili")
+                    events = []
+
+            if ids:
+                cur.execute(
+                    f"SELECT id, {', '.join(COLUMNS)} FROM spedizioni WHERE id IN ({', '.join(['%s'] * len(ids))})",
+                    ids
+                )
+                current = {row[0]: dict(zip(COLUMNS, row[1:])) for row in cur.fetchall()}
+
+            for spedizione_id in ids:
+                existing = current.get(spedizione_id)
+                if existing is None:
+                    continue
+                diff = {column: value for column, value in batch[spedizione_id].items()
+                        if existing[column] != value}
+                if diff:
+                    changed[spedizione_id] = diff
+
+            if changed:
+                sql, params = self._build_update(changed)
+                cur.execute(sql, params)
+
+            if events:
+                try:
+                    stored_events = tracking_events.store_events_many(cur, events)
+                except Exception:
+                    # Gli eventi non devono impedire l'aggiornamento di last_position
+                    LOG.exception("Errore salvataggio eventi tracking (%d spedizioni)", len(events))
+
+            if changed or events:
+                conn.commit()
+
+        if changed:
+            count_cache.invalidate()
+
+        with self._lock:
+            self.stats["written"] += len(changed)
+            self.stats["missing"] += len(ids) - len(current)
+            self.stats["unchanged"] += len(current) - len(changed)
+            self.stats["events"] += stored_events
+            if changed or events:
+                self.stats["transactions"] += 1
+
+        LOG.debug("Tracking writer: %d/%d righe aggiornate, %d eventi", len(changed), len(ids), stored_events)
+        return len(changed)
+
+    @staticmethod
+    def _build_update(changed: Dict[int, Dict[str, Any]]) -> tuple:
+        """
+        Costruisce una UPDATE multi-riga:
+            SET col = CASE id WHEN %s THEN %s ... ELSE col END
+        Solo le colonne presenti in almeno una riga compaiono nella SET.
+        """
+        assignments: List[str] = []
+        params: List[Any] = []
+        for column in COLUMNS:
+            rows = [(spedizione_id, values[column]) for spedizione_id, values in changed.items()
+                    if column in values]
+            if not rows:
+                continue
+            whens = " ".join(["WHEN %s THEN %s"] * len(rows))
+            assignments.append(f"{column} = CASE id {whens} ELSE {column} END")
+            for spedizione_id, value in rows:
+                params.extend([spedizione_id, value])
+
+        ids = list(changed)
+        params.extend(ids)
+        sql = (f"UPDATE spedizioni SET {', '.join(assignments)} "
+               f"WHERE id IN ({', '.join(['%s'] * len(ids))})")
+        return sql, params
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Contatori di righe accodate, scritte e invariate"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["pending"] = len(self._pending)
+        stats["batch_size"] = self.batch_size
+        return stats
@@ -5,12 +5,70 @@ UPS Quote Client
 Client per preventivi spedizioni UPS utilizzando XML API.
 """
 
+import base64
 import requests
 import xml.etree.ElementTree as ET
 import json
 from datetime import datetime
 from typing import Dict, List, Optional
 from config import UPSConfig
+from dim_weight import normalize_packages, round_up, summarize
+from http_transport import HttpRequest
+from quote_policy import Stage, get_policy
+import token_manager
+from token_manager import TokenError
+
+
+def _ups_measure(value: float) -> str:
+    # UPS accetta al massimo un decimale: arrotonda per eccesso
+    return f"{round_up(value, 0.1):g}"
+
+
+def _valid_rate_xml(xml_response) -> bool:
+    """Risposta Rating valida per la policy: XML non vuoto e senza Error"""
+    return bool(xml_response) and '<Error>' not in xml_response
+
+
+def _is_european_route(xml_data: str) -> bool:
+    return any(f"CountryCode>{country}<" in xml_data for country in ('IT', 'DE', 'FR', 'ES'))
+
+
+def rest_packages(packages: List[Dict]) -> List[Dict]:
+    """
+    Elementi Package della Rating API REST, uno per collo
+
+    Args:
+        packages: Colli normalizzati (dim_weight.normalize_packages); le buste
+                  sono inviate come UPS Letter senza dimensioni
+    """
+    elements = []
+    for package in packages:
+        is_envelope = package['is_envelope']
+        element = {
+            "PackagingType": {
+                "Code": "01" if is_envelope else "02",
+                "Description": "Letter" if is_envelope else "Customer Supplied Package"
+            }
+        }
+        if not is_envelope:
+            element["Dimensions"] = {
+                "UnitOfMeasurement": {
+                    "Code": "CM",
+                    "Description": "Centimeters"
+                },
+                "Length": _ups_measure(package['length_cm']),
+                "Width": _ups_measure(package['width_cm']),
+                "Height": _ups_measure(package['height_cm'])
+            }
+        element["PackageWeight"] = {
+            "UnitOfMeasurement": {
+                "Code": "KGS",
+                "Description": "Kilograms"
+            },
+            "Weight": _ups_measure(package['weight_kg'])
+        }
+        elements.append(element)
+    return elements
 
 
 class UPSQuoteClient:
@@ -41,6 +99,11 @@ class UPSQuoteClient:
         self.config = config or UPSConfig.from_env()
         # Abilita debug per mostrare la chiamata XML
         self.config.debug = True
+        # Token OAuth condiviso tra istanze e worker, rinnovato in background
+        self._token_name = token_manager.register('UPS', self.config.client_id, self._fetch_token_flow)
+        # Catene di fallback con budget per fase e richieste hedged
+        self._policy = get_policy('UPS')
+        self._detailed_policy = get_policy('UPS_DETAILED')
         
     def get_detailed_quote(self, 
                            origin_country: str,
@@ -53,15 +116,24 @@ class UPSQuoteClient:
                            height_cm: float = 15) -> Dict:
         """
         Ottiene preventivo dettagliato con breakdown completo usando UPS Shipping API
-        Questa API fornisce IVA, fuel surcharge e tutti i dettagli fiscali
+        Questa API fornisce IVA, fuel surcharge e tutti i dettagli fiscali.
+        Se la Shipping API supera il suo p95 parte in parallelo la stima da Rating API.
         """
         try:
-            # Usa direttamente l'API shipping per breakdown completo
-            return self._get_shipping_breakdown(
-                origin_country, origin_postal,
-                destination_country, destination_postal,
-                weight_kg, length_cm, width_cm, height_cm
-            )
+            result, trace = self._detailed_policy.run([
+                Stage('SHIPPING', lambda: self._get_shipping_breakdown(
+                    origin_country, origin_postal,
+                    destination_country, destination_postal,
+                    weight_kg, length_cm, width_cm, height_cm,
+                    fallback=False
+                )),
+                Stage('RATE_ESTIMATE', lambda: self._fallback_to_rate_with_calculation(
+                    origin_country, origin_postal, destination_country, destination_postal, weight_kg
+                )),
+            ])
+            result['quote_source'] = trace['source']
+            result['quote_policy'] = trace
+            return result
         except Exception as e:
             return {
                 'error': f'UPS Detailed Quote Error: {str(e)}',
@@ -97,68 +169,55 @@ class UPSQuoteClient:
             Dictionary con preventivi per servizi disponibili
         """
         try:
-            # Gestione parametri multi-collo vs singolo
-            is_envelope = False
+            # Gestione parametri multi-collo vs singolo: ogni collo con peso e dimensioni propri
             if packages:
-                # Multi-collo: usa il primo pacco per ora (UPS API ha limitazioni)
-                first_package = packages[0]
-                is_envelope = first_package.get('is_envelope', False)
-                
-                if is_envelope:
-                    # Per buste: usa peso effettivo senza arrotondamenti
-                    total_weight = sum(p['weight_kg'] for p in packages)
-                else:
-                    # Per pacchi: calcolo normale 
-                    total_weight = sum(p['weight_kg'] for p in packages)
-                    
-                package_data = {
-                    'weight_kg': total_weight,
-                    'length_cm': first_package['length_cm'],
-                    'width_cm': first_package['width_cm'],
-                    'height_cm': first_package['height_cm']
-                }
-                num_packages = len(packages)
+                package_list = normalize_packages(packages)
             else:
                 # Singolo pacco (compatibilità)
                 if weight_kg is None:
                     raise ValueError("weight_kg or packages must be provided")
-                package_data = {
+                package_list = normalize_packages([{
                     'weight_kg': weight_kg,
                     'length_cm': length_cm,
                     'width_cm': width_cm,
                     'height_cm': height_cm
-                }
-                num_packages = 1            # Crea richiesta XML con supporto envelope
+                }])
+            weights = summarize(package_list, 'UPS')
+            is_envelope = weights['is_envelope']
+            num_packages = weights['num_packages']
+            first_package = package_list[0]
+
+            # Crea richiesta XML con un elemento Package per collo
             xml_request = self._create_quote_xml(
                 origin_country, origin_postal,
                 destination_country, destination_postal,
-                package_data['weight_kg'], 
-                package_data['length_cm'], 
-                package_data['width_cm'], 
-                package_data['height_cm'],
-                is_envelope=is_envelope
+                first_package['weight_kg'],
+                first_package['length_cm'],
+                first_package['width_cm'],
+                first_package['height_cm'],
+                is_envelope=is_envelope,
+                packages=package_list
             )
             
-            # Invia richiesta
-            xml_response = self._send_request(xml_request)
+            # Invia richiesta (REST/XML/simulazione secondo la policy)
+            xml_response, trace = self._policy.run(self._rate_stages(xml_request), is_valid=_valid_rate_xml)
             
             # Parse risposta
             result = self._parse_quote_response(xml_response)
+            result['quote_source'] = trace['source']
+            result['quote_policy'] = trace
             
             # Aggiungi info multi-collo al risultato
-            if result and 'quotes' in result:
-                result['packages_info'] = {
-                    'num_packages': num_packages,
-                    'total_weight_kg': package_data['weight_kg'],
-                    'is_multi_package': num_packages > 1,
-                    'is_envelope': is_envelope
-                }
+            if result and result.get('rates'):
+                result['packages_info'] = weights
                 
                 # Nota per multi-collo
                 if num_packages > 1:
-                    result['multi_package_note'] = f"Preventivo per {num_packages} colli (peso totale: {package_data['weight_kg']:.2f}kg)"
+                    result['multi_package_note'] = (f"Preventivo per {num_packages} colli (peso totale: "
+                                                    f"{weights['total_weight_kg']:.2f}kg, tassabile: "
+                                                    f"{weights['billing_weight_kg']:.2f}kg)")
                 elif is_envelope:
-                    result['envelope_note'] = f"Preventivo per busta/documenti (peso: {package_data['weight_kg']:.2f}kg)"
+                    result['envelope_note'] = f"Preventivo per busta/documenti (peso: {weights['total_weight_kg']:.2f}kg)"
             
             return result
             
@@ -179,8 +238,9 @@ class UPSQuoteClient:
                          width_cm: int,
                          height_cm: int,
                          service_code: Optional[str] = None,
-                         is_envelope: bool = False) -> str:
-        """Crea XML per richiesta preventivo UPS con supporto buste"""
+                         is_envelope: bool = False,
+                         packages: Optional[List[Dict]] = None) -> str:
+        """Crea XML per richiesta preventivo UPS con supporto buste (un Package per collo in `packages`)"""
         
         # Per paesi europei o buste, usa unità metriche
         use_metric = (origin_country in ['IT', 'DE', 'FR', 'ES', 'NL', 'BE', 'AT'] and 
@@ -188,27 +248,29 @@ class UPSQuoteClient:
         
         if use_metric:
             # Usa unità metriche per rotte europee o buste
-            weight_value = weight_kg
+            weight_factor = 1
             weight_unit = "KGS"
             weight_desc = "Kilograms"
             
-            length_value = length_cm
-            width_value = width_cm
-            height_value = height_cm
+            dim_factor = 1
             dim_unit = "CM"
             dim_desc = "Centimeters"
         else:
             # Usa unità imperiali per altre rotte (solo pacchi non-europei)
-            weight_value = round(weight_kg * 2.20462, 1)
+            weight_factor = 2.20462
             weight_unit = "LBS"
             weight_desc = "Pounds"
             
-            length_value = round(length_cm / 2.54, 1)
-            width_value = round(width_cm / 2.54, 1)
-            height_value = round(height_cm / 2.54, 1)
+            dim_factor = 1 / 2.54
             dim_unit = "IN"
             dim_desc = "Inches"
         
+        if packages is None:
+            packages = normalize_packages([{
+                'weight_kg': weight_kg, 'length_cm': length_cm, 'width_cm': width_cm,
+                'height_cm': height_cm, 'is_envelope': is_envelope
+            }])
+        
         # Request Option: "Shop" per tutti i servizi o "Rate" per servizio specifico
         request_option = "Rate" if service_code else "Shop"
         
@@ -239,15 +301,38 @@ class UPSQuoteClient:
             dest_city = "Default City"
             dest_state = ""
         
-        # Determina tipo di packaging
-        if is_envelope:
-            # Per buste: UPS Letter (codice 01)
-            packaging_code = "01"
-            packaging_desc = "UPS Letter"
-        else:
-            # Per pacchi: UPS Package (codice 02)
-            packaging_code = "02"
-            packaging_desc = "UPS Package"
+        packages_xml = ""
+        for package in packages:
+            # Tipo di packaging: UPS Letter (codice 01) per buste, UPS Package (codice 02) per pacchi
+            if package['is_envelope']:
+                packaging_code = "01"
+                packaging_desc = "UPS Letter"
+            else:
+                packaging_code = "02"
+                packaging_desc = "UPS Package"
+            packages_xml += f"""
+        <Package>
+            <PackagingType>
+                <Code>{packaging_code}</Code>
+                <Description>{packaging_desc}</Description>
+            </PackagingType>
+            <Dimensions>
+                <UnitOfMeasurement>
+                    <Code>{dim_unit}</Code>
+                    <Description>{dim_desc}</Description>
+                </UnitOfMeasurement>
+                <Length>{_ups_measure(package['length_cm'] * dim_factor)}</Length>
+                <Width>{_ups_measure(package['width_cm'] * dim_factor)}</Width>
+                <Height>{_ups_measure(package['height_cm'] * dim_factor)}</Height>
+            </Dimensions>
+            <PackageWeight>
+                <UnitOfMeasurement>
+                    <Code>{weight_unit}</Code>
+                    <Description>{weight_desc}</Description>
+                </UnitOfMeasurement>
+                <Weight>{_ups_measure(package['weight_kg'] * weight_factor)}</Weight>
+            </PackageWeight>
+        </Package>"""
         
         xml_template = f"""<?xml version="1.0"?>
 <AccessRequest xml:lang="en-US">
@@ -313,38 +398,7 @@ class UPSQuoteClient:
                     <CountryCode>{origin_country}</CountryCode>
                 </BillShipper>
             </Prepaid>
-        </PaymentInformation>{service_xml}
-        <Package>
-            <PackagingType>
-                <Code>{packaging_code}</Code>
-                <Description>{packaging_desc}</Description>
-            </PackagingType>
-            <Dimensions>
-                <UnitOfMeasurement>
-                    <Code>{dim_unit}</Code>
-                    <Description>{dim_desc}</Description>
-                </UnitOfMeasurement>
-                <Length>{length_value}</Length>
-                <Width>{width_value}</Width>
-                <Height>{height_value}</Height>
-            </Dimensions>
-            <Dimensions>
-                <UnitOfMeasurement>
-                    <Code>{dim_unit}</Code>
-                    <Description>{dim_desc}</Description>
-                </UnitOfMeasurement>
-                <Length>{length_value}</Length>
-                <Width>{width_value}</Width>
-                <Height>{height_value}</Height>
-            </Dimensions>
-            <PackageWeight>
-                <UnitOfMeasurement>
-                    <Code>{weight_unit}</Code>
-                    <Description>{weight_desc}</Description>
-                </UnitOfMeasurement>
-                <Weight>{weight_value}</Weight>
-            </PackageWeight>
-        </Package>
+        </PaymentInformation>{service_xml}{packages_xml}
         <RateInformation>
             <NegotiatedRatesIndicator/>
         </RateInformation>
@@ -353,20 +407,23 @@ class UPSQuoteClient:
         
         return xml_template
     
-    def _send_request(self, xml_data: str) -> str:
-        """Invia richiesta a UPS - prova OAuth REST API prima, poi XML fallback"""
-        
+    def _rate_stages(self, xml_data: str) -> List[Stage]:
+        """Fasi della Rating API: OAuth REST, XML in parallelo oltre il p95, simulazione per l'Europa"""
+        stages = []
         # Se abbiamo credenziali OAuth, usa REST API per tariffe contrattuali
         if self.config.client_id and self.config.client_secret:
-            try:
-                print("🔑 Usando OAuth REST API per tariffe contrattuali...")
-                return self._send_rest_request(xml_data)
-            except Exception as e:
-                print(f"⚠️ OAuth REST API fallita: {e}")
-                print("🔄 Fallback a XML API...")
-        
-        # Fallback a XML API
-        return self._send_xml_request(xml_data)
+            print("🔑 Usando OAuth REST API per tariffe contrattuali...")
+            stages.append(Stage('REST', lambda: self._send_rest_request(xml_data)))
+        stages.append(Stage('XML', lambda: self._send_xml_request(xml_data, simulate=False)))
+        if _is_european_route(xml_data):
+            # Ultima istanza: l'account test non supporta le rotte europee
+            stages.append(Stage('SIMULATION', lambda: self._generate_simulated_european_response(xml_data),
+                                hedge=False))
+        return stages
+    
+    def _send_request(self, xml_data: str) -> str:
+        """Invia richiesta a UPS - OAuth REST API, XML e simulazione secondo la policy"""
+        return self._policy.run(self._rate_stages(xml_data), is_valid=_valid_rate_xml)[0]
     
     def _send_rest_request(self, xml_data: str) -> str:
         """Invia richiesta REST con OAuth (PRODUZIONE per tariffe contrattuali)"""
@@ -386,8 +443,7 @@ class UPSQuoteClient:
         headers = {
             "Content-Type": "application/json",
             "transId": f"Rate_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
-            "transactionSrc": "production",  # PRODUZIONE
-            "Authorization": f"Bearer {self._get_oauth_token()}"
+            "transactionSrc": "production"  # PRODUZIONE (Authorization in _post_authorized)
         }
         
         try:
@@ -401,12 +457,13 @@ class UPSQuoteClient:
                 print("=" * 50)
             
             # Invia richiesta
-            response = requests.post(
+            response = self._post_authorized(
                 url,
+                headers,
                 json=json_data,
-                headers=headers,
                 params=query,
-                timeout=self.config.timeout
+                # Oltre il budget della fase la risposta non verrebbe più usata
+                timeout=min(self.config.timeout, self._policy.budget('REST'))
             )
             
             response.raise_for_status()
@@ -435,14 +492,11 @@ class UPSQuoteClient:
             print(f"❌ DEBUG REST API Error: {e}{error_details}")
             raise Exception(f"UPS REST API request failed: {str(e)}")
     
-    def _send_xml_request(self, xml_data: str) -> str:
-        """Invia richiesta XML con fallback simulato per rotte non supportate"""
+    def _send_xml_request(self, xml_data: str, simulate: bool = True) -> str:
+        """Invia richiesta XML con fallback simulato per rotte non supportate (se simulate)"""
         # Strategia intelligente: USA testing URL, Europa con simulazione
         # Parse del paese di origine dalla richiesta
-        is_european_route = ("CountryCode>IT<" in xml_data or 
-                           "CountryCode>DE<" in xml_data or 
-                           "CountryCode>FR<" in xml_data or
-                           "CountryCode>ES<" in xml_data)
+        is_european_route = _is_european_route(xml_data)
         
         if is_european_route:
             # Prima prova con URL di produzione
@@ -470,7 +524,7 @@ class UPSQuoteClient:
                 url,
                 data=xml_data,
                 headers=headers,
-                timeout=self.config.timeout
+                timeout=min(self.config.timeout, self._policy.budget('XML'))
             )
             
             response.raise_for_status()
@@ -484,13 +538,15 @@ class UPSQuoteClient:
             # Se la risposta contiene errore 111100 per rotte europee, usa simulazione
             if is_european_route and "111100" in response.text:
                 print("⚠️ Account test non supporta rotte europee")
+                if not simulate:
+                    raise Exception("UPS XML API: rotta europea non supportata (111100)")
                 print("🔄 Generando simulazione UPS basata su tariffe reali...")
                 return self._generate_simulated_european_response(xml_data)
             
             return response.text
             
         except requests.exceptions.RequestException as e:
-            if is_european_route:
+            if is_european_route and simulate:
                 print(f"⚠️ Errore connessione UPS per Europa: {e}")
                 print("🔄 Generando simulazione UPS basata su tariffe reali...")
                 return self._generate_simulated_european_response(xml_data)
@@ -580,23 +636,28 @@ class UPSQuoteClient:
         dest_country = re.search(r'<ShipTo>.*?<CountryCode>([A-Z]{2})</CountryCode>', xml_data, re.DOTALL)
         origin_postal = re.search(r'<Shipper>.*?<PostalCode>([^<]+)</PostalCode>', xml_data, re.DOTALL)
         dest_postal = re.search(r'<ShipTo>.*?<PostalCode>([^<]+)</PostalCode>', xml_data, re.DOTALL)
-        weight_match = re.search(r'<Weight>([0-9.]+)</Weight>', xml_data)
         
-        # Estrai il packaging type dall'XML
-        packaging_match = re.search(r'<PackagingType>.*?<Code>([^<]+)</Code>', xml_data, re.DOTALL)
-        packaging_code = packaging_match.group(1) if packaging_match else "02"
-        
-        # Determina la descrizione del packaging
-        if packaging_code == "01":
-            packaging_desc = "Letter"
-        else:
-            packaging_desc = "Package"
+        # Un collo per ogni elemento Package (unità imperiali riportate in KGS/CM)
+        packages = []
+        for block in re.findall(r'<Package>(.*?)</Package>', xml_data, re.DOTALL):
+            packaging = re.search(r'<PackagingType>\s*<Code>([^<]+)</Code>', block)
+            weight = re.search(r'<PackageWeight>.*?<Code>([^<]+)</Code>.*?<Weight>([0-9.]+)</Weight>', block, re.DOTALL)
+            dims = re.search(r'<Dimensions>.*?<Code>([^<]+)</Code>.*?<Length>([0-9.]+)</Length>\s*'
+                             r'<Width>([0-9.]+)</Width>\s*<Height>([0-9.]+)</Height>', block, re.DOTALL)
+            package = {'is_envelope': bool(packaging) and packaging.group(1) == "01", 'weight_kg': 1.0}
+            if weight:
+                package['weight_kg'] = float(weight.group(2)) / (2.20462 if weight.group(1) == "LBS" else 1)
+            if dims:
+                factor = 2.54 if dims.group(1) == "IN" else 1
+                package.update(length_cm=float(dims.group(2)) * factor, width_cm=float(dims.group(3)) * factor,
+                               height_cm=float(dims.group(4)) * factor)
+            packages.append(package)
+        packages = normalize_packages(packages or [{'weight_kg': 1.0}])
         
         origin_country_code = origin_country.group(1) if origin_country else "IT"
         dest_country_code = dest_country.group(1) if dest_country else "IT"
         origin_postal_code = origin_postal.group(1) if origin_postal else "00100"
         dest_postal_code = dest_postal.group(1) if dest_postal else "20100"
-        weight_value = weight_match.group(1) if weight_match else "1.0"
         
         # Indirizzi corretti per paese
         if origin_country_code == "IT":
@@ -663,32 +724,7 @@ class UPSQuoteClient:
                             }
                         ]
                     },
-                    "Package": [
-                        {
-                            "PackagingType": {
-                                "Code": packaging_code,
-                                "Description": packaging_desc
-                            },
-                            **({
-                                "Dimensions": {
-                                    "UnitOfMeasurement": {
-                                        "Code": "CM",
-                                        "Description": "Centimeters"
-                                    },
-                                    "Length": "30",
-                                    "Width": "20", 
-                                    "Height": "15"
-                                }
-                            } if packaging_code != "01" else {}),
-                            "PackageWeight": {
-                                "UnitOfMeasurement": {
-                                    "Code": "KGS",
-                                    "Description": "Kilograms"
-                                },
-                                "Weight": weight_value
-                            }
-                        }
-                    ]
+                    "Package": rest_packages(packages)
                 }
             }
         }
@@ -696,63 +732,70 @@ class UPSQuoteClient:
         return json_payload
     
     def _get_oauth_token(self) -> str:
-        """Ottieni token OAuth UPS usando Client Credentials flow (PRODUZIONE)"""
+        """Token OAuth UPS condiviso tra istanze e worker (token_manager, rinnovo in background)"""
+        try:
+            return token_manager.get_token(self._token_name)
+        except TokenError as e:
+            print(f"❌ Errore OAuth: {e}")
+            raise Exception(f"OAuth authentication failed: {e}")
+    
+    def _post_authorized(self, url: str, headers: Dict, **kwargs) -> requests.Response:
+        """
+        POST alle API REST UPS con il Bearer token condiviso
+
+        Con un 401 (token revocato o scaduto prima del previsto) il token viene
+        scartato e la richiesta ripetuta una volta con uno nuovo.
+        """
+        for attempt in range(2):
+            authorized = dict(headers, Authorization=f"Bearer {self._get_oauth_token()}")
+            response = requests.post(url, headers=authorized, **kwargs)
+            if response.status_code != 401 or attempt:
+                return response
+            print("⚠️ UPS OAuth 401: token scartato, nuovo tentativo con un token nuovo")
+            token_manager.invalidate(self._token_name)
+        return response
+
+    def _fetch_token_flow(self):
+        """Flow che richiede un token OAuth UPS con Client Credentials (PRODUZIONE)"""
         # Endpoint OAuth UPS PRODUZIONE per tariffe contrattuali
         token_url = "https://onlinetools.ups.com/security/v1/oauth/token"
         
-        # Headers per richiesta token
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Accept": "application/json"
-        }
-        
         # Basic Auth con Client ID e Client Secret REALI
-        import base64
         client_credentials = f"{self.config.client_id}:{self.config.client_secret}"
         encoded_credentials = base64.b64encode(client_credentials.encode()).decode()
-        headers["Authorization"] = f"Basic {encoded_credentials}"
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Accept": "application/json",
+            "Authorization": f"Basic {encoded_credentials}"
+        }
         
         # Payload per Client Credentials flow
         data = {
             "grant_type": "client_credentials"
         }
         
-        try:
-            # Debug per vedere la richiesta OAuth
-            if self.config.debug:
-                print(f"🔐 DEBUG - RICHIESTA OAUTH TOKEN PRODUZIONE:")
-                print("=" * 50)
-                print(f"URL: {token_url}")
-                print(f"Client ID: {self.config.client_id[:10]}...") 
-                print(f"Headers: {headers}")
-                print(f"Data: {data}")
-                print("=" * 50)
-            
-            response = requests.post(
-                token_url,
-                headers=headers, 
-                data=data,
-                timeout=30
-            )
-            
-            response.raise_for_status()
-            token_data = response.json()
-            
-            if self.config.debug:
-                print(f"🔐 DEBUG - RISPOSTA OAUTH TOKEN:")
-                print("=" * 50)
-                print(f"Token ricevuto: {token_data.get('access_token', 'N/A')[:20]}...")
-                print(f"Token Type: {token_data.get('token_type', 'N/A')}")
-                print(f"Expires in: {token_data.get('expires_in', 'N/A')} secondi")
-                print("=" * 50)
-            
-            return token_data.get("access_token", "")
-            
-        except requests.exceptions.RequestException as e:
-            print(f"❌ Errore OAuth: {e}")
-            if hasattr(e, 'response') and e.response is not None:
-                print(f"❌ Response: {e.response.text}")
-            raise Exception(f"OAuth authentication failed: {e}")
+        # Debug per vedere la richiesta OAuth
+        if self.config.debug:
+            print(f"🔐 DEBUG - RICHIESTA OAUTH TOKEN PRODUZIONE:")
+            print("=" * 50)
+            print(f"URL: {token_url}")
+            print(f"Client ID: {self.config.client_id[:10]}...") 
+            print("=" * 50)
+        
+        response = yield HttpRequest('UPS', 'POST', token_url, headers=headers, data=data,
+                                     timeout=30, rate_limited=False)
+        if response.status_code != 200:
+            raise TokenError(f"UPS OAuth {response.status_code} - {response.text}")
+        token_data = response.json()
+        
+        if self.config.debug:
+            print(f"🔐 DEBUG - RISPOSTA OAUTH TOKEN:")
+            print("=" * 50)
+            print(f"Token Type: {token_data.get('token_type', 'N/A')}")
+            print(f"Expires in: {token_data.get('expires_in', 'N/A')} secondi")
+            print("=" * 50)
+        
+        return token_data.get("access_token", ""), float(token_data.get("expires_in") or 3600)
     
     def _json_to_xml_response(self, json_response: Dict) -> str:
         """Converte risposta JSON REST in XML per compatibilità con parser"""
@@ -795,10 +838,13 @@ class UPSQuoteClient:
     
     def _get_shipping_breakdown(self, origin_country: str, origin_postal: str,
                                destination_country: str, destination_postal: str,
-                               weight_kg: float, length_cm: float, width_cm: float, height_cm: float) -> Dict:
+                               weight_kg: float, length_cm: float, width_cm: float, height_cm: float,
+                               fallback: bool = True) -> Dict:
         """
         Chiama UPS Shipping API per ottenere breakdown completo con IVA, fuel surcharge, etc.
         Endpoint: /ship/v1/shipments (simulazione per quote dettagliate)
+        Con fallback=False gli errori sono restituiti come {'error': ...} invece di
+        passare alla stima (la policy la esegue come fase separata).
         """
         try:
             # Costruisci payload per shipping API (che include breakdown completo)
@@ -891,8 +937,7 @@ class UPSQuoteClient:
             headers = {
                 "Content-Type": "application/json",
                 "transId": f"Ship_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
-                "transactionSrc": "production",
-                "Authorization": f"Bearer {self._get_oauth_token()}"
+                "transactionSrc": "production"
             }
             
             if self.config.debug:
@@ -902,11 +947,11 @@ class UPSQuoteClient:
                 print(f"Payload: {json.dumps(shipping_payload, indent=2)}")
                 print("=" * 50)
             
-            response = requests.post(
+            response = self._post_authorized(
                 url,
+                headers,
                 json=shipping_payload,
-                headers=headers,
-                timeout=30
+                timeout=self._detailed_policy.budget('SHIPPING')
             )
             
             # Anche se fallisce, proviamo a estrarre info utili
@@ -929,6 +974,9 @@ class UPSQuoteClient:
                 except:
                     pass
                 
+                if not fallback:
+                    return {'error': f'UPS Shipping API error: {response.status_code}'}
+                
                 # Fallback al rate normale se shipping non funziona
                 print(f"⚠️ Shipping API fallback a Rate API normale...")
                 return self._fallback_to_rate_with_calculation(
@@ -948,6 +996,8 @@ class UPSQuoteClient:
         except Exception as e:
             if self.config.debug:
                 print(f"❌ Shipping API Error: {e}")
+            if not fallback:
+                return {'error': f'UPS Shipping API error: {e}'}
             
             # Fallback al calcolo manuale
             return self._fallback_to_rate_with_calculation(
@@ -7,12 +7,19 @@ Supporta buste, multi-collo e calcolo IVA al 22%.
 """
 
 import json
+import base64
 import requests
 import xml.etree.ElementTree as ET
 import re
 from typing import Dict, List, Optional
 from datetime import datetime
-from config import UPSConfig
+from config import UPSConfig, UPS_A65C50_SIMULATED_RATES, UPS_A65C50_SIMULATED_PER_KG, UPS_A65C50_ENVELOPE_DISCOUNT
+from dim_weight import normalize_packages, summarize
+from ups_quote import rest_packages
+from http_transport import HttpRequest
+from quote_policy import Stage, get_policy
+import token_manager
+from token_manager import TokenError
 
 
 class UPSQuoteClientN:
@@ -54,8 +61,10 @@ class UPSQuoteClientN:
         else:
             self.config = config
             
-        self.oauth_token = None
-        self.token_expires = None
+        # Token OAuth condiviso tra istanze e worker, rinnovato in background
+        self._token_name = token_manager.register('UPS', self.config.client_id, self._fetch_token_flow)
+        # REST -> XML -> simulazione con budget per fase e richieste hedged
+        self._policy = get_policy('UPS_A65C50')
         
     def get_quote(self, 
                   origin_country: str,
@@ -85,91 +94,65 @@ class UPSQuoteClientN:
             Dict con rates, currency e informazioni spedizione
         """
         try:
-            # Gestione parametri multi-collo vs singolo
-            is_envelope = False
+            # Gestione parametri multi-collo vs singolo: ogni collo con peso e dimensioni propri
             if packages:
-                # Multi-collo: usa il primo pacco per ora (UPS API ha limitazioni)
-                first_package = packages[0]
-                is_envelope = first_package.get('is_envelope', False)
-                
-                if is_envelope:
-                    # Per buste: usa peso effettivo senza arrotondamenti
-                    total_weight = sum(p['weight_kg'] for p in packages)
-                else:
-                    # Per pacchi: calcolo normale 
-                    total_weight = sum(p['weight_kg'] for p in packages)
-                    
-                package_data = {
-                    'weight_kg': total_weight,
-                    'length_cm': first_package['length_cm'],
-                    'width_cm': first_package['width_cm'],
-                    'height_cm': first_package['height_cm']
-                }
-                num_packages = len(packages)
+                package_list = normalize_packages(packages)
             else:
                 if weight_kg is None:
                     raise ValueError("weight_kg or packages must be provided")
-                package_data = {
+                package_list = normalize_packages([{
                     'weight_kg': weight_kg,
                     'length_cm': length_cm,
                     'width_cm': width_cm,
                     'height_cm': height_cm
-                }
-                num_packages = 1
-                is_envelope = False
+                }])
+            weights = summarize(package_list, 'UPS')
+            is_envelope = weights['is_envelope']
             
-            # Prova prima OAuth REST API
+            # Dati aggregati per XML e simulazione: peso tassabile totale
+            first_package = package_list[0]
+            package_data = {
+                'weight_kg': weights['chargeable_weight_kg'],
+                'length_cm': first_package['length_cm'],
+                'width_cm': first_package['width_cm'],
+                'height_cm': first_package['height_cm']
+            }
+            
+            # REST, poi XML in parallelo se REST supera il suo p95; simulazione solo
+            # quando le API sono fallite o fuori budget. Vince la prima risposta valida.
             print("🔑 Usando OAuth REST API per tariffe contrattuali...")
-            oauth_result = self._get_quote_oauth_rest(
-                origin_country, origin_postal,
-                destination_country, destination_postal,
-                package_data, is_envelope
-            )
+            result, trace = self._policy.run([
+                Stage('REST', lambda: self._get_quote_oauth_rest(
+                    origin_country, origin_postal,
+                    destination_country, destination_postal,
+                    package_list, is_envelope
+                )),
+                Stage('XML', lambda: self._get_quote_xml(
+                    origin_country, origin_postal,
+                    destination_country, destination_postal,
+                    package_data, is_envelope
+                )),
+                Stage('SIMULATION', lambda: self._generate_simulation(
+                    origin_country, origin_postal,
+                    destination_country, destination_postal,
+                    package_data, is_envelope, packages
+                ), hedge=False),
+            ])
             
-            if oauth_result and 'rates' in oauth_result:
-                # Aggiungi informazioni multi-collo se disponibili
-                if packages:
-                    oauth_result['packages_info'] = {
-                        'is_multi_package': len(packages) > 1,
-                        'num_packages': len(packages),
-                        'total_weight_kg': package_data['weight_kg'],
-                        'is_envelope': is_envelope
-                    }
-                    
+            # Aggiungi informazioni multi-collo se disponibili (tariffe reali)
+            if packages and trace['source'] in ('REST', 'XML'):
+                result['packages_info'] = weights
+                
+                if trace['source'] == 'REST':
                     if is_envelope:
-                        oauth_result['envelope_note'] = f"Spedizione busta/documenti - Account A65c50"
+                        result['envelope_note'] = f"Spedizione busta/documenti - Account A65c50"
                     elif len(packages) > 1:
-                        oauth_result['multi_package_note'] = f"Spedizione {len(packages)} colli - Account A65c50"
-                
-                return oauth_result
-            
-            # Fallback: prova XML API
-            print("⚠️ OAuth REST API fallita, fallback a XML API...")
-            xml_result = self._get_quote_xml(
-                origin_country, origin_postal,
-                destination_country, destination_postal,
-                package_data, is_envelope
-            )
+                        result['multi_package_note'] = f"Spedizione {len(packages)} colli - Account A65c50"
             
-            if xml_result and 'rates' in xml_result:
-                # Aggiungi informazioni multi-collo per XML
-                if packages:
-                    xml_result['packages_info'] = {
-                        'is_multi_package': len(packages) > 1,
-                        'num_packages': len(packages),
-                        'total_weight_kg': package_data['weight_kg'],
-                        'is_envelope': is_envelope
-                    }
-                
-                return xml_result
-            
-            # Se tutto fallisce, genera simulazione
-            print("🔄 Generando simulazione UPS basata su tariffe reali...")
-            return self._generate_simulation(
-                origin_country, origin_postal,
-                destination_country, destination_postal,
-                package_data, is_envelope, packages
-            )
+            # Fonte della risposta ed esito di ogni fase
+            result['quote_source'] = trace['source']
+            result['quote_policy'] = trace
+            return result
             
         except Exception as e:
             return {
@@ -179,68 +162,78 @@ class UPSQuoteClientN:
             }
 
     def _get_oauth_token(self) -> Optional[str]:
-        """Ottieni token OAuth per API REST UPS con account A65c50"""
+        """Token OAuth per API REST UPS con account A65c50 (condiviso, rinnovo in background)"""
         try:
-            import base64
-            
-            # Endpoint OAuth UPS produzione
-            oauth_url = "https://onlinetools.ups.com/security/v1/oauth/token"
-            
-            # Credenziali base64 per account A65c50
-            credentials = f"{self.config.client_id}:{self.config.client_secret}"
-            credentials_b64 = base64.b64encode(credentials.encode()).decode()
-            
-            headers = {
-                'Content-Type': 'application/x-www-form-urlencoded',
-                'Accept': 'application/json',
-                'Authorization': f'Basic {credentials_b64}'
-            }
-            
-            data = {
-                'grant_type': 'client_credentials'
-            }
-            
-            print("🔐 DEBUG - RICHIESTA OAUTH TOKEN A65c50:")
-            print("=" * 50)
-            print(f"URL: {oauth_url}")
-            print(f"Client ID: {self.config.client_id[:10]}...")
-            print(f"Headers: {headers}")
-            print(f"Data: {data}")
-            print("=" * 50)
-            
-            response = requests.post(oauth_url, headers=headers, data=data, timeout=30)
-            
-            if response.status_code == 200:
-                token_data = response.json()
-                self.oauth_token = token_data.get('access_token')
-                expires_in = token_data.get('expires_in', 3600)
-                
-                print("🔐 DEBUG - RISPOSTA OAUTH TOKEN:")
-                print("=" * 50)
-                print(f"Token ricevuto: {self.oauth_token[:20]}...")
-                print(f"Token Type: {token_data.get('token_type', 'Bearer')}")
-                print(f"Expires in: {expires_in} secondi")
-                print("=" * 50)
-                
-                return self.oauth_token
-            else:
-                print(f"❌ OAuth Error: {response.status_code} - {response.text}")
-                return None
-                
-        except Exception as e:
-            print(f"❌ OAuth Exception: {str(e)}")
+            return token_manager.get_token(self._token_name)
+        except TokenError as e:
+            print(f"❌ OAuth Error: {str(e)}")
             return None
 
+    def _post_authorized(self, url: str, headers: Dict, **kwargs) -> Optional[requests.Response]:
+        """
+        POST alle API REST UPS con il Bearer token A65c50
+
+        Con un 401 il token viene scartato e la richiesta ripetuta una volta
+        con uno nuovo. None se il token non è disponibile.
+        """
+        response = None
+        for attempt in range(2):
+            token = self._get_oauth_token()
+            if not token:
+                return response
+            response = requests.post(url, headers=dict(headers, Authorization=f'Bearer {token}'), **kwargs)
+            if response.status_code != 401 or attempt:
+                return response
+            print("⚠️ UPS A65c50 OAuth 401: token scartato, nuovo tentativo con un token nuovo")
+            token_manager.invalidate(self._token_name)
+        return response
+
+    def _fetch_token_flow(self):
+        """Flow che richiede un token OAuth UPS per l'account A65c50 (usato da token_manager)"""
+        # Endpoint OAuth UPS produzione
+        oauth_url = "https://onlinetools.ups.com/security/v1/oauth/token"
+        
+        # Credenziali base64 per account A65c50
+        credentials = f"{self.config.client_id}:{self.config.client_secret}"
+        credentials_b64 = base64.b64encode(credentials.encode()).decode()
+        
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Accept': 'application/json',
+            'Authorization': f'Basic {credentials_b64}'
+        }
+        
+        data = {
+            'grant_type': 'client_credentials'
+        }
+        
+        print("🔐 DEBUG - RICHIESTA OAUTH TOKEN A65c50:")
+        print("=" * 50)
+        print(f"URL: {oauth_url}")
+        print(f"Client ID: {self.config.client_id[:10]}...")
+        print("=" * 50)
+        
+        response = yield HttpRequest('UPS', 'POST', oauth_url, headers=headers, data=data,
+                                     timeout=30, rate_limited=False)
+        if response.status_code != 200:
+            raise TokenError(f"{response.status_code} - {response.text}")
+        
+        token_data = response.json()
+        expires_in = token_data.get('expires_in', 3600)
+        
+        print("🔐 DEBUG - RISPOSTA OAUTH TOKEN:")
+        print("=" * 50)
+        print(f"Token Type: {token_data.get('token_type', 'Bearer')}")
+        print(f"Expires in: {expires_in} secondi")
+        print("=" * 50)
+        
+        return token_data.get('access_token'), float(expires_in or 3600)
+
     def _get_quote_oauth_rest(self, origin_country: str, origin_postal: str,
                              destination_country: str, destination_postal: str,
-                             package_data: Dict, is_envelope: bool) -> Optional[Dict]:
-        """Ottieni preventivo via OAuth REST API con account A65c50"""
+                             packages: List[Dict], is_envelope: bool) -> Optional[Dict]:
+        """Ottieni preventivo via OAuth REST API con account A65c50 (un elemento Package per collo)"""
         try:
-            # Ottieni token OAuth
-            token = self._get_oauth_token()
-            if not token:
-                return None
-            
             # Determina packaging type
             if is_envelope:
                 packaging_code = "01"  # Letter
@@ -250,12 +243,11 @@ class UPSQuoteClientN:
             # Endpoint UPS Rate API
             rate_url = "https://onlinetools.ups.com/api/rating/v1/Shop"
             
-            # Headers con token OAuth
+            # Headers (il token OAuth è aggiunto da _post_authorized)
             headers = {
                 'Content-Type': 'application/json',
                 'transId': f"Rate_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
-                'transactionSrc': 'production',
-                'Authorization': f'Bearer {token}'
+                'transactionSrc': 'production'
             }
             
             # Payload per REST API
@@ -315,32 +307,7 @@ class UPSQuoteClientN:
                                 }
                             ]
                         },
-                        "Package": [
-                            {
-                                "PackagingType": {
-                                    "Code": packaging_code,
-                                    "Description": "Letter" if packaging_code == "01" else "Customer Supplied Package"
-                                },
-                                "PackageWeight": {
-                                    "UnitOfMeasurement": {
-                                        "Code": "KGS",
-                                        "Description": "Kilograms"
-                                    },
-                                    "Weight": str(package_data['weight_kg'])
-                                },
-                                **({
-                                    "Dimensions": {
-                                        "UnitOfMeasurement": {
-                                            "Code": "CM",
-                                            "Description": "Centimeters"
-                                        },
-                                        "Length": str(package_data['length_cm']),
-                                        "Width": str(package_data['width_cm']),
-                                        "Height": str(package_data['height_cm'])
-                                    }
-                                } if packaging_code != "01" else {})
-                            }
-                        ]
+                        "Package": rest_packages(packages)
                     }
                 }
             }
@@ -352,7 +319,11 @@ class UPSQuoteClientN:
             print(f"Payload: {json.dumps(payload, indent=2)}")
             print("=" * 50)
             
-            response = requests.post(rate_url, headers=headers, json=payload, timeout=60)
+            # Oltre il budget della fase la risposta non verrebbe più usata
+            response = self._post_authorized(rate_url, headers, json=payload,
+                                             timeout=self._policy.budget('REST'))
+            if response is None:
+                return None
             
             if response.status_code == 200:
                 result = response.json()
@@ -484,23 +455,18 @@ class UPSQuoteClientN:
         print(f"🔄 Generando simulazione UPS per account A65c50...")
         
         # Base rates simulate per diversi servizi con tempi di consegna realistici
-        base_rates = {
-            '11': {'name': 'UPS Standard', 'base': 18.50, 'days': '2-3'},
-            '65': {'name': 'UPS Saver', 'base': 23.80, 'days': '1-2'}, 
-            '08': {'name': 'UPS Worldwide Expedited', 'base': 27.20, 'days': '3-5'},
-            '07': {'name': 'UPS Worldwide Express', 'base': 34.80, 'days': '1-3'}
-        }
+        base_rates = UPS_A65C50_SIMULATED_RATES
         
         rates = []
         weight = package_data['weight_kg']
         
         for service_code, info in base_rates.items():
             # Calcolo base con peso
-            total_cost = info['base'] + (weight * 2.5)
+            total_cost = info['base'] + (weight * UPS_A65C50_SIMULATED_PER_KG)
             
             # Aggiustamenti per buste (sconto)
             if is_envelope and weight <= 1.0:
-                total_cost *= 0.85  # 15% sconto per buste leggere
+                total_cost *= UPS_A65C50_ENVELOPE_DISCOUNT  # 15% sconto per buste leggere
             
             # NESSUN calcolo IVA automatico - solo il totale da UPS
             rate_info = {
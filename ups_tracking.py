@@ -10,8 +10,11 @@ import requests
 import xml.etree.ElementTree as ET
 from datetime import datetime
 from typing import Dict, List, Optional
-import time
 from config import UPSConfig
+import http_transport
+from http_transport import HttpRequest, Sleep
+from rate_limiter import get_limiter
+from tracking_cache import cached_tracking, cached_tracking_async
 
 
 class UPSTrackingClient:
@@ -27,9 +30,9 @@ class UPSTrackingClient:
         self.config = config or UPSConfig.from_env()
         self.config.debug = True  # MODIFICATO: Attiva debug
         
-        # Rate limiting ottimizzato per produzione
-        self.min_delay_between_requests = 5.0  # 5 secondi tra richieste
-        self.last_request_time = 0
+        # Rate limiting: token bucket condiviso tra client, thread e processi
+        # (velocità e burst configurabili con RATE_LIMIT_UPS_RATE / RATE_LIMIT_UPS_BURST)
+        self.rate_limiter = get_limiter('UPS')
         
         # Retry logic per gestire errori 429
         self.max_retries = 5
@@ -39,6 +42,7 @@ class UPSTrackingClient:
         self.request_count = 0
         self.error_count = 0
         
+    @cached_tracking('UPS')
     def track_shipment(self, tracking_number: str, verbose: bool = True) -> Dict:
         """
         Traccia una spedizione UPS
@@ -50,6 +54,15 @@ class UPSTrackingClient:
         Returns:
             Dict con informazioni di tracking o errore
         """
+        return http_transport.run(self._track_flow(tracking_number, verbose))
+    
+    @cached_tracking_async('UPS')
+    async def track_shipment_async(self, tracking_number: str, verbose: bool = True) -> Dict:
+        """Variante asyncio di track_shipment()"""
+        return await http_transport.run_async(self._track_flow(tracking_number, verbose))
+    
+    def _track_flow(self, tracking_number: str, verbose: bool = True):
+        """Flow di track_shipment (vedi http_transport)"""
         try:
             if verbose:
                 print(f"Tracciamento in corso: {tracking_number}...")
@@ -58,7 +71,7 @@ class UPSTrackingClient:
             xml_request = self._create_tracking_xml(tracking_number)
             
             # Invia richiesta con retry
-            xml_response = self._send_request_with_retry(xml_request, verbose)
+            xml_response = yield from self._send_request_with_retry(xml_request, verbose)
             
             # Parse risposta
             result = self._parse_tracking_response(xml_response, tracking_number)
@@ -99,21 +112,16 @@ class UPSTrackingClient:
         if verbose:
             print(f"\n{'='*60}")
             print(f"Tracking di {total} spedizioni in corso...")
-            print(f"Delay tra richieste: {self.min_delay_between_requests}s")
+            print(f"Rate limit: {self.rate_limiter.rate} richieste/s (burst {self.rate_limiter.burst})")
             print(f"{'='*60}\n")
         
         for i, tracking_number in enumerate(tracking_numbers, 1):
             if verbose:
                 print(f"[{i}/{total}] ", end="")
             
+            # L'attesa tra richieste è gestita dal rate limiter
             result = self.track_shipment(tracking_number, verbose)
             results.append(result)
-            
-            # Attesa tra richieste (tranne l'ultima)
-            if i < total:
-                if verbose:
-                    print(f"    Attesa {self.min_delay_between_requests}s prima della prossima richiesta...\n")
-                time.sleep(self.min_delay_between_requests)
         
         if verbose:
             print(f"\n{'='*60}")
@@ -153,29 +161,9 @@ class UPSTrackingClient:
         
         return xml_template
     
-    def _wait_for_rate_limit(self, verbose: bool = False):
+    def _send_request_with_retry(self, xml_data: str, verbose: bool = False):
         """
-        Attende il tempo necessario per rispettare il rate limiting
-        
-        Args:
-            verbose: Se True, mostra messaggi di debug
-        """
-        current_time = time.time()
-        time_since_last_request = current_time - self.last_request_time
-        
-        if time_since_last_request < self.min_delay_between_requests:
-            wait_time = self.min_delay_between_requests - time_since_last_request
-            
-            if verbose:
-                print(f"    Rate limiting: attesa di {wait_time:.1f}s...")
-            
-            time.sleep(wait_time)
-        
-        self.last_request_time = time.time()
-    
-    def _send_request_with_retry(self, xml_data: str, verbose: bool = False) -> str:
-        """
-        Invia richiesta XML a UPS con retry logic per gestire errore 429
+        Flow: invia richiesta XML a UPS con retry logic per gestire errore 429
         
         Args:
             xml_data: XML della richiesta
@@ -191,12 +179,9 @@ class UPSTrackingClient:
         
         for attempt in range(self.max_retries):
             try:
-                # Rispetta rate limiting
-                if attempt == 0:
-                    self._wait_for_rate_limit(verbose)
-                
-                # Invia richiesta
-                response_text = self._send_request(xml_data)
+                # Invia richiesta (il trasporto rispetta il rate limit
+                # condiviso anche sui retry)
+                response_text = yield from self._send_request(xml_data)
                 
                 # Se arriva qui, la richiesta è andata a buon fine
                 return response_text
@@ -214,7 +199,7 @@ class UPSTrackingClient:
                             print(f"    ⚠ Rate limit raggiunto (tentativo {attempt + 1}/{self.max_retries})")
                             print(f"    Attesa di {wait_time}s prima di riprovare...")
                         
-                        time.sleep(wait_time)
+                        yield Sleep(wait_time)
                         continue
                     else:
                         raise Exception(
@@ -235,9 +220,9 @@ class UPSTrackingClient:
         else:
             raise Exception("Richiesta fallita dopo tutti i retry")
     
-    def _send_request(self, xml_data: str) -> str:
+    def _send_request(self, xml_data: str):
         """
-        Invia richiesta XML a UPS
+        Flow: invia richiesta XML a UPS
         
         Args:
             xml_data: XML della richiesta
@@ -266,11 +251,12 @@ class UPSTrackingClient:
                 print("=" * 50)
             
             # Invia richiesta
-            response = requests.post(
-                url,
+            response = yield HttpRequest(
+                'UPS', 'POST', url,
                 data=xml_data,
                 headers=headers,
-                timeout=self.config.timeout
+                timeout=self.config.timeout,
+                idempotent=True
             )
             
             # Solleva eccezione per status code 4xx/5xx
@@ -561,12 +547,6 @@ if __name__ == "__main__":
                         print(f"  ✓ {result['last_position']}\n")
                     else:
                         print(f"  ✗ {result.get('error')}\n")
-                    
-                    # Delay tra richieste (tranne l'ultima)
-                    if i < len(spedizioni):
-                        import time
-                        print(f"  Attesa 5s...\n")
-                        time.sleep(5)
                 
                 print("="*60)
                 print(f"Completato! Processate {len(spedizioni)} spedizioni UPS")